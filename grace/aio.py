@@ -0,0 +1,292 @@
+"""
+Relaying the bytes of a L{grace.pipe.Pipe}'s connections on an asyncio event
+loop.
+
+A pipe whose C{engine} is C{'asyncio'} accepts, connects, balances and
+drains in the reactor as usual.  Once both sides of a connection are
+established, it hands the two sockets to an L{AsyncioRelay}, whose event
+loop relays bytes between them with asyncio protocols and transports.  When
+either side is done the sockets are handed back to the reactor to be closed,
+just as with L{grace.splice}.
+
+The event loop runs in a helper thread of its own unless it's given one
+that something else runs, such as asyncio services sharing the process (see
+L{useLoop}).  On Python 2 asyncio is provided by C{trollius}.
+"""
+
+from twisted.python import log
+
+import functools
+import socket
+import threading
+
+try:
+    import asyncio
+except ImportError:
+    try:
+        import trollius as asyncio
+    except ImportError:
+        asyncio = None
+
+
+
+def asyncioAvailable():
+    """
+    @return: C{True} if asyncio (or C{trollius}) can be imported.
+    """
+    return asyncio is not None
+
+
+
+_relay = None
+
+def getRelay(reactor):
+    """
+    Get the L{AsyncioRelay} shared by every L{Pipe} in this process.
+    """
+    global _relay
+    if _relay is None:
+        _relay = AsyncioRelay(reactor)
+    return _relay
+
+
+
+def useLoop(reactor, loop):
+    """
+    Relay on C{loop}, an asyncio event loop run by something else in this
+    process, instead of in a thread of grace's own.  Call this before any
+    connections are relayed.
+
+    @return: The L{AsyncioRelay} every L{Pipe} will use.
+    """
+    global _relay
+    _relay = AsyncioRelay(reactor, loop)
+    return _relay
+
+
+
+def _ensureFuture(coro, loop):
+    ensure = getattr(asyncio, 'ensure_future', None)
+    if ensure is None:
+        ensure = getattr(asyncio, 'async')
+    return ensure(coro, loop=loop)
+
+
+
+def _dup(sock):
+    dup = socket.fromfd(sock.fileno(), sock.family, socket.SOCK_STREAM)
+    dup.setblocking(False)
+    return dup
+
+
+
+class _Side(object):
+    """
+    The asyncio protocol for one socket of a L{RelayedConnection}: whatever
+    it reads is written to the other socket.  I'm also one of the
+    connection's directions.
+
+    @ivar moved: Number of bytes read from my socket and passed on so far.
+    @ivar eof: C{True} once my socket has reached end of file.
+    @ivar lost: C{True} once my socket has been closed.
+    @ivar early: Bytes read before the other socket's transport was ready.
+    @ivar paused: C{True} if I've stopped reading because the other socket
+        isn't keeping up.
+    """
+
+    def __init__(self, conn, sock):
+        self.conn = conn
+        self.sock = sock
+        self.peer = None
+        self.transport = None
+        self.moved = 0
+        self.eof = False
+        self.lost = False
+        self.early = None
+        self.paused = False
+
+
+    def connection_made(self, transport):
+        self.transport = transport
+        if self.conn.aborted:
+            transport.abort()
+            return
+        if self.peer.early:
+            transport.writelines(self.peer.early)
+            self.peer.early = None
+        if self.conn.finishing:
+            transport.close()
+
+
+    def data_received(self, data):
+        self.moved += len(data)
+        peer = self.peer
+        if peer.transport is None:
+            if self.early is None:
+                self.early = []
+            self.early.append(data)
+        else:
+            peer.transport.write(data)
+
+
+    def eof_received(self):
+        self.eof = True
+        if self.conn.first is None:
+            self.conn.first = self
+        self.conn.finish()
+        # Closed by finish, once what's been read has been written.
+        return True
+
+
+    def pause_writing(self):
+        peer = self.peer
+        if not self.conn.finishing and not peer.paused:
+            peer.paused = True
+            peer.transport.pause_reading()
+
+
+    def resume_writing(self):
+        peer = self.peer
+        if not self.conn.finishing and peer.paused:
+            peer.paused = False
+            peer.transport.resume_reading()
+
+
+    def connection_lost(self, exc):
+        if exc is not None:
+            log.msg('asyncio relay error: %s' % (exc,))
+        self.lost = True
+        self.conn.finish()
+        self.conn.sideLost()
+
+
+
+class RelayedConnection(object):
+    """
+    A pair of sockets being relayed by an L{AsyncioRelay}.  I'm used like a
+    L{grace.splice.SplicedConnection}.
+
+    @ivar directions: The L{_Side}s reading from the first socket and from
+        the second.
+    @ivar first: The L{_Side} that reached end of file first, or C{None}.
+    @ivar done: Called in the reactor thread once the relay has let go of
+        both sockets.
+    @ivar finishing: C{True} once the sockets are being closed.
+    @ivar aborted: C{True} if they're being closed without flushing what's
+        waiting to be written.
+    """
+
+    def __init__(self, relay, sock1, sock2, done):
+        self.relay = relay
+        self.done = done
+        self.directions = (_Side(self, sock1), _Side(self, sock2))
+        a, b = self.directions
+        a.peer, b.peer = b, a
+        self.first = None
+        self.finishing = False
+        self.aborted = False
+        self._finished = False
+
+
+    def stop(self):
+        """
+        Stop relaying (from the reactor thread).  C{done} will still be
+        called once the event loop has let go of the sockets.
+        """
+        self.relay.loop.call_soon_threadsafe(self.abort)
+
+
+    def start(self):
+        """
+        Give both sockets to the event loop (in its thread).
+        """
+        loop = self.relay.loop
+        for side in self.directions:
+            future = _ensureFuture(
+                loop.create_connection(lambda side=side: side,
+                                       sock=side.sock),
+                loop)
+            future.add_done_callback(functools.partial(self._attached, side))
+
+
+    def _attached(self, side, future):
+        exc = future.exception()
+        if exc is not None:
+            log.msg('asyncio relay error: %s' % (exc,))
+            side.sock.close()
+            side.lost = True
+            self.abort()
+            self.sideLost()
+
+
+    def finish(self):
+        """
+        Close both sockets once what has been read from each has been
+        written to the other.
+        """
+        if self.finishing:
+            return
+        self.finishing = True
+        for side in self.directions:
+            if side.transport is not None:
+                side.transport.close()
+
+
+    def abort(self):
+        """
+        Close both sockets straight away.
+        """
+        self.finishing = self.aborted = True
+        for side in self.directions:
+            if side.transport is not None:
+                side.transport.abort()
+
+
+    def sideLost(self):
+        if self._finished or not all(d.lost for d in self.directions):
+            return
+        self._finished = True
+        self.relay.reactor.callFromThread(self.done)
+
+
+
+class AsyncioRelay(object):
+    """
+    I relay data between pairs of sockets on an asyncio event loop.
+
+    @ivar reactor: The reactor to report finished connections to.
+    @ivar loop: The event loop, once there is one.
+    """
+
+    def __init__(self, reactor, loop=None):
+        self.reactor = reactor
+        self.loop = loop
+        self._thread = None
+
+
+    def _startLoop(self):
+        self.loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self.loop.run_forever,
+                                        name='grace-asyncio')
+        self._thread.daemon = True
+        self._thread.start()
+
+
+    def add(self, sock1, sock2, done):
+        """
+        Start relaying between two connected, non-blocking sockets.  The
+        reactor must not read from or write to them until C{done} is called.
+        The event loop relays on duplicates of them, so that the reactor can
+        close the originals in the usual way afterwards.
+
+        @param done: Called with no arguments in the reactor thread once I've
+            finished with the sockets, either because one side closed or
+            because of L{RelayedConnection.stop}.
+
+        @rtype: L{RelayedConnection}
+        """
+        if self.loop is None:
+            self._startLoop()
+        conn = RelayedConnection(self, _dup(sock1), _dup(sock2), done)
+        self.loop.call_soon_threadsafe(conn.start)
+        return conn
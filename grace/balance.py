@@ -0,0 +1,160 @@
+"""
+Ways of choosing which of a L{grace.pipe.Pipe}'s active destinations a new
+connection goes to.
+
+A strategy has a C{pick} method which is given the L{Pipe}, the list of
+destinations to choose from (the pipe's C{dsts}, less any that are unhealthy)
+and the address of the connecting client, and returns one of the
+destinations.
+"""
+
+from bisect import bisect
+import hashlib
+
+
+
+class RoundRobin(object):
+    """
+    I send each new connection to the next destination in turn.
+    """
+
+    def __init__(self):
+        self._next = 0
+
+
+    def pick(self, pipe, dsts, addr):
+        i = self._next % len(dsts)
+        self._next = i + 1
+        return dsts[i]
+
+
+
+class LeastConnections(object):
+    """
+    I send each new connection to the destination with the fewest open
+    connections, taking turns between destinations that are tied.
+    """
+
+    def __init__(self):
+        self._next = 0
+
+
+    def pick(self, pipe, dsts, addr):
+        start = self._next % len(dsts)
+        self._next = start + 1
+        best = None
+        for dst in dsts[start:] + dsts[:start]:
+            conns = pipe._connections[dst]
+            if best is None or conns < best[0]:
+                best = (conns, dst)
+        return best[1]
+
+
+
+class WeightedRoundRobin(object):
+    """
+    I send each destination a share of the new connections in proportion to
+    its weight in the pipe's C{weights}, interleaving them as evenly as I
+    can.  A destination with no weight gets no connections.
+    """
+
+    def __init__(self):
+        self._current = {}
+
+
+    def pick(self, pipe, dsts, addr):
+        weights = pipe.weights
+        total = 0
+        best = None
+        for dst in dsts:
+            weight = weights.get(dst, 0)
+            total += weight
+            current = self._current.get(dst, 0) + weight
+            self._current[dst] = current
+            if best is None or current > self._current[best]:
+                best = dst
+        self._current[best] -= total
+        return best
+
+
+
+def _hash(s):
+    return int(hashlib.md5(s).hexdigest()[:8], 16)
+
+
+
+def clientKey(addr):
+    """
+    Get the part of a client's address that identifies it for hashing: the
+    host for IP addresses, or the whole address otherwise.
+    """
+    host = getattr(addr, 'host', None)
+    if host is not None:
+        return host
+    return str(addr)
+
+
+
+class ConsistentHash(object):
+    """
+    I send all connections from the same client host to the same destination,
+    and when destinations are added or removed I only move the clients I
+    have to.
+
+    @ivar replicas: Number of points each destination gets on the hash ring.
+    """
+
+    replicas = 100
+
+
+    def __init__(self):
+        self._ring = None
+        self._ringFor = None
+
+
+    def ring(self, dsts):
+        """
+        Get the hash ring for a list of destinations.
+
+        @return: A pair of sorted lists: the points on the ring and the
+            destination owning each one.
+        """
+        key = tuple(dsts)
+        if self._ringFor != key:
+            points = []
+            for dst in dsts:
+                for i in range(self.replicas):
+                    points.append((_hash('%s-%d' % (dst, i)), dst))
+            points.sort()
+            self._ring = ([p[0] for p in points], [p[1] for p in points])
+            self._ringFor = key
+        return self._ring
+
+
+    def pick(self, pipe, dsts, addr):
+        hashes, owners = self.ring(dsts)
+        i = bisect(hashes, _hash(clientKey(addr))) % len(hashes)
+        return owners[i]
+
+
+
+strategies = {
+    'round-robin': RoundRobin,
+    'least-conns': LeastConnections,
+    'hash': ConsistentHash,
+}
+
+
+def getStrategy(name):
+    """
+    Make a balancing strategy.
+
+    @param name: One of the keys of L{strategies}.
+
+    @raise ValueError: If there's no such strategy.
+    """
+    try:
+        return strategies[name]()
+    except KeyError:
+        raise ValueError('Unknown balancing strategy %r (choose from %s)' % (
+                         name, ', '.join(sorted(strategies))))
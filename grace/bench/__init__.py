@@ -0,0 +1,5 @@
+"""
+Benchmarks for grace.  Each module can be run on its own, for instance:
+
+    python -m grace.bench.endpoint_cache
+"""
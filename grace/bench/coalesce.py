@@ -0,0 +1,257 @@
+"""
+Count the system calls a L{Pipe} makes per megabyte of chatty traffic, with
+and without write coalescing.
+
+A thread sends many small messages, each with its own C{send}, through a
+pipe in this process to a sink in another thread.  The pipe's C{send}s (one
+each time the reactor writes out a transport's buffer), C{recv}s, C{epoll}
+calls and the calls for the C{timerfd}s that time its flushes (see
+L{grace.timers.ShortTimer}) are counted, first without C{coalesce_delay}
+and then with it.  The threads' own system calls aren't counted.
+
+Each mode is run C{--runs} times, alternately, and the median of each count
+is shown: how quickly the pipe reads decides how much each C{recv} gets, and
+that varies a lot from run to run when the messages aren't paced.
+
+    python -m grace.bench.coalesce [--messages=N] [--size=BYTES]
+        [--interval=SECONDS] [--coalesce-delay=SECONDS] [--runs=N]
+"""
+
+from twisted.internet import defer, endpoints, task, tcp, threads
+from twisted.python import usage
+
+import socket
+import sys
+import time
+
+from grace.pipe import Pipe
+from grace import timers
+
+
+
+class Counts(object):
+    """
+    I count the system calls the reactor makes for its TCP and UNIX
+    connections, for C{epoll} and for L{timers.ShortTimer}s, while I'm
+    installed.
+    """
+
+    def __init__(self):
+        self.reset()
+
+
+    def reset(self):
+        self.send = 0
+        self.recv = 0
+        self.epoll_ctl = 0
+        self.epoll_wait = 0
+        self.timerfd = 0
+
+
+    def install(self, reactor):
+        """
+        Start counting.
+
+        @return: A function that stops counting.
+        """
+        counts = self
+        writeSomeData = tcp.Connection.writeSomeData
+        doRead = tcp.Connection.doRead
+        timer = timers.ShortTimer
+        start, settime = timer.start, timer._settime
+        timerRead, close = timer.doRead, timer.close
+        def countedWrite(conn, data):
+            counts.send += 1
+            return writeSomeData(conn, data)
+        def countedRead(conn):
+            counts.recv += 1
+            return doRead(conn)
+        def countedStart(timer, delay):
+            created = timer._fd is None
+            start(timer, delay)
+            if created and timer._fd is not None:
+                counts.timerfd += 1
+        def countedSettime(timer, nsec):
+            counts.timerfd += 1
+            return settime(timer, nsec)
+        def countedTimerRead(timer):
+            counts.timerfd += 1
+            return timerRead(timer)
+        def countedClose(timer):
+            if timer._fd is not None:
+                counts.timerfd += 1
+            return close(timer)
+        tcp.Connection.writeSomeData = countedWrite
+        tcp.Connection.doRead = countedRead
+        timer.start, timer._settime = countedStart, countedSettime
+        timer.doRead, timer.close = countedTimerRead, countedClose
+        poller = getattr(reactor, '_poller', None)
+        if poller is not None:
+            reactor._poller = CountingPoller(poller, self)
+        def uninstall():
+            tcp.Connection.writeSomeData = writeSomeData
+            tcp.Connection.doRead = doRead
+            timer.start, timer._settime = start, settime
+            timer.doRead, timer.close = timerRead, close
+            if poller is not None:
+                reactor._poller = poller
+        return uninstall
+
+
+
+class CountingPoller(object):
+    """
+    I stand in for an epoll reactor's poller, counting calls into it.
+    """
+
+    def __init__(self, poller, counts):
+        self._poller = poller
+        self._counts = counts
+
+
+    def register(self, *args):
+        self._counts.epoll_ctl += 1
+        return self._poller.register(*args)
+
+
+    def modify(self, *args):
+        self._counts.epoll_ctl += 1
+        return self._poller.modify(*args)
+
+
+    def unregister(self, *args):
+        self._counts.epoll_ctl += 1
+        return self._poller.unregister(*args)
+
+
+    def poll(self, *args):
+        self._counts.epoll_wait += 1
+        return self._poller.poll(*args)
+
+
+    def __getattr__(self, name):
+        return getattr(self._poller, name)
+
+
+
+def sink(listener):
+    """
+    Accept one connection and read from it until it closes.
+
+    @return: The number of bytes read.
+    """
+    conn, addr = listener.accept()
+    received = 0
+    while True:
+        data = conn.recv(65536)
+        if not data:
+            break
+        received += len(data)
+    conn.close()
+    return received
+
+
+
+def send(port, messages, size, interval):
+    """
+    Connect to C{port} and send C{messages} messages of C{size} bytes,
+    C{interval} seconds apart.
+    """
+    conn = socket.create_connection(('127.0.0.1', port))
+    conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    message = 'x' * size
+    for i in xrange(messages):
+        conn.sendall(message)
+        if interval:
+            time.sleep(interval)
+    conn.close()
+
+
+
+@defer.inlineCallbacks
+def run(reactor, counts, options, **pipe_options):
+    """
+    Send the messages through a new L{Pipe}, counting system calls.
+
+    @return: A C{Deferred} firing with the number of bytes relayed.
+    """
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    pipe = Pipe('tcp:host=127.0.0.1:port=%d' % (listener.getsockname()[1],),
+                _reactor=reactor, **pipe_options)
+    port = yield endpoints.serverFromString(
+        reactor, 'tcp:0:interface=127.0.0.1').listen(pipe)
+    received = threads.deferToThread(sink, listener)
+    counts.reset()
+    yield threads.deferToThread(send, port.getHost().port,
+                                options['messages'], options['size'],
+                                options['interval'])
+    received = yield received
+    listener.close()
+    yield port.stopListening()
+    defer.returnValue(received)
+
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ['messages', 'n', 20000, "Number of messages to send", int],
+        ['size', 's', 100, "Bytes in each message", int],
+        ['interval', 'i', 0.0, "Seconds to wait between messages", float],
+        ['coalesce-delay', None, 0.001, "The pipe's coalesce_delay when "
+            "coalescing", float],
+        ['coalesce-size', None, 16384, "The pipe's coalesce_size when "
+            "coalescing", int],
+        ['runs', 'r', 5, "Times to run each mode", int],
+    ]
+
+
+
+def median(values):
+    values = sorted(values)
+    middle = len(values) // 2
+    if len(values) % 2:
+        return values[middle]
+    return (values[middle - 1] + values[middle]) / 2.0
+
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    counts = Counts()
+    uninstall = counts.install(reactor)
+    modes = [
+        ('off', {}),
+        ('%gms' % (options['coalesce-delay'] * 1e3,), {
+            'coalesce_delay': options['coalesce-delay'],
+            'coalesce_size': options['coalesce-size']}),
+    ]
+    samples = dict((label, []) for label, pipe_options in modes)
+    for i in xrange(options['runs']):
+        for label, pipe_options in modes:
+            received = yield run(reactor, counts, options, **pipe_options)
+            mb = received / 1e6
+            samples[label].append((
+                counts.send / mb, counts.recv / mb, counts.epoll_ctl / mb,
+                counts.epoll_wait / mb, counts.timerfd / mb,
+                (counts.send + counts.recv + counts.epoll_ctl +
+                 counts.epoll_wait + counts.timerfd) / mb))
+    uninstall()
+    print 'median syscalls per MB over %d runs (%d messages of %d bytes)' % (
+        options['runs'], options['messages'], options['size'])
+    print '%-10s %10s %10s %10s %10s %10s %10s' % (
+        'coalesce', 'send', 'recv', 'epoll_ctl', 'epoll_wait', 'timerfd',
+        'total')
+    for label, pipe_options in modes:
+        row = [median(column) for column in zip(*samples[label])]
+        print '%-10s %10.0f %10.0f %10.0f %10.0f %10.0f %10.0f' % tuple(
+            [label] + row)
+
+
+
+if __name__ == '__main__':
+    task.react(main, sys.argv[1:])
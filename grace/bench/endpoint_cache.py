@@ -0,0 +1,126 @@
+"""
+Measure how long it takes from a client connecting to a L{Pipe} until the
+upstream server sees the forwarded connection, with and without the
+L{Pipe}'s endpoint cache.
+
+    python -m grace.bench.endpoint_cache [connections]
+"""
+
+from twisted.internet import reactor, defer, endpoints, protocol, task
+from twisted.python import usage
+
+import time
+
+from grace.pipe import Pipe
+
+
+
+class UncachedPipe(Pipe):
+    """
+    I am a L{Pipe} that parses the destination endpoint on every connection,
+    the way L{Pipe} used to.
+    """
+
+
+    def getEndpoint(self, dst):
+        return endpoints.clientFromString(self._reactor, dst)
+
+
+
+class Upstream(protocol.Protocol):
+
+
+    def connectionMade(self):
+        self.factory.connected(self)
+
+
+
+class UpstreamFactory(protocol.Factory):
+    """
+    I fire a Deferred each time something connects to me.
+    """
+
+    protocol = Upstream
+
+
+    def __init__(self):
+        self.waiting = None
+
+
+    def connected(self, proto):
+        proto.transport.loseConnection()
+        d, self.waiting = self.waiting, None
+        if d is not None:
+            d.callback(time.time())
+
+
+
+@defer.inlineCallbacks
+def measure(pipeFactory, count, upstream_port):
+    """
+    Connect C{count} clients, one after another, to a pipe made by
+    C{pipeFactory}.
+
+    @return: A C{Deferred} firing with a list of accept-to-upstream-connect
+        times in seconds.
+    """
+    upstream = UpstreamFactory()
+    up_port = yield endpoints.serverFromString(reactor,
+        'tcp:%d:interface=127.0.0.1' % upstream_port).listen(upstream)
+    pipe = pipeFactory('tcp:host=127.0.0.1:port=%d' % upstream_port)
+    pipe_port = yield endpoints.serverFromString(reactor,
+        'tcp:0:interface=127.0.0.1').listen(pipe)
+    client_ep = endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                             pipe_port.getHost().port)
+    times = []
+    try:
+        for i in range(count):
+            upstream.waiting = defer.Deferred()
+            start = time.time()
+            client = yield client_ep.connect(
+                protocol.Factory.forProtocol(protocol.Protocol))
+            end = yield upstream.waiting
+            times.append(end - start)
+            client.transport.loseConnection()
+    finally:
+        yield pipe_port.stopListening()
+        yield up_port.stopListening()
+    defer.returnValue(times)
+
+
+
+def summarize(name, times):
+    times = sorted(times)
+    n = len(times)
+    return '%-10s n=%d mean=%.1fus p50=%.1fus p99=%.1fus' % (
+        name, n,
+        sum(times) / n * 1e6,
+        times[n // 2] * 1e6,
+        times[min(n - 1, int(n * 0.99))] * 1e6)
+
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ['connections', 'n', 2000, "Number of connections to make", int],
+        ['port', 'p', 10444, "Port for the upstream server", int],
+    ]
+
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    count = options['connections']
+    uncached = yield measure(UncachedPipe, count, options['port'])
+    cached = yield measure(Pipe, count, options['port'])
+    print summarize('uncached', uncached)
+    print summarize('cached', cached)
+
+
+
+if __name__ == '__main__':
+    import sys
+    task.react(main, sys.argv[1:])
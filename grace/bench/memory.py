@@ -0,0 +1,211 @@
+"""
+Measure how much memory each idle relayed connection costs a L{Pipe}.
+
+A helper process runs an echo server and opens connections to it through a
+pipe in this process, each sending a byte and waiting for it to come back so
+that both halves of the connection are set up.  The growth in this process's
+resident memory, divided by the number of connections, is what each one
+costs (the kernel's socket buffers aren't counted).
+
+    python -m grace.bench.memory [--connections=N] [--splice]
+"""
+
+from twisted.internet import defer, endpoints, protocol, task
+from twisted.python import usage
+
+import gc
+import os
+import resource
+import select
+import socket
+import sys
+import threading
+
+from grace.pipe import Pipe
+
+
+
+def rss():
+    """
+    @return: This process's resident set size in bytes.  Where there's no
+        C{/proc}, the peak size is all there is to go on.
+    """
+    try:
+        statm = open('/proc/self/statm').read()
+    except IOError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    return int(statm.split()[1]) * resource.getpagesize()
+
+
+
+def raiseFileLimit():
+    """
+    Allow as many open files as the hard limit allows.
+
+    @return: The new limit.
+    """
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY:
+        hard = 1024 * 1024
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+    return hard
+
+
+
+def footprint(obj):
+    """
+    @return: The bytes taken by C{obj} and its instance dictionary, if it
+        has one.
+    """
+    size = sys.getsizeof(obj)
+    d = getattr(obj, '__dict__', None)
+    if d is not None:
+        size += sys.getsizeof(d)
+    return size
+
+
+
+def echo(listener):
+    """
+    Accept connections on C{listener} and echo whatever they send, forever.
+    """
+    poller = select.poll()
+    poller.register(listener, select.POLLIN)
+    conns = {}
+    while True:
+        for fd, event in poller.poll():
+            if fd == listener.fileno():
+                s, addr = listener.accept()
+                conns[s.fileno()] = s
+                poller.register(s, select.POLLIN)
+                continue
+            s = conns[fd]
+            data = s.recv(65536)
+            if data:
+                s.sendall(data)
+            else:
+                poller.unregister(fd)
+                del conns[fd]
+                s.close()
+
+
+
+def helper():
+    """
+    Run the echo server, say which port it's on, then read a pipe's port and
+    a number of connections from stdin, make them and say so.  Exit at the
+    end of stdin.
+    """
+    raiseFileLimit()
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1024)
+    thread = threading.Thread(target=echo, args=(listener,))
+    thread.daemon = True
+    thread.start()
+    print listener.getsockname()[1]
+    sys.stdout.flush()
+
+    port, count = [int(x) for x in sys.stdin.readline().split()]
+    clients = []
+    for i in range(count):
+        s = socket.create_connection(('127.0.0.1', port))
+        s.sendall('x')
+        s.recv(1)
+        clients.append(s)
+    print 'connected'
+    sys.stdout.flush()
+    sys.stdin.read()
+
+
+
+class HelperProtocol(protocol.ProcessProtocol):
+    """
+    I talk to a L{helper} process a line at a time.
+    """
+
+    def __init__(self):
+        self.lines = defer.DeferredQueue()
+        self.ended = defer.Deferred()
+        self._buffer = ''
+
+
+    def outReceived(self, data):
+        self._buffer += data
+        while '\n' in self._buffer:
+            line, self._buffer = self._buffer.split('\n', 1)
+            self.lines.put(line)
+
+
+    def errReceived(self, data):
+        sys.stderr.write(data)
+
+
+    def processEnded(self, reason):
+        self.ended.callback(None)
+
+
+
+class Options(usage.Options):
+
+    optFlags = [
+        ['splice', None, "Relay with splice(2)"],
+        ['helper', None, "Be the echo server and client process (internal)"],
+    ]
+
+    optParameters = [
+        ['connections', 'n', 10000, "Number of idle connections to open",
+            int],
+    ]
+
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    count = options['connections']
+    limit = raiseFileLimit()
+    if 2 * count + 100 > limit:
+        raise usage.UsageError('%d connections need more than the %d open '
+                               'files allowed' % (count, limit))
+    proto = HelperProtocol()
+    reactor.spawnProcess(proto, sys.executable,
+                         [sys.executable, '-m', 'grace.bench.memory',
+                          '--helper'],
+                         env=os.environ)
+    echoPort = int((yield proto.lines.get()))
+    pipe = Pipe('tcp:host=127.0.0.1:port=%d' % (echoPort,),
+                splice=options['splice'])
+    port = yield endpoints.serverFromString(
+        reactor, 'tcp:0:interface=127.0.0.1:backlog=1024').listen(pipe)
+
+    gc.collect()
+    before = rss()
+    proto.transport.write('%d %d\n' % (port.getHost().port, count))
+    yield proto.lines.get()
+    gc.collect()
+    after = rss()
+
+    server = next(iter(pipe._open[pipe.dst]))
+    print 'connections: %d' % (count,)
+    print 'rss:         %.1fMB -> %.1fMB' % (before / 1e6, after / 1e6)
+    print 'per conn:    %d bytes' % ((after - before) // count,)
+    for name, obj in [('ProxyServer', server),
+                      ('ProxyClient', server.peer),
+                      ('server transport', server.transport),
+                      ('client transport', server.peer.transport)]:
+        print '  %-18s %d bytes' % (name, footprint(obj))
+
+    proto.transport.closeStdin()
+    yield proto.ended
+    yield port.stopListening()
+
+
+
+if __name__ == '__main__':
+    if '--helper' in sys.argv:
+        helper()
+    else:
+        task.react(main, sys.argv[1:])
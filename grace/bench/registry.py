@@ -0,0 +1,99 @@
+"""
+Measure how long it takes to add pipes, switch one and list them all, for a
+L{Plumber} with many pipes, with and without its index of pipes by C{src}.
+
+    python -m grace.bench.registry [--sizes 1000,10000,50000]
+"""
+
+from twisted.python import usage
+
+import random
+import time
+
+from grace.plumbing import Plumber
+
+
+
+class ScanningPlumber(Plumber):
+    """
+    I am a L{Plumber} that finds pipes by looking through all of them, and
+    sorts them to list them, the way L{Plumber} used to.
+    """
+
+
+    def getListener(self, src):
+        return [x for x in self.pipe_services if x.name == src][0]
+
+
+    def ls(self):
+        keys = [x.name for x in self.pipe_services]
+        keys.sort()
+        for key in keys:
+            for x in self.pipeCommand(key, 'ls'):
+                yield tuple([key] + list(x))
+
+
+
+def measure(plumberFactory, count, switches):
+    """
+    Add C{count} pipes to a L{Plumber} made by C{plumberFactory} (without
+    listening), then switch C{switches} of them at random and list them all.
+
+    @return: A dictionary of the mean seconds per C{'add'} and C{'switch'},
+        and the seconds to C{'ls'}.
+    """
+    plumber = plumberFactory()
+    srcs = ['tcp:%d' % (i,) for i in range(count)]
+    random.shuffle(srcs)
+    start = time.time()
+    for src in srcs:
+        plumber.addPipe(src, 'tcp:host=127.0.0.1:port=1')
+    added = time.time()
+    chosen = [random.choice(srcs) for i in range(switches)]
+    for src in chosen:
+        plumber.pipeCommand(src, 'switch', 'tcp:host=127.0.0.1:port=2')
+    switched = time.time()
+    rows = list(plumber.ls())
+    listed = time.time()
+    assert len(rows) == count
+    return {
+        'add': (added - start) / count,
+        'switch': (switched - added) / switches,
+        'ls': listed - switched,
+    }
+
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ['sizes', 's', '1000,10000,50000', "Comma-separated numbers of pipes "
+            "to try"],
+        ['switches', 'n', 200, "Number of pipes to switch", int],
+        ['scan-limit', None, 10000, "Don't measure the scanning plumber "
+            "with more pipes than this (it's slow)", int],
+    ]
+
+
+
+def main(argv):
+    options = Options()
+    options.parseOptions(argv)
+    sizes = [int(x) for x in options['sizes'].split(',')]
+    print '%-9s %7s %10s %12s %10s' % ('plumber', 'pipes', 'add', 'switch',
+                                       'ls')
+    for count in sizes:
+        for name, factory in [('scanning', ScanningPlumber),
+                              ('indexed', Plumber)]:
+            if factory is ScanningPlumber and count > options['scan-limit']:
+                continue
+            r = measure(factory, count, options['switches'])
+            print '%-9s %7d %8.1fus %10.1fus %8.1fms' % (
+                name, count, r['add'] * 1e6, r['switch'] * 1e6,
+                r['ls'] * 1e3)
+
+
+
+if __name__ == '__main__':
+    import sys
+    main(sys.argv[1:])
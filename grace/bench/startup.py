@@ -0,0 +1,97 @@
+"""
+Measure how long C{grace ls} takes from start to finish, run through
+L{grace.quick} (no Twisted) and through L{grace.cli} (Twisted and a
+reactor), against a real grace process with a few pipes.
+
+    python -m grace.bench.startup [--runs 20] [--pipes 10]
+"""
+
+from twisted.python import usage
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+
+
+# Each path runs the command line given after it, as bin/grace would.
+paths = [
+    ('python', 'pass'),
+    ('quick', 'from grace.quick import run; run()'),
+    ('cli', 'from grace.cli import run; run()'),
+]
+
+
+
+def grace(code, basedir, *args):
+    """
+    Run a grace command line with C{python -c code}.
+
+    @return: The seconds it took.
+    """
+    start = time.time()
+    subprocess.check_call([sys.executable, '-c', code, '-d', basedir] +
+                          list(args), stdout=open(os.devnull, 'w'))
+    return time.time() - start
+
+
+
+def measure(basedir, runs):
+    """
+    Run C{grace ls} C{runs} times each way.
+
+    @return: A dictionary of the sorted times for each way.
+    """
+    times = dict((name, []) for name, code in paths)
+    for i in range(runs):
+        for name, code in paths:
+            times[name].append(grace(code, basedir, 'ls'))
+    for name in times:
+        times[name].sort()
+    return times
+
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ['runs', 'n', 20, "Number of times to run each command", int],
+        ['pipes', 'p', 10, "Number of pipes to list", int],
+    ]
+
+
+
+def main(argv):
+    options = Options()
+    options.parseOptions(argv)
+    top = os.path.dirname(os.path.dirname(os.path.dirname(
+        os.path.abspath(__file__))))
+    os.environ['PYTHONPATH'] = top
+    tmp = tempfile.mkdtemp()
+    basedir = os.path.join(tmp, 'grace')
+    start = 'from grace.cli import run; run()'
+    socket = 'unix:%s/s%%d' % (tmp,)
+    grace(start, basedir, 'start', socket % (0,), 'tcp:host=127.0.0.1:port=1')
+    try:
+        config = os.path.join(tmp, 'pipes.conf')
+        open(config, 'w').write(''.join(
+            '%s tcp:host=127.0.0.1:port=1\n' % (socket % (i,),)
+            for i in range(options['pipes'])))
+        grace(start, basedir, 'apply', config)
+        times = measure(basedir, options['runs'])
+    finally:
+        grace(start, basedir, 'stop')
+        shutil.rmtree(tmp)
+    print '%-7s %9s %9s %9s' % ('path', 'min', 'median', 'max')
+    for name, code in paths:
+        t = times[name]
+        print '%-7s %7.1fms %7.1fms %7.1fms' % (
+            name, t[0] * 1e3, t[len(t) // 2] * 1e3, t[-1] * 1e3)
+
+
+
+if __name__ == '__main__':
+    main(sys.argv[1:])
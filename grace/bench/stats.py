@@ -0,0 +1,146 @@
+"""
+Measure relay throughput through a L{Pipe} with and without its traffic
+counters, to check that counting doesn't slow relaying down.
+
+    python -m grace.bench.stats [--megabytes=N] [--rounds=N]
+"""
+
+from twisted.internet import reactor, defer, endpoints, protocol, task
+from twisted.python import usage
+
+import time
+
+from grace.pipe import Pipe, Proxy, ProxyServer, ProxyClient
+
+
+
+class Sink(protocol.Protocol):
+    """
+    I count what I'm sent and fire C{factory.done} once I've had it all.
+    """
+
+    def connectionMade(self):
+        self.received = 0
+
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.received >= self.factory.expected and self.factory.done:
+            d, self.factory.done = self.factory.done, None
+            d.callback(time.time())
+
+
+
+class Source(protocol.Protocol):
+    """
+    I send C{size} bytes as fast as the connection will take them.
+    """
+
+    chunk = 'x' * 65536
+
+    def __init__(self, size):
+        self.remaining = size
+
+
+    def connectionMade(self):
+        self.transport.registerProducer(self, False)
+
+
+    def resumeProducing(self):
+        if self.remaining <= 0:
+            self.transport.unregisterProducer()
+            return
+        self.transport.write(self.chunk)
+        self.remaining -= len(self.chunk)
+
+
+    def stopProducing(self):
+        pass
+
+
+
+class UncountedClient(ProxyClient):
+
+    def dataReceived(self, data):
+        if self.peer is None:
+            ProxyClient.dataReceived(self, data)
+        else:
+            self.peer.transport.write(data)
+
+
+
+class UncountedServer(ProxyServer):
+
+    dataReceived = Proxy.dataReceived.im_func
+
+
+
+class UncountedPipe(Pipe):
+    """
+    I am a L{Pipe} that relays without counting bytes, the way L{Pipe} used
+    to.
+    """
+
+    protocol = UncountedServer
+    clientProtocol = UncountedClient
+
+
+
+@defer.inlineCallbacks
+def measure(pipeFactory, size):
+    """
+    Send C{size} bytes through a pipe made by C{pipeFactory}.
+
+    @return: A C{Deferred} firing with the throughput in MB/s.
+    """
+    sink = protocol.Factory.forProtocol(Sink)
+    sink.expected = size
+    sink.done = done = defer.Deferred()
+    up_port = yield endpoints.serverFromString(reactor,
+        'tcp:0:interface=127.0.0.1').listen(sink)
+    pipe = pipeFactory('tcp:host=127.0.0.1:port=%d' % up_port.getHost().port)
+    pipe_port = yield endpoints.serverFromString(reactor,
+        'tcp:0:interface=127.0.0.1').listen(pipe)
+    client_ep = endpoints.TCP4ClientEndpoint(reactor, '127.0.0.1',
+                                             pipe_port.getHost().port)
+    try:
+        start = time.time()
+        client = yield endpoints.connectProtocol(client_ep, Source(size))
+        end = yield done
+        client.transport.loseConnection()
+    finally:
+        yield pipe_port.stopListening()
+        yield up_port.stopListening()
+    defer.returnValue(size / (end - start) / 1e6)
+
+
+
+class Options(usage.Options):
+
+    optParameters = [
+        ['megabytes', 'm', 500, "Megabytes to send each round", int],
+        ['rounds', 'r', 5, "Rounds to run each way", int],
+    ]
+
+
+
+@defer.inlineCallbacks
+def main(reactor, *argv):
+    options = Options()
+    options.parseOptions(argv)
+    size = options['megabytes'] * 1000000
+    results = {'uncounted': [], 'counted': []}
+    # Alternate, so that neither gets the benefit of a warmer machine.
+    for i in range(options['rounds']):
+        results['uncounted'].append((yield measure(UncountedPipe, size)))
+        results['counted'].append((yield measure(Pipe, size)))
+    for name in ['uncounted', 'counted']:
+        r = sorted(results[name])
+        print '%-10s best=%.0fMB/s median=%.0fMB/s' % (name, r[-1],
+                                                     r[len(r) // 2])
+
+
+
+if __name__ == '__main__':
+    import sys
+    task.react(main, sys.argv[1:])
@@ -0,0 +1,545 @@
+"""
+Run a suite of benchmarks for the relay and the control plane, and save the
+results as JSON or compare them with results saved earlier.
+
+Local backends, over TCP and UNIX sockets, stand in for the destinations: a
+sink for bulk throughput through a L{Pipe}, an echo server for the
+round-trip latency of small messages, and a server that sends a fixed
+response and hangs up for connections per second.  For the control plane,
+the suite times how long after a L{Pipe.switch} the first new connection
+reaches the new destination, and how long L{Plumber.listPipes} (what
+C{grace ls} asks for) takes with many pipes.
+
+Everything runs in this process, on one reactor, so the numbers understate
+what grace could do on its own; they're for comparing runs on the same
+machine.
+
+    python -m grace.bench.suite [--quick] [--output results.json]
+        [--baseline baseline.json] [--engine=asyncio]
+    python -m grace.bench.suite --compare baseline.json results.json
+
+With a baseline, results more than C{--tolerance} worse than it are flagged
+and the exit status is 1.  Results saved with one C{--engine} make a
+baseline for comparing another with.
+"""
+
+from twisted.internet import defer, endpoints, protocol, task
+from twisted.python import usage
+
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+
+from grace.bench.stats import Sink, Source
+from grace.pipe import Pipe, engines
+from grace.plumbing import Plumber
+
+
+
+# Which way is better for each unit.
+higherIsBetter = {
+    'MB/s': True,
+    'conns/s': True,
+    'us': False,
+    'ms': False,
+}
+
+
+
+def percentile(values, p):
+    """
+    @param values: A sorted list.
+    @return: The value C{p} percent of the way through C{values}.
+    """
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+
+
+def median(values):
+    return sorted(values)[len(values) // 2]
+
+
+
+class Sockets(object):
+    """
+    I listen on sockets of one kind, C{'tcp'} (on the loopback interface) or
+    C{'unix'} (in a temporary directory), and stop them all when asked.  My
+    L{Pipe}s relay with C{engine}.
+    """
+
+    def __init__(self, reactor, kind, engine='twisted'):
+        self.reactor = reactor
+        self.kind = kind
+        self.engine = engine
+        self.ports = []
+        self.tmp = tempfile.mkdtemp() if kind == 'unix' else None
+
+
+    @defer.inlineCallbacks
+    def listen(self, factory):
+        """
+        Listen with C{factory}.
+
+        @return: A C{Deferred} firing with the client endpoint string for
+            connecting to it.
+        """
+        if self.kind == 'tcp':
+            port = yield endpoints.serverFromString(
+                self.reactor, 'tcp:0:interface=127.0.0.1').listen(factory)
+            dst = 'tcp:host=127.0.0.1:port=%d' % (port.getHost().port,)
+        else:
+            path = os.path.join(self.tmp, 's%d' % (len(self.ports),))
+            port = yield endpoints.serverFromString(
+                self.reactor, 'unix:' + path).listen(factory)
+            dst = 'unix:path=' + path
+        self.ports.append(port)
+        defer.returnValue(dst)
+
+
+    @defer.inlineCallbacks
+    def pipe(self, dst):
+        """
+        Start a L{Pipe} to C{dst}.
+
+        @return: A C{Deferred} firing with the pipe and a client endpoint
+            for connecting to it.
+        """
+        pipe = Pipe(dst, engine=self.engine, _reactor=self.reactor)
+        src = yield self.listen(pipe)
+        defer.returnValue((pipe, endpoints.clientFromString(self.reactor,
+                                                            src)))
+
+
+    @defer.inlineCallbacks
+    def close(self):
+        for port in self.ports:
+            yield port.stopListening()
+        self.ports = []
+        if self.tmp is not None:
+            shutil.rmtree(self.tmp)
+
+
+
+class Echo(protocol.Protocol):
+
+
+    def dataReceived(self, data):
+        self.transport.write(data)
+
+
+
+class Fixed(protocol.Protocol):
+    """
+    I send C{factory.response} and hang up.
+    """
+
+
+    def connectionMade(self):
+        self.transport.write(self.factory.response)
+        self.transport.loseConnection()
+
+
+
+class Accepting(protocol.Protocol):
+    """
+    I tell C{factory.waiting}, if it's there, that I've been connected.
+    """
+
+
+    def connectionMade(self):
+        self.transport.loseConnection()
+        d, self.factory.waiting = self.factory.waiting, None
+        if d is not None:
+            d.callback(time.time())
+
+
+
+class Pinger(protocol.Protocol):
+    """
+    I send C{message} and wait for all of it to come back, C{count} times,
+    then fire C{done} with the round trip times.
+    """
+
+    def __init__(self, message, count):
+        self.message = message
+        self.count = count
+        self.times = []
+        self.done = defer.Deferred()
+
+
+    def connectionMade(self):
+        self._ping()
+
+
+    def _ping(self):
+        self.received = 0
+        self.sent = time.time()
+        self.transport.write(self.message)
+
+
+    def dataReceived(self, data):
+        self.received += len(data)
+        if self.received < len(self.message):
+            return
+        self.times.append(time.time() - self.sent)
+        if len(self.times) < self.count:
+            self._ping()
+        else:
+            self.transport.loseConnection()
+            self.done.callback(self.times)
+
+
+
+class Fetcher(protocol.Protocol):
+    """
+    I fire C{done} once the server has hung up.
+    """
+
+    def __init__(self):
+        self.done = defer.Deferred()
+
+
+    def connectionLost(self, reason):
+        self.done.callback(None)
+
+
+
+@defer.inlineCallbacks
+def throughput(sockets, size):
+    """
+    Send C{size} bytes through a L{Pipe} to a sink.
+
+    @return: A C{Deferred} firing with MB/s.
+    """
+    sink = protocol.Factory.forProtocol(Sink)
+    sink.expected = size
+    sink.done = done = defer.Deferred()
+    pipe, ep = yield sockets.pipe((yield sockets.listen(sink)))
+    start = time.time()
+    client = yield endpoints.connectProtocol(ep, Source(size))
+    end = yield done
+    client.transport.loseConnection()
+    defer.returnValue(size / (end - start) / 1e6)
+
+
+
+@defer.inlineCallbacks
+def latency(sockets, count, size=64):
+    """
+    Send C{count} messages of C{size} bytes, one at a time, through a
+    L{Pipe} to an echo server.
+
+    @return: A C{Deferred} firing with the sorted round trip times.
+    """
+    echo = protocol.Factory.forProtocol(Echo)
+    pipe, ep = yield sockets.pipe((yield sockets.listen(echo)))
+    pinger = yield endpoints.connectProtocol(ep, Pinger('x' * size, count))
+    times = yield pinger.done
+    defer.returnValue(sorted(times))
+
+
+
+@defer.inlineCallbacks
+def connRate(sockets, count, concurrency=10):
+    """
+    Make C{count} connections through a L{Pipe} to a server that sends a
+    short response and hangs up, C{concurrency} at a time.
+
+    @return: A C{Deferred} firing with connections per second.
+    """
+    fixed = protocol.Factory.forProtocol(Fixed)
+    fixed.response = 'HTTP/1.0 204 No Content\r\n\r\n'
+    pipe, ep = yield sockets.pipe((yield sockets.listen(fixed)))
+    remaining = [count]
+    @defer.inlineCallbacks
+    def worker():
+        while remaining[0] > 0:
+            remaining[0] -= 1
+            fetcher = yield endpoints.connectProtocol(ep, Fetcher())
+            yield fetcher.done
+    start = time.time()
+    yield defer.gatherResults([worker() for i in range(concurrency)])
+    defer.returnValue(count / (time.time() - start))
+
+
+
+@defer.inlineCallbacks
+def switchLatency(sockets, count):
+    """
+    Switch a L{Pipe} back and forth between two destinations C{count}
+    times, connecting a client straight after each switch.
+
+    @return: A C{Deferred} firing with the sorted times from each switch
+        until the destination switched to was connected to.
+    """
+    backends = []
+    for i in range(2):
+        backend = protocol.Factory.forProtocol(Accepting)
+        backend.waiting = None
+        backends.append((backend, (yield sockets.listen(backend))))
+    pipe, ep = yield sockets.pipe(backends[0][1])
+    times = []
+    for i in range(count):
+        backend, dst = backends[(i + 1) % 2]
+        backend.waiting = d = defer.Deferred()
+        start = time.time()
+        pipe.switch(dst)
+        client = yield endpoints.connectProtocol(ep, protocol.Protocol())
+        end = yield d
+        client.transport.loseConnection()
+        times.append(end - start)
+    defer.returnValue(sorted(times))
+
+
+
+def lsLatency(pipes, calls):
+    """
+    List the pipes of a L{Plumber} with C{pipes} pipes (not listening)
+    C{calls} times.
+
+    @return: The mean seconds per listing.
+    """
+    plumber = Plumber()
+    for i in range(pipes):
+        plumber.addPipe('tcp:%d' % (i,), 'tcp:host=127.0.0.1:port=1')
+    start = time.time()
+    for i in range(calls):
+        plumber.listPipes()
+    return (time.time() - start) / calls
+
+
+
+# Sizes of each benchmark, normally and with --quick.
+sizes = {
+    'throughput': (200 * 1000000, 20 * 1000000),
+    'latency': (5000, 500),
+    'conn_rate': (2000, 200),
+    'switch': (500, 50),
+    'ls': (10000, 1000),
+}
+
+
+
+benchmarks = ['throughput', 'latency', 'conn_rate', 'switch', 'ls']
+
+
+
+@defer.inlineCallbacks
+def runOnce(reactor, name, kind, size, engine='twisted'):
+    """
+    Run one benchmark once.
+
+    @param kind: The kind of socket to use, if it uses sockets.
+    @param engine: The L{Pipe} engine to relay with.
+
+    @return: A C{Deferred} firing with a dictionary of result names to
+        values.
+    """
+    if name == 'ls':
+        calls = max(10, 100000 // size)
+        defer.returnValue({'ls.%d' % (size,): lsLatency(size, calls) * 1e3})
+    sockets = Sockets(reactor, kind, engine)
+    try:
+        if name == 'throughput':
+            r = {'throughput.' + kind: (yield throughput(sockets, size))}
+        elif name == 'latency':
+            times = yield latency(sockets, size)
+            r = dict(('latency.%s.p%d' % (kind, p),
+                      percentile(times, p) * 1e6) for p in (50, 90, 99))
+        elif name == 'conn_rate':
+            r = {'conn_rate.' + kind: (yield connRate(sockets, size))}
+        elif name == 'switch':
+            times = yield switchLatency(sockets, size)
+            r = dict(('switch.%s.p%d' % (kind, p),
+                      percentile(times, p) * 1e6) for p in (50, 99))
+    finally:
+        yield sockets.close()
+    defer.returnValue(r)
+
+
+
+def unit(name):
+    """
+    @return: The unit of a result, by its name.
+    """
+    return {
+        'throughput': 'MB/s',
+        'latency': 'us',
+        'conn_rate': 'conns/s',
+        'switch': 'us',
+        'ls': 'ms',
+    }[name.split('.')[0]]
+
+
+
+@defer.inlineCallbacks
+def runSuite(reactor, names, kinds, rounds, quick=False,
+             engine='twisted'):
+    """
+    Run benchmarks, each C{rounds} times over each kind of socket, keeping
+    the median of each result.
+
+    @return: A C{Deferred} firing with a dictionary of result names to
+        dictionaries of their C{'value'} and C{'unit'}.
+    """
+    values = {}
+    for name in names:
+        size = sizes[name][1 if quick else 0]
+        for kind in (kinds if name != 'ls' else [None]):
+            for i in range(rounds):
+                r = yield runOnce(reactor, name, kind, size, engine)
+                for key, value in r.items():
+                    values.setdefault(key, []).append(value)
+    defer.returnValue(dict((key, {'value': median(v), 'unit': unit(key)})
+                           for key, v in values.items()))
+
+
+
+def compare(baseline, current, tolerance):
+    """
+    Compare two sets of results, as from L{runSuite}.
+
+    @param tolerance: The fraction by which a result may be worse than the
+        baseline before it counts as a regression.
+
+    @return: A list of C{(name, old, new, change, flag)} tuples for the
+        results in both, where C{change} is the fractional change in value
+        and C{flag} is C{'REGRESSION'}, C{'improved'} or C{''}.
+    """
+    rows = []
+    for name in sorted(set(baseline) & set(current)):
+        old = baseline[name]['value']
+        new = current[name]['value']
+        change = (new - old) / old if old else 0.0
+        better = change if higherIsBetter[current[name]['unit']] else -change
+        if better < -tolerance:
+            flag = 'REGRESSION'
+        elif better > tolerance:
+            flag = 'improved'
+        else:
+            flag = ''
+        rows.append((name, old, new, change, flag))
+    return rows
+
+
+
+def formatResults(results):
+    return '\n'.join('%-24s %12.1f %s' % (name, results[name]['value'],
+                                          results[name]['unit'])
+                     for name in sorted(results))
+
+
+
+def formatComparison(rows):
+    lines = ['%-24s %12s %12s %8s' % ('', 'baseline', 'now', 'change')]
+    for name, old, new, change, flag in rows:
+        lines.append('%-24s %12.1f %12.1f %+7.1f%% %s' % (
+            name, old, new, change * 100, flag))
+    return '\n'.join(lines)
+
+
+
+def load(path):
+    """
+    Read results saved with C{--output}.
+    """
+    return json.load(open(path))['results']
+
+
+
+class Options(usage.Options):
+
+    synopsis = '[options] | --compare baseline.json results.json'
+
+    optFlags = [
+        ['quick', 'q', "Run smaller benchmarks, for a quick look"],
+        ['compare', None, "Compare two saved result files instead of "
+            "running anything"],
+    ]
+
+    optParameters = [
+        ['only', None, ','.join(benchmarks), "Comma-separated benchmarks to "
+            "run"],
+        ['sockets', None, 'tcp,unix', "Comma-separated kinds of socket to "
+            "relay over"],
+        ['rounds', 'r', 3, "Run each benchmark this many times and keep the "
+            "median", int],
+        ['output', 'o', None, "Save the results to this JSON file"],
+        ['baseline', 'b', None, "Compare the results with those saved in "
+            "this JSON file"],
+        ['tolerance', 't', 0.1, "Flag results worse than the baseline by "
+            "more than this fraction", float],
+        ['engine', 'e', 'twisted', "Relay with this engine: twisted or "
+            "asyncio"],
+    ]
+
+
+    def parseArgs(self, *files):
+        self['files'] = files
+
+
+    def postOptions(self):
+        if self['compare'] and len(self['files']) != 2:
+            raise usage.UsageError('--compare needs a baseline file and a '
+                                   'results file')
+        if not self['compare'] and self['files']:
+            raise usage.UsageError('Result files are only given with '
+                                   '--compare')
+        for name in self['only'].split(','):
+            if name not in benchmarks:
+                raise usage.UsageError('Unknown benchmark %r (choose from '
+                                       '%s)' % (name, ', '.join(benchmarks)))
+        for kind in self['sockets'].split(','):
+            if kind not in ('tcp', 'unix'):
+                raise usage.UsageError('Unknown kind of socket %r' % (kind,))
+        if self['engine'] not in engines:
+            raise usage.UsageError('Unknown engine %r (choose from %s)' % (
+                                   self['engine'], ', '.join(engines)))
+
+
+
+def report(baseline, results, tolerance):
+    """
+    Print a comparison and exit with status 1 if there are regressions.
+    """
+    rows = compare(baseline, results, tolerance)
+    print formatComparison(rows)
+    if [row for row in rows if row[-1] == 'REGRESSION']:
+        raise SystemExit(1)
+
+
+
+@defer.inlineCallbacks
+def main(reactor, options):
+    results = yield runSuite(reactor, options['only'].split(','),
+                             options['sockets'].split(','),
+                             options['rounds'], options['quick'],
+                             options['engine'])
+    if options['output']:
+        json.dump({
+            'time': time.time(),
+            'python': sys.version.split()[0],
+            'platform': platform.platform(),
+            'quick': bool(options['quick']),
+            'engine': options['engine'],
+            'results': results,
+        }, open(options['output'], 'w'), indent=2, sort_keys=True)
+    if options['baseline']:
+        report(load(options['baseline']), results, options['tolerance'])
+    else:
+        print formatResults(results)
+
+
+
+if __name__ == '__main__':
+    options = Options()
+    options.parseOptions(sys.argv[1:])
+    if options['compare']:
+        baseline, current = options['files']
+        report(load(baseline), load(current), options['tolerance'])
+    else:
+        task.react(main, [options])
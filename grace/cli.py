@@ -1,12 +1,16 @@
-from twisted.internet import protocol, defer, reactor, utils, task
+from twisted.internet import reactor
 from twisted.python import usage
 from twisted.python.filepath import FilePath
 
-import commands
 import sys, os
 
 
 from grace.tac import setupDir
+from grace.daemon import spawnDaemon
+from grace.client import ControlClient
+from grace.format import formatList, formatResults, formatStats
+from grace.format import formatForced
+from grace.pipe import engines
 
 
 
@@ -16,69 +20,56 @@ class Runner:
     """
 
     
-    def _twistdBin(self):
+    def start(self, basedir, src, dst, workers=0, metrics=None,
+              defaults=None, **options):
         """
-        Get the path to the twistd executable.
-        
-        @return: Full path to C{twistd} exectuable.
-        """
-        # XXX what problems will this cause by blocking?
-        return commands.getoutput('which twistd')
-
-
-    def twistd(self, *args, **kwargs):
-        """
-        Run the C{twistd} command-line executable with the given arguments.
+        Start a grace forwarder.
         
-        @param *args: Passed through to
-            C{twisted.internet.utils.getProcessOutputAndValue}.
-        @param *kwargs: Passed through to
-            C{twisted.internet.utils.getProcessOutputAndValue}.
+        @param basedir: Directory to put the configuration, log and pid files.
+        @param src: Listening endpoint
+        @param dst: Connecting endpoint, or a list of them
+        @param workers: Number of worker processes to relay connections in,
+            or 0 to relay them in the main process.
+        @param metrics: Server endpoint on which to serve metrics, if any.
+        @param defaults: Options for every pipe the process starts, such as
+            C{engine}.  See L{grace.plumbing.Plumber.pipeDefaults}.
+        @param **options: Options for the L{grace.pipe.Pipe}, passed through
+            to L{grace.plumbing.Plumber.addPipe}.
         
-        @return: C{Deferred} which fires with (out, err, code) tuple.
+        @return: C{Deferred} which fires with an (out, err, code) tuple once
+            the process is listening on everything, or has failed to.  See
+            L{grace.daemon}.
         """
-        twistd = self._twistdBin()
-        return utils.getProcessOutputAndValue(twistd, *args, **kwargs)
+        setupDir(basedir, (src, dst, options), workers, metrics, defaults)
+        return spawnDaemon(reactor, basedir)
 
 
-    def start(self, basedir, src, dst):
+    def restart(self, basedir):
         """
-        Start a grace forwarder.
-        
-        @param basedir: Directory to put the configuration, log and pid files.
-        @param src: Listening endpoint
-        @param dst: Connecting endpoint
+        Replace a running grace process with a new one, which takes over its
+        pipes without closing their listening sockets.  The old process
+        exits once its connections have closed.
         
-        @return: C{Deferred} which fires with (out, err, code) tuple from
-            running C{twistd} to start the process.
+        @return: C{Deferred} which fires with an (out, err, code) tuple once
+            the new process is listening on everything, or has failed to.
         """
-        setupDir(basedir, (src, dst))
-        r = self.twistd(['--logfile=grace.log', '--pidfile=grace.pid',
-                         '--python=grace.tac'], env=None, path=basedir)
-        
-        def cb(result, basedir):
-            socket = self._waitForFile(FilePath(basedir).child('grace.socket'))
-            return socket.addCallback(lambda x:result)
-        return r.addCallback(cb, basedir)
+        return spawnDaemon(reactor, basedir, takeover=True)
 
 
-    def _waitForFile(self, filepath):
+    def _control(self, basedir, method, *args, **kwargs):
         """
-        Start waiting for a file
-        """
-        d = defer.Deferred()
-        def f(filepath, d):
-            if filepath.exists():
-                d.callback(None)
-                
-        lc = task.LoopingCall(f, filepath, d)
-        lc.start(0.1)
-        
-        def cb(result, lc):
-            lc.stop()
-            return
-        return d.addCallback(cb, lc)
+        Connect to a running grace process, call a
+        L{grace.client.ControlClient} method and disconnect.
         
+        @return: A C{Deferred} firing with the method's result.
+        """
+        client = ControlClient(basedir)
+        client.connectRetries = 0
+        d = getattr(client, method)(*args, **kwargs)
+        def done(result):
+            client.close()
+            return result
+        return d.addBoth(done)
 
 
     def stop(self, basedir):
@@ -87,91 +78,98 @@ class Runner:
         
         @param basedir: Directory with pid file
         """
-        from grace.control import Stop
-        from twisted.protocols import amp
-
-        fp = FilePath(basedir)
-        client = protocol.ClientCreator(reactor, amp.AMP)
-        socket = fp.child('grace.socket').path
-        r = client.connectUNIX(socket)
-        r.addCallback(lambda p: p.callRemote(Stop))
-        return r
+        return self._control(basedir, 'stop')
 
 
     def ls(self, basedir):
         """
-        XXX
+        List a grace process's pipes.
+        
+        @return: A C{Deferred} firing with the rows of the
+            L{grace.control.List} response.
         """
-        from grace.control import List
-        from twisted.protocols import amp
+        return self._control(basedir, 'ls')
+
 
-        fp = FilePath(basedir)
-        client = protocol.ClientCreator(reactor, amp.AMP)
-        socket = fp.child('grace.socket').path
-        r = client.connectUNIX(socket)
-        self.proto = None
-        def gotProto(proto):
-            self.proto = proto
-            return proto.callRemote(List)
+    def switch(self, basedir, src, dst, drain_timeout=None, grace=None):
+        """
+        Switch a pipe to C{dst}, an endpoint or a list of them.
         
-        def gotList(result):
-            self.proto.transport.loseConnection()
-            return result['pipes']
+        @param drain_timeout: If given, wait for the old destinations to
+            drain, closing whatever connections are left after this many
+            seconds.  See L{grace.client.ControlClient.switch}.
         
-        r.addCallback(gotProto)
-        r.addCallback(gotList)
-        return r
+        @return: A C{Deferred}.  With a C{drain_timeout}, it fires with the
+            number of connections that were closed.
+        """
+        return self._control(basedir, 'switch', src, dst, drain_timeout,
+                             grace)
 
 
-    def switch(self, basedir, src, dst):
+    def shift(self, basedir, src, dst, over, steps=0):
         """
-        XXX
+        Move a pipe's new connections to C{dst} gradually.
+        
+        @param over: Number of seconds to take about it.
+        @param steps: Number of equal steps to take, or C{0} to move
+            smoothly.
         """
-        from grace.control import Switch
-        from twisted.protocols import amp
+        return self._control(basedir, 'shift', src, dst, over, steps)
 
-        fp = FilePath(basedir)
-        client = protocol.ClientCreator(reactor, amp.AMP)
-        socket = fp.child('grace.socket').path
-        r = client.connectUNIX(socket)
-        self.proto = None
-        def gotProto(proto):
-            self.proto = proto
-            return proto.callRemote(Switch, src=src, dst=dst)
-        
-        def gotList(result):
-            self.proto.transport.loseConnection()
-            return result
+
+    def shiftControl(self, basedir, src, action):
+        """
+        Pause, resume or abort a shift started with L{shift}.
         
-        r.addCallback(gotProto)
-        r.addCallback(gotList)
-        return r
+        @param action: C{'pause'}, C{'resume'} or C{'abort'}.
+        """
+        return self._control(basedir, action + 'Shift', src)
 
 
-    def wait(self, basedir, src):
+    def limit(self, basedir, src, **limits):
         """
-        XXX
+        Change a pipe's rate limits.
+
+        @param limits: See L{grace.client.ControlClient.limit}.
         """
-        # XXX holy duplicate code, batman
-        from grace.control import Wait
-        from twisted.protocols import amp
+        return self._control(basedir, 'limit', src, **limits)
+
+
+    def stats(self, basedir):
+        """
+        Get the traffic counts of a running grace process.
         
-        fp = FilePath(basedir)
-        client = protocol.ClientCreator(reactor, amp.AMP)
-        socket = fp.child('grace.socket').path
-        r = client.connectUNIX(socket)
-        self.proto = None
-        def gotProto(proto):
-            self.proto = proto
-            return proto.callRemote(Wait, src=src)
+        @return: A C{Deferred} firing with the L{grace.control.Stats}
+            response.
+        """
+        return self._control(basedir, 'stats')
+
+
+    def apply(self, basedir, pipes, wait=False):
+        """
+        Make a running grace process's pipes match a configuration.
         
-        def doneWaiting(result):
-            self.proto.transport.loseConnection()
-            return result
+        @param pipes: A list of (src, dst) pairs, as from
+            L{grace.config.parseConfig}.
+        @param wait: If C{True}, don't return until the old destinations of
+            switched pipes have drained.
         
-        r.addCallback(gotProto)
-        r.addCallback(doneWaiting)
-        return r
+        @return: A C{Deferred} firing with the list of results from
+            L{grace.control.ApplyConfig}.
+        """
+        return self._control(basedir, 'apply', pipes, wait)
+
+
+    def wait(self, basedir, src, timeout=None, grace=None):
+        """
+        Wait until all of a pipe's connections are going to its current
+        destinations.
+        
+        @param timeout: If given, close the connections to old destinations
+            that are left after this many seconds, and fire with how many
+            there were.
+        """
+        return self._control(basedir, 'wait', src, timeout, grace)
 
 
     def run(self):
@@ -183,7 +181,9 @@ class Runner:
         so = options.subOptions
         if options.subCommand == 'start':
             self.code = 0
-            r = self.start(options['basedir'], so['src'], so['dst'])
+            r = self.start(options['basedir'], so['src'], so['dst'],
+                           so['workers'], so['metrics'], so.pipeDefaults(),
+                           **so.pipeOptions())
             def done(result):
                 out, err, code = result
                 self.code = code
@@ -199,6 +199,22 @@ class Runner:
             r.addCallback(done)
             reactor.run()
             sys.exit(self.code)
+        elif options.subCommand == 'restart':
+            self.code = 0
+            r = self.restart(options['basedir'])
+            def done(result):
+                out, err, code = result
+                self.code = code
+                if out:
+                    sys.stdout.write(out)
+                if err:
+                    sys.stderr.write(err)
+                if not err and not self.code:
+                    print 'Restarted'
+                reactor.stop()
+            r.addCallback(done)
+            reactor.run()
+            sys.exit(self.code)
         elif options.subCommand == 'stop':
             self.code = 0
             r = self.stop(options['basedir'])
@@ -207,6 +223,7 @@ class Runner:
                 reactor.stop()
             def eb(result):
                 print 'Error: %s' % result
+                self.code = 1
                 reactor.stop()
             r.addCallback(cb)
             r.addErrback(eb)
@@ -216,13 +233,7 @@ class Runner:
             self.code = 0
             r = self.ls(options['basedir'])
             def cb(result):
-                print 'src dst connections status'
-                for row in result:
-                    if row['active']:
-                        row['active'] = 'active'
-                    else:
-                        row['active'] = 'inactive'
-                    print '%(src)s %(dst)s %(conns)s %(active)s' % row
+                print formatList(result)
                 reactor.stop()
             def eb(result):
                 print 'Error: %s' % result
@@ -234,8 +245,25 @@ class Runner:
             sys.exit(self.code)
         elif options.subCommand == 'switch':
             self.code = 0
-            r = self.switch(options['basedir'], so['src'], so['dst'])
+            r = self.switch(options['basedir'], so['src'], so['dst'],
+                            so['drain-timeout'], so['grace'])
+            def cb(result):
+                if result is not None:
+                    print formatForced(result)
+                reactor.stop()
+            def eb(result):
+                print 'Error: %s' % result
+                self.code = 1
+                reactor.stop()
+            r.addCallback(cb)
+            r.addErrback(eb)
+            reactor.run()
+            sys.exit(self.code)
+        elif options.subCommand == 'stats':
+            self.code = 0
+            r = self.stats(options['basedir'])
             def cb(result):
+                print formatStats(result)
                 reactor.stop()
             def eb(result):
                 print 'Error: %s' % result
@@ -245,10 +273,75 @@ class Runner:
             r.addErrback(eb)
             reactor.run()
             sys.exit(self.code)
+        elif options.subCommand == 'shift':
+            self.code = 0
+            if so.action:
+                r = self.shiftControl(options['basedir'], so['src'],
+                                      so.action)
+            else:
+                r = self.shift(options['basedir'], so['src'], so['dst'],
+                               so['over'], so['steps'])
+            def cb(result):
+                reactor.stop()
+            def eb(result):
+                print 'Error: %s' % result
+                self.code = 1
+                reactor.stop()
+            r.addCallback(cb)
+            r.addErrback(eb)
+            reactor.run()
+            sys.exit(self.code)
+        elif options.subCommand == 'limit':
+            self.code = 0
+            r = self.limit(options['basedir'], so['src'], **so.limits())
+            def cb(result):
+                reactor.stop()
+            def eb(result):
+                print 'Error: %s' % result
+                self.code = 1
+                reactor.stop()
+            r.addCallback(cb)
+            r.addErrback(eb)
+            reactor.run()
+            sys.exit(self.code)
+        elif options.subCommand == 'apply':
+            self.code = 0
+            r = self.apply(options['basedir'], so['pipes'], so['wait'])
+            def cb(results):
+                output = formatResults(results, so['verbose'])
+                if output:
+                    print output
+                if [x for x in results if x['action'] == 'failed']:
+                    self.code = 1
+                reactor.stop()
+            def eb(result):
+                print 'Error: %s' % result.getErrorMessage()
+                self.code = 1
+                reactor.stop()
+            r.addCallback(cb)
+            r.addErrback(eb)
+            reactor.run()
+            sys.exit(self.code)
+        elif options.subCommand in ('batch', 'shell'):
+            from twisted.internet import stdio
+            from grace.shell import CommandShell
+            client = ControlClient(options['basedir'])
+            shell = CommandShell(client, options.subCommand == 'shell')
+            stdio.StandardIO(shell)
+            def done(failures):
+                client.close()
+                self.code = 1 if failures else 0
+                reactor.stop()
+            shell.done.addCallback(done)
+            reactor.run()
+            sys.exit(self.code)
         elif options.subCommand == 'wait':
             self.code = 0
-            r = self.wait(options['basedir'], so['src'])
+            r = self.wait(options['basedir'], so['src'], so['timeout'],
+                          so['grace'])
             def cb(result):
+                if result is not None:
+                    print formatForced(result)
                 reactor.stop()
             def eb(result):
                 print 'Error: %s' % result
@@ -260,18 +353,197 @@ class Runner:
             sys.exit(self.code)
 
 
+def _unescape(s):
+    return s.decode('string_escape')
+
+
+
+def _dstArg(dst, dsts):
+    """
+    Turn one or more destination arguments into what L{Runner} takes.
+    """
+    if dsts:
+        return [dst] + list(dsts)
+    return dst
+
+
+
+def parseDuration(s):
+    """
+    Parse a duration such as C{60}, C{60s}, C{2m}, C{1h} or C{500ms}.
+    
+    @return: A number of seconds.
+    """
+    units = [('ms', 0.001), ('s', 1), ('m', 60), ('h', 3600)]
+    for suffix, scale in units:
+        if s.endswith(suffix):
+            try:
+                return float(s[:-len(suffix)]) * scale
+            except ValueError:
+                break
+    try:
+        return float(s)
+    except ValueError:
+        raise usage.UsageError('Not a duration: %r' % (s,))
+
+
+
+def parseRate(s):
+    """
+    Parse a number of bytes per second such as C{500000}, C{500k}, C{20M} or
+    C{1G}.
+
+    @return: A number of bytes per second.
+    """
+    units = [('k', 1e3), ('K', 1e3), ('M', 1e6), ('G', 1e9)]
+    number, scale = s, 1
+    for suffix, value in units:
+        if s.endswith(suffix):
+            number, scale = s[:-len(suffix)], value
+            break
+    try:
+        rate = float(number) * scale
+    except ValueError:
+        raise usage.UsageError('Not a rate: %r' % (s,))
+    if rate < 0:
+        raise usage.UsageError('A rate must not be negative: %r' % (s,))
+    return rate
+
+
+
+# Options for a pipe's rate limits; see Pipe.limit.
+rateParameters = [
+    ['rate-limit', None, None, "Relay at most this many bytes a second, "
+        "both ways, over the whole pipe (e.g. 500k, 20M)", parseRate],
+    ['dst-rate-limit', None, None, "Relay at most this many bytes a "
+        "second to and from each destination", parseRate],
+    ['conn-rate-limit', None, None, "Relay at most this many bytes a "
+        "second on each connection", parseRate],
+]
+
+
+
 class StartOptions(usage.Options):
 
-    synopsis = 'src dst'
+    synopsis = '[options] src dst [dst ...]'
     longdesc = ('`src` is the server endpoint on which to listen.  `dst` is a '
                 'client endpoint to connect to.  For example, to start '
                 'forwarding from tcp port 9000 to tcp port 8700 do: '
-                '\n\ngrace start tcp:9000 tcp:host=127.0.0.1:port=8700')
+                '\n\ngrace start tcp:9000 tcp:host=127.0.0.1:port=8700'
+                '\n\nGive more than one `dst` to spread connections over '
+                'them.')
 
+    optFlags = [
+        ['splice', None, "Relay plain TCP and UNIX connections with "
+            "splice(2) (Linux only)"],
+    ]
 
-    def parseArgs(self, src, dst):
+    optParameters = [
+        ['workers', None, 0, "Number of worker processes to accept and "
+            "relay connections in (tcp and unix listeners only)", int],
+        ['metrics', None, None, "Serve metrics for Prometheus to scrape on "
+            "this server endpoint (e.g. tcp:9100:interface=127.0.0.1)"],
+        ['engine', None, None, "What relays plain TCP and UNIX connections "
+            "for every pipe: twisted (the default) or asyncio"],
+        ['high-water', None, None, "Stop reading from one side of a "
+            "connection when this many bytes are waiting to be written to "
+            "the other", int],
+        ['low-water', None, None, "Start reading again once this many "
+            "bytes are waiting", int],
+        ['pool-size', None, None, "Keep this many upstream connections "
+            "open and ready for new clients", int],
+        ['pool-idle', None, None, "Close the ready upstream connections "
+            "after this many seconds without a new client", float],
+        ['balance', None, None, "How to choose between several "
+            "destinations: round-robin, least-conns or hash (on the client "
+            "address)"],
+        ['health-interval', None, None, "Probe each destination this "
+            "often (in seconds) and keep new connections away from "
+            "unhealthy ones", float],
+        ['health-timeout', None, None, "Seconds a probe may take", float],
+        ['health-send', None, None, "Bytes a probe sends once connected "
+            "(with backslash escapes, e.g. 'PING\\r\\n')", _unescape],
+        ['health-expect', None, None, "Bytes a probe must receive to pass",
+            _unescape],
+        ['health-rise', None, None, "Successes in a row that make a "
+            "destination healthy again", int],
+        ['health-fall', None, None, "Failures in a row (of probes or "
+            "connections) that make a destination unhealthy", int],
+        ['connect-timeout', None, None, "Give up connecting to a "
+            "destination after this many seconds", float],
+        ['connect-retries', None, None, "Retry a failed connection this "
+            "many times, to another destination if there is one, while the "
+            "client waits", int],
+        ['retry-backoff', None, None, "Seconds before the first retry; "
+            "doubled (with jitter) for each retry after that", float],
+        ['idle-timeout', None, None, "Close a connection after nothing has "
+            "been relayed on it for this long (e.g. 10m)", parseDuration],
+        ['keepalive', None, None, "Send TCP keepalive probes on both sides "
+            "of a connection after it has been silent this long",
+            parseDuration],
+        ['user-timeout', None, None, "Drop a TCP connection when data sent "
+            "on it goes unacknowledged this long (Linux only)",
+            parseDuration],
+        ['max-conns', None, None, "Relay at most this many connections at "
+            "once; more wait their turn", int],
+        ['max-dst-conns', None, None, "Relay at most this many connections "
+            "to each destination at once", int],
+        ['queue-size', None, None, "How many connections may wait for "
+            "their turn before more are refused (default 100)", int],
+        ['queue-timeout', None, None, "Close a connection that has waited "
+            "this long (default 10s)", parseDuration],
+        ['coalesce-delay', None, None, "Gather small chunks for up to this "
+            "long (e.g. 1ms) and write them to the other side together",
+            parseDuration],
+        ['coalesce-size', None, None, "Write gathered chunks as soon as "
+            "there are this many bytes of them (default 16384)", int],
+    ] + rateParameters
+
+
+    def parseArgs(self, src, dst, *dsts):
         self['src'] = src
-        self['dst'] = dst
+        self['dst'] = _dstArg(dst, dsts)
+
+
+    def pipeOptions(self):
+        """
+        Get the options given for the L{grace.pipe.Pipe}, suitable for
+        passing to L{Runner.start}.
+        """
+        options = {}
+        if self['splice']:
+            options['splice'] = True
+        for name in ['high-water', 'low-water', 'pool-size', 'pool-idle',
+                     'balance', 'health-interval', 'health-timeout',
+                     'health-send', 'health-expect', 'health-rise',
+                     'health-fall', 'connect-timeout', 'connect-retries',
+                     'retry-backoff', 'idle-timeout', 'keepalive',
+                     'user-timeout', 'max-conns', 'max-dst-conns',
+                     'queue-size', 'queue-timeout', 'rate-limit',
+                     'dst-rate-limit', 'conn-rate-limit', 'coalesce-delay',
+                     'coalesce-size']:
+            if self[name] is not None:
+                options[name.replace('-', '_')] = self[name]
+        return options
+
+
+    def pipeDefaults(self):
+        """
+        Get the options given for every pipe the process starts, suitable
+        for passing to L{Runner.start}.
+        """
+        if self['engine'] is None:
+            return {}
+        return {'engine': self['engine']}
+
+
+    def postOptions(self):
+        if self['engine'] not in (None,) + engines:
+            raise usage.UsageError('--engine must be one of: %s' % (
+                                   ', '.join(engines),))
+        if self['engine'] == 'asyncio' and self['splice']:
+            raise usage.UsageError("--splice can't be used with "
+                                   "--engine=asyncio")
 
 
 class StopOptions(usage.Options):
@@ -281,6 +553,18 @@ class StopOptions(usage.Options):
 
 
 
+class RestartOptions(usage.Options):
+
+    synopsis = ''
+    longdesc = ('Replace the running grace process with a new one, for '
+                'instance to upgrade grace.  The new process takes over '
+                'every pipe as it is now, listening socket and all, so '
+                'connecting is never refused.  The old process stops '
+                'accepting connections and exits once the ones it has '
+                'have closed.  This does not work with --workers.')
+
+
+
 class ListOptions(usage.Options):
 
     synopsis = ''
@@ -288,33 +572,210 @@ class ListOptions(usage.Options):
 
 
 
+# Options for draining old destinations by a deadline; see Pipe.drain.
+drainParameters = [
+    ['drain-timeout', None, None, "Wait this long, e.g. 30s, 5m, for the old "
+        "destinations to drain, then close the connections that are left",
+        parseDuration],
+    ['grace', None, None, "Close only idle connections when time's up, and "
+        "the rest this much later", parseDuration],
+]
+
+
+
 class SwitchOptions(usage.Options):
 
-    synopsis = 'src dst'
+    synopsis = 'src dst [dst ...]'
     longdesc = ('`src` is the server endpoint on which grace is currently '
                 'listening.  `dst` is the client endpoint to connect future '
                 'connections to.  For example, if you started grace like this:'
                 '\n\ngrace start tcp:9000 tcp:host=127.0.0.1:port=8700'
                 '\n\nThen you can switch traffic from port 8700 to another by '
                 'doing this:'
-                '\n\ngrace switch tcp:9000 tcp:host=127.0.0.1:port=6000')
+                '\n\ngrace switch tcp:9000 tcp:host=127.0.0.1:port=6000'
+                '\n\nGive more than one `dst` to spread connections over '
+                'them.'
+                '\n\nWith --drain-timeout, wait for the old destinations to '
+                'drain, closing any of their connections still open after '
+                'that long and saying how many there were.')
+
+    optParameters = drainParameters
 
 
-    def parseArgs(self, src, dst):
+    def parseArgs(self, src, dst, *dsts):
+        self['src'] = src
+        self['dst'] = _dstArg(dst, dsts)
+
+
+    def postOptions(self):
+        if self['grace'] is not None and self['drain-timeout'] is None:
+            raise usage.UsageError('--grace needs a --drain-timeout')
+
+
+class ApplyOptions(usage.Options):
+
+    synopsis = '[options] config-file'
+    longdesc = ('Make the running pipes match a config file in one go: pipes '
+                'not in the file are removed, new ones are added and ones '
+                'whose destinations differ are switched.  Each line of the '
+                'file is a `src` followed by its `dst`s, as for `grace '
+                'start`; blank lines and lines starting with # are ignored.  '
+                'Use - to read the config from stdin.')
+
+    optFlags = [
+        ['wait', 'w', "Don't exit until the old destinations of switched "
+            "pipes have drained"],
+        ['verbose', 'v', "List unchanged pipes too"],
+    ]
+
+
+    def parseArgs(self, filename):
+        from grace.config import parseConfig, ConfigError
+        if filename == '-':
+            content = sys.stdin.read()
+        else:
+            try:
+                content = FilePath(filename).getContent()
+            except (IOError, OSError) as e:
+                raise usage.UsageError('Could not read %s: %s' % (filename, e))
+        try:
+            self['pipes'] = parseConfig(content)
+        except ConfigError as e:
+            raise usage.UsageError('%s: %s' % (filename, e))
+
+
+
+class StatsOptions(usage.Options):
+
+    synopsis = ''
+    longdesc = ('Show traffic counts for each pipe and destination: '
+                'connections accepted and per second (a moving average), '
+                'bytes in from clients and out to them, failed connections '
+                'to the destination and how connections were closed')
+
+
+
+class ShiftOptions(usage.Options):
+
+    synopsis = '[options] src [dst]'
+    longdesc = ('Move new connections on `src` over to `dst` gradually, so '
+                'that a new destination gets busy bit by bit.  Once all new '
+                'connections go to `dst` the old destinations drain as they '
+                'do after a switch.  For example:'
+                '\n\ngrace shift tcp:9000 tcp:host=127.0.0.1:port=6000 '
+                '--over 60s'
+                '\n\nA shift in progress can be paused, resumed or aborted '
+                '(sending everything back to the old destinations):'
+                '\n\ngrace shift --abort tcp:9000')
+
+    optFlags = [
+        ['pause', None, "Pause the shift in progress"],
+        ['resume', None, "Resume a paused shift"],
+        ['abort', None, "Abort the shift in progress"],
+    ]
+
+    optParameters = [
+        ['over', None, None, "How long to take, e.g. 90, 90s, 5m",
+            parseDuration],
+        ['steps', None, 0, "Move in this many equal steps instead of "
+            "smoothly", int],
+    ]
+
+    action = None
+
+
+    def parseArgs(self, src, dst=None):
         self['src'] = src
         self['dst'] = dst
 
 
+    def postOptions(self):
+        actions = [x for x in ['pause', 'resume', 'abort'] if self[x]]
+        if len(actions) > 1:
+            raise usage.UsageError('Give only one of --pause, --resume and '
+                                   '--abort')
+        if actions:
+            self.action = actions[0]
+        elif self['dst'] is None or self['over'] is None:
+            raise usage.UsageError('Give a dst and --over to start a shift')
+
+
+
+class LimitOptions(usage.Options):
+
+    synopsis = '[options] src'
+    longdesc = ('Change the rate limits of the pipe listening on `src`, '
+                'for the connections it is relaying as well as new ones.  '
+                'Limits not given are left as they are; 0 turns one off.  '
+                'For example:'
+                '\n\ngrace limit tcp:9000 --conn-rate-limit=1M')
+
+    optParameters = rateParameters
+
+
+    def parseArgs(self, src):
+        self['src'] = src
+
+
+    def limits(self):
+        """
+        Get the limits given, suitable for passing to L{Runner.limit}.
+        """
+        return dict((name.replace('-', '_'), self[name])
+                    for name, _, _, _, _ in rateParameters
+                    if self[name] is not None)
+
+
+    def postOptions(self):
+        if not self.limits():
+            raise usage.UsageError('Give at least one limit to change')
+
+
+
+class BatchOptions(usage.Options):
+
+    synopsis = ''
+    longdesc = ('Run commands read from stdin, one per line, over a single '
+                'connection to the grace process.  Each line is a grace '
+                'command without the `grace`, e.g. `switch tcp:9000 '
+                'tcp:host=10.0.0.2:port=80`.  Commands are sent without '
+                'waiting for earlier ones to finish; their output is written '
+                'in order, with `ok` for commands that have none.  Exits '
+                'with status 1 if any command failed.')
+
+
+
+class ShellOptions(usage.Options):
+
+    synopsis = ''
+    longdesc = ('Run commands interactively over a single connection to the '
+                'grace process.  Commands are as for `grace batch`.')
+
+
+
 class WaitOptions(usage.Options):
 
-    synopsis = 'src'
-    longdesc = ('`src` is the listening endpoint')
+    synopsis = '[options] src'
+    longdesc = ('`src` is the listening endpoint.  With --timeout, close any '
+                'connections to old destinations still open after that long '
+                'and say how many there were.')
+
+    optParameters = [
+        ['timeout', None, None, "Give up waiting after this long, e.g. 30s, "
+            "5m, and close the connections that are left", parseDuration],
+        drainParameters[1],
+    ]
 
 
     def parseArgs(self, src):
         self['src'] = src
 
 
+    def postOptions(self):
+        if self['grace'] is not None and self['timeout'] is None:
+            raise usage.UsageError('--grace needs a --timeout')
+
+
 
 class Options(usage.Options):
 
@@ -327,8 +788,17 @@ class Options(usage.Options):
     subCommands = [
         ['start', None, StartOptions, "Start forwarding"],
         ['stop', None, StopOptions, "Stop forwarding"],
+        ['restart', None, RestartOptions, "Replace the grace process without "
+            "dropping connections"],
         ['ls', None, ListOptions, "List forwards"],
         ['switch', 'x', SwitchOptions, "Switch forwarding"],
+        ['shift', None, ShiftOptions, "Switch forwarding gradually"],
+        ['limit', None, LimitOptions, "Change a pipe's rate limits"],
+        ['stats', None, StatsOptions, "Show traffic counts"],
+        ['apply', None, ApplyOptions, "Make the pipes match a config file"],
+        ['batch', None, BatchOptions, "Run commands from stdin over one "
+            "connection"],
+        ['shell', None, ShellOptions, "Run commands interactively"],
         ['wait', 'w', WaitOptions, "Wait for all traffic to forward to new "
             "destination"],
     ]
@@ -0,0 +1,276 @@
+"""
+Talking to a running grace process over its control socket.
+
+A L{ControlClient} keeps one connection open and sends every command over
+it, without waiting for earlier commands to be answered first:
+
+    client = ControlClient('~/.grace')
+    d1 = client.switch('tcp:9000', 'tcp:host=10.0.0.2:port=80')
+    d2 = client.switch('tcp:9001', 'tcp:host=10.0.0.2:port=81')
+    d3 = client.ls()
+"""
+
+from twisted.internet import defer, endpoints, error, task
+from twisted.protocols import amp
+from twisted.python.filepath import FilePath
+
+import os
+
+from grace.control import AddPipe, AddBalancedPipe, RemovePipe
+from grace.control import Switch, SwitchBalanced, Stop, Wait, List, Stats
+from grace.control import Shift, PauseShift, ResumeShift, AbortShift
+from grace.control import ApplyConfig, Limit, _given
+from grace.config import dstList
+
+
+
+class _ClientProtocol(amp.AMP):
+
+
+    def __init__(self, client):
+        amp.AMP.__init__(self)
+        self.client = client
+
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.client._lost(self)
+
+
+
+class ControlClient(object):
+    """
+    I send commands to a grace process over one long-lived connection to its
+    control socket.
+
+    I connect when the first command is sent.  If the connection is lost,
+    commands that were waiting for an answer fail, and the next command
+    connects again.  If connecting fails, I try again up to
+    C{connectRetries} times, C{retryDelay} seconds apart, in case the
+    process is restarting.
+    """
+
+    connectRetries = 3
+    retryDelay = 0.5
+
+
+    def __init__(self, basedir, reactor=None, endpoint=None):
+        """
+        @param basedir: The grace process's directory.
+        @param endpoint: A client endpoint to connect to instead of the
+            control socket in C{basedir}.
+        """
+        if reactor is None:
+            from twisted.internet import reactor
+        self.reactor = reactor
+        if endpoint is None:
+            path = FilePath(os.path.expanduser(basedir)).child('grace.socket')
+            endpoint = endpoints.UNIXClientEndpoint(reactor, path.path)
+        self.endpoint = endpoint
+        self._proto = None
+        self._waiting = []
+
+
+    def connect(self):
+        """
+        Get a connection, making one if there isn't one already.
+
+        @return: A C{Deferred} firing with the connected C{AMP} protocol.
+        """
+        if self._proto is not None:
+            return defer.succeed(self._proto)
+        d = defer.Deferred()
+        self._waiting.append(d)
+        if len(self._waiting) == 1:
+            self._attempt(0)
+        return d
+
+
+    def _attempt(self, tries):
+        d = endpoints.connectProtocol(self.endpoint, _ClientProtocol(self))
+        d.addCallbacks(self._connected, self._failed, errbackArgs=(tries,))
+
+
+    def _connected(self, proto):
+        self._proto = proto
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.callback(proto)
+
+
+    def _failed(self, reason, tries):
+        if reason.check(error.ConnectError) and tries < self.connectRetries:
+            task.deferLater(self.reactor, self.retryDelay, self._attempt,
+                            tries + 1)
+            return
+        waiting, self._waiting = self._waiting, []
+        for d in waiting:
+            d.errback(reason)
+
+
+    def _lost(self, proto):
+        if self._proto is proto:
+            self._proto = None
+
+
+    def close(self):
+        """
+        Close the connection, if there is one.
+        """
+        if self._proto is not None:
+            self._proto.transport.loseConnection()
+            self._proto = None
+
+
+    def callRemote(self, command, **kwargs):
+        """
+        Send a command.
+
+        @return: A C{Deferred} firing with the response.
+        """
+        d = self.connect()
+        return d.addCallback(lambda proto: proto.callRemote(command, **kwargs))
+
+
+    def _call(self, command, **kwargs):
+        # For commands whose response is empty.
+        return self.callRemote(command, **kwargs).addCallback(lambda r: None)
+
+
+    def addPipe(self, src, dst, **options):
+        """
+        Add a pipe.
+
+        @param dst: A client endpoint or a list of them.
+        @param options: Options for the L{grace.pipe.Pipe}.
+        """
+        if isinstance(dst, basestring):
+            return self._call(AddPipe, src=src, dst=dst, **options)
+        return self._call(AddBalancedPipe, src=src, dsts=dst, **options)
+
+
+    def rmPipe(self, src):
+        return self._call(RemovePipe, src=src)
+
+
+    def _drained(self, command, drain_timeout, grace, **kwargs):
+        if drain_timeout is None:
+            return self._call(command, **kwargs)
+        if grace is not None:
+            grace = float(grace)
+        d = self.callRemote(command, drain_timeout=float(drain_timeout),
+                            grace=grace, **kwargs)
+        return d.addCallback(lambda r: r['forced'])
+
+
+    def switch(self, src, dst, drain_timeout=None, grace=None):
+        """
+        Switch a pipe to C{dst}, an endpoint or a list of them.
+
+        @param drain_timeout: If given, wait for the old destinations to
+            drain, closing the connections to them that are left after this
+            many seconds.  See L{grace.pipe.Pipe.drain}.
+        @param grace: With C{drain_timeout}, close only idle connections at
+            first, and the rest this many seconds later.
+
+        @return: A C{Deferred}.  With a C{drain_timeout}, it fires once the
+            old destinations have drained, with the number of connections
+            that were closed.
+        """
+        if isinstance(dst, basestring):
+            return self._drained(Switch, drain_timeout, grace, src=src,
+                                 dst=dst)
+        return self._drained(SwitchBalanced, drain_timeout, grace, src=src,
+                             dsts=dst)
+
+
+    def shift(self, src, dst, over, steps=0):
+        return self._call(Shift, src=src, dst=dst, over=over, steps=steps)
+
+
+    def pauseShift(self, src):
+        return self._call(PauseShift, src=src)
+
+
+    def resumeShift(self, src):
+        return self._call(ResumeShift, src=src)
+
+
+    def abortShift(self, src):
+        return self._call(AbortShift, src=src)
+
+
+    def limit(self, src, **limits):
+        """
+        Change a pipe's rate limits.
+
+        @param limits: Any of C{rate_limit}, C{dst_rate_limit} and
+            C{conn_rate_limit}, in bytes per second, or C{0} to turn one
+            off.  See L{grace.pipe.Pipe.limit}.
+        """
+        limits = dict((k, float(v)) for k, v in limits.items()
+                      if v is not None)
+        return self._call(Limit, src=src, **limits)
+
+
+    def wait(self, src, timeout=None, grace=None):
+        """
+        @param timeout: If given, close the connections to old destinations
+            that are left after this many seconds, as for L{switch}'s
+            C{drain_timeout}.
+
+        @return: A C{Deferred} that fires once all of a pipe's connections
+            are going to its current destinations; with a C{timeout}, with
+            the number of connections that were closed.
+        """
+        return self._drained(Wait, timeout, grace, src=src)
+
+
+    def ls(self):
+        """
+        @return: A C{Deferred} firing with the rows of the
+            L{grace.control.List} response, leaving out optional details
+            that weren't sent.
+        """
+        d = self.callRemote(List)
+        return d.addCallback(lambda r: [
+            dict((k, v) for k, v in row.items() if v is not None)
+            for row in r['pipes']])
+
+
+    def stats(self):
+        """
+        @return: A C{Deferred} firing with the L{grace.control.Stats}
+            response.
+        """
+        return self.callRemote(Stats)
+
+
+    def apply(self, pipes, wait=False):
+        """
+        Make the pipes match a configuration.  See
+        L{grace.plumbing.Plumber.applyConfig}.
+
+        @param pipes: A list of (src, dst) pairs.
+        @param wait: If C{True}, the result isn't given until the old
+            destinations of switched pipes have drained.
+
+        @return: A C{Deferred} firing with the list of results.
+        """
+        pipes = [{'src': src, 'dsts': dstList(dst)} for src, dst in pipes]
+        d = self.callRemote(ApplyConfig, pipes=pipes, wait=wait)
+        return d.addCallback(lambda r: [_given(x) for x in r['results']])
+
+
+    def stop(self):
+        """
+        Stop the grace process.
+        """
+        d = self.connect()
+        def stop(proto):
+            # The process may stop before it answers.
+            r = proto.callRemote(Stop)
+            r.addErrback(lambda f: f.trap(error.ConnectionDone,
+                                          error.ConnectionLost))
+            return r.addCallback(lambda r: None)
+        return d.addCallback(stop)
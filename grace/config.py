@@ -0,0 +1,83 @@
+"""
+Describing a whole set of pipes at once, for L{grace.plumbing.Plumber.applyConfig}.
+
+A config file has a line for each pipe: its C{src} endpoint followed by one
+or more C{dst} endpoints, separated by whitespace, just like the arguments
+to C{grace start}.  Blank lines and lines starting with C{#} are ignored:
+
+    # public web
+    tcp:80  tcp:host=10.0.0.1:port=8080 tcp:host=10.0.0.2:port=8080
+    tcp:443 tcp:host=10.0.0.1:port=8443
+"""
+
+from twisted.internet import endpoints
+
+
+
+class ConfigError(ValueError):
+    """
+    A configuration doesn't make sense.
+    """
+
+
+
+def parseConfig(content):
+    """
+    Parse the content of a config file.
+
+    @return: A list of (src, dst) pairs in the order they appear, where
+        C{dst} is an endpoint string or, if there are several, a list of
+        them.
+
+    @raise ConfigError: If a line has no destination or a C{src} appears
+        more than once.
+    """
+    pipes = []
+    seen = set()
+    for number, line in enumerate(content.splitlines(), 1):
+        words = line.split()
+        if not words or words[0].startswith('#'):
+            continue
+        if len(words) < 2:
+            raise ConfigError('Line %d: %r has no destination' % (
+                              number, words[0]))
+        src = words[0]
+        if src in seen:
+            raise ConfigError('Line %d: %r is configured more than once' % (
+                              number, src))
+        seen.add(src)
+        dsts = words[1:]
+        pipes.append((src, dsts[0] if len(dsts) == 1 else dsts))
+    return pipes
+
+
+
+def dstList(dst):
+    """
+    Get a pipe's destinations as a list, whether C{dst} is one endpoint
+    string or a list of them.
+    """
+    if isinstance(dst, basestring):
+        return [dst]
+    return list(dst)
+
+
+
+def checkPipe(reactor, src, dsts, new=True):
+    """
+    Check that a pipe's endpoints can be parsed.
+
+    @param dsts: A list of client endpoint strings.
+    @param new: If C{False}, the pipe exists already so C{src} isn't
+        checked.
+
+    @raise ConfigError: If any can't be.
+    """
+    strings = [(endpoints.clientFromString, x) for x in dsts]
+    if new:
+        strings.insert(0, (endpoints.serverFromString, src))
+    for parse, string in strings:
+        try:
+            parse(reactor, string)
+        except Exception as e:
+            raise ConfigError('%s: bad endpoint %r: %s' % (src, string, e))
@@ -1,6 +1,48 @@
 from twisted.protocols import amp
 from twisted.internet.protocol import Factory
-
+from twisted.internet import defer
+
+from grace.config import ConfigError
+
+
+
+# A pipe's rate limits, in bytes per second.  See Pipe.limit.
+rateLimits = [
+    ('rate_limit', amp.Float(optional=True)),
+    ('dst_rate_limit', amp.Float(optional=True)),
+    ('conn_rate_limit', amp.Float(optional=True)),
+]
+
+
+# Optional arguments for commands that make a Pipe, passed through to
+# Pipe.__init__ as keyword arguments.
+pipeOptions = [
+    ('splice', amp.Boolean(optional=True)),
+    ('high_water', amp.Integer(optional=True)),
+    ('low_water', amp.Integer(optional=True)),
+    ('pool_size', amp.Integer(optional=True)),
+    ('pool_idle', amp.Float(optional=True)),
+    ('balance', amp.String(optional=True)),
+    ('health_interval', amp.Float(optional=True)),
+    ('health_timeout', amp.Float(optional=True)),
+    ('health_send', amp.String(optional=True)),
+    ('health_expect', amp.String(optional=True)),
+    ('health_rise', amp.Integer(optional=True)),
+    ('health_fall', amp.Integer(optional=True)),
+    ('connect_timeout', amp.Float(optional=True)),
+    ('connect_retries', amp.Integer(optional=True)),
+    ('retry_backoff', amp.Float(optional=True)),
+    ('idle_timeout', amp.Float(optional=True)),
+    ('keepalive', amp.Float(optional=True)),
+    ('user_timeout', amp.Float(optional=True)),
+    ('max_conns', amp.Integer(optional=True)),
+    ('max_dst_conns', amp.Integer(optional=True)),
+    ('queue_size', amp.Integer(optional=True)),
+    ('queue_timeout', amp.Float(optional=True)),
+    ('engine', amp.String(optional=True)),
+    ('coalesce_delay', amp.Float(optional=True)),
+    ('coalesce_size', amp.Integer(optional=True)),
+] + rateLimits
 
 
 class AddPipe(amp.Command):
@@ -8,7 +50,19 @@ class AddPipe(amp.Command):
     arguments = [
         ('src', amp.String()),
         ('dst', amp.String()),
-    ]
+    ] + pipeOptions
+    response = []
+
+
+class AddBalancedPipe(amp.Command):
+    """
+    Like L{AddPipe}, but spreading connections over several destinations.
+    """
+    
+    arguments = [
+        ('src', amp.String()),
+        ('dsts', amp.ListOf(amp.String())),
+    ] + pipeOptions
     response = []
 
 
@@ -20,27 +74,123 @@ class RemovePipe(amp.Command):
     response = []
 
 
+# Optional arguments for commands that drain a pipe's old destinations:
+# after drain_timeout seconds whatever connections are left are closed (idle
+# ones first, if there's a grace period), and the number closed is sent back
+# as forced.  See Pipe.drain.
+drainOptions = [
+    ('drain_timeout', amp.Float(optional=True)),
+    ('grace', amp.Float(optional=True)),
+]
+
+drainResponse = [
+    ('forced', amp.Integer(optional=True)),
+]
+
+
 class Switch(amp.Command):
+    """
+    Switch a pipe to C{dst}.  Given a C{drain_timeout}, the response isn't
+    sent until the old destination has drained.
+    """
+    
+    arguments = [
+        ('src', amp.String()),
+        ('dst', amp.String()),
+    ] + drainOptions
+    response = drainResponse
+
+
+class SwitchBalanced(amp.Command):
+    """
+    Like L{Switch}, but to several destinations.
+    """
+    
+    arguments = [
+        ('src', amp.String()),
+        ('dsts', amp.ListOf(amp.String())),
+    ] + drainOptions
+    response = drainResponse
+
+
+class Shift(amp.Command):
+    """
+    Move a pipe's new connections to C{dst} gradually over C{over} seconds,
+    smoothly or in C{steps} steps.
+    """
     
     arguments = [
         ('src', amp.String()),
         ('dst', amp.String()),
+        ('over', amp.Float()),
+        ('steps', amp.Integer(optional=True)),
     ]
     response = []
 
 
+class PauseShift(amp.Command):
+    
+    arguments = [
+        ('src', amp.String()),
+    ]
+    response = []
+
+
+class ResumeShift(amp.Command):
+    
+    arguments = [
+        ('src', amp.String()),
+    ]
+    response = []
+
+
+class AbortShift(amp.Command):
+    
+    arguments = [
+        ('src', amp.String()),
+    ]
+    response = []
+
+
+class Limit(amp.Command):
+    """
+    Change a pipe's rate limits without disturbing its connections.  Limits
+    that aren't sent are left as they are; C{0} turns a limit off.
+    """
+
+    arguments = [
+        ('src', amp.String()),
+    ] + rateLimits
+    response = []
+
+
 class Stop(amp.Command):
     
     arguments = []
     response = []
 
 
+class HandOff(amp.Command):
+    """
+    Sent by a new grace process to the running one to take over its pipes.
+    The running one sends each pipe back with L{grace.workers.AdoptPipe},
+    stops accepting on them and stops its control socket, then answers.  It
+    exits once its connections have closed.  See L{grace.daemon}.
+    """
+
+    arguments = []
+    response = []
+    errors = {
+        ValueError: 'CANNOT_HAND_OFF',
+    }
+
+
 class Wait(amp.Command):
 
     arguments = [
         ('src', amp.String()),
-    ]
-    response = []
+    ] + drainOptions
+    response = drainResponse
 
 
 class List(amp.Command):
@@ -52,12 +202,96 @@ class List(amp.Command):
                 ('dst', amp.String()),
                 ('conns', amp.Integer()),
                 ('active', amp.Boolean()),
+                ('pool_hits', amp.Integer(optional=True)),
+                ('pool_misses', amp.Integer(optional=True)),
+                ('weight', amp.Float(optional=True)),
+                ('healthy', amp.Boolean(optional=True)),
+                ('retries', amp.Integer(optional=True)),
+                ('timeouts', amp.Integer(optional=True)),
             ]
         )),
     ]
 
 
 
+# Traffic counters, as in grace.stats.Counters.
+statsFields = [
+    ('accepted', amp.Integer()),
+    ('connect_failures', amp.Integer()),
+    ('connect_retries', amp.Integer()),
+    ('connect_timeouts', amp.Integer()),
+    ('bytes_in', amp.Integer()),
+    ('bytes_out', amp.Integer()),
+    ('closed_by_client', amp.Integer()),
+    ('closed_by_upstream', amp.Integer()),
+    ('closed_on_error', amp.Integer()),
+    ('closed_forced', amp.Integer()),
+    ('closed_idle', amp.Integer()),
+    ('queued', amp.Integer()),
+    ('queue_wait', amp.Float()),
+    ('rejected', amp.Integer()),
+    ('queue_timeouts', amp.Integer()),
+    ('pauses_src', amp.Integer()),
+    ('pauses_dst', amp.Integer()),
+    ('rate', amp.Float()),
+    # Pipes only: connections waiting to be admitted now, and seconds spent
+    # holding connections back for rate limits.
+    ('waiting', amp.Integer(optional=True)),
+    ('throttled', amp.Float(optional=True)),
+]
+
+
+class Stats(amp.Command):
+    """
+    Get traffic counts for every pipe, and for each of their destinations.
+    """
+
+    response = [
+        ('pipes', amp.AmpList([('src', amp.String())] + statsFields)),
+        ('dsts', amp.AmpList([('src', amp.String()), ('dst', amp.String())]
+                             + statsFields)),
+    ]
+
+
+
+class ApplyConfig(amp.Command):
+    """
+    Make the pipes match a whole configuration at once.  See
+    L{grace.plumbing.Plumber.applyConfig}.
+
+    If C{wait} is true, the response isn't sent until the old destinations
+    of switched pipes have drained.
+    """
+
+    arguments = [
+        ('pipes', amp.AmpList([
+            ('src', amp.String()),
+            ('dsts', amp.ListOf(amp.String())),
+        ])),
+        ('wait', amp.Boolean(optional=True)),
+    ]
+    response = [
+        ('results', amp.AmpList([
+            ('src', amp.String()),
+            ('action', amp.String()),
+            ('error', amp.String(optional=True)),
+        ])),
+    ]
+    errors = {
+        ConfigError: 'CONFIG_ERROR',
+    }
+
+
+
+def _given(options):
+    """
+    Drop optional AMP arguments that weren't sent (and so came through as
+    C{None}) so that the defaults further down apply.
+    """
+    return dict((k, v) for k, v in options.items() if v is not None)
+
+
+
 class Server(amp.AMP):
     """
     Administration server protocol
@@ -69,8 +303,14 @@ class Server(amp.AMP):
 
 
     @AddPipe.responder
-    def addPipe(self, src, dst):
-        self.plumber.addPipe(src, dst)
+    def addPipe(self, src, dst, **options):
+        self.plumber.addPipe(src, dst, **_given(options))
+        return {}
+
+
+    @AddBalancedPipe.responder
+    def addBalancedPipe(self, src, dsts, **options):
+        self.plumber.addPipe(src, dsts, **_given(options))
         return {}
 
 
@@ -80,11 +320,54 @@ class Server(amp.AMP):
         return {}
 
 
+    def _drain(self, src, drain_timeout, grace):
+        if drain_timeout is None:
+            return {}
+        d = self.plumber.drain(src, drain_timeout, grace)
+        return d.addCallback(lambda forced: {'forced': forced})
+
+
     @Switch.responder
-    def switch(self, src, dst):
+    def switch(self, src, dst, drain_timeout=None, grace=None):
         self.plumber.pipeCommand(src, 'switch', dst)
+        return self._drain(src, drain_timeout, grace)
+
+    
+    @SwitchBalanced.responder
+    def switchBalanced(self, src, dsts, drain_timeout=None, grace=None):
+        self.plumber.pipeCommand(src, 'switch', dsts)
+        return self._drain(src, drain_timeout, grace)
+
+    
+    @Shift.responder
+    def shift(self, src, dst, over, steps=None):
+        self.plumber.pipeCommand(src, 'shift', dst, over, steps or 0)
+        return {}
+
+
+    @PauseShift.responder
+    def pauseShift(self, src):
+        self.plumber.pipeCommand(src, 'pauseShift')
         return {}
 
+
+    @ResumeShift.responder
+    def resumeShift(self, src):
+        self.plumber.pipeCommand(src, 'resumeShift')
+        return {}
+
+
+    @AbortShift.responder
+    def abortShift(self, src):
+        self.plumber.pipeCommand(src, 'abortShift')
+        return {}
+
+
+    @Limit.responder
+    def limit(self, src, **limits):
+        d = defer.maybeDeferred(self.plumber.limit, src, **_given(limits))
+        return d.addCallback(lambda x: {})
+
     
     @Stop.responder
     def stop(self):
@@ -92,22 +375,43 @@ class Server(amp.AMP):
         return {}
 
 
+    @HandOff.responder
+    def handOff(self):
+        d = defer.maybeDeferred(self.plumber.handOff, self)
+        d.addCallback(lambda x: self.plumber.retire())
+        return d.addCallback(lambda x: {})
+
+
     @List.responder
     def ls(self):
-        r = list(self.plumber.ls())
-        pipes = []
-        for src,dst,conns,active in r:
-            pipes.append({
-                'src': src,
-                'dst': dst,
-                'conns': conns,
-                'active': active,
-            })
-        return {'pipes':pipes}
+        r = self.plumber.listPipes()
+        if isinstance(r, defer.Deferred):
+            return r.addCallback(lambda pipes: {'pipes':pipes})
+        return {'pipes':r}
+
+
+    @Stats.responder
+    def stats(self):
+        def response(result):
+            pipes, dsts = result
+            return {'pipes': pipes, 'dsts': dsts}
+        return defer.maybeDeferred(self.plumber.stats).addCallback(response)
+
+
+    @ApplyConfig.responder
+    def applyConfig(self, pipes, wait=None):
+        results, drained = self.plumber.applyConfig(
+            [(x['src'], x['dsts']) for x in pipes])
+        response = {'results': results}
+        if wait:
+            return drained.addCallback(lambda x: response)
+        return response
 
 
     @Wait.responder
-    def wait(self, src):
+    def wait(self, src, drain_timeout=None, grace=None):
+        if drain_timeout is not None:
+            return self._drain(src, drain_timeout, grace)
         r = self.plumber.pipeCommand(src, 'wait')
         r.addCallback(lambda x: {})
         return r
@@ -0,0 +1,416 @@
+"""
+Running a grace process in the background without C{twistd}.
+
+C{grace start} runs C{python -m grace.daemon --ready-fd 3 BASEDIR} with a
+pipe on file descriptor 3.  That process detaches itself, loads
+C{BASEDIR/grace.tac} and starts the application in it.  Once everything in
+it is listening it writes C{ready} to the pipe and closes it; if anything
+fails to listen it writes the error instead, and exits.  So C{grace start}
+knows straight away whether the pipes are up, rather than polling for the
+control socket.
+
+C{grace restart} does the same with C{--takeover}.  Rather than the pipes
+in C{grace.tac}, the new process takes over the running process's pipes as
+they are now, listening sockets and all, with L{grace.control.HandOff}; see
+L{takeOver}.
+
+Nothing may import the reactor before L{main} has forked.
+"""
+
+from twisted.application import service, internet
+from twisted.internet import defer, protocol, endpoints
+from twisted.protocols import amp
+from twisted.python import failure, log, logfile, usage
+
+import errno
+import os
+import sys
+
+from grace.workers import SharedListener, WorkerPool, AdoptPipe
+from grace.control import HandOff, _given
+from grace.listeners import socketFamily
+
+
+
+READY = 'ready'
+
+
+
+def runningPid(pidfile):
+    """
+    Get the pid of the process named in a pid file, if it's still running.
+
+    @return: The pid, or C{None} if there's no pid file or no such process.
+    """
+    try:
+        pid = int(open(pidfile).read().strip())
+    except (IOError, ValueError):
+        return None
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        if e.errno == errno.ESRCH:
+            return None
+    return pid
+
+
+
+def daemonize():
+    """
+    Detach from the terminal and the parent process, the usual way: fork,
+    start a new session and fork again, so that only the grandchild returns.
+    """
+    if os.fork():
+        os._exit(0)
+    os.setsid()
+    if os.fork():
+        os._exit(0)
+    os.umask(077)
+    null = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null, fd)
+    os.close(null)
+
+
+
+def _services(top):
+    """
+    Iterate over C{top} and every service under it.
+    """
+    yield top
+    collection = service.IServiceCollection(top, None)
+    if collection is not None:
+        for child in collection:
+            for s in _services(child):
+                yield s
+
+
+
+def _observe(d):
+    """
+    Get a C{Deferred} that fires with C{d}'s result, leaving C{d} alone.
+    """
+    observer = defer.Deferred()
+    def fire(result):
+        observer.callback(result)
+        return result
+    d.addBoth(fire)
+    return observer
+
+
+
+def startListening(top):
+    """
+    Start C{top}, with listening errors raised rather than logged.
+
+    @raise Exception: If a service couldn't start listening.
+    """
+    for s in _services(top):
+        if isinstance(s, internet.StreamServerEndpointService):
+            s._raiseSynchronously = True
+    top.privilegedStartService()
+    top.startService()
+
+
+
+def whenListening(top):
+    """
+    Wait until every service under C{top} that listens is listening, and
+    every L{WorkerPool} has its workers.
+
+    @return: A C{Deferred} that fires once they are, or fails with the first
+        error.
+    """
+    dl = []
+    for s in _services(top):
+        if isinstance(s, internet.StreamServerEndpointService):
+            # Errors the endpoint reports late are logged, and the
+            # port comes out as None.
+            def check(port, s=s):
+                if port is None:
+                    raise Exception("%s isn't listening; see grace.log" % (
+                                    s.endpoint,))
+            dl.append(_observe(s._waitingForPort).addCallback(check))
+        elif isinstance(s, SharedListener):
+            dl.append(_observe(s.listening))
+        elif isinstance(s, WorkerPool):
+            dl.append(_observe(s.ready))
+    d = defer.gatherResults(dl, consumeErrors=True)
+    return d.addErrback(lambda f: f.value.subFailure)
+
+
+
+class Notifier(object):
+    """
+    I tell the process that started me whether I'm ready, once.
+
+    A failure isn't sent until L{close}, so that by the time it's heard the
+    process has cleaned up after itself.
+    """
+
+    reason = None
+
+
+    def __init__(self, fd, pidfile=None):
+        """
+        @param fd: The file descriptor of the pipe to write to, or C{None}
+            to not bother.
+        @param pidfile: If given, the file to write my pid to once I'm
+            ready.
+        """
+        self.fd = fd
+        self.pidfile = pidfile
+
+
+    def _send(self, message):
+        if self.fd is None:
+            return
+        fd, self.fd = self.fd, None
+        try:
+            os.write(fd, message + '\n')
+            os.close(fd)
+        except OSError:
+            pass
+
+
+    def ready(self):
+        if self.pidfile is not None:
+            open(self.pidfile, 'w').write('%d\n' % (os.getpid(),))
+        self._send(READY)
+
+
+    def failed(self, reason):
+        if self.reason is None:
+            self.reason = reason
+
+
+    def close(self):
+        """
+        Send the failure, if I haven't said I'm ready.
+        """
+        self._send(self.reason or
+                   "grace stopped before it was ready; see grace.log")
+
+
+
+class _Successor(amp.AMP):
+    """
+    My end of the connection to the grace process I'm taking over from.
+    """
+
+
+    def __init__(self, plumber):
+        amp.AMP.__init__(self)
+        self.plumber = plumber
+
+
+    @AdoptPipe.responder
+    def adoptPipe(self, src, dst, fd, dsts=None, **options):
+        family = socketFamily(fd, src)
+        self.plumber.adoptPipe(src, fd, family, dsts or dst, unlink=True,
+                               **_given(options))
+        return {}
+
+
+
+def takeOver(reactor, plumber, basedir):
+    """
+    Take over the pipes of the grace process running in C{basedir}, in place
+    of any C{plumber} has.  The pipes are adopted by C{plumber} but not
+    started.
+
+    @return: A C{Deferred} that fires once C{plumber} has all the other
+        process's pipes and the other process has stopped accepting on them
+        and stopped its control socket (and anything else it was running),
+        so this process can start its own.
+    """
+    for s in list(plumber.pipe_services):
+        s.disownServiceParent()
+    proto = _Successor(plumber)
+    ep = endpoints.UNIXClientEndpoint(reactor,
+                                      os.path.join(basedir, 'grace.socket'))
+    d = endpoints.connectProtocol(ep, proto)
+    d.addCallback(lambda proto: proto.callRemote(HandOff))
+    def done(result):
+        if proto.transport is not None:
+            proto.transport.loseConnection()
+        return result
+    return d.addBoth(done)
+
+
+
+def loadTac(path):
+    """
+    Run a tac file.
+
+    @return: The names it defines, such as C{application} and C{plumber}.
+    """
+    namespace = {'__file__': path}
+    execfile(path, namespace)
+    return namespace
+
+
+
+class AppendingLogFile(logfile.LogFile):
+    """
+    I am a C{LogFile} opened for appending, so that two processes can write
+    to me at once without overwriting each other, as they do for a while
+    after a restart.
+    """
+
+
+    def _openFile(self):
+        self.closed = False
+        self._file = open(self.path, 'ab', 0)
+        self.size = os.fstat(self._file.fileno()).st_size
+
+
+
+def run(basedir, notifier, reactor=None, takeover=False):
+    """
+    Run the application in C{basedir}'s C{grace.tac} until the reactor
+    stops.
+
+    @param takeover: If C{True}, take over the pipes of the grace process
+        already running in C{basedir} first, with L{takeOver}.
+    """
+    if reactor is None:
+        from twisted.internet import reactor
+    log.startLogging(AppendingLogFile.fromFullPath(
+        os.path.join(basedir, 'grace.log')))
+    try:
+        tac = loadTac(os.path.join(basedir, 'grace.tac'))
+        top = service.IService(tac['application'])
+    except Exception as e:
+        log.err(None, 'Failed to load grace.tac')
+        notifier.failed('Failed to load grace.tac: %s' % (e,))
+        return
+
+    def failed(reason):
+        log.err(reason, 'Failed to start')
+        notifier.failed(reason.getErrorMessage())
+        reactor.stop()
+
+    def start():
+        try:
+            startListening(top)
+        except Exception:
+            return failed(failure.Failure())
+        d = whenListening(top)
+        d.addCallbacks(lambda x: notifier.ready(), failed)
+
+    def stop():
+        if top.running:
+            return top.stopService()
+
+    def begin():
+        if not takeover:
+            return start()
+        d = takeOver(reactor, tac['plumber'], basedir)
+        d.addCallbacks(lambda x: start(), failed)
+
+    reactor.callWhenRunning(begin)
+    reactor.addSystemEventTrigger('before', 'shutdown', stop)
+    reactor.run()
+    log.msg('Server Shut Down.')
+
+
+
+class _StartProtocol(protocol.ProcessProtocol):
+
+
+    def __init__(self):
+        self.output = {1: [], 2: [], 3: []}
+        self.done = defer.Deferred()
+
+
+    def childDataReceived(self, fd, data):
+        self.output[fd].append(data)
+
+
+    def processEnded(self, reason):
+        out, err, ready = [''.join(self.output[fd]) for fd in (1, 2, 3)]
+        code = reason.value.exitCode or 0
+        if ready.strip() != READY:
+            code = code or 1
+            if ready:
+                err += ready
+            elif not err:
+                err = "grace exited before it was ready; see grace.log\n"
+        self.done.callback((out, err, code))
+
+
+
+def spawnDaemon(reactor, basedir, takeover=False):
+    """
+    Start a grace process in C{basedir} in the background.
+
+    @param takeover: If C{True}, the new process takes over from the one
+        already running in C{basedir}.
+
+    @return: A C{Deferred} which fires with an (out, err, code) tuple once
+        the process is listening or has failed to.  C{code} is 0 if it's
+        listening.
+    """
+    proto = _StartProtocol()
+    args = [sys.executable, '-m', 'grace.daemon', '--ready-fd', '3']
+    if takeover:
+        args.append('--takeover')
+    args.append(os.path.abspath(basedir))
+    reactor.spawnProcess(proto, sys.executable, args, env=None, path=basedir,
+                         childFDs={0: 'w', 1: 'r', 2: 'r', 3: 'r'})
+    return proto.done
+
+
+
+class Options(usage.Options):
+
+    synopsis = '[options] basedir'
+
+    optParameters = [
+        ['ready-fd', None, None, "File descriptor to say whether we're "
+            "ready on", int],
+    ]
+
+    optFlags = [
+        ['nodaemon', 'n', "Run in the foreground"],
+        ['takeover', None, "Take over from the grace process running in "
+            "basedir"],
+    ]
+
+
+    def parseArgs(self, basedir):
+        self['basedir'] = os.path.abspath(basedir)
+
+
+
+def main(argv=None):
+    options = Options()
+    options.parseOptions(argv)
+    basedir = options['basedir']
+    pidfile = os.path.join(basedir, 'grace.pid')
+    notifier = Notifier(options['ready-fd'], pidfile)
+    pid = runningPid(pidfile)
+    if options['takeover'] and pid is None:
+        notifier.failed('grace is not running in %s' % (basedir,))
+    elif not options['takeover'] and pid is not None:
+        notifier.failed('grace is already running in %s (pid %d)' % (
+                        basedir, pid))
+    if notifier.reason is not None:
+        notifier.close()
+        sys.exit(1)
+    if not options['nodaemon']:
+        daemonize()
+    os.chdir(basedir)
+    try:
+        run(basedir, notifier, takeover=options['takeover'])
+    finally:
+        # After a restart, the pid file is the new process's.
+        if runningPid(pidfile) == os.getpid():
+            os.remove(pidfile)
+        notifier.close()
+
+
+
+if __name__ == '__main__':
+    main()
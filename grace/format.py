@@ -0,0 +1,96 @@
+"""
+Formatting the responses of control commands for people to read.
+
+This doesn't import Twisted, so that L{grace.quick} can use it.
+"""
+
+
+
+def formatList(rows):
+    """
+    Format the rows of a L{grace.control.List} response, a line for each
+    destination of each pipe.
+    """
+    lines = ['src dst connections status']
+    for row in rows:
+        row = dict(row, active='active' if row['active'] else 'inactive')
+        line = '%(src)s %(dst)s %(conns)s %(active)s' % row
+        if 'pool_hits' in row:
+            line += ' pool=%(pool_hits)s/%(pool_misses)s' % row
+        if 'weight' in row:
+            line += ' weight=%(weight).2f' % row
+        if 'healthy' in row:
+            line += ' healthy' if row['healthy'] else ' unhealthy'
+        if 'retries' in row:
+            line += ' retries=%(retries)s timeouts=%(timeouts)s' % row
+        lines.append(line)
+    return '\n'.join(lines)
+
+
+
+def formatResults(results, verbose=False):
+    """
+    Format the results of a L{grace.control.ApplyConfig} command, a line for
+    each pipe that changed or failed (or for every pipe, if C{verbose}).
+    """
+    lines = []
+    for row in results:
+        if row.get('error'):
+            lines.append('%(action)s %(src)s: %(error)s' % row)
+        elif verbose or row['action'] != 'unchanged':
+            lines.append('%(action)s %(src)s' % row)
+    return '\n'.join(lines)
+
+
+
+def formatForced(forced):
+    """
+    Say how many connections a drain closed because time ran out.
+    """
+    if forced == 1:
+        return 'Drained; closed 1 connection that was still open'
+    return 'Drained; closed %d connections that were still open' % (forced,)
+
+
+
+def formatStats(stats):
+    """
+    Format the response to a L{grace.control.Stats} command as a table: a
+    line for each pipe followed by a line for each of its destinations.
+    """
+    columns = ['accepted', 'rate', 'bytes_in', 'bytes_out',
+               'connect_failures', 'connect_retries', 'connect_timeouts',
+               'closed_by_client', 'closed_by_upstream', 'closed_on_error',
+               'closed_forced', 'closed_idle', 'queued', 'queue_wait',
+               'rejected', 'queue_timeouts', 'waiting', 'throttled',
+               'pauses_src', 'pauses_dst']
+    lines = [['src/dst', 'accepted', 'conns/s', 'in', 'out', 'failed',
+              'retried', 'timed out', 'closed:client', 'upstream', 'error',
+              'forced', 'idle', 'queued', 'avg wait', 'rejected', 'expired',
+              'waiting', 'throttled', 'paused:client', 'upstream']]
+    def line(name, row):
+        cells = [name]
+        for c in columns:
+            if c == 'rate':
+                cells.append('%.2f' % row[c])
+            elif c == 'queue_wait':
+                cells.append('%.3f' % (row[c] / row['queued'])
+                             if row['queued'] else '-')
+            elif row.get(c) is None:
+                cells.append('')
+            elif c == 'throttled':
+                cells.append('%.1f' % row[c])
+            else:
+                cells.append(str(row[c]))
+        return cells
+    dsts = {}
+    for dst in stats['dsts']:
+        dsts.setdefault(dst['src'], []).append(dst)
+    for pipe in stats['pipes']:
+        lines.append(line(pipe['src'], pipe))
+        for dst in dsts.get(pipe['src'], []):
+            lines.append(line('  ' + dst['dst'], dst))
+    widths = [max(len(l[i]) for l in lines) for i in range(len(lines[0]))]
+    return '\n'.join(' '.join([l[0].ljust(widths[0])] +
+                              [c.rjust(w) for c, w in zip(l[1:], widths[1:])])
+                     for l in lines)
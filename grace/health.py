@@ -0,0 +1,171 @@
+"""
+Keeping track of which of a L{grace.pipe.Pipe}'s destinations are up, so new
+connections can be kept away from the ones that aren't.
+"""
+
+from twisted.internet import protocol, endpoints, defer
+from twisted.python import log
+
+
+
+class ProbeFailed(Exception):
+    """
+    A destination didn't answer a health probe the way it should have.
+    """
+
+
+
+class _Probe(protocol.Protocol):
+    """
+    I check that a destination accepts a connection and, optionally, that it
+    answers C{send} with something starting with C{expect}.
+
+    @ivar result: A C{Deferred} firing with C{None} if the check passed.
+    """
+
+    def __init__(self, send=None, expect=None):
+        self.send = send
+        self.expect = expect
+        self.result = defer.Deferred()
+        self._received = ''
+
+
+    def connectionMade(self):
+        if self.send:
+            self.transport.write(self.send)
+        if not self.expect:
+            self.result.callback(None)
+
+
+    def dataReceived(self, data):
+        if self.result.called:
+            return
+        self._received += data
+        if len(self._received) >= len(self.expect):
+            if self._received.startswith(self.expect):
+                self.result.callback(None)
+            else:
+                self.result.errback(ProbeFailed(
+                    'Expected %r, got %r' % (self.expect, self._received)))
+
+
+    def connectionLost(self, reason):
+        if not self.result.called:
+            self.result.errback(reason)
+
+
+
+class HealthCheck(object):
+    """
+    I decide whether one destination of a L{Pipe} is healthy.
+
+    I probe the destination every C{health_interval} seconds, and the pipe
+    also tells me how its real connections to the destination go.  After
+    C{health_fall} failures in a row the destination is unhealthy; after
+    C{health_rise} successes in a row it's healthy again.
+
+    @ivar healthy: Whether the destination is healthy.
+    @ivar failures: Number of failures since the last success.
+    @ivar successes: Number of successes since the last failure.
+    """
+
+    def __init__(self, pipe, dst):
+        self.pipe = pipe
+        self.dst = dst
+        self.healthy = True
+        self.failures = 0
+        self.successes = 0
+        self._call = None
+        self._probing = False
+
+
+    def start(self):
+        """
+        Start probing.
+        """
+        if self._call is None:
+            self._schedule()
+
+
+    def stop(self):
+        """
+        Stop probing.
+        """
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
+
+
+    def _schedule(self):
+        self._call = self.pipe._reactor.callLater(self.pipe.health_interval,
+                                                  self._tick)
+
+
+    def _tick(self):
+        self._schedule()
+        self.probe()
+
+
+    def probe(self):
+        """
+        Check the destination now, unless a check is already under way.
+
+        @return: A C{Deferred} which fires once the check is done.
+        """
+        if self._probing:
+            return defer.succeed(None)
+        self._probing = True
+        reactor = self.pipe._reactor
+        try:
+            endpoint = self.pipe.getEndpoint(self.dst)
+        except Exception:
+            self._probing = False
+            self.failure(None)
+            return defer.succeed(None)
+        proto = _Probe(self.pipe.health_send, self.pipe.health_expect)
+        d = endpoints.connectProtocol(endpoint, proto)
+        d.addCallback(lambda p: p.result)
+
+        def timedOut():
+            if proto.transport is not None:
+                proto.transport.abortConnection()
+            else:
+                d.cancel()
+        timer = reactor.callLater(self.pipe.health_timeout, timedOut)
+
+        def done(result):
+            if timer.active():
+                timer.cancel()
+            self._probing = False
+            if proto.transport is not None:
+                proto.transport.loseConnection()
+            return result
+        d.addBoth(done)
+        d.addCallbacks(lambda x: self.success(), self.failure)
+        return d
+
+
+    def success(self):
+        """
+        The destination worked.
+        """
+        self.failures = 0
+        self.successes += 1
+        if not self.healthy and self.successes >= self.pipe.health_rise:
+            self.healthy = True
+            log.msg('%s is healthy again' % (self.dst,))
+
+
+    def failure(self, reason):
+        """
+        The destination didn't work.
+
+        @param reason: A C{Failure} saying why, or C{None}.
+        """
+        self.successes = 0
+        self.failures += 1
+        if self.healthy and self.failures >= self.pipe.health_fall:
+            self.healthy = False
+            why = reason.getErrorMessage() if reason is not None else '?'
+            log.msg('%s is unhealthy after %d failures (%s)' % (
+                    self.dst, self.failures, why))
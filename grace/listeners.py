@@ -0,0 +1,154 @@
+"""
+Listening on sockets that somebody else bound: another process, or this one
+before it handed them on.
+"""
+
+from twisted.application import service, internet
+from twisted.internet import defer, tcp, unix
+
+import os
+import socket
+
+
+# getsockopt(SOL_SOCKET, SO_DOMAIN) gives a socket's address family on Linux.
+SO_DOMAIN = getattr(socket, 'SO_DOMAIN', 39)
+
+
+def socketFamily(fd, src=None):
+    """
+    Work out the address family of a socket.
+
+    @param fd: File descriptor of the socket.
+    @param src: The server endpoint string the socket was bound for, used as
+        a hint where the platform can't tell.
+
+    @return: C{socket.AF_UNIX}, C{socket.AF_INET} or C{socket.AF_INET6}.
+    """
+    s = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        return s.getsockopt(socket.SOL_SOCKET, SO_DOMAIN)
+    except socket.error:
+        pass
+    finally:
+        s.close()
+    if src is not None:
+        if src.startswith('unix:'):
+            return socket.AF_UNIX
+        if src.startswith('tcp6:'):
+            return socket.AF_INET6
+    return socket.AF_INET
+
+
+
+class _SharedUNIXPort(unix.Port):
+    """
+    A UNIX port that leaves the socket file alone when it stops listening,
+    because another process is still listening on it.
+    """
+
+    def connectionLost(self, reason):
+        return tcp.Port.connectionLost(self, reason)
+
+
+
+def adoptPort(reactor, fd, family, factory, unlink=True):
+    """
+    Start accepting connections on a socket that's already listening, like
+    C{reactor.adoptStreamPort}.
+
+    @param fd: The listening socket.  It is duplicated, so the caller should
+        still close it.
+    @param unlink: If C{False} and this is a UNIX socket, don't remove the
+        socket file when the port stops listening.
+
+    @return: The listening port.
+    """
+    if family == socket.AF_UNIX and not unlink:
+        port = _SharedUNIXPort._fromListeningDescriptor(reactor, fd, factory)
+        port.startListening()
+        return port
+    return reactor.adoptStreamPort(fd, family, factory)
+
+
+
+def releasePort(port):
+    """
+    Stop accepting connections on a listening port and close this process's
+    copy of its socket, leaving it listening in any other process that has a
+    copy.  Unlike C{stopListening}, this leaves a UNIX socket's file where
+    it is.
+
+    @return: A C{Deferred} that fires once the port is closed.
+    """
+    # Shutting a listening socket down would stop it listening everywhere,
+    # not just here; closing it only closes this process's copy.
+    port._shouldShutdown = False
+    if isinstance(port, unix.Port):
+        if port.lockFile is not None:
+            port.lockFile.unlock()
+            port.lockFile = None
+        port.__class__ = _SharedUNIXPort
+    return defer.maybeDeferred(port.stopListening)
+
+
+
+class PortService(internet.StreamServerEndpointService):
+    """
+    I am a C{strports} service that keeps hold of its listening port, so
+    that the socket can be handed to another process.
+
+    @ivar port: The listening port, once I'm listening.
+    """
+
+    port = None
+
+
+    def privilegedStartService(self):
+        internet.StreamServerEndpointService.privilegedStartService(self)
+        self._waitingForPort.addCallback(self._listening)
+
+
+    def _listening(self, port):
+        self.port = port
+        return port
+
+
+
+class AdoptedPortService(service.Service):
+    """
+    I serve a factory on a listening socket I was given, the way a
+    C{strports} service serves one on a socket it binds itself.
+
+    @ivar factory: The factory connections are handed to.
+    @ivar port: The listening port, once I've started.
+    """
+
+    port = None
+
+
+    def __init__(self, reactor, fd, family, factory, unlink=True):
+        """
+        @param fd: The listening socket.  I close it once I've started
+            listening on it.
+        @param unlink: See L{adoptPort}.
+        """
+        self.reactor = reactor
+        self.fd = fd
+        self.family = family
+        self.factory = factory
+        self.unlink = unlink
+
+
+    def startService(self):
+        service.Service.startService(self)
+        self.port = adoptPort(self.reactor, self.fd, self.family,
+                              self.factory, self.unlink)
+        os.close(self.fd)
+        self.fd = None
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is not None:
+            port, self.port = self.port, None
+            return port.stopListening()
@@ -0,0 +1,353 @@
+"""
+Serving a grace process's pipe and process metrics over HTTP in the
+OpenMetrics text format, for Prometheus and friends to scrape.
+
+Add this to a tac file to serve them:
+
+    from grace.metrics import metricsSite
+    strports.service('tcp:9100', metricsSite(plumber)).setServiceParent(
+        application)
+"""
+
+from twisted.internet import task, defer
+from twisted.web import server, resource
+from twisted.python import log
+
+import os
+import resource as _resource
+
+
+
+CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+
+def escape(value):
+    """
+    Escape a label value.
+    """
+    return (str(value).replace('\\', '\\\\').replace('"', '\\"')
+            .replace('\n', '\\n'))
+
+
+
+def formatValue(value):
+    if isinstance(value, bool):
+        return '1' if value else '0'
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+
+class Families(object):
+    """
+    I collect samples into metric families, and write them out a family at
+    a time as the format requires.
+    """
+
+    def __init__(self):
+        self._order = []
+        self._families = {}
+
+
+    def add(self, name, type, help, labels, value, suffix='', unit=None):
+        """
+        Add a sample.
+
+        @param name: The family name.
+        @param type: C{'gauge'} or C{'counter'}.
+        @param labels: A list of (name, value) pairs.
+        @param suffix: Appended to C{name} to make the sample's name, such
+            as C{'_total'} for counters.
+        """
+        family = self._families.get(name)
+        if family is None:
+            family = self._families[name] = (type, help, unit, [])
+            self._order.append(name)
+        label = ','.join('%s="%s"' % (k, escape(v)) for k, v in labels)
+        if label:
+            label = '{%s}' % (label,)
+        family[3].append('%s%s%s %s\n' % (name, suffix, label,
+                                          formatValue(value)))
+
+
+    def counter(self, name, help, labels, value, unit=None):
+        self.add(name, 'counter', help, labels, value, '_total', unit)
+
+
+    def gauge(self, name, help, labels, value, unit=None):
+        self.add(name, 'gauge', help, labels, value, '', unit)
+
+
+    def lines(self):
+        """
+        Generate the lines of the exposition, without the final C{# EOF}.
+        """
+        for name in self._order:
+            type, help, unit, samples = self._families[name]
+            yield '# TYPE %s %s\n' % (name, type)
+            if unit:
+                yield '# UNIT %s %s\n' % (name, unit)
+            yield '# HELP %s %s\n' % (name, help)
+            for sample in samples:
+                yield sample
+
+
+
+def addCounts(families, scope, labels, counts):
+    """
+    Add the traffic counts of a pipe or destination, as from
+    L{grace.stats.Counters.asDict}.
+
+    @param scope: C{'pipe'} or C{'dst'}.
+    """
+    prefix = 'grace_%s_' % (scope,)
+    families.counter(prefix + 'accepted', 'Connections accepted', labels,
+                     counts['accepted'])
+    families.counter(prefix + 'connect_failures', 'Connections that could '
+                     'not be made to the destination', labels,
+                     counts['connect_failures'])
+    families.counter(prefix + 'connect_retries', 'Connections retried to the '
+                     'destination after failing', labels,
+                     counts['connect_retries'])
+    families.counter(prefix + 'connect_timeouts', 'Connections to the '
+                     'destination that timed out', labels,
+                     counts['connect_timeouts'])
+    families.counter(prefix + 'bytes', 'Bytes relayed in from and out to '
+                     'clients', labels + [('direction', 'in')],
+                     counts['bytes_in'], 'bytes')
+    families.counter(prefix + 'bytes', 'Bytes relayed in from and out to '
+                     'clients', labels + [('direction', 'out')],
+                     counts['bytes_out'], 'bytes')
+    for reason in ['client', 'upstream']:
+        families.counter(prefix + 'closed', 'Connections closed, by reason',
+                         labels + [('reason', reason)],
+                         counts['closed_by_' + reason])
+    families.counter(prefix + 'closed', 'Connections closed, by reason',
+                     labels + [('reason', 'error')], counts['closed_on_error'])
+    families.counter(prefix + 'closed', 'Connections closed, by reason',
+                     labels + [('reason', 'forced')], counts['closed_forced'])
+    families.counter(prefix + 'closed', 'Connections closed, by reason',
+                     labels + [('reason', 'idle')], counts['closed_idle'])
+    families.counter(prefix + 'queued', 'Connections that waited for a '
+                     'connection limit', labels, counts['queued'])
+    families.counter(prefix + 'queue_wait_seconds', 'Time connections '
+                     'spent waiting for a connection limit', labels,
+                     counts['queue_wait'], 'seconds')
+    families.counter(prefix + 'rejected', 'Connections closed because the '
+                     'queue was full', labels, counts['rejected'])
+    families.counter(prefix + 'queue_timeouts', 'Connections closed because '
+                     'they waited too long', labels, counts['queue_timeouts'])
+    for side in ['src', 'dst']:
+        families.counter(prefix + 'pauses', 'Times reading from one side was '
+                         'paused because the other was not keeping up',
+                         labels + [('side', side)], counts['pauses_' + side])
+    if counts.get('waiting') is not None:
+        families.gauge(prefix + 'waiting', 'Connections waiting for a '
+                       'connection limit', labels, counts['waiting'])
+    if counts.get('throttled') is not None:
+        families.counter(prefix + 'throttled_seconds', 'Time spent holding '
+                         'back connections for rate limits', labels,
+                         counts['throttled'], 'seconds')
+    families.gauge(prefix + 'accept_rate', 'Moving average of connections '
+                   'accepted per second', labels, counts['rate'])
+
+
+
+def addDestination(families, src, row, counts):
+    """
+    Add the metrics of one destination of a pipe.
+
+    @param row: The destination's row from
+        L{grace.plumbing.Plumber.listPipes}.
+    @param counts: The destination's traffic counts, or C{None}.
+    """
+    labels = [('src', src), ('dst', row['dst'])]
+    families.gauge('grace_dst_connections', 'Open connections', labels,
+                   row['conns'])
+    families.gauge('grace_dst_active', 'Whether new connections may go to '
+                   'the destination', labels, bool(row['active']))
+    if row.get('weight') is not None:
+        families.gauge('grace_dst_weight', 'Share of new connections during '
+                       'a shift', labels, row['weight'])
+    if row.get('healthy') is not None:
+        families.gauge('grace_dst_healthy', 'Whether health checks pass',
+                       labels, bool(row['healthy']))
+    if row.get('pool_hits') is not None:
+        families.counter('grace_dst_pool_hits', 'New connections given a '
+                         'ready upstream connection', labels, row['pool_hits'])
+        families.counter('grace_dst_pool_misses', 'New connections that had '
+                         'to wait for an upstream connection', labels,
+                         row['pool_misses'])
+    if counts is not None:
+        addCounts(families, 'dst', labels, counts)
+
+
+
+def processStats():
+    """
+    Get stats about this process.
+
+    @return: A dictionary with C{'cpu_seconds'} and, where the platform can
+        tell, C{'resident_memory_bytes'}, C{'open_fds'} and
+        C{'start_time_seconds'}.
+    """
+    usage = _resource.getrusage(_resource.RUSAGE_SELF)
+    r = {'cpu_seconds': usage.ru_utime + usage.ru_stime}
+    try:
+        with open('/proc/self/statm') as f:
+            pages = int(f.read().split()[1])
+        r['resident_memory_bytes'] = pages * _resource.getpagesize()
+    except (IOError, OSError, ValueError, IndexError):
+        pass
+    try:
+        r['open_fds'] = len(os.listdir('/proc/self/fd'))
+    except OSError:
+        pass
+    try:
+        with open('/proc/self/stat') as f:
+            # The command name can contain spaces; skip past it.
+            fields = f.read().rsplit(')', 1)[1].split()
+        with open('/proc/stat') as f:
+            btime = [int(l.split()[1]) for l in f if l.startswith('btime')][0]
+        ticks = os.sysconf(os.sysconf_names['SC_CLK_TCK'])
+        r['start_time_seconds'] = btime + float(fields[19]) / ticks
+    except (IOError, OSError, ValueError, IndexError, KeyError):
+        pass
+    return r
+
+
+
+def addProcess(families):
+    stats = processStats()
+    families.counter('process_cpu_seconds', 'User and system CPU time', [],
+                     stats['cpu_seconds'], 'seconds')
+    if 'resident_memory_bytes' in stats:
+        families.gauge('process_resident_memory_bytes', 'Resident memory',
+                       [], stats['resident_memory_bytes'], 'bytes')
+    if 'open_fds' in stats:
+        families.gauge('process_open_fds', 'Open file descriptors', [],
+                       stats['open_fds'])
+    if 'start_time_seconds' in stats:
+        families.gauge('process_start_time_seconds', 'When the process '
+                       'started, in seconds since the epoch', [],
+                       stats['start_time_seconds'], 'seconds')
+
+
+
+class MetricsResource(resource.Resource):
+    """
+    I render a L{Plumber}'s metrics.
+
+    Rendering is done in small pieces with a L{task.Cooperator}, one pipe at
+    a time and then C{chunkLines} lines at a time, so that a process with
+    thousands of pipes keeps relaying while it's scraped.
+    """
+
+    isLeaf = True
+    chunkLines = 500
+
+
+    def __init__(self, plumber, cooperator=None):
+        resource.Resource.__init__(self)
+        self.plumber = plumber
+        self.cooperator = cooperator or task
+
+
+    def render_GET(self, request):
+        request.setHeader('content-type', CONTENT_TYPE)
+        work = self.cooperator.cooperate(self.generate(request))
+        def finished(ignored):
+            request.finish()
+        def failed(reason):
+            if not reason.check(task.TaskStopped):
+                log.err(reason, 'Rendering metrics')
+                request.finish()
+        work.whenDone().addCallbacks(finished, failed)
+        request.notifyFinish().addErrback(lambda x: work.stop())
+        return server.NOT_DONE_YET
+
+
+    def generate(self, request):
+        """
+        Write the metrics to C{request}, yielding between pieces of work.
+        """
+        families = Families()
+        addProcess(families)
+        if self.plumber.workers is not None:
+            for x in self.gatherWorkers(families):
+                yield x
+        else:
+            for x in self.gather(families):
+                yield x
+        chunk = []
+        for line in families.lines():
+            chunk.append(line)
+            if len(chunk) >= self.chunkLines:
+                request.write(''.join(chunk))
+                chunk = []
+                yield
+        chunk.append('# EOF\n')
+        request.write(''.join(chunk))
+
+
+    def gather(self, families):
+        """
+        Collect the metrics of each of my plumber's pipes in turn.
+        """
+        plumber = self.plumber
+        for src in list(plumber.pipe_services.names):
+            try:
+                pipe = plumber.getPipe(src)
+            except KeyError:
+                # Removed since we started.
+                continue
+            total, dsts = pipe.stats()
+            counts = dict((x['dst'], x) for x in dsts)
+            conns = 0
+            for dst, n, active in pipe.ls():
+                conns += n
+                row = {'dst': dst, 'conns': n, 'active': active}
+                row.update(pipe.info(dst))
+                addDestination(families, src, row, counts.get(dst))
+            families.gauge('grace_pipe_connections', 'Open connections',
+                           [('src', src)], conns)
+            addCounts(families, 'pipe', [('src', src)], total)
+            yield
+
+
+    def gatherWorkers(self, families):
+        """
+        Collect the metrics of my plumber's pipes from its worker processes.
+        """
+        rows = []
+        stats = []
+        d = defer.maybeDeferred(self.plumber.listPipes)
+        d.addCallback(rows.extend)
+        yield d
+        d = defer.maybeDeferred(self.plumber.stats)
+        d.addCallback(stats.append)
+        yield d
+        pipes, dsts = stats[0]
+        counts = dict(((x['src'], x['dst']), x) for x in dsts)
+        conns = {}
+        for row in rows:
+            src = row['src']
+            conns[src] = conns.get(src, 0) + row['conns']
+            addDestination(families, src, row, counts.get((src, row['dst'])))
+        for total in pipes:
+            src = total['src']
+            families.gauge('grace_pipe_connections', 'Open connections',
+                           [('src', src)], conns.get(src, 0))
+            addCounts(families, 'pipe', [('src', src)], total)
+
+
+
+def metricsSite(plumber):
+    """
+    Make a web site serving a L{Plumber}'s metrics at every path (including
+    the conventional C{/metrics}).
+    """
+    site = server.Site(MetricsResource(plumber))
+    site.noisy = False
+    return site
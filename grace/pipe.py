@@ -1,106 +1,1632 @@
-from twisted.internet import protocol, endpoints, defer
-from twisted.python import log
-from twisted.protocols import portforward
+from twisted.internet import protocol, endpoints, defer, abstract, error
+from twisted.internet import interfaces
+from twisted.python import log, failure
+from zope.interface import implementer
 
+from grace.splice import spliceAvailable, canSplice, getRelay
+from grace import aio
+from grace.pool import UpstreamPool
+from grace.balance import getStrategy, WeightedRoundRobin
+from grace.shift import Shift
+from grace.health import HealthCheck
+from grace.stats import Counters, Rate
+from grace.timers import TimerWheel, ShortTimer
+from grace.sockopts import tuneConnection
+from grace.shaping import TokenBucket, checkRate
 
+import collections
+import random
 
-class ProxyServer(portforward.ProxyServer):
+
+# What can relay the bytes of a Pipe's connections.  See Pipe.__init__.
+engines = ('twisted', 'asyncio')
+
+
+
+def _fileDescriptor(transport):
+    """
+    Find the socket transport underneath any protocol wrappers (such as TLS).
+
+    @return: An L{abstract.FileDescriptor} or C{None}.
+    """
+    while not isinstance(transport, abstract.FileDescriptor):
+        transport = getattr(transport, 'transport', None)
+        if transport is None:
+            return None
+    return transport
+
+
+
+def bufferedBytes(transport):
+    """
+    @return: The number of bytes written to C{transport} that haven't been
+        sent yet, or C{None} if that can't be determined.
+    """
+    fd = _fileDescriptor(transport)
+    if fd is None:
+        return None
+    return len(fd.dataBuffer) - fd.offset + fd._tempDataLen
+
+
+
+def _backedUp(transport):
+    """
+    @return: Whether C{transport} has paused its producer because too much is
+        waiting to be written to it.
+    """
+    fd = _fileDescriptor(transport)
+    return fd is not None and fd.producerPaused
+
+
+
+class Valve(object):
+    """
+    I pause the C{source} side of a relayed connection while too much of the
+    data read from it is waiting to be written to the C{sink} side.
+
+    I am registered as the sink's streaming producer, and the sink's
+    C{bufferSize} is set to the L{Pipe}'s C{high_water}, so the sink pauses
+    me once more than that is buffered.  Transports only ask their producer
+    to resume once their buffer is empty; if the L{Pipe} has a non-zero
+    C{low_water}, I check the buffer every C{lowWaterInterval} seconds while
+    paused and resume as soon as it has drained that far.
+
+    @ivar side: C{'src'} if I pause reading from the connecting client,
+        C{'dst'} if I pause reading from the upstream server.
+    @ivar stats: The L{grace.stats.Counters} of the connection's
+        destination, whose C{pauses_src} or C{pauses_dst} (according to
+        C{side}) I count my pauses in, if any.
+    @ivar proxy: The L{Proxy} whose transport C{source} is, if any.  I
+        don't resume it while the L{Pipe}'s rate limits are holding it back;
+        they resume it themselves when they're done.
+    @ivar _paused: C{True} while I'm paused.  Transports pause their
+        producer on every write while their buffer is full, so only the
+        first pause after a resume counts.
+    """
+
+    __slots__ = ('pipe', 'source', 'sink', 'side', 'stats', 'proxy',
+                 '_check', '_paused')
+
+    lowWaterInterval = 0.01
+
+
+    def __init__(self, pipe, source, sink, side, stats=None, proxy=None):
+        self.pipe = pipe
+        self.source = source
+        self.sink = sink
+        self.side = side
+        self.stats = stats
+        self.proxy = proxy
+        self._check = None
+        self._paused = False
+        fd = _fileDescriptor(sink)
+        if fd is not None and pipe.high_water is not None:
+            fd.bufferSize = pipe.high_water
+
+
+    def pauseProducing(self):
+        if self._paused:
+            return
+        self._paused = True
+        if self.stats is not None:
+            if self.side == 'src':
+                self.stats.pauses_src += 1
+            else:
+                self.stats.pauses_dst += 1
+        self.source.pauseProducing()
+        if self.pipe.low_water:
+            self._check = self.pipe._reactor.callLater(self.lowWaterInterval,
+                                                       self._checkLowWater)
+
+
+    def resumeProducing(self):
+        self._paused = False
+        self._cancelCheck()
+        if self.proxy is not None and self.proxy._held is not None:
+            return
+        self.source.resumeProducing()
+
+
+    def stopProducing(self):
+        self._paused = False
+        self._cancelCheck()
+        self.source.stopProducing()
+
+
+    def _cancelCheck(self):
+        if self._check is not None and self._check.active():
+            self._check.cancel()
+        self._check = None
+
+
+    def _checkLowWater(self):
+        self._check = None
+        buffered = bufferedBytes(self.sink)
+        if buffered is not None and buffered <= self.pipe.low_water:
+            # The sink still thinks I'm paused; let it pause me again next
+            # time it fills up.
+            _fileDescriptor(self.sink).producerPaused = False
+            self.resumeProducing()
+        else:
+            self._check = self.pipe._reactor.callLater(self.lowWaterInterval,
+                                                       self._checkLowWater)
+
+
+
+@implementer(interfaces.IProtocol, interfaces.ILoggingContext)
+class Proxy(object):
+    """
+    I am one half of a relayed connection, passing what I receive to my
+    C{peer}'s transport, like C{twisted.protocols.portforward.Proxy}.
+
+    A pipe may hold hundreds of thousands of us, so we have C{__slots__}
+    rather than instance dictionaries (which C{Protocol}, being an old-style
+    class, can't do without), and no per-connection factories.
+
+    @ivar _held: While my L{Pipe}'s rate limits are holding back what I
+        read, the timed call that lets it go again.  See L{Pipe.shape}.
+    @ivar _pending: A L{_Batch} of what my L{Pipe} is gathering to write to
+        my transport, if anything.  See L{Pipe.coalesce}.
+    """
+
+    __slots__ = ('factory', 'transport', 'connected', 'peer', '_held',
+                 '_pending')
+
+    noisy = False
+
+
+    def __init__(self):
+        self.factory = None
+        self.transport = None
+        self.connected = 0
+        self.peer = None
+        self._held = None
+        self._pending = None
+
+
+    def logPrefix(self):
+        return self.__class__.__name__
+
+
+    def makeConnection(self, transport):
+        self.connected = 1
+        self.transport = transport
+        self.connectionMade()
+
+
+    def connectionMade(self):
+        pass
+
+
+    def setPeer(self, peer):
+        self.peer = peer
+
+
+    def dataReceived(self, data):
+        self.peer.transport.write(data)
+
+
+    def flush(self):
+        """
+        Write what my L{Pipe} has gathered for my transport, in one go.
+        """
+        batch = self._pending
+        if batch is None:
+            return
+        self._pending = None
+        self.transport.writeSequence(batch.chunks)
+
+
+    def connectionLost(self, reason):
+        self.connected = 0
+        self._pending = None
+        if self.peer is not None:
+            self.peer.flush()
+            self.peer.transport.loseConnection()
+            self.peer = None
+
+
+
+class _Batch(object):
+    """
+    Small writes being gathered for a L{Proxy}'s transport.
+
+    @ivar size: How many bytes there are.
+    """
+
+    __slots__ = ('chunks', 'size')
+
+
+    def __init__(self):
+        self.chunks = []
+        self.size = 0
+
+
+
+class ProxyClient(Proxy):
+    """
+    I am the upstream half of a relayed connection.  I'm connected without
+    a peer, and given one with L{attach}; anything the server sends before
+    then is kept until it can be relayed.
+
+    If my L{Pipe} has C{splice} turned on and both sockets are plain TCP or
+    UNIX sockets, I hand them to a L{grace.splice.SpliceRelay} instead of
+    relaying data through Python.  Likewise, if its C{engine} is
+    C{'asyncio'} I hand them to a L{grace.aio.AsyncioRelay}.
+
+    @ivar pool: The L{grace.pool.UpstreamPool} I'm waiting in, if I was
+        connected ahead of time and haven't been given a client yet.
+    """
+
+    __slots__ = ('pool', '_spliced', '_early')
+
+
+    def __init__(self):
+        Proxy.__init__(self)
+        self.pool = None
+        self._spliced = None
+        self._early = None
+
+
+    def attach(self, server):
+        """
+        Start relaying for C{server}.
+        """
+        self.setPeer(server)
+        self.relay()
+
+
+    def relay(self):
+        """
+        Start moving data between my transport and my peer's.
+        """
+        server = self.peer
+        pipe = server.factory
+        pipe.tune(self.transport)
+        offload = (not pipe.shaping and not self._early
+                   and canSplice(self.transport)
+                   and canSplice(server.transport))
+        if offload and (pipe.splice or pipe.engine == 'asyncio'):
+            server.setPeer(self)
+            self.transport.stopReading()
+            server.transport.stopReading()
+            if pipe.splice:
+                self._spliced = getRelay(pipe._reactor).add(
+                    server.transport.fileno(), self.transport.fileno(),
+                    self._spliceDone)
+            else:
+                self._spliced = aio.getRelay(pipe._reactor).add(
+                    server.transport.getHandle(),
+                    self.transport.getHandle(), self._spliceDone)
+        else:
+            server.setPeer(self)
+            self.transport.registerProducer(
+                Valve(pipe, server.transport, self.transport, 'src',
+                      server._stats, server),
+                True)
+            server.transport.registerProducer(
+                Valve(pipe, self.transport, server.transport, 'dst',
+                      server._stats, self),
+                True)
+            if self._early:
+                server._stats.bytes_out += sum(map(len, self._early))
+                server.transport.writeSequence(self._early)
+                self._early = None
+            server.transport.resumeProducing()
+        server.startIdleTimer()
+
+
+    def dataReceived(self, data):
+        if self.peer is None:
+            # Connected ahead of time and the server spoke first.
+            if self._early is None:
+                self._early = []
+            self._early.append(data)
+        else:
+            peer = self.peer
+            pipe = peer.factory
+            peer._stats.bytes_out += len(data)
+            peer.lastActive = pipe._reactor.seconds()
+            if pipe.coalesce_delay:
+                pipe.coalesce(peer, data)
+            else:
+                peer.transport.write(data)
+            if pipe.shaping:
+                pipe.shape(peer, self, len(data))
+
+
+    def connectionLost(self, reason):
+        if self.pool is not None:
+            self.pool.lost(self)
+            self.pool = None
+            return
+        if self.peer is not None:
+            self.peer.countClose(reason, 'closed_by_upstream')
+            if self._held is not None:
+                self.peer.factory.unhold(self)
+        _unplug(self)
+        return Proxy.connectionLost(self, reason)
+
+
+    def _spliceDone(self):
+        """
+        Called once the splice (or asyncio) relay has let go of both
+        sockets.
+        """
+        if self.peer is not None:
+            up, down = self._spliced.directions
+            stats = self.peer._stats
+            stats.bytes_in += up.moved
+            stats.bytes_out += down.moved
+            # Whichever side hit end of file first closed the connection.
+            done = failure.Failure(error.ConnectionDone())
+            first = self._spliced.first
+            if first is up:
+                self.peer.countClose(done, 'closed_by_client')
+            elif first is down:
+                self.peer.countClose(done, 'closed_by_upstream')
+        self._spliced = None
+        self.transport.loseConnection()
+        if self.peer is not None:
+            self.peer.transport.loseConnection()
+
+
+
+def _unplug(proxy):
+    """
+    Stop the peer of a disconnected proxy from producing into it, so the peer
+    can close as soon as it has flushed what it has.
+    """
+    if proxy.peer is not None and proxy.peer.transport is not None:
+        proxy.peer.transport.unregisterProducer()
+
+
+
+class ProxyClientFactory(protocol.ClientFactory):
+    """
+    I build the L{ProxyClient}s for all of a L{Pipe}'s upstream connections.
+    """
+
+    noisy = False
+
+
+    def __init__(self, protocol):
+        self.protocol = protocol
+
+
+    def buildProtocol(self, addr):
+        return self.protocol()
+
+
+
+class ProxyServer(Proxy):
+    """
+    I am the client-facing half of a relayed connection.
+
+    If connecting upstream fails, I try again up to the L{Pipe}'s
+    C{connect_retries} times, failing over to another destination if there
+    is one, while the client waits.
+
+    @ivar _stats: The L{grace.stats.Counters} for my destination.
+    @ivar _attempts: How many times I've retried connecting upstream.
+    @ivar _waitingSince: When I started waiting in my L{Pipe}'s queue, if
+        I'm waiting there.  See L{Pipe.admit}.
+    @ivar _bucket: The L{grace.shaping.TokenBucket} for my L{Pipe}'s
+        C{conn_rate_limit}, if it has one.
+    @ivar lastActive: When I last relayed anything, in either direction.
+    """
+
+    __slots__ = ('lastActive', '_dst', '_stats', '_idleTimer',
+                 '_splicedMoved', '_closeCounted', '_lost', '_attempts',
+                 '_connecting', '_retry', '_waitingSince', '_bucket')
+
+
+    def __init__(self):
+        Proxy.__init__(self)
+        self.lastActive = 0
+        self._dst = None
+        self._stats = None
+        self._idleTimer = None
+        self._splicedMoved = 0
+        self._closeCounted = False
+        self._lost = False
+        self._attempts = 0
+        self._connecting = None
+        self._retry = None
+        self._waitingSince = None
+        self._bucket = None
 
 
     def connectionMade(self):
         # Don't read anything from the connecting client until we have
         # somewhere to send it to.
-        self._dst = dst = self.factory.dst
-        self.factory.addConnection(dst, self)
         self.transport.pauseProducing()
+        self.factory.tune(self.transport)
+        self.factory.admit(self)
+
+
+    def start(self, dst):
+        """
+        Start connecting upstream to C{dst}, having been admitted by my
+        L{Pipe}.
+        """
+        pipe = self.factory
+        self._dst = dst
+        self.lastActive = pipe._reactor.seconds()
+        pipe.addConnection(dst, self)
+        self._stats = pipe.accepted(dst)
+        self._bucket = pipe.connectionBucket()
+
+        client = pipe.takePooled(dst)
+        if client is not None:
+            client.attach(self)
+            return
+        self._connect()
+
 
-        client = self.clientProtocolFactory()
-        client.setServer(self)
+    def reject(self):
+        """
+        Close this connection without relaying anything, because my L{Pipe}
+        had no room for it.
+        """
+        self._closeCounted = True
+        self.transport.loseConnection()
+
+
+    def _connect(self):
+        pipe = self.factory
+        d = self._connecting = pipe.connect(self._dst, pipe.clientFactory)
+        d.addCallbacks(self._upstreamConnected, self._upstreamFailed)
+
+
+    def _upstreamConnected(self, client):
+        self._connecting = None
+        self.factory.connectSucceeded(self._dst)
+        client.attach(self)
+
+
+    def _upstreamFailed(self, reason):
+        self._connecting = None
+        if self._lost:
+            return
+        self.factory.connectFailed(self._dst, reason)
+        if self._attempts < self.factory.connect_retries:
+            self._attempts += 1
+            delay = self.factory.retryDelay(self._attempts)
+            log.msg('Unable to connect to %r: %s; retrying in %.3fs' % (
+                    self._dst, reason.getErrorMessage(), delay))
+            self._retry = self.factory._reactor.callLater(delay,
+                                                          self._retryConnect)
+            return
+        log.msg('Unable to connect to %r: %s' % (self._dst,
+                                                 reason.getErrorMessage()))
+        self._closeCounted = True
+        self.transport.loseConnection()
+
+
+    def _retryConnect(self):
+        """
+        Try connecting again, to another destination if there's one to try.
+        The client stays paused meanwhile.
+        """
+        self._retry = None
+        pipe = self.factory
+        dst = pipe.retryDst(self._dst, self.transport.getPeer())
+        if dst != self._dst:
+            pipe.addConnection(dst, self)
+            pipe.removeConnection(self._dst, self)
+            self._dst = dst
+        self._stats = pipe.retrying(dst)
+        self._connect()
 
-        from twisted.internet import reactor
-        endpoint = endpoints.clientFromString(reactor, dst)
-        endpoint.connect(client)
+
+    def dataReceived(self, data):
+        pipe = self.factory
+        self._stats.bytes_in += len(data)
+        self.lastActive = pipe._reactor.seconds()
+        if pipe.coalesce_delay:
+            pipe.coalesce(self.peer, data)
+        else:
+            self.peer.transport.write(data)
+        if pipe.shaping:
+            pipe.shape(self, self, len(data))
+
+
+    def isIdle(self, now):
+        """
+        Whether I've relayed nothing for the last L{Pipe.idleAfter}
+        seconds.  A spliced connection's traffic isn't seen, so it never
+        counts as idle.
+        """
+        if self.peer is not None and self.peer._spliced is not None:
+            return False
+        return now - self.lastActive >= self.factory.idleAfter
+
+
+    def startIdleTimer(self):
+        """
+        Start timing how long I've relayed nothing for, if my L{Pipe} has
+        an C{idle_timeout}.  Called once relaying starts.
+        """
+        pipe = self.factory
+        if not pipe.idle_timeout:
+            return
+        self.lastActive = pipe._reactor.seconds()
+        self._idleTimer = pipe._timers.add(self.lastActive + pipe.idle_timeout,
+                                           self._checkIdle)
+
+
+    def _checkIdle(self):
+        """
+        Close this connection if it has been idle for the L{Pipe}'s
+        C{idle_timeout}, and otherwise check again when it might have been.
+
+        Relaying doesn't touch the timer; it only updates L{lastActive},
+        which is looked at here.  A spliced connection's traffic isn't seen
+        as it happens, so it counts as active whenever more bytes have moved
+        than last time, and may be idle up to twice C{idle_timeout} before
+        it's closed.
+        """
+        self._idleTimer = None
+        pipe = self.factory
+        now = pipe._reactor.seconds()
+        spliced = self.peer is not None and self.peer._spliced
+        if spliced:
+            moved = sum(d.moved for d in spliced.directions)
+            if moved != self._splicedMoved:
+                self._splicedMoved = moved
+                self.lastActive = now
+        deadline = self.lastActive + pipe.idle_timeout
+        if deadline > now:
+            self._idleTimer = pipe._timers.add(deadline, self._checkIdle)
+            return
+        self._closeCounted = True
+        self._stats.closed_idle += 1
+        self._abort()
+
+
+    def forceClose(self):
+        """
+        Close both sides of this connection straight away, discarding
+        anything not yet relayed.
+        """
+        self._closeCounted = True
+        self._stats.closed_forced += 1
+        self._abort()
+
+
+    def _abort(self):
+        peer = self.peer
+        if peer is not None and peer._spliced is not None:
+            # The splice relay closes both sides once it lets go of them.
+            peer._spliced.stop()
+            return
+        self.transport.abortConnection()
+        if peer is not None:
+            peer.transport.abortConnection()
+
+
+    def countClose(self, reason, clean):
+        """
+        Count why this connection closed, if it hasn't been counted yet.
+
+        @param reason: The C{Failure} the first side to close was given.
+        @param clean: The counter to add to if it closed cleanly.
+        """
+        if self._closeCounted:
+            return
+        self._closeCounted = True
+        if reason.check(error.ConnectionDone):
+            setattr(self._stats, clean, getattr(self._stats, clean) + 1)
+        else:
+            self._stats.closed_on_error += 1
 
 
     def connectionLost(self, reason):
-        self.factory.removeConnection(self._dst, self)
-        return portforward.ProxyServer.connectionLost(self, reason)
+        self._lost = True
+        if self._idleTimer is not None:
+            self.factory._timers.remove(self._idleTimer, self._checkIdle)
+            self._idleTimer = None
+        if self._retry is not None:
+            self._retry.cancel()
+            self._retry = None
+        if self._connecting is not None:
+            self._connecting.cancel()
+        if self._held is not None:
+            self.factory.unhold(self)
+        self.countClose(reason, 'closed_by_client')
+        if self._dst is not None:
+            self.factory.removeConnection(self._dst, self)
+        elif self._waitingSince is not None:
+            self.factory.unqueue(self)
+        _unplug(self)
+        return Proxy.connectionLost(self, reason)
 
 
 
 class Pipe(protocol.Factory):
     """
     I forward connections from wherever I'm listening to a
-    particular endpoint.  The endpoint I forward to can be changed
-    at runtime with L{switch}.
+    particular endpoint, or spread them over several.  The endpoints I
+    forward to can be changed at runtime with L{switch}.
     
+    @ivar dsts: The list of endpoints new connections are forwarded to.
+    @ivar dst: The first of L{dsts}.
+    @ivar balancer: The strategy from L{grace.balance} that picks which of
+        L{dsts} a new connection goes to.
+    @ivar weights: C{None}, or a dictionary of the share of new connections
+        each of L{dsts} should get, which overrides L{balancer}.
+    @ivar shifting: The L{grace.shift.Shift} in progress, if any.
+    @ivar health: A dictionary of L{grace.health.HealthCheck}s for each of
+        L{dsts}, if C{health_interval} was given.
+
+    @ivar counters: A dictionary of L{grace.stats.Counters} for each
+        endpoint in L{alive}.  See L{stats}.
+    @ivar rate: A L{grace.stats.Rate} of accepted connections.
+
     @ivar alive: A dictionary whose keys are endpoints to which I
         have at least one connection going and whose values are
         C{Deferred}s that fire when the connections have finished.
+
+    @ivar splice: If C{True}, relay plain TCP and UNIX connections with
+        C{splice(2)} instead of through Python.
+    @ivar engine: What relays the bytes of plain TCP and UNIX connections:
+        C{'twisted'} (the reactor) or C{'asyncio'} (an asyncio event loop;
+        see L{grace.aio}).
+
+    @ivar pool_size: Number of upstream connections to keep ready for the
+        active destination.  See L{grace.pool.UpstreamPool}.
+
+    @ivar maxRetryDelay: The longest to wait before retrying a connection,
+        however many times it has failed.
+
+    @ivar idleAfter: How many seconds a connection must have relayed
+        nothing for to count as idle when L{drain} closes idle connections
+        first.
+
+    @ivar keepaliveInterval: Seconds between TCP keepalive probes, once
+        C{keepalive} seconds have passed without a reply.
+    @ivar keepaliveProbes: Unanswered keepalive probes after which the
+        kernel drops a connection.
+    @ivar timerTick: Granularity of C{idle_timeout}, in seconds.  See
+        L{grace.timers.TimerWheel}.
+
+    @ivar waiting: The number of connections waiting to be admitted.  See
+        L{admit}.
+
+    @ivar shaping: Whether I have any rate limits.  See L{shape}.
+    @ivar throttled: The number of connection sides my rate limits are
+        holding back now.
+    @ivar rateBurst: How many seconds' worth of a rate limit may be relayed
+        in one go after a quiet spell.
+
+    @ivar clientProtocol: The protocol for the upstream half of each
+        connection.
+    @ivar clientFactory: The L{ProxyClientFactory} shared by all my upstream
+        connections.
     """
     
     protocol = ProxyServer
+    clientProtocol = ProxyClient
+    maxRetryDelay = 5.0
+    idleAfter = 1.0
+    keepaliveInterval = 10
+    keepaliveProbes = 3
+    timerTick = 1.0
+    rateBurst = 0.1
     
     
-    def __init__(self, dst):
+    def __init__(self, dst, splice=False, high_water=None, low_water=0,
+                 pool_size=0, pool_idle=60, balance='round-robin',
+                 health_interval=0, health_timeout=2, health_send=None,
+                 health_expect=None, health_rise=2, health_fall=3,
+                 connect_timeout=None, connect_retries=0, retry_backoff=0.1,
+                 idle_timeout=None, keepalive=None, user_timeout=None,
+                 max_conns=None, max_dst_conns=None, queue_size=100,
+                 queue_timeout=10, rate_limit=None, dst_rate_limit=None,
+                 conn_rate_limit=None, engine='twisted', coalesce_delay=None,
+                 coalesce_size=16384, _reactor=None):
         """
         @param dst: The endpoint a client would use to connect to
             the server I will forward to.  For instance:
-            C{tcp:host=127.0.0.1:port=2930}.
+            C{tcp:host=127.0.0.1:port=2930}.  Or a list of them to spread
+            connections over.
+
+        @param splice: Relay with C{splice(2)} where possible.  Ignored
+            (with a log message) on platforms that don't have it.
+
+        @param high_water: Stop reading from one side of a connection when
+            more than this many bytes are waiting to be written to the other
+            side.  Defaults to the transport's C{bufferSize}.
+
+        @param low_water: Start reading again when the bytes waiting to be
+            written have drained to this many.  See L{Valve}.
+
+        @param pool_size: Keep this many upstream connections open and ready
+            for new clients while I'm listening.
+
+        @param pool_idle: Close the ready connections if none have been
+            used for this many seconds.
+
+        @param balance: The name of a strategy in
+            L{grace.balance.strategies} for choosing between destinations.
+
+        @param health_interval: If not C{0}, probe each destination this
+            often and stop sending new connections to those that fail.  See
+            L{grace.health.HealthCheck}.
+
+        @param health_timeout: Seconds to wait for a probe to pass.
+
+        @param health_send: Bytes for a probe to send once connected.
+
+        @param health_expect: Bytes a probe must receive to pass.  If not
+            given, connecting is enough.
+
+        @param health_rise: Number of successes in a row that make an
+            unhealthy destination healthy.
+
+        @param health_fall: Number of failures in a row (of probes or of
+            real connections) that make a destination unhealthy.
+
+        @param connect_timeout: Give up on connecting to a destination after
+            this many seconds.  If not given, the endpoint's own timeout
+            applies.
+
+        @param connect_retries: How many more times to try connecting a
+            client upstream after the first attempt fails.
+
+        @param retry_backoff: Seconds to wait before the first retry.  The
+            wait doubles with each retry after that, up to
+            L{maxRetryDelay}, and is jittered so clients don't all retry at
+            once.  See L{retryDelay}.
+
+        @param idle_timeout: Close a connection once nothing has been
+            relayed either way for this many seconds (give or take
+            L{timerTick}).
+
+        @param keepalive: Turn on TCP keepalives for both sides of each TCP
+            connection, probing after this many seconds of silence, so that
+            the kernel notices peers that have gone away.
+
+        @param user_timeout: Have the kernel drop a TCP connection when data
+            sent on it has gone unacknowledged for this many seconds (Linux's
+            C{TCP_USER_TIMEOUT}).
+
+        @param max_conns: Don't relay more than this many connections at
+            once.  See L{admit}.
+
+        @param max_dst_conns: Don't relay more than this many connections
+            to any one destination at once.
+
+        @param queue_size: How many connections may wait for their turn
+            when C{max_conns} or C{max_dst_conns} has been reached.  Any
+            more are closed straight away.
+
+        @param queue_timeout: Close a connection that has waited this many
+            seconds without its turn coming.
+
+        @param rate_limit: Relay at most this many bytes a second, counting
+            both directions, over all my connections.  See L{shape}.
+
+        @param dst_rate_limit: Relay at most this many bytes a second to and
+            from each destination.
+
+        @param conn_rate_limit: Relay at most this many bytes a second on
+            each connection.
+
+        @param engine: C{'twisted'} to relay bytes in the reactor, or
+            C{'asyncio'} to relay plain TCP and UNIX connections on an
+            asyncio event loop.  Accepting, connecting, draining and the rest
+            stay in the reactor either way.  Falls back (with a log message)
+            to C{'twisted'} if asyncio isn't available; connections are
+            relayed in the reactor while there are rate limits.
+
+        @param coalesce_delay: Gather up what's read from one side of a
+            connection for up to this many seconds before writing it to the
+            other side, so that many small chunks cost one C{send} instead
+            of one each.  See L{coalesce}.
+
+        @param coalesce_size: Write what's been gathered as soon as there's
+            this many bytes of it.
         """
+        if high_water is not None and low_water > high_water:
+            raise ValueError('low_water (%r) must not be more than '
+                             'high_water (%r)' % (low_water, high_water))
+        if _reactor is None:
+            from twisted.internet import reactor as _reactor
+        self._reactor = _reactor
+        if engine not in engines:
+            raise ValueError('Unknown engine %r (choose from %s)' % (
+                             engine, ', '.join(engines)))
+        if engine == 'asyncio' and splice:
+            raise ValueError("splice and the asyncio engine can't be used "
+                             "together")
+        if splice and not spliceAvailable():
+            log.msg('splice(2) is not available; relaying normally')
+            splice = False
+        self.splice = splice
+        if engine == 'asyncio' and not aio.asyncioAvailable():
+            log.msg('asyncio is not available; relaying with Twisted')
+            engine = 'twisted'
+        self.engine = engine
+        self.high_water = high_water
+        self.low_water = low_water
+        self.pool_size = pool_size
+        self.pool_idle = pool_idle
+        self.balancer = getStrategy(balance)
+        self.weights = None
+        self.shifting = None
+        self.health_interval = health_interval
+        self.health_timeout = health_timeout
+        self.health_send = health_send
+        self.health_expect = health_expect
+        self.health_rise = health_rise
+        self.health_fall = health_fall
+        self.connect_timeout = connect_timeout
+        self.connect_retries = connect_retries
+        self.retry_backoff = retry_backoff
+        self.idle_timeout = idle_timeout
+        self.keepalive = keepalive
+        self.user_timeout = user_timeout
+        self.max_conns = max_conns
+        self.max_dst_conns = max_dst_conns
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.coalesce_delay = coalesce_delay
+        self.coalesce_size = coalesce_size
+        self._unflushed = []
+        self._flushTimer = ShortTimer(_reactor, self._flush)
+        self.rate_limit = None
+        self.dst_rate_limit = None
+        self.conn_rate_limit = None
+        self.shaping = False
+        self.throttled = 0
+        self._bucket = None
+        self._dstBuckets = {}
+        self._throttledSince = None
+        self._throttledTime = 0.0
+        self.waiting = 0
+        self._queue = collections.deque()
+        self._queueCall = None
+        self._active = 0
+        self._timers = TimerWheel(_reactor, self.timerTick)
+        self.clientFactory = ProxyClientFactory(self.clientProtocol)
+        self.health = {}
+        self.counters = {}
+        self.rate = Rate(_reactor)
+        self._retired = Counters(_reactor)
+        self._unrouted = Counters(_reactor)
+        self._weighted = WeightedRoundRobin()
         self.alive = {}
         self._connections = {}
+        self._open = {}
+        self._endpoints = {}
+        self._pools = {}
+        self._listening = False
         self._setDst(dst)
         self._waiters = []
+        self.limit(rate_limit, dst_rate_limit, conn_rate_limit)
+
+
+    def getEndpoint(self, dst):
+        """
+        Get a client endpoint for connecting to C{dst}.
+        
+        Endpoints are parsed once and cached for as long as C{dst} is
+        active or still has connections, so that accepting a connection
+        doesn't mean re-parsing the endpoint string (and, for C{ssl:}
+        endpoints, rebuilding the TLS context).
+        
+        @param dst: A client endpoint string.
+        
+        @return: An object providing C{IStreamClientEndpoint}.
+        """
+        endpoint = self._endpoints.get(dst)
+        if endpoint is None:
+            endpoint = endpoints.clientFromString(self._reactor, dst)
+            self._endpoints[dst] = endpoint
+        return endpoint
+
+
+    def connect(self, dst, factory):
+        """
+        Connect to C{dst}, giving up after C{connect_timeout} seconds.
+
+        @param factory: The protocol factory to connect with.
+
+        @return: A C{Deferred} firing with the connected protocol, or
+            failing with L{error.TimeoutError} if it took too long.
+        """
+        d = defer.maybeDeferred(lambda: self.getEndpoint(dst).connect(factory))
+        if self.connect_timeout is None:
+            return d
+        timedOut = []
+        def timeout():
+            timedOut.append(True)
+            d.cancel()
+        call = self._reactor.callLater(self.connect_timeout, timeout)
+        def done(result):
+            if call.active():
+                call.cancel()
+            if timedOut and isinstance(result, failure.Failure):
+                raise error.TimeoutError(string='Connecting to %s took more '
+                                         'than %ss' % (dst,
+                                                       self.connect_timeout))
+            return result
+        return d.addBoth(done)
+
+
+    def tune(self, transport):
+        """
+        Set the C{keepalive} and C{user_timeout} socket options, if I have
+        them, on one side of a relayed connection.
+        """
+        tuneConnection(transport, self.keepalive, self.keepaliveInterval,
+                       self.keepaliveProbes, self.user_timeout)
+
+
+    def limit(self, rate_limit=None, dst_rate_limit=None,
+              conn_rate_limit=None):
+        """
+        Change my rate limits (see L{__init__}), for the connections I'm
+        relaying as well as for new ones.  A limit given as C{None} is left
+        as it is, and one given as C{0} is turned off.
+
+        Connections being relayed with C{splice(2)} or on an asyncio event
+        loop can't be limited; while I have any limits, new connections are
+        relayed in the reactor.
+        """
+        for rate in (rate_limit, dst_rate_limit, conn_rate_limit):
+            checkRate(rate)
+        now = self._reactor.seconds()
+        if rate_limit is not None:
+            self.rate_limit = rate_limit or None
+            self._bucket = self._rebucket(self._bucket, rate_limit, now)
+        if dst_rate_limit is not None:
+            self.dst_rate_limit = dst_rate_limit or None
+            for dst, bucket in self._dstBuckets.items():
+                self._dstBuckets[dst] = self._rebucket(bucket, dst_rate_limit,
+                                                       now)
+            if not dst_rate_limit:
+                self._dstBuckets = {}
+        if conn_rate_limit is not None:
+            self.conn_rate_limit = conn_rate_limit or None
+            for conns in self._open.values():
+                for conn in conns:
+                    conn._bucket = self._rebucket(conn._bucket,
+                                                  conn_rate_limit, now)
+        self.shaping = bool(self.rate_limit or self.dst_rate_limit
+                            or self.conn_rate_limit)
+        if not self.shaping and self.throttled:
+            for conns in self._open.values():
+                for conn in conns:
+                    for proxy in (conn, conn.peer):
+                        if proxy is not None and proxy._held is not None:
+                            proxy._held.cancel()
+                            self._release(proxy)
+
+
+    def _rebucket(self, bucket, rate, now):
+        """
+        Get a L{TokenBucket} for C{rate} bytes a second: C{bucket} changed
+        to that rate if there is one, otherwise a new one.
+
+        @return: The bucket, or C{None} if C{rate} is C{0}.
+        """
+        if not rate:
+            return None
+        if bucket is None:
+            return TokenBucket(rate, rate * self.rateBurst, now)
+        bucket.setRate(rate, rate * self.rateBurst, now)
+        return bucket
+
+
+    def connectionBucket(self):
+        """
+        Get a L{TokenBucket} for a new connection's C{conn_rate_limit}.
+
+        @return: The bucket, or C{None} if there's no limit.
+        """
+        if self.conn_rate_limit is None:
+            return None
+        return self._rebucket(None, self.conn_rate_limit,
+                              self._reactor.seconds())
+
+
+    def shape(self, conn, proxy, n):
+        """
+        Charge C{n} bytes just relayed on a connection to my rate limits.  If
+        that's more than they allow, stop reading from the side the bytes
+        came from until the limits have caught up with them.  Nothing is
+        delayed once it has been read, so what's being held back is the
+        sender, by TCP flow control.
+
+        @param conn: The L{ProxyServer} for the connection.
+        @param proxy: The side the bytes came from: C{conn}, or its peer.
+        """
+        now = self._reactor.seconds()
+        delay = 0
+        if self._bucket is not None:
+            delay = self._bucket.take(n, now)
+        if self.dst_rate_limit is not None:
+            bucket = self._dstBuckets.get(conn._dst)
+            if bucket is None:
+                bucket = self._dstBuckets[conn._dst] = self._rebucket(
+                    None, self.dst_rate_limit, now)
+            delay = max(delay, bucket.take(n, now))
+        if conn._bucket is not None:
+            delay = max(delay, conn._bucket.take(n, now))
+        if delay:
+            self._hold(proxy, delay, now)
+
+
+    def _hold(self, proxy, delay, now):
+        if proxy._held is not None:
+            # Read from while held back, which shouldn't happen; hold it
+            # until that's been paid for too.
+            proxy._held.reset(delay)
+            return
+        if not self.throttled:
+            self._throttledSince = now
+        self.throttled += 1
+        proxy.transport.pauseProducing()
+        proxy._held = self._reactor.callLater(delay, self._release, proxy)
+
+
+    def _release(self, proxy, resume=True):
+        """
+        Stop holding back one side of a connection, and read from it again
+        unless flow control wants it paused.
+        """
+        proxy._held = None
+        self.throttled -= 1
+        if not self.throttled:
+            self._throttledTime += (self._reactor.seconds() -
+                                    self._throttledSince)
+        if (resume and proxy.peer is not None
+                and not _backedUp(proxy.peer.transport)):
+            proxy.transport.resumeProducing()
+
+
+    def unhold(self, proxy):
+        """
+        One side of a connection that my rate limits were holding back has
+        closed.
+        """
+        proxy._held.cancel()
+        self._release(proxy, False)
+
+
+    def coalesce(self, proxy, data):
+        """
+        Write C{data} to C{proxy}'s transport together with whatever else
+        arrives for it, in one C{writeSequence}: at most C{coalesce_delay}
+        seconds after the first of it arrived, or as soon as there's
+        C{coalesce_size} bytes of it.  A chunk that's big enough on its own
+        isn't held up at all.
+
+        There's one L{grace.timers.ShortTimer} for all my connections
+        rather than one for each, which writes out everything gathered
+        since it was started.
+
+        Connections being relayed with C{splice(2)} or on an asyncio event
+        loop aren't coalesced.
+        """
+        batch = proxy._pending
+        if batch is None:
+            if len(data) >= self.coalesce_size:
+                proxy.transport.write(data)
+                return
+            batch = proxy._pending = _Batch()
+            self._unflushed.append(proxy)
+            if not self._flushTimer.pending:
+                self._flushTimer.start(self.coalesce_delay)
+        batch.chunks.append(data)
+        batch.size += len(data)
+        if batch.size >= self.coalesce_size:
+            proxy.flush()
+
+
+    def _flush(self):
+        unflushed, self._unflushed = self._unflushed, []
+        for proxy in unflushed:
+            proxy.flush()
+
+
+    def retryDelay(self, attempt):
+        """
+        Get how long to wait before retry number C{attempt} (counting from
+        1): C{retry_backoff} doubled for each earlier retry, capped at
+        L{maxRetryDelay}, of which a random part up to half is taken off.
+        """
+        delay = min(self.retry_backoff * 2 ** (attempt - 1),
+                    self.maxRetryDelay)
+        return delay / 2 + random.uniform(0, delay / 2)
+
+
+    def retryDst(self, dst, addr):
+        """
+        Choose where to retry a connection that couldn't be made to C{dst}:
+        another usable destination if there is one.
+
+        @param addr: The address of the connecting client.
+        """
+        others = [x for x in self.usableDsts() if x != dst
+                  and self._hasRoom(x)]
+        if not others:
+            return dst if dst in self.dsts else self.dsts[0]
+        if len(others) == 1:
+            return others[0]
+        return self.balancer.pick(self, others, addr)
+
+
+    def startFactory(self):
+        self._listening = True
+        for dst in self.dsts:
+            self._startPool(dst)
+        for check in self.health.values():
+            check.start()
+
+
+    def stopFactory(self):
+        self._listening = False
+        for pool in self._pools.values():
+            pool.close()
+        for check in self.health.values():
+            check.stop()
+
+
+    def _startPool(self, dst):
+        if not (self.pool_size and self._listening):
+            return
+        pool = self._pools.get(dst)
+        if pool is None:
+            try:
+                endpoint = self.getEndpoint(dst)
+            except Exception:
+                return
+            pool = UpstreamPool(self._reactor, endpoint, self.pool_size,
+                                self.pool_idle, self.clientProtocol)
+            self._pools[dst] = pool
+        pool.start()
+
+
+    def takePooled(self, dst):
+        """
+        Get an upstream connection to C{dst} that's ready to go.
+        
+        @return: A connected L{ProxyClient} with no peer, or C{None} if there
+            isn't one.
+        """
+        pool = self._pools.get(dst)
+        if pool is None:
+            return None
+        return pool.take()
+
+
+    def info(self, dst):
+        """
+        Get details about one of my destinations beyond what L{ls} lists.
+        
+        @return: A dictionary, empty if there's nothing more to say.  If
+            C{dst} has a connection pool, includes C{'pool_hits'} and
+            C{'pool_misses'}.  If I retry or time out connections, includes
+            how many C{'retries'} and C{'timeouts'} there have been.  If I'm
+            L{shifting}, includes C{dst}'s C{'weight'}.  If I'm checking
+            C{dst}'s L{health}, includes whether it's C{'healthy'}.
+        """
+        r = {}
+        check = self.health.get(dst)
+        if check is not None:
+            r['healthy'] = check.healthy
+        if self.weights is not None and dst in self.weights:
+            r['weight'] = self.weights[dst]
+        pool = self._pools.get(dst)
+        if pool is not None:
+            r['pool_hits'] = pool.hits
+            r['pool_misses'] = pool.misses
+        counters = self.counters.get(dst)
+        if counters is not None and (self.connect_retries
+                                     or self.connect_timeout is not None):
+            r['retries'] = counters.connect_retries
+            r['timeouts'] = counters.connect_timeouts
+        return r
+
+
+    def admit(self, conn):
+        """
+        Start a newly accepted connection on its way upstream, unless that
+        would take me over C{max_conns} or every destination over
+        C{max_dst_conns}.  In that case it waits, still paused, at the back
+        of a queue of up to C{queue_size} connections, and is started as
+        soon as it gets to the front and there's room.  If the queue is
+        full, or it waits more than C{queue_timeout} seconds, it's closed.
+
+        @param conn: A L{ProxyServer}.
+        """
+        if not self._queue:
+            dst = self._admissible(conn)
+            if dst is not None:
+                conn.start(dst)
+                return
+        if self.waiting >= self.queue_size:
+            self._unrouted.rejected += 1
+            conn.reject()
+            return
+        conn._waitingSince = self._reactor.seconds()
+        self._queue.append(conn)
+        self.waiting += 1
+        if self._queueCall is None:
+            self._scheduleExpiry()
+
+
+    def unqueue(self, conn):
+        """
+        A connection waiting to be admitted has closed.
+        """
+        conn._waitingSince = None
+        self.waiting -= 1
+
+
+    def _admissible(self, conn):
+        """
+        Get the destination C{conn} should go to, if there's room for it.
+        """
+        if self.max_conns is not None and self._active >= self.max_conns:
+            return None
+        return self.pickDst(conn.transport.getPeer())
+
+
+    def _hasRoom(self, dst):
+        return (self.max_dst_conns is None
+                or self._connections[dst] < self.max_dst_conns)
+
+
+    def _popWaiting(self):
+        """
+        Take the connection at the front of the queue off it.
+        """
+        conn = self._queue.popleft()
+        conn._waitingSince = None
+        self.waiting -= 1
+        return conn
+
+
+    def _firstWaiting(self):
+        """
+        Get the connection at the front of the queue, dropping any that
+        closed while they waited.
+        """
+        queue = self._queue
+        while queue and queue[0]._waitingSince is None:
+            queue.popleft()
+        return queue[0] if queue else None
+
+
+    def _admitWaiting(self):
+        """
+        Start as many waiting connections as there's now room for, in the
+        order they arrived.
+        """
+        while True:
+            conn = self._firstWaiting()
+            if conn is None:
+                return
+            dst = self._admissible(conn)
+            if dst is None:
+                return
+            counters = self.counters[dst]
+            counters.queued += 1
+            counters.queue_wait += (self._reactor.seconds() -
+                                    conn._waitingSince)
+            self._popWaiting().start(dst)
+
+
+    def _scheduleExpiry(self):
+        conn = self._firstWaiting()
+        if conn is None:
+            return
+        now = self._reactor.seconds()
+        delay = conn._waitingSince + self.queue_timeout - now
+        self._queueCall = self._reactor.callLater(max(0, delay),
+                                                  self._expireWaiting)
+
+
+    def _expireWaiting(self):
+        """
+        Close the connections that have waited too long.  They're all at the
+        front of the queue, so only one timed call is needed however many
+        are waiting.
+        """
+        self._queueCall = None
+        now = self._reactor.seconds()
+        while True:
+            conn = self._firstWaiting()
+            if (conn is None
+                    or now - conn._waitingSince < self.queue_timeout):
+                break
+            self._unrouted.queue_timeouts += 1
+            self._popWaiting().reject()
+        self._scheduleExpiry()
+
+
+    def pickDst(self, addr):
+        """
+        Choose which destination a new connection should go to.
+        
+        @param addr: The address of the connecting client.
+
+        @return: The destination, or C{None} if they're all at
+            C{max_dst_conns}.
+        """
+        dsts = self.usableDsts()
+        if self.max_dst_conns is not None:
+            dsts = [x for x in dsts if self._hasRoom(x)]
+            if not dsts:
+                return None
+        if len(dsts) == 1:
+            return dsts[0]
+        if self.weights is not None:
+            return self._weighted.pick(self, dsts, addr)
+        return self.balancer.pick(self, dsts, addr)
+
+
+    def usableDsts(self):
+        """
+        Get the destinations new connections may go to: the healthy ones,
+        or all of them if none are healthy.
+        """
+        if not self.health:
+            return self.dsts
+        healthy = [x for x in self.dsts if self.health[x].healthy]
+        return healthy or self.dsts
+
+
+    def accepted(self, dst):
+        """
+        A connection was accepted and will be forwarded to C{dst}.
+        
+        @return: The L{grace.stats.Counters} it should count its traffic
+            in.
+        """
+        self.rate.mark()
+        counters = self.counters[dst]
+        counters.accepted += 1
+        counters.rate.mark()
+        return counters
+
+
+    def stats(self):
+        """
+        Get my traffic counts.
+        
+        @return: A tuple of a dictionary of totals (see
+            L{grace.stats.Counters}) and a list of dictionaries of counts
+            for each destination, which also have a C{'dst'} key.
+            Destinations that have drained count towards the totals but
+            aren't listed, as do connections that were turned away before
+            they had a destination.  The totals also have the number of
+            connections C{'waiting'} to be admitted, and the seconds for
+            which my rate limits have been holding back at least one
+            connection, C{'throttled'}.
+        """
+        totals = Counters(self._reactor)
+        totals.add(self._retired)
+        totals.add(self._unrouted)
+        dsts = []
+        for dst, counters in sorted(self.counters.items()):
+            totals.add(counters)
+            row = counters.asDict()
+            row['dst'] = dst
+            dsts.append(row)
+        total = totals.asDict()
+        total['rate'] = self.rate.value()
+        total['waiting'] = self.waiting
+        total['throttled'] = self._throttledTime
+        if self.throttled:
+            total['throttled'] += (self._reactor.seconds() -
+                                   self._throttledSince)
+        return total, dsts
+
+
+    def retrying(self, dst):
+        """
+        A connection that couldn't be made is being retried to C{dst}.
+
+        @return: The L{grace.stats.Counters} it should count its traffic
+            in.
+        """
+        counters = self.counters[dst]
+        counters.connect_retries += 1
+        return counters
+
+
+    def connectSucceeded(self, dst):
+        """
+        A connection to C{dst} was made.
+        """
+        check = self.health.get(dst)
+        if check is not None:
+            check.success()
+
+
+    def connectFailed(self, dst, reason):
+        """
+        A connection to C{dst} couldn't be made.
+        """
+        counters = self.counters[dst]
+        counters.connect_failures += 1
+        if reason is not None and reason.check(error.TimeoutError):
+            counters.connect_timeouts += 1
+        check = self.health.get(dst)
+        if check is not None:
+            check.failure(reason)
 
 
     def addConnection(self, dst, conn):
         self._connections[dst] += 1
+        self._open[dst].add(conn)
+        self._active += 1
 
 
     def removeConnection(self, dst, conn):
         self._connections[dst] -= 1
+        self._open[dst].discard(conn)
+        self._active -= 1
+        if not self._active:
+            # Nothing's left to coalesce writes for.
+            self._flushTimer.close()
+            self._unflushed = []
         self._expireDst(dst)
+        if self._queue:
+            self._admitWaiting()
 
 
     def _expireDst(self, dst):
-        if self._connections[dst] == 0 and dst != self.dst:
+        if self._connections[dst] == 0 and dst not in self.dsts:
             self.alive[dst].callback(dst)
             del self._connections[dst]
+            del self._open[dst]
             del self.alive[dst]
-            if len(self.alive) == 1:
-                for w in self._waiters:
-                    w.callback(self)
-                self._waiters = []
+            self._endpoints.pop(dst, None)
+            self._pools.pop(dst, None)
+            self._dstBuckets.pop(dst, None)
+            self._retired.add(self.counters.pop(dst))
+            self._checkWaiters()
+
+
+    def _checkWaiters(self):
+        if len(self.alive) == len(self.dsts) and self.shifting is None:
+            waiters, self._waiters = self._waiters, []
+            for w in waiters:
+                w.callback(self)
 
 
     def _setDst(self, dst):
-        self.dst = dst
-        if dst not in self._connections:
-            self._connections[dst] = 0
-        if dst not in self.alive:
-            self.alive[dst] = defer.Deferred()
-        
+        if isinstance(dst, basestring):
+            dsts = [dst]
+        else:
+            dsts = []
+            for d in dst:
+                if d not in dsts:
+                    dsts.append(d)
+        if not dsts:
+            raise ValueError('A pipe needs at least one destination')
+        self.dsts = dsts
+        self.dst = dsts[0]
+        for dst in dsts:
+            if dst not in self._connections:
+                self._connections[dst] = 0
+                self._open[dst] = set()
+            if dst not in self.alive:
+                self.alive[dst] = defer.Deferred()
+            if dst not in self.counters:
+                self.counters[dst] = Counters(self._reactor)
+            try:
+                self.getEndpoint(dst)
+            except Exception as e:
+                # Leave it for connectionMade to complain about; switching to
+                # a destination has never required it to be valid up front.
+                log.msg('Unable to parse endpoint %r: %s' % (dst, e))
+            self._startPool(dst)
+            if self.health_interval and dst not in self.health:
+                check = self.health[dst] = HealthCheck(self, dst)
+                if self._listening:
+                    check.start()
+        for dst in list(self.health):
+            if dst not in dsts:
+                self.health.pop(dst).stop()
+
 
     def switch(self, dst):
         """
         Switch the place that this forwarder forwards to.
         
+        Any ready connections pooled for destinations that are no longer
+        active are closed.  Each of those destinations drains separately.
+        
         @param dst: The client endpoint needed to connect to the receiving
-            server.
+            server, or a list of them.
         
         @return: A C{Deferred} which will fire when the last
-            remaining connection from the previous destination has
-            been closed.  It will fire with the previous destination
-            endpoint.
+            remaining connection from the previous destinations that are no
+            longer active has been closed, or straight away if they're all
+            still active.  If there was one previous destination, it will
+            fire with that endpoint; otherwise with a list of the ones that
+            are no longer active.
         """
-        old_dst = self.dst
+        if self.shifting is not None:
+            self.shifting.cancel()
+        self.weights = None
+        old_dsts = self.dsts
         self._setDst(dst)
-        r = self.alive[old_dst]
-        self._expireDst(old_dst)
+        removed = [x for x in old_dsts if x not in self.dsts]
+        for old_dst in removed:
+            pool = self._pools.get(old_dst)
+            if pool is not None:
+                pool.close()
+        if len(old_dsts) == 1:
+            if removed:
+                r = self.alive[old_dsts[0]]
+            else:
+                r = defer.succeed(old_dsts[0])
+        else:
+            r = defer.gatherResults([self.alive[x] for x in removed])
+        for old_dst in old_dsts:
+            self._expireDst(old_dst)
+        self._checkWaiters()
+        if self._queue:
+            self._admitWaiting()
         return r
 
 
+    def shift(self, dst, over, steps=0):
+        """
+        Move new connections over to C{dst} gradually.  See
+        L{grace.shift.Shift}.
+        
+        @param dst: The client endpoint to move to, or a list of them.
+        @param over: How many seconds to take about it.
+        @param steps: Move in this many equal steps, or smoothly if C{0}.
+        
+        @return: A C{Deferred} which fires like the one from L{switch} once
+            the shift has finished and the old destinations have drained, or
+            with C{None} if the shift is aborted.
+        """
+        if self.shifting is not None:
+            raise ValueError('Already shifting to %r' % (self.shifting.new,))
+        self.shifting = Shift(self, dst, over, steps)
+        return self.shifting.start()
+
+
+    def _getShift(self):
+        if self.shifting is None:
+            raise ValueError('Not shifting')
+        return self.shifting
+
+
+    def pauseShift(self):
+        """
+        Hold the current L{shift}'s weights where they are.
+        """
+        self._getShift().pause()
+
+
+    def resumeShift(self):
+        """
+        Carry on with a paused L{shift}.
+        """
+        self._getShift().resume()
+
+
+    def abortShift(self):
+        """
+        Give up on the current L{shift} and send all new connections back
+        where they were going before it.
+        """
+        self._getShift().abort()
+
+
     def ls(self):
         """
         List the endpoints that are either currently active or
@@ -111,7 +1637,7 @@ class Pipe(protocol.Factory):
             (ENDPOINT, NUMBER OF CONNECTIONS, ACTIVE?)
         """
         for endpoint, conns in self._connections.items():
-            yield (endpoint, conns, endpoint == self.dst)
+            yield (endpoint, conns, endpoint in self.dsts)
 
 
     def wait(self):
@@ -121,10 +1647,48 @@ class Pipe(protocol.Factory):
         @return: A Deferred which fires when all connections are going to the
             current forwarding rule.
         """
-        if len(self.alive) == 1:
+        if len(self.alive) == len(self.dsts) and self.shifting is None:
             return defer.succeed(self)
         d = defer.Deferred()
         self._waiters.append(d)
         return d
 
 
+    def drain(self, timeout, grace=None):
+        """
+        Like L{wait}, but don't wait more than C{timeout} seconds for the
+        connections to previous destinations to finish: close whichever are
+        left then.
+        
+        @param grace: If given, only close the idle connections (see
+            L{idleAfter}) once C{timeout} is up, and the rest this many
+            seconds after that.
+        
+        @return: A C{Deferred} which fires with the number of connections
+            that were closed when all connections are going to the current
+            forwarding rule.
+        """
+        forced = set()
+        def close(idleOnly):
+            now = self._reactor.seconds()
+            for dst, conns in self._open.items():
+                if dst in self.dsts:
+                    continue
+                for conn in list(conns):
+                    if conn in forced:
+                        continue
+                    if not idleOnly or conn.isIdle(now):
+                        forced.add(conn)
+                        conn.forceClose()
+        calls = [self._reactor.callLater(timeout, close, grace is not None)]
+        if grace is not None:
+            calls.append(self._reactor.callLater(timeout + grace, close,
+                                                 False))
+        def done(result):
+            for call in calls:
+                if call.active():
+                    call.cancel()
+            return len(forced)
+        return self.wait().addCallback(done)
+
+
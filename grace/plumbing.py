@@ -1,38 +1,152 @@
 
-from twisted.internet import defer, reactor
-from twisted.application import service, strports
+from twisted.internet import defer, reactor, endpoints, task
+from twisted.application import service
 
 
 from grace.pipe import Pipe
+from grace.listeners import AdoptedPortService, PortService, releasePort
+from grace.config import ConfigError, dstList, checkPipe
+from grace.shaping import checkRate
+
+import bisect
+
+
+
+class PipeServices(service.MultiService):
+    """
+    I hold the services listening for a L{Plumber}'s L{Pipe}s.
+
+    Like any C{MultiService} I index my services by name (their C{src}
+    endpoint) in C{namedServices}; I also keep the names in order so they
+    can be listed without sorting them every time.
+
+    @ivar names: The sorted names of my services.
+    """
+
+    def __init__(self):
+        service.MultiService.__init__(self)
+        self.names = []
+
+
+    def addService(self, s):
+        try:
+            service.MultiService.addService(self, s)
+        except:
+            # It couldn't be started; forget it, so that it can be added
+            # again.
+            if s in self.services:
+                self.services.remove(s)
+                if s.name is not None:
+                    del self.namedServices[s.name]
+            if s.parent is self:
+                s.parent = None
+            raise
+        if s.name is not None:
+            bisect.insort(self.names, s.name)
+
+
+    def removeService(self, s):
+        if s.name is not None:
+            del self.names[bisect.bisect_left(self.names, s.name)]
+        return service.MultiService.removeService(self, s)
 
 
 
 class Plumber:
     """
     I add, remove and fiddle with L{Pipe}s.
+    
+    @ivar workers: A L{grace.workers.WorkerPool} if my L{Pipe}s are run in
+        worker processes (see L{useWorkers}), otherwise C{None}.
+    @ivar retireInterval: Once I've handed my pipes off, how often to check
+        whether their connections have all closed.  See L{retire}.
+    @ivar pipeDefaults: Options for every L{Pipe} I start, such as
+        C{engine}, unless they're given to L{addPipe} or L{adoptPipe}.
     """
     
     pipeFactory = Pipe
+    workers = None
+    retireInterval = 1
 
 
     def __init__(self, _reactor=None):
-        self.pipe_services = service.MultiService()
+        self.pipe_services = PipeServices()
         self._reactor = _reactor or reactor
+        self.pipeDefaults = {}
 
 
-    def addPipe(self, src, dst):
+    def useWorkers(self, count, basedir):
         """
-        Start a new L{Pipe}.
+        Run my L{Pipe}s in C{count} worker processes instead of in this one.
+        Every worker accepts connections on every pipe's listening socket,
+        and commands are passed on to all of them.
+        
+        Call this before adding any pipes, and start the returned service
+        along with L{pipe_services}.
+        
+        @param basedir: Directory in which to make the socket the workers
+            connect to.
         
+        @return: The L{grace.workers.WorkerPool} service.
+        """
+        from grace.workers import WorkerPool
+        self.workers = WorkerPool(self, count, basedir, self._reactor)
+        return self.workers
+
+
+    def addPipe(self, src, dst, **options):
+        """
+        Start a new L{Pipe}.
+
         @param src: server endpoint on which to listen
         @param dst: client endpoint L{Pipe} will connect to
-        
+        @param **options: Keyword arguments passed through to
+            L{pipeFactory}, such as C{splice}, on top of L{pipeDefaults}.
+
         @return: The newly-created Service for this pipe.  You can get to the
             L{Pipe} itself by accessing the C{factory} attribute.  Or you can
-            get it with L{getPipe}.
+            get it with L{getPipe}.  Its C{options} attribute has the
+            options used, defaults included.
         """
-        factory = self.pipeFactory(dst)
-        s = strports.service(src, factory)
+        options = dict(self.pipeDefaults, **options)
+        if self.workers is not None:
+            from grace.workers import SharedListener
+            s = SharedListener(self.workers, src, dst, options)
+            s.setServiceParent(self.pipe_services)
+            return s
+        factory = self.pipeFactory(dst, **options)
+        s = PortService(endpoints.serverFromString(self._reactor, src),
+                        factory)
+        s._raiseSynchronously = True
+        s.options = options
+        s.setName(src)
+        s.setServiceParent(self.pipe_services)
+        return s
+
+
+    def adoptPipe(self, src, fd, family, dst, unlink=False, **options):
+        """
+        Start a new L{Pipe} on a socket that's already listening, for
+        instance one passed from another process.
+        
+        @param src: The server endpoint the socket was bound for, used as
+            the pipe's name.
+        @param fd: The listening socket's file descriptor.  It will be
+            closed once the pipe is listening.
+        @param family: The socket's address family.
+        @param unlink: If C{True}, remove a UNIX socket's file when the pipe
+            stops listening: the socket is this process's now, rather than
+            shared with the process it came from.
+        
+        The other arguments are as for L{addPipe}.
+        
+        @return: The newly-created Service for this pipe.
+        """
+        options = dict(self.pipeDefaults, **options)
+        factory = self.pipeFactory(dst, **options)
+        s = AdoptedPortService(self._reactor, fd, family, factory,
+                               unlink=unlink)
+        s.options = options
         s.setName(src)
         s.setServiceParent(self.pipe_services)
         return s
@@ -47,8 +161,20 @@ class Plumber:
         @return: A C{Deferred} which will fire once the L{Pipe} has stopped
             listening.
         """
-        s = [x for x in self.pipe_services if x.name == src][0]
-        return defer.maybeDeferred(s.disownServiceParent)
+        s = self.getListener(src)
+        d = defer.maybeDeferred(s.disownServiceParent)
+        if self.workers is not None:
+            d = defer.gatherResults([d, self.workers.rmPipe(src)])
+        return d
+
+
+    def getListener(self, src):
+        """
+        Get the service that's listening on the given endpoint.
+
+        @raise KeyError: If there's no such service.
+        """
+        return self.pipe_services.namedServices[src]
 
 
     def getPipe(self, src):
@@ -58,9 +184,129 @@ class Plumber:
         @param src: An endpoint that was originally given to L{addPipe}.
         
         @return: L{Pipe}.
+
+        @raise KeyError: If there's no such L{Pipe}.
+        """
+        return self.getListener(src).factory
+
+
+    def getDsts(self, src):
+        """
+        Get the list of destinations a pipe is forwarding new connections
+        to.
         """
-        s = [x for x in self.pipe_services if x.name == src][0]
-        return s.factory
+        listener = self.getListener(src)
+        if self.workers is not None:
+            return dstList(listener.dst)
+        return list(listener.factory.dsts)
+
+
+    def applyConfig(self, pipes):
+        """
+        Make my pipes match a whole configuration at once: pipes that aren't
+        in it are removed, pipes that are new are added and pipes whose
+        destinations differ are switched, all before returning.
+
+        The configuration is checked, and new pipes start listening, before
+        anything else is changed, so either all of it is applied or none of
+        it is.  If any new pipe can't listen (because its port is in use,
+        say), the ones that could are removed again and nothing else is
+        done.
+
+        @param pipes: A list of (src, dst) pairs, where C{dst} is an
+            endpoint or a list of them, as from
+            L{grace.config.parseConfig}.
+
+        @return: A tuple of a list of results and a C{Deferred}.  Each result
+            is a dictionary with the C{'src'} of a pipe and what was done to
+            it: its C{'action'} is C{'added'}, C{'removed'}, C{'switched'}
+            or C{'unchanged'}.  If nothing was done because new pipes
+            couldn't listen, their C{'action'} is C{'failed'}, with the
+            reason as C{'error'}, and the C{'action'} of every other pipe
+            that would have changed is C{'skipped'}.  The results are in
+            order of C{src}.  The C{Deferred} fires once removed pipes have
+            stopped listening and switched pipes' old destinations have
+            drained.
+
+        @raise ConfigError: If a C{src} appears twice or an endpoint can't
+            be parsed.
+        """
+        wanted = {}
+        for src, dst in pipes:
+            if src in wanted:
+                raise ConfigError('%r is configured more than once' % (src,))
+            wanted[src] = dsts = dstList(dst)
+            if not dsts:
+                raise ConfigError('%r has no destination' % (src,))
+        current = set(self.pipe_services.names)
+        switches = []
+        for src in sorted(wanted):
+            dsts = wanted[src]
+            if src not in current:
+                checkPipe(self._reactor, src, dsts)
+            elif dsts != self.getDsts(src):
+                checkPipe(self._reactor, src, dsts, new=False)
+                switches.append(src)
+
+        actions = {}
+        errors = {}
+        for src, dsts in sorted(wanted.items()):
+            if src in current:
+                continue
+            error = self._listen(src, dsts[0] if len(dsts) == 1 else dsts)
+            if error is None:
+                actions[src] = 'added'
+            else:
+                errors[src] = error
+                actions[src] = 'failed'
+
+        dl = []
+        if errors:
+            for src, action in actions.items():
+                if action == 'added':
+                    dl.append(self.rmPipe(src))
+                    actions[src] = 'skipped'
+            for src in (current - set(wanted)).union(switches):
+                actions[src] = 'skipped'
+        else:
+            for src in current - set(wanted):
+                dl.append(self.rmPipe(src))
+                actions[src] = 'removed'
+            for src in switches:
+                dsts = wanted[src]
+                self.pipeCommand(src, 'switch', dsts[0] if len(dsts) == 1
+                                 else dsts)
+                dl.append(defer.maybeDeferred(self.pipeCommand, src, 'wait'))
+                actions[src] = 'switched'
+        for src in current.intersection(wanted):
+            actions.setdefault(src, 'unchanged')
+        results = []
+        for src, action in sorted(actions.items()):
+            result = {'src': src, 'action': action}
+            if src in errors:
+                result['error'] = errors[src]
+            results.append(result)
+        return results, defer.gatherResults(dl, consumeErrors=True)
+
+
+    def _listen(self, src, dst):
+        """
+        Add a pipe for L{applyConfig}.
+
+        @return: C{None} if it's listening, otherwise why it isn't.
+        """
+        try:
+            s = self.addPipe(src, dst)
+        except Exception as e:
+            return str(e)
+        # Shared listeners bind straight away, but say so with a Deferred.
+        failures = []
+        if getattr(s, 'listening', None) is not None:
+            s.listening.addErrback(failures.append)
+        if failures:
+            s.disownServiceParent()
+            return failures[0].getErrorMessage()
+        return None
 
 
     def pipeCommand(self, src, command, *args, **kwargs):
@@ -77,20 +323,179 @@ class Plumber:
         
         @return: Whatever the L{Pipe}'s method returns.
         """
+        if self.workers is not None:
+            if command in ('switch', 'shift'):
+                # Workers started from now on get the new destination.
+                self.getListener(src).dst = args[0]
+            return self.workers.pipeCommand(src, command, *args, **kwargs)
         pipe = self.getPipe(src)
         m = getattr(pipe, command, None)
         return m(*args, **kwargs)
 
 
+    def limit(self, src, **limits):
+        """
+        Change one of my L{Pipe}s' rate limits.  They're kept with its
+        options too, so that a restarted process or worker has them.
+
+        @see: L{Pipe.limit}
+        """
+        for rate in limits.values():
+            checkRate(rate)
+        self.getListener(src).options.update(limits)
+        return self.pipeCommand(src, 'limit', **limits)
+
+
+    def drain(self, src, timeout, grace=None):
+        """
+        Wait for a pipe's previous destinations to drain, closing the
+        connections to them that are left after C{timeout} seconds.
+        
+        @see: L{Pipe.drain}
+        
+        @return: A C{Deferred} firing with the number of connections that
+            were closed, in all my L{workers} if I have them.
+        """
+        d = self.pipeCommand(src, 'drain', timeout, grace)
+        if self.workers is not None:
+            d.addCallback(lambda responses: sum(r['forced']
+                                                for r in responses))
+        return d
+
+
+    def info(self, src, dst):
+        """
+        Get the extra details one of my L{Pipe}s has about a destination.
+        
+        @see: L{Pipe.info}
+        """
+        return self.pipeCommand(src, 'info', dst)
+
+
+    def listPipes(self):
+        """
+        List all my L{Pipe}s and their status, with the details from
+        L{info}.
+        
+        @return: A list of dictionaries with C{'src'}, C{'dst'},
+            C{'conns'} and C{'active'} keys and any keys from L{info}.  If
+            I'm using L{workers}, a C{Deferred} firing with their combined
+            list.
+        """
+        if self.workers is not None:
+            return self.workers.listPipes()
+        pipes = []
+        for src,dst,conns,active in self.ls():
+            row = {
+                'src': src,
+                'dst': dst,
+                'conns': conns,
+                'active': active,
+            }
+            row.update(self.info(src, dst))
+            pipes.append(row)
+        return pipes
+
+
+    def stats(self):
+        """
+        Get the traffic counts of all my L{Pipe}s.
+        
+        @return: A tuple of a list of each pipe's totals and a list of the
+            counts for each of their destinations, as returned by
+            L{Pipe.stats} plus a C{'src'} key.  If I'm using L{workers}, a
+            C{Deferred} firing with their combined counts.
+        """
+        if self.workers is not None:
+            return self.workers.stats()
+        pipes = []
+        dsts = []
+        for src in self.pipe_services.names:
+            total, rows = self.pipeCommand(src, 'stats')
+            total['src'] = src
+            pipes.append(total)
+            for row in rows:
+                row['src'] = src
+                dsts.append(row)
+        return pipes, dsts
+
+
     def ls(self):
         """
-        List all my L{Pipe}s and their status.
+        List all my L{Pipe}s and their status, in order of C{src}.
+        """
+        named = self.pipe_services.namedServices
+        for src in self.pipe_services.names:
+            for x in named[src].factory.ls():
+                yield (src,) + x
+
+
+    def handOff(self, proto):
         """
-        keys = [x.name for x in self.pipe_services]
-        keys.sort()
-        for key in keys:
-            for x in self.pipeCommand(key, 'ls'):
-                yield tuple([key] + list(x))
+        Hand every pipe's listening socket to another grace process, with
+        the pipe's current destinations and options, then stop accepting
+        connections on them myself.  Connections already accepted carry on.
+
+        The sockets never stop listening, so connecting to a pipe is never
+        refused while this happens.
+
+        @param proto: An AMP connection to the other process, which adopts
+            each pipe it's sent with L{grace.workers.AdoptPipe}.
+
+        @return: A C{Deferred} that fires once the other process has every
+            socket and I've stopped accepting on them.  If it fails, I'm
+            still accepting on all of them.
+
+        @raise ValueError: If I'm using L{workers}.
+        """
+        if self.workers is not None:
+            raise ValueError("Pipes can't be handed off from worker "
+                             "processes")
+        from grace.workers import AdoptPipe
+        listeners = [self.getListener(src) for src in self.pipe_services.names]
+        listeners = [x for x in listeners if x.port is not None]
+        dl = []
+        for listener in listeners:
+            dsts = self.getDsts(listener.name)
+            dl.append(proto.callRemote(AdoptPipe, src=listener.name,
+                                       dst=dsts[0], fd=listener.port.fileno(),
+                                       dsts=dsts if len(dsts) > 1 else None,
+                                       **listener.options))
+        d = defer.gatherResults(dl, consumeErrors=True)
+        def release(ignored):
+            return defer.gatherResults([releasePort(x.port)
+                                        for x in listeners])
+        return d.addCallback(release)
+
+
+    def retire(self):
+        """
+        Make way for the process I've handed my pipes to with L{handOff}:
+        stop the services alongside my pipes, such as the control socket, so
+        that it can listen in their place, then stop this process once my
+        pipes' last connections have closed.
+
+        @return: A C{Deferred} that fires once the other services have
+            stopped.
+        """
+        parent = self.pipe_services.parent
+        others = [x for x in (parent or []) if x is not self.pipe_services]
+        d = defer.gatherResults([defer.maybeDeferred(x.disownServiceParent)
+                                 for x in others])
+        def drain(ignored):
+            call = task.LoopingCall(self._stopWhenDrained)
+            call.clock = self._reactor
+            self._draining = call
+            # Not straight away: whoever asked me to retire still needs an
+            # answer before I stop.
+            call.start(self.retireInterval, now=False)
+        return d.addCallback(drain)
+
+
+    def _stopWhenDrained(self):
+        if not sum(conns for src, dst, conns, active in self.ls()):
+            self._draining.stop()
+            self.stop()
 
 
     def stop(self):
@@ -0,0 +1,191 @@
+"""
+Pools of ready-connected upstream connections, so that a newly accepted
+client doesn't have to wait for an upstream connect (and TLS handshake)
+before its bytes start flowing.
+"""
+
+from twisted.internet import protocol
+from twisted.python import log
+
+
+
+class _PoolFactory(protocol.ClientFactory):
+    """
+    I build unattached upstream protocols for an L{UpstreamPool}.
+    """
+
+    noisy = False
+
+
+    def __init__(self, pool):
+        self.pool = pool
+
+
+    def buildProtocol(self, addr):
+        proto = self.pool.protocol()
+        proto.pool = self.pool
+        return proto
+
+
+
+class UpstreamPool(object):
+    """
+    I keep up to C{size} connections to one destination open and ready to be
+    handed to new clients.
+
+    Connections are refilled in the background as they are taken, and after
+    the destination closes ready ones.  If the destination keeps closing
+    them, I wait longer and longer (up to C{maxRefillDelay} seconds) before
+    refilling.  If none have been taken for C{idle} seconds I close them all
+    and stop refilling until the next time one is asked for.
+
+    @ivar ready: Connected protocols waiting to be taken.
+    @ivar hits: Number of times L{take} had a connection to hand out.
+    @ivar misses: Number of times L{take} didn't.
+    @ivar closed: C{True} once L{close} has been called.
+    @ivar refillDelay: Seconds to wait before refilling after a ready
+        connection is lost.  The wait doubles each time one is lost within
+        C{maxRefillDelay} seconds of the last refill.
+    """
+
+    refillDelay = 0.1
+    maxRefillDelay = 30
+
+    def __init__(self, reactor, endpoint, size, idle, protocol):
+        """
+        @param endpoint: Client endpoint to connect to.
+        @param size: How many connections to keep ready.
+        @param idle: Seconds without a L{take} before I shrink to nothing.
+        @param protocol: Protocol class to connect with.  Instances get a
+            C{pool} attribute and must call L{lost} if they disconnect
+            before being taken.
+        """
+        self.reactor = reactor
+        self.endpoint = endpoint
+        self.size = size
+        self.idle = idle
+        self.protocol = protocol
+        self.factory = _PoolFactory(self)
+        self.ready = []
+        self.connecting = 0
+        self.hits = 0
+        self.misses = 0
+        self.closed = True
+        self._target = 0
+        self._idleCall = None
+        self._refillCall = None
+        self._backoff = self.refillDelay
+        self._refilledAt = None
+
+
+    def start(self):
+        """
+        Start filling the pool.
+        """
+        self.closed = False
+        self._target = self.size
+        self._resetIdle()
+        self.fill()
+
+
+    def fill(self):
+        """
+        Open connections until there are enough ready or on their way.
+        """
+        while not self.closed and (len(self.ready) + self.connecting
+                                   < self._target):
+            self.connecting += 1
+            d = self.endpoint.connect(self.factory)
+            d.addCallbacks(self._connected, self._failed)
+
+
+    def _connected(self, proto):
+        self.connecting -= 1
+        if self.closed or len(self.ready) >= self._target:
+            proto.transport.loseConnection()
+        else:
+            self.ready.append(proto)
+
+
+    def _failed(self, reason):
+        # Don't try again until somebody asks for a connection; there's no
+        # sense hammering a destination that's down.
+        self.connecting -= 1
+        log.msg('Pool connection to %r failed: %s' % (self.endpoint,
+                                                       reason.getErrorMessage()))
+
+
+    def take(self):
+        """
+        Take a connected protocol out of the pool.
+
+        @return: A protocol from L{ready} or C{None} if there aren't any.
+        """
+        if self.closed:
+            return None
+        self._target = self.size
+        self._resetIdle()
+        proto = None
+        if self.ready:
+            proto = self.ready.pop(0)
+            proto.pool = None
+            self.hits += 1
+        else:
+            self.misses += 1
+        self.fill()
+        return proto
+
+
+    def lost(self, proto):
+        """
+        A connection in the pool was closed from the other end.
+        """
+        if proto not in self.ready:
+            return
+        self.ready.remove(proto)
+        if self._refillCall is not None and self._refillCall.active():
+            return
+        if (self._refilledAt is not None and self.reactor.seconds()
+                - self._refilledAt < self.maxRefillDelay):
+            self._backoff = min(self._backoff * 2, self.maxRefillDelay)
+        else:
+            self._backoff = self.refillDelay
+        self._refillCall = self.reactor.callLater(self._backoff, self._refill)
+
+
+    def _refill(self):
+        self._refillCall = None
+        self._refilledAt = self.reactor.seconds()
+        self.fill()
+
+
+    def _resetIdle(self):
+        if self._idleCall is not None and self._idleCall.active():
+            self._idleCall.reset(self.idle)
+        else:
+            self._idleCall = self.reactor.callLater(self.idle, self.shrink)
+
+
+    def shrink(self):
+        """
+        Close all ready connections and stop refilling until L{take} is
+        next called.
+        """
+        self._target = 0
+        ready, self.ready = self.ready, []
+        for proto in ready:
+            proto.transport.loseConnection()
+
+
+    def close(self):
+        """
+        Close all ready connections and stop filling the pool.
+        """
+        self.closed = True
+        if self._idleCall is not None and self._idleCall.active():
+            self._idleCall.cancel()
+        self._idleCall = None
+        if self._refillCall is not None and self._refillCall.active():
+            self._refillCall.cancel()
+        self._refillCall = None
+        self.shrink()
@@ -0,0 +1,348 @@
+"""
+Running the simplest control commands without Twisted.
+
+Importing Twisted and running a reactor takes much longer than sending one
+command does, which matters to scripts that run C{grace ls} every few
+seconds.  So C{bin/grace} calls L{run}, which handles C{ls}, C{stats},
+C{switch}, C{wait} and C{stop} (when they're given no options) by speaking
+AMP over a plain blocking UNIX socket, and hands every other command line
+to L{grace.cli}.
+
+Nothing here may import Twisted, or anything that does.
+"""
+
+import os
+import socket
+import struct
+import sys
+
+from grace.format import formatList, formatStats
+
+
+
+class RemoteError(Exception):
+    """
+    The grace process answered a command with an error.
+    """
+
+
+    def __init__(self, code, description):
+        Exception.__init__(self, code, description)
+        self.code = code
+        self.description = description
+
+
+    def __str__(self):
+        return '%s: %s' % (self.code, self.description)
+
+
+
+class ConnectionClosed(Exception):
+    """
+    The grace process closed the connection before answering.
+    """
+
+
+
+def packString(s):
+    """
+    Prefix C{s} with its length, as AMP does with keys, values and the
+    items of a C{ListOf}.
+    """
+    return struct.pack('!H', len(s)) + s
+
+
+
+def packBox(box):
+    """
+    Serialize a dictionary of strings as an AMP box.
+    """
+    return ''.join(packString(k) + packString(v)
+                   for k, v in sorted(box.items())) + '\x00\x00'
+
+
+
+def unpackBoxes(data):
+    """
+    Parse as many AMP boxes as there are in C{data}.
+
+    @return: A tuple of a list of the complete boxes (as dictionaries) and
+        whatever is left of C{data} after them.
+    """
+    boxes = []
+    box = {}
+    key = None
+    offset = end = 0
+    while len(data) - offset >= 2:
+        length = struct.unpack('!H', data[offset:offset + 2])[0]
+        if len(data) - offset - 2 < length:
+            break
+        string = data[offset + 2:offset + 2 + length]
+        offset += 2 + length
+        if key is not None:
+            box[key] = string
+            key = None
+        elif string:
+            key = string
+        else:
+            boxes.append(box)
+            box = {}
+            end = offset
+    return boxes, data[end:]
+
+
+
+def _bool(s):
+    return s == 'True'
+
+
+
+# How to read the values of the grace.control.List and grace.control.Stats
+# responses; anything not listed is a string.
+listTypes = {
+    'conns': int,
+    'active': _bool,
+    'pool_hits': int,
+    'pool_misses': int,
+    'weight': float,
+    'healthy': _bool,
+    'retries': int,
+    'timeouts': int,
+}
+
+statsTypes = {
+    'accepted': int,
+    'connect_failures': int,
+    'connect_retries': int,
+    'connect_timeouts': int,
+    'bytes_in': int,
+    'bytes_out': int,
+    'closed_by_client': int,
+    'closed_by_upstream': int,
+    'closed_on_error': int,
+    'closed_forced': int,
+    'closed_idle': int,
+    'queued': int,
+    'queue_wait': float,
+    'rejected': int,
+    'queue_timeouts': int,
+    'pauses_src': int,
+    'pauses_dst': int,
+    'waiting': int,
+    'throttled': float,
+    'rate': float,
+}
+
+
+
+def unpackList(data, types):
+    """
+    Parse the value of an C{AmpList}.
+
+    @param types: A dictionary of functions to convert the values of some
+        keys with.
+
+    @return: A list of dictionaries.
+    """
+    rows = unpackBoxes(data)[0]
+    for row in rows:
+        for key, value in row.items():
+            if key in types:
+                row[key] = types[key](value)
+    return rows
+
+
+
+class BlockingClient(object):
+    """
+    I send commands to a grace process over its control socket, blocking
+    until each is answered.
+    """
+
+
+    def __init__(self, path):
+        """
+        @param path: The path of the control socket.
+        """
+        self.path = path
+        self.sock = None
+        self._tag = 0
+        self._buffer = ''
+
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+    def callRemote(self, command, **arguments):
+        """
+        Send a command and wait for the answer.
+
+        @param arguments: The command's arguments, already serialized.
+
+        @return: The answer box.
+
+        @raise RemoteError: If the answer is an error.
+        @raise ConnectionClosed: If there's no answer.
+        """
+        if self.sock is None:
+            self.connect()
+        self._tag += 1
+        tag = '%x' % (self._tag,)
+        self.sock.sendall(packBox(dict(arguments, _command=command,
+                                       _ask=tag)))
+        while True:
+            boxes, self._buffer = unpackBoxes(self._buffer)
+            for box in boxes:
+                if box.get('_answer') == tag:
+                    return box
+                if box.get('_error') == tag:
+                    raise RemoteError(box.get('_error_code'),
+                                      box.get('_error_description'))
+            data = self.sock.recv(65536)
+            if not data:
+                raise ConnectionClosed('The connection was closed before an '
+                                       'answer came')
+            self._buffer += data
+
+
+    def ls(self):
+        """
+        @return: The rows of the L{grace.control.List} response.
+        """
+        return unpackList(self.callRemote('List')['pipes'], listTypes)
+
+
+    def stats(self):
+        """
+        @return: The L{grace.control.Stats} response.
+        """
+        box = self.callRemote('Stats')
+        return {
+            'pipes': unpackList(box['pipes'], statsTypes),
+            'dsts': unpackList(box['dsts'], statsTypes),
+        }
+
+
+    def switch(self, src, dst):
+        """
+        Switch a pipe to C{dst}, an endpoint or a list of them.
+        """
+        if isinstance(dst, basestring):
+            self.callRemote('Switch', src=src, dst=dst)
+        else:
+            self.callRemote('SwitchBalanced', src=src,
+                            dsts=''.join(packString(x) for x in dst))
+
+
+    def wait(self, src):
+        self.callRemote('Wait', src=src)
+
+
+    def stop(self):
+        try:
+            self.callRemote('Stop')
+        except (ConnectionClosed, socket.error):
+            # The process may stop before it answers.
+            pass
+
+
+
+# The number of arguments each command takes, at least and at most.
+arities = {
+    'ls': (0, 0),
+    'stats': (0, 0),
+    'stop': (0, 0),
+    'switch': (2, None),
+    'wait': (1, 1),
+}
+
+aliases = {
+    'x': 'switch',
+    'w': 'wait',
+}
+
+
+
+def parseArgs(argv):
+    """
+    Parse a command line if it's simple enough for L{run} to handle.
+
+    @return: A tuple of the base directory, the command and its arguments,
+        or C{None} if L{grace.cli} should handle the command line.
+    """
+    basedir = '~/.grace'
+    args = list(argv)
+    while args and args[0].startswith('-'):
+        opt = args.pop(0)
+        if opt in ('-d', '--basedir') and args:
+            basedir = args.pop(0)
+        elif opt.startswith('--basedir='):
+            basedir = opt[len('--basedir='):]
+        elif opt.startswith('-d') and len(opt) > 2:
+            basedir = opt[2:]
+        else:
+            return None
+    if not args:
+        return None
+    name = aliases.get(args[0], args[0])
+    args = args[1:]
+    if name not in arities or [x for x in args if x.startswith('-')]:
+        return None
+    least, most = arities[name]
+    if len(args) < least or (most is not None and len(args) > most):
+        return None
+    return os.path.expanduser(basedir), name, args
+
+
+
+def runCommand(client, name, args):
+    """
+    Run a command parsed by L{parseArgs}.
+
+    @return: The command's output, or C{None}.
+    """
+    if name == 'ls':
+        return formatList(client.ls())
+    elif name == 'stats':
+        return formatStats(client.stats())
+    elif name == 'switch':
+        src, dsts = args[0], args[1:]
+        client.switch(src, dsts[0] if len(dsts) == 1 else dsts)
+    elif name == 'wait':
+        client.wait(args[0])
+    elif name == 'stop':
+        client.stop()
+        return 'Stopped'
+
+
+
+def run(argv=None):
+    """
+    Run a command from the command line.
+    """
+    if argv is None:
+        argv = sys.argv[1:]
+    parsed = parseArgs(argv)
+    if parsed is None:
+        from grace import cli
+        return cli.run()
+    basedir, name, args = parsed
+    client = BlockingClient(os.path.join(basedir, 'grace.socket'))
+    try:
+        output = runCommand(client, name, args)
+    except (RemoteError, ConnectionClosed, socket.error) as e:
+        print 'Error: %s' % (e,)
+        sys.exit(1)
+    finally:
+        client.close()
+    if output:
+        print output
+    sys.exit(0)
@@ -0,0 +1,75 @@
+"""
+Rate limits on the bytes a L{grace.pipe.Pipe} relays.
+
+Bytes are relayed as soon as they're read and charged to a L{TokenBucket}
+afterwards.  When that leaves the bucket owing, the side of the connection
+they came from isn't read from again until the debt has been paid off, so
+the sender is held back by TCP flow control rather than by anything
+buffering up in between.  See L{grace.pipe.Pipe.shape}.
+"""
+
+
+
+def checkRate(rate):
+    """
+    @raise ValueError: If C{rate} isn't a rate limit: a number of bytes per
+        second, or C{0} or C{None} for no limit.
+    """
+    if rate is not None and rate < 0:
+        raise ValueError('A rate limit must not be negative: %r' % (rate,))
+
+
+
+class TokenBucket(object):
+    """
+    I hold up to C{burst} tokens, each good for one byte, and am refilled at
+    C{rate} tokens a second.  Taking more tokens than I have leaves me in
+    debt, which has to be paid off by refilling before I'm any use again.
+
+    @ivar rate: Bytes per second.
+    @ivar burst: The most tokens I can hold.
+    @ivar tokens: How many tokens I held at C{stamp}; negative if I was in
+        debt.
+    @ivar stamp: When I was last refilled.
+    """
+
+    __slots__ = ('rate', 'burst', 'tokens', 'stamp')
+
+    def __init__(self, rate, burst, now):
+        """
+        I start out full.
+
+        @param now: The time, by the same clock as is given to L{take}.
+        """
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = burst
+        self.stamp = now
+
+
+    def take(self, n, now):
+        """
+        Take C{n} tokens, however many I have.
+
+        @return: Seconds until I'm out of debt, or C{0} if I'm not in debt.
+        """
+        tokens = self.tokens + (now - self.stamp) * self.rate
+        if tokens > self.burst:
+            tokens = self.burst
+        tokens -= n
+        self.tokens = tokens
+        self.stamp = now
+        if tokens >= 0:
+            return 0
+        return -tokens / self.rate
+
+
+    def setRate(self, rate, burst, now):
+        """
+        Change my rate from C{now} on, keeping the tokens (or the debt) I
+        have.
+        """
+        self.take(0, now)
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = min(self.tokens, burst)
@@ -0,0 +1,188 @@
+"""
+Running control commands read a line at a time, all over one connection to
+the grace process: C{grace batch} and C{grace shell}.
+
+Each line is a command as it would be given to C{grace}, without the
+C{grace}, such as:
+
+    switch tcp:9000 tcp:host=10.0.0.2:port=80
+    wait tcp:9000
+    ls
+"""
+
+from twisted.internet import defer, interfaces
+from twisted.protocols import basic
+from twisted.python import usage
+
+from zope.interface import implementer
+
+import shlex
+
+from grace import cli
+
+
+
+commands = {
+    'ls': cli.ListOptions,
+    'switch': cli.SwitchOptions,
+    'shift': cli.ShiftOptions,
+    'limit': cli.LimitOptions,
+    'stats': cli.StatsOptions,
+    'wait': cli.WaitOptions,
+    'apply': cli.ApplyOptions,
+    'stop': cli.StopOptions,
+}
+
+
+
+def parseCommand(line):
+    """
+    Parse a command line.
+
+    @return: A tuple of the command's name and its parsed options, or
+        C{None} if there's no command on the line (or it asked for
+        C{--help}, which has been printed).
+
+    @raise usage.UsageError: If the command is wrong.
+    """
+    words = shlex.split(line, comments=True)
+    if not words:
+        return None
+    name, args = words[0], words[1:]
+    if name not in commands:
+        raise usage.UsageError('Unknown command %r (choose from %s)' % (
+                               name, ', '.join(sorted(commands))))
+    if name == 'apply' and '-' in args:
+        raise usage.UsageError("Can't read a config from stdin here")
+    options = commands[name]()
+    try:
+        options.parseOptions(args)
+    except SystemExit:
+        return None
+    return name, options
+
+
+
+def _forced(forced):
+    if forced is not None:
+        return cli.formatForced(forced)
+
+
+
+def runCommand(client, name, options):
+    """
+    Run a parsed command.
+
+    @param client: A L{grace.client.ControlClient}.
+
+    @return: A C{Deferred} firing with the command's output.
+    """
+    if name == 'ls':
+        d = client.ls().addCallback(cli.formatList)
+    elif name == 'switch':
+        d = client.switch(options['src'], options['dst'],
+                          options['drain-timeout'], options['grace'])
+        d.addCallback(_forced)
+    elif name == 'shift':
+        if options.action:
+            d = getattr(client, options.action + 'Shift')(options['src'])
+        else:
+            d = client.shift(options['src'], options['dst'],
+                             options['over'], options['steps'])
+    elif name == 'limit':
+        d = client.limit(options['src'], **options.limits())
+    elif name == 'stats':
+        d = client.stats().addCallback(cli.formatStats)
+    elif name == 'wait':
+        d = client.wait(options['src'], options['timeout'], options['grace'])
+        d.addCallback(_forced)
+    elif name == 'apply':
+        d = client.apply(options['pipes'], options['wait'])
+        d.addCallback(cli.formatResults, options['verbose'])
+    elif name == 'stop':
+        d = client.stop().addCallback(lambda x: 'Stopped')
+    return d.addCallback(lambda output: 'ok' if output is None else output)
+
+
+
+@implementer(interfaces.IHalfCloseableProtocol)
+class CommandShell(basic.LineReceiver):
+    """
+    I run the commands I'm given a line at a time.
+
+    In batch mode I send each command as soon as I read it, without waiting
+    for the ones before it to finish, and write their output in the order
+    they were given.  Interactively, I prompt for each command and wait for
+    it to finish before reading the next.
+
+    @ivar failures: How many commands have failed.
+    @ivar done: A C{Deferred} firing with L{failures} once I've reached the
+        end of my input, every command has finished and its output has been
+        written.
+    """
+
+    delimiter = '\n'
+    prompt = 'grace> '
+
+
+    def __init__(self, client, interactive=False):
+        self.client = client
+        self.interactive = interactive
+        self.failures = 0
+        self.done = defer.Deferred()
+        self._output = defer.succeed(None)
+
+
+    def connectionMade(self):
+        self.showPrompt()
+
+
+    def showPrompt(self):
+        if self.interactive:
+            self.transport.write(self.prompt)
+
+
+    def lineReceived(self, line):
+        try:
+            command = parseCommand(line)
+        except usage.UsageError as e:
+            result = defer.fail(e)
+        else:
+            if command is None:
+                self.showPrompt()
+                return
+            result = runCommand(self.client, *command)
+        if self.interactive:
+            self.transport.pauseProducing()
+        self._output.addCallback(lambda ignored: result)
+        self._output.addCallbacks(self.write, self.error)
+        if self.interactive:
+            self._output.addCallback(self._next)
+
+
+    def _next(self, ignored):
+        self.transport.resumeProducing()
+        self.showPrompt()
+
+
+    def write(self, output):
+        if output:
+            self.transport.write(output + '\n')
+
+
+    def error(self, reason):
+        self.failures += 1
+        self.transport.write('Error: %s\n' % (reason.getErrorMessage(),))
+
+
+    def readConnectionLost(self):
+        self._output.addCallback(lambda ignored:
+                                 self.transport.loseConnection())
+
+
+    def writeConnectionLost(self):
+        pass
+
+
+    def connectionLost(self, reason):
+        self.done.callback(self.failures)
@@ -0,0 +1,174 @@
+"""
+Moving a L{grace.pipe.Pipe}'s new connections from one destination to another
+a bit at a time, so a cold backend isn't handed all the load at once.
+"""
+
+from twisted.internet import defer
+
+import math
+
+
+
+class Shift(object):
+    """
+    I ramp the share of a L{Pipe}'s new connections that go to C{dst} from
+    nothing to all of them over C{over} seconds, either smoothly or in
+    C{steps} equal steps.  While I run, the pipe's old and new destinations
+    are all active and the pipe's C{weights} say what share each gets.  When
+    I finish I switch the pipe to C{dst}, so the old destinations drain as
+    they would after L{Pipe.switch}.
+
+    @ivar old: The destinations connections are being moved away from.
+    @ivar new: The destinations connections are being moved to.
+    @ivar fraction: The share of new connections currently going to L{new}.
+    @ivar state: One of C{'running'}, C{'paused'}, C{'done'},
+        C{'aborted'} or C{'cancelled'}.
+    @ivar done: A C{Deferred} which fires like the one returned by
+        L{Pipe.switch} once I've finished and the old destinations have
+        drained, or with C{None} if I'm aborted or cancelled.
+    """
+
+    # How often to update the weights of a smooth shift, at most.
+    interval = 1.0
+
+
+    def __init__(self, pipe, dst, over, steps=0):
+        if over <= 0:
+            raise ValueError('A shift must take some time, not %r' % (over,))
+        self.pipe = pipe
+        self.old = list(pipe.dsts)
+        if isinstance(dst, basestring):
+            dst = [dst]
+        self.new = list(dst)
+        self.over = over
+        self.steps = steps
+        self.fraction = 0.0
+        self.state = None
+        self.done = defer.Deferred()
+        self._elapsed = 0.0
+        self._started = None
+        self._call = None
+
+
+    def start(self):
+        """
+        Start moving connections.
+
+        @return: L{done}
+        """
+        self.pipe._setDst(self.old + [x for x in self.new
+                                      if x not in self.old])
+        self._run()
+        return self.done
+
+
+    def elapsed(self):
+        """
+        @return: How many seconds I've been running for, not counting time
+            spent paused.
+        """
+        if self.state == 'running':
+            return self._elapsed + (self.pipe._reactor.seconds()
+                                    - self._started)
+        return self._elapsed
+
+
+    def _run(self):
+        self.state = 'running'
+        self._started = self.pipe._reactor.seconds()
+        self._update()
+
+
+    def _update(self):
+        self._call = None
+        elapsed = self.elapsed()
+        if elapsed >= self.over:
+            self._finish()
+            return
+        fraction = elapsed / self.over
+        if self.steps:
+            step = math.floor(fraction * self.steps)
+            fraction = step / self.steps
+            delay = (step + 1) * self.over / self.steps - elapsed
+        else:
+            delay = min(self.interval, self.over - elapsed)
+        self.setFraction(fraction)
+        self._call = self.pipe._reactor.callLater(delay, self._update)
+
+
+    def setFraction(self, fraction):
+        """
+        Send C{fraction} of new connections to L{new}, split evenly between
+        them, and the rest to L{old}.
+        """
+        self.fraction = fraction
+        old = [x for x in self.old if x not in self.new]
+        weights = {}
+        for dst in old:
+            weights[dst] = (1.0 - fraction) / len(old)
+        for dst in self.new:
+            weights[dst] = (fraction if old else 1.0) / len(self.new)
+        self.pipe.weights = weights
+
+
+    def pause(self):
+        """
+        Stop changing the weights until L{resume} is called.
+        """
+        if self.state != 'running':
+            raise ValueError('Shift is %s, not running' % (self.state,))
+        self._elapsed = self.elapsed()
+        self.state = 'paused'
+        self._stopTimer()
+
+
+    def resume(self):
+        """
+        Carry on after L{pause}.
+        """
+        if self.state != 'paused':
+            raise ValueError('Shift is %s, not paused' % (self.state,))
+        self._run()
+
+
+    def abort(self):
+        """
+        Stop and send all new connections back to the old destinations.  The
+        new destinations drain.
+        """
+        self._end('aborted')
+        self.pipe.switch(self.old)
+        self.done.callback(None)
+
+
+    def cancel(self):
+        """
+        Stop, leaving the destinations to whoever's cancelling me.
+        """
+        self._end('cancelled')
+        self.done.callback(None)
+
+
+    def _finish(self):
+        self._end('done')
+        self.pipe.switch(self.new).addBoth(self._drained)
+
+
+    def _drained(self, result):
+        # Pass the result on, for anything else waiting on the switch.
+        self.done.callback(result)
+        return result
+
+
+    def _end(self, state):
+        self._stopTimer()
+        self.state = state
+        self.fraction = 1.0 if state == 'done' else 0.0
+        self.pipe.shifting = None
+        self.pipe.weights = None
+
+
+    def _stopTimer(self):
+        if self._call is not None and self._call.active():
+            self._call.cancel()
+        self._call = None
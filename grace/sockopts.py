@@ -0,0 +1,84 @@
+"""
+TCP options for noticing relayed connections whose other end has gone away
+without saying so, such as a phone that lost its signal behind a NAT.
+"""
+
+from twisted.python import log
+
+import socket
+import sys
+
+
+# Not in Python 2's socket module; the value is Linux's.
+TCP_USER_TIMEOUT = getattr(socket, 'TCP_USER_TIMEOUT', 18)
+
+
+
+def tcpSocket(transport):
+    """
+    Get the socket of a TCP connection.
+
+    @return: A C{socket.socket}, or C{None} if C{transport} isn't a plain TCP
+        connection (it might be a UNIX socket, or not a socket at all).
+    """
+    getHandle = getattr(transport, 'getHandle', None)
+    if getHandle is None:
+        return None
+    sock = getHandle()
+    if getattr(sock, 'family', None) not in (socket.AF_INET, socket.AF_INET6):
+        return None
+    return sock
+
+
+
+def setKeepalive(sock, idle, interval, probes):
+    """
+    Have the kernel probe a connection once it has been idle for C{idle}
+    seconds, then every C{interval} seconds, and drop it after C{probes}
+    unanswered probes.  Platforms without the timing options keep their
+    defaults for them.
+    """
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+    for name, value in [('TCP_KEEPIDLE', idle),
+                        ('TCP_KEEPINTVL', interval),
+                        ('TCP_KEEPCNT', probes)]:
+        option = getattr(socket, name, None)
+        if option is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, option, max(1, int(value)))
+
+
+
+def setUserTimeout(sock, timeout):
+    """
+    Have the kernel drop a connection when data sent on it has gone
+    unacknowledged for C{timeout} seconds (Linux only).
+    """
+    if sys.platform.startswith('linux'):
+        sock.setsockopt(socket.IPPROTO_TCP, TCP_USER_TIMEOUT,
+                        int(timeout * 1000))
+
+
+
+def tuneConnection(transport, keepalive=None, keepalive_interval=10,
+                   keepalive_probes=3, user_timeout=None):
+    """
+    Set the keepalive and user timeout options on a TCP connection.  Other
+    kinds of connection are left alone.
+
+    @param keepalive: Seconds idle before the first keepalive probe, or
+        C{None} for no keepalives.
+    @param user_timeout: See L{setUserTimeout}, or C{None} to leave it.
+    """
+    if not keepalive and not user_timeout:
+        return
+    sock = tcpSocket(transport)
+    if sock is None:
+        return
+    try:
+        if keepalive:
+            setKeepalive(sock, keepalive, keepalive_interval,
+                         keepalive_probes)
+        if user_timeout:
+            setUserTimeout(sock, user_timeout)
+    except socket.error as e:
+        log.msg('Unable to set TCP options on %r: %s' % (transport, e))
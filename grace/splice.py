@@ -0,0 +1,350 @@
+"""
+Zero-copy relaying of bytes between two sockets with Linux's C{splice(2)}.
+
+Once both sides of a relayed connection are established, a L{Pipe} with
+C{splice} turned on hands the two sockets to a L{SpliceRelay}.  A single
+helper thread then moves data between them through a kernel pipe without it
+ever being copied into Python.  When one side reaches end of file, whatever
+is left in the kernel pipe is delivered and the other side's writing half is
+shut down, while data keeps flowing the other way.  Once both sides are done
+the sockets are handed back to the reactor to be closed in the usual way.
+"""
+
+from twisted.internet import abstract, interfaces
+from twisted.python import log
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import socket
+import sys
+import threading
+
+
+SPLICE_F_MOVE = 1
+SPLICE_F_NONBLOCK = 2
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _loadSplice():
+    """
+    Get libc's C{splice} function, or C{None} if it isn't available.
+    """
+    if not sys.platform.startswith('linux') or not hasattr(select, 'epoll'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        splice = libc.splice
+    except (OSError, AttributeError):
+        return None
+    splice.argtypes = [ctypes.c_int, ctypes.c_void_p, ctypes.c_int,
+                       ctypes.c_void_p, ctypes.c_size_t, ctypes.c_uint]
+    splice.restype = ctypes.c_ssize_t
+    return splice
+
+_splice = _loadSplice()
+
+
+
+def spliceAvailable():
+    """
+    @return: C{True} if splice relaying can be used on this platform.
+    """
+    return _splice is not None
+
+
+
+_relay = None
+
+def getRelay(reactor):
+    """
+    Get the L{SpliceRelay} shared by every L{Pipe} in this process.
+    """
+    global _relay
+    if _relay is None:
+        _relay = SpliceRelay(reactor)
+    return _relay
+
+
+
+def canSplice(transport):
+    """
+    @return: C{True} if C{transport} is a plain socket (not TLS) whose file
+        descriptor can be handed to a L{SpliceRelay}.
+    """
+    return (isinstance(transport, abstract.FileDescriptor)
+            and not interfaces.ISSLTransport.providedBy(transport)
+            and not getattr(transport, 'TLS', False))
+
+
+
+def splice(fd_in, fd_out, length):
+    """
+    Move up to C{length} bytes from C{fd_in} to C{fd_out} without blocking.
+
+    @return: The number of bytes moved, C{0} at end of file or C{None} if
+        the operation would block.
+
+    @raise OSError: For any other error.
+    """
+    n = _splice(fd_in, None, fd_out, None, length,
+                SPLICE_F_MOVE | SPLICE_F_NONBLOCK)
+    if n < 0:
+        err = ctypes.get_errno()
+        if err in (errno.EAGAIN, errno.EINTR):
+            return None
+        raise OSError(err, os.strerror(err))
+    return n
+
+
+
+def shutdownWrite(fd):
+    """
+    Shut down the writing half of the socket C{fd}, so the other end sees
+    end of file.  A socket that's already disconnected is left alone.
+    """
+    sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.shutdown(socket.SHUT_WR)
+    except socket.error as e:
+        if e.errno != errno.ENOTCONN:
+            raise OSError(e.errno, os.strerror(e.errno))
+    finally:
+        sock.close()
+
+
+
+class _Direction(object):
+    """
+    One direction of a spliced connection: bytes read from C{src} go through
+    a kernel pipe to C{dst}.
+
+    @ivar pending: Number of bytes sitting in the kernel pipe.
+    @ivar moved: Number of bytes delivered to C{dst} so far.
+    @ivar eof: C{True} once C{src} has reached end of file.
+    @ivar shut: C{True} once everything read from C{src} has been delivered
+        and C{dst}'s writing half has been shut down.
+    @ivar wantRead: C{True} if I'm waiting for C{src} to be readable.
+    @ivar wantWrite: C{True} if I'm waiting for C{dst} to be writable.
+    """
+
+    def __init__(self, src, dst):
+        self.src = src
+        self.dst = dst
+        self.pipe_r, self.pipe_w = os.pipe()
+        self.pending = 0
+        self.moved = 0
+        self.eof = False
+        self.shut = False
+        self.wantRead = True
+        self.wantWrite = False
+
+
+    def pump(self):
+        """
+        Move as much data as can be moved without blocking.
+        """
+        self.wantRead = self.wantWrite = False
+        while True:
+            if self.pending:
+                n = splice(self.pipe_r, self.dst, self.pending)
+                if n is None:
+                    self.wantWrite = True
+                    return
+                self.pending -= n
+                self.moved += n
+                continue
+            if self.eof:
+                if not self.shut:
+                    self.shut = True
+                    shutdownWrite(self.dst)
+                return
+            n = splice(self.src, self.pipe_w, CHUNK_SIZE)
+            if n is None:
+                self.wantRead = True
+                return
+            if n == 0:
+                self.eof = True
+                continue
+            self.pending = n
+
+
+    def close(self):
+        os.close(self.pipe_r)
+        os.close(self.pipe_w)
+
+
+
+class SplicedConnection(object):
+    """
+    A pair of sockets being relayed by a L{SpliceRelay}.
+
+    @ivar first: The direction whose source reached end of file first, or
+        C{None}.
+    @ivar done: Called in the reactor thread once the relay has let go of
+        both sockets.
+    """
+
+    def __init__(self, relay, fd1, fd2, done):
+        self.relay = relay
+        self.fds = (fd1, fd2)
+        self.done = done
+        self.directions = (_Direction(fd1, fd2), _Direction(fd2, fd1))
+        self.first = None
+
+
+    def stop(self):
+        """
+        Stop relaying (from the reactor thread).  C{done} will still be
+        called once the helper thread has let go of the sockets.
+        """
+        self.relay.remove(self)
+
+
+    def pump(self):
+        """
+        Move data in both directions.
+
+        @return: C{True} once both directions have reached end of file and
+            delivered everything they read.
+        """
+        for d in self.directions:
+            d.pump()
+            if d.eof and self.first is None:
+                self.first = d
+        return all(d.shut for d in self.directions)
+
+
+    def masks(self):
+        """
+        @return: A dict of file descriptor to the epoll events I'm waiting
+            for on it.
+        """
+        r = dict((fd, 0) for fd in self.fds)
+        for d in self.directions:
+            if d.wantRead:
+                r[d.src] |= select.EPOLLIN
+            if d.wantWrite:
+                r[d.dst] |= select.EPOLLOUT
+        return r
+
+
+    def close(self):
+        for d in self.directions:
+            d.close()
+
+
+
+class SpliceRelay(object):
+    """
+    I relay data between pairs of sockets in a helper thread.
+
+    @ivar reactor: The reactor to report finished connections to.
+    """
+
+    def __init__(self, reactor):
+        self.reactor = reactor
+        self._lock = threading.Lock()
+        self._added = []
+        self._removed = []
+        self._thread = None
+        self._wake_r, self._wake_w = os.pipe()
+
+
+    def add(self, fd1, fd2, done):
+        """
+        Start relaying between two connected, non-blocking sockets.  The
+        reactor must not read from or write to them until C{done} is called.
+
+        @param done: Called with no arguments in the reactor thread once I've
+            finished with the sockets, either because one side closed or
+            because of L{SplicedConnection.stop}.
+
+        @rtype: L{SplicedConnection}
+        """
+        conn = SplicedConnection(self, fd1, fd2, done)
+        with self._lock:
+            self._added.append(conn)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run,
+                                                name='grace-splice')
+                self._thread.daemon = True
+                self._thread.start()
+        os.write(self._wake_w, 'x')
+        return conn
+
+
+    def remove(self, conn):
+        with self._lock:
+            self._removed.append(conn)
+        os.write(self._wake_w, 'x')
+
+
+    def _run(self):
+        poller = select.epoll()
+        poller.register(self._wake_r, select.EPOLLIN)
+        by_fd = {}
+        registered = {}
+
+        def update(conn):
+            for fd, mask in conn.masks().items():
+                if fd in registered:
+                    if registered[fd] != mask:
+                        poller.modify(fd, mask)
+                else:
+                    poller.register(fd, mask)
+                registered[fd] = mask
+
+        def finish(conn):
+            for fd in conn.fds:
+                by_fd.pop(fd, None)
+                if registered.pop(fd, None) is not None:
+                    poller.unregister(fd)
+            conn.close()
+            self.reactor.callFromThread(conn.done)
+
+        while True:
+            try:
+                events = poller.poll()
+            except IOError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                raise
+            ready = set()
+            broken = set()
+            for fd, mask in events:
+                if fd == self._wake_r:
+                    os.read(self._wake_r, 4096)
+                    with self._lock:
+                        added, self._added = self._added, []
+                        removed, self._removed = self._removed, []
+                    for conn in added:
+                        for cfd in conn.fds:
+                            by_fd[cfd] = conn
+                        ready.add(conn)
+                    for conn in removed:
+                        ready.discard(conn)
+                        if by_fd.get(conn.fds[0]) is conn:
+                            finish(conn)
+                elif fd in by_fd:
+                    ready.add(by_fd[fd])
+                    if mask & select.EPOLLERR:
+                        # The socket was reset.  That's reported whatever
+                        # I'm waiting for, so finish now rather than spin
+                        # until a direction that's still open uses it.
+                        broken.add(by_fd[fd])
+            for conn in ready:
+                try:
+                    finished = conn.pump() or conn in broken
+                except OSError as e:
+                    if e.errno not in (errno.ECONNRESET, errno.EPIPE):
+                        log.msg('splice error: %s' % (e,))
+                    finished = True
+                if finished:
+                    finish(conn)
+                else:
+                    update(conn)
@@ -0,0 +1,154 @@
+"""
+Traffic counters for L{grace.pipe.Pipe}s.
+
+Counting is kept to adding to an attribute on the relay path; anything more
+(rates, totals) is worked out when somebody asks.
+"""
+
+import math
+
+
+
+class Rate(object):
+    """
+    I keep an exponentially weighted moving average of how often something
+    happens per second, like the Unix load average.
+
+    Events are only counted as they happen; the average is brought up to
+    date every C{interval} seconds' worth, lazily, when an event is counted
+    or the rate is read.
+    """
+
+    __slots__ = ('clock', 'interval', 'alpha', 'rate', '_uncounted', '_last')
+
+    def __init__(self, clock, window=60.0, interval=5.0):
+        """
+        @param clock: Something with a C{seconds} method, like a reactor.
+        @param window: Time constant of the average, in seconds.
+        @param interval: How often the average is updated, in seconds.
+        """
+        self.clock = clock
+        self.interval = interval
+        self.alpha = 1 - math.exp(-interval / window)
+        self.rate = 0.0
+        self._uncounted = 0
+        self._last = clock.seconds()
+
+
+    def mark(self, n=1):
+        """
+        Count C{n} events.
+        """
+        self._tick()
+        self._uncounted += n
+
+
+    def value(self):
+        """
+        @return: The average number of events per second.
+        """
+        self._tick()
+        return self.rate
+
+
+    def _tick(self):
+        elapsed = self.clock.seconds() - self._last
+        if elapsed < self.interval:
+            return
+        ticks = int(elapsed // self.interval)
+        instant = self._uncounted / self.interval
+        self._uncounted = 0
+        self.rate += self.alpha * (instant - self.rate)
+        if ticks > 1:
+            self.rate *= (1 - self.alpha) ** (ticks - 1)
+        self._last += ticks * self.interval
+
+
+
+class Counters(object):
+    """
+    Traffic through a L{Pipe} to one destination.
+
+    @ivar accepted: Connections accepted and sent to the destination.
+    @ivar connect_failures: Connections that couldn't be made to the
+        destination.
+    @ivar connect_retries: Connections retried to the destination after
+        failing (to it or to another destination).
+    @ivar connect_timeouts: Connections to the destination that failed by
+        taking too long.
+    @ivar bytes_in: Bytes from clients relayed to the destination.
+    @ivar bytes_out: Bytes from the destination relayed to clients.
+    @ivar closed_by_client: Connections the client closed first.
+    @ivar closed_by_upstream: Connections the destination closed first.
+    @ivar closed_on_error: Connections that ended with an error on either
+        side.
+    @ivar closed_forced: Connections closed by grace because the
+        destination was being drained and they didn't finish in time.
+    @ivar closed_idle: Connections closed by grace because nothing was
+        relayed on them for the pipe's C{idle_timeout}.
+    @ivar queued: Connections that had to wait for the pipe's or the
+        destination's connection limit before going to the destination.
+    @ivar queue_wait: Total seconds those connections waited.
+    @ivar rejected: Connections closed because the limit had been reached
+        and the queue was full.  These never get a destination, so only
+        count towards the pipe's totals.
+    @ivar queue_timeouts: Connections closed because they waited too long
+        (also only in the pipe's totals).
+    @ivar pauses_src: Times reading from a client was paused because the
+        destination wasn't keeping up.
+    @ivar pauses_dst: Times reading from the destination was paused because
+        a client wasn't keeping up.
+    @ivar rate: A L{Rate} of accepted connections.
+    """
+
+    fields = ('accepted', 'connect_failures', 'connect_retries',
+              'connect_timeouts', 'bytes_in', 'bytes_out', 'closed_by_client',
+              'closed_by_upstream', 'closed_on_error', 'closed_forced',
+              'closed_idle', 'queued', 'queue_wait', 'rejected',
+              'queue_timeouts', 'pauses_src', 'pauses_dst')
+
+    __slots__ = fields + ('rate',)
+
+    def __init__(self, clock):
+        for name in self.fields:
+            setattr(self, name, 0)
+        self.queue_wait = 0.0
+        self.rate = Rate(clock)
+
+
+    def add(self, other):
+        """
+        Add the counts from another L{Counters} to mine.
+        """
+        for name in self.fields:
+            setattr(self, name, getattr(self, name) + getattr(other, name))
+
+
+    def asDict(self):
+        """
+        @return: A dictionary of my counts, plus the current C{'rate'}.
+        """
+        r = dict((name, getattr(self, name)) for name in self.fields)
+        r['rate'] = self.rate.value()
+        return r
+
+
+
+def mergeStats(rows, keys):
+    """
+    Add up stats rows (as from L{Counters.asDict}) that have the same values
+    for C{keys}.
+
+    @return: A list of merged rows, sorted by C{keys}.
+    """
+    merged = {}
+    for row in rows:
+        key = tuple(row[k] for k in keys)
+        m = merged.get(key)
+        if m is None:
+            merged[key] = dict(row)
+        else:
+            for name, value in row.items():
+                if name not in keys and value is not None:
+                    m[name] = (m.get(name) or 0) + value
+    return [merged[k] for k in sorted(merged)]
@@ -4,31 +4,60 @@ grace_root = FilePath(__file__).parent()
 tac_template = grace_root.child('grace.tac')
 
 
-def getTac(pipedef=None):
+def getTac(pipedef=None, workers=0, metrics=None, defaults=None):
     """
     Get the content of a tac file.
     
     @param pipedef: (optional) a tuple of strings that will be expanded and
-        passed to L{grace.plumbing.Plumber.addPipe} in the tac file.
+        passed to L{grace.plumbing.Plumber.addPipe} in the tac file.  A
+        dictionary of keyword arguments for C{addPipe} may follow the
+        strings.
+    
+    @param workers: (optional) Number of worker processes to relay
+        connections in.  See L{grace.plumbing.Plumber.useWorkers}.
+    
+    @param metrics: (optional) Server endpoint on which to serve metrics.
+        See L{grace.metrics}.
+    
+    @param defaults: (optional) A dictionary of options for every pipe the
+        process starts.  See L{grace.plumbing.Plumber.pipeDefaults}.
         
     @return: A string suitable for use as the contents of a tac file.
     """
     template = tac_template.getContent()
+    if workers:
+        template += ('\nplumber.useWorkers(%d, d.path).setServiceParent('
+                     'application)\n' % (workers,))
+    if defaults:
+        template += '\nplumber.pipeDefaults.update(%r)\n' % (defaults,)
+    if metrics:
+        template += ('\nfrom grace.metrics import metricsSite\n'
+                     'metrics_service = strports.service(%r, '
+                     'metricsSite(plumber))\n'
+                     'metrics_service.setServiceParent(application)\n' % (
+                     metrics,))
     if pipedef:
-        template += '\nplumber.addPipe(%r, %r)\n' % pipedef
+        args = [repr(x) for x in pipedef if not isinstance(x, dict)]
+        for options in [x for x in pipedef if isinstance(x, dict)]:
+            args += ['%s=%r' % (k, v) for k, v in sorted(options.items())]
+        template += '\nplumber.addPipe(%s)\n' % ', '.join(args)
     return template
 
 
 
-def setupDir(dirname, pipedef):
+def setupDir(dirname, pipedef, workers=0, metrics=None, defaults=None):
     """
     Create a grace process directory.
     
     @param dirname: Name of the directory to make into a grace process dir.
     @param pipedef: Argument to pass through to L{getTac} when making the
         tac file.
+    @param workers: Argument to pass through to L{getTac}.
+    @param metrics: Argument to pass through to L{getTac}.
+    @param defaults: Argument to pass through to L{getTac}.
     """
     fp = FilePath(dirname)
     if not fp.exists():
         fp.makedirs()
-    fp.child('grace.tac').setContent(getTac(pipedef))
\ No newline at end of file
+    fp.child('grace.tac').setContent(getTac(pipedef, workers, metrics,
+                                              defaults))
\ No newline at end of file
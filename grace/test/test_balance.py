@@ -0,0 +1,165 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet.address import IPv4Address, UNIXAddress
+
+
+from grace.balance import RoundRobin, LeastConnections, ConsistentHash
+from grace.balance import WeightedRoundRobin
+from grace.balance import getStrategy, strategies, clientKey
+
+
+
+class FakePipe:
+
+
+    def __init__(self, dsts):
+        self.dsts = dsts
+        self._connections = dict((x, 0) for x in dsts)
+
+
+
+def addr(host, port=1234):
+    return IPv4Address('TCP', host, port)
+
+
+
+class RoundRobinTest(TestCase):
+
+
+    def test_pick(self):
+        """
+        Each destination is picked in turn.
+        """
+        pipe = FakePipe(['a', 'b', 'c'])
+        s = RoundRobin()
+        r = [s.pick(pipe, pipe.dsts, addr('1.1.1.1')) for i in range(7)]
+        self.assertEqual(r, ['a', 'b', 'c', 'a', 'b', 'c', 'a'])
+
+
+    def test_shrink(self):
+        """
+        Destinations can be removed between picks.
+        """
+        pipe = FakePipe(['a', 'b', 'c'])
+        s = RoundRobin()
+        s.pick(pipe, pipe.dsts, None)
+        s.pick(pipe, pipe.dsts, None)
+        pipe.dsts = ['a']
+        self.assertEqual(s.pick(pipe, pipe.dsts, None), 'a')
+
+
+
+class LeastConnectionsTest(TestCase):
+
+
+    def test_pick(self):
+        """
+        The destination with the fewest connections is picked.
+        """
+        pipe = FakePipe(['a', 'b', 'c'])
+        pipe._connections.update({'a': 3, 'b': 1, 'c': 2})
+        s = LeastConnections()
+        self.assertEqual(s.pick(pipe, pipe.dsts, None), 'b')
+        self.assertEqual(s.pick(pipe, pipe.dsts, None), 'b')
+
+
+    def test_ties(self):
+        """
+        Tied destinations take turns.
+        """
+        pipe = FakePipe(['a', 'b'])
+        s = LeastConnections()
+        self.assertEqual([s.pick(pipe, pipe.dsts, None) for i in range(4)],
+                         ['a', 'b', 'a', 'b'])
+
+
+
+class WeightedRoundRobinTest(TestCase):
+
+
+    def test_pick(self):
+        """
+        Destinations are picked in proportion to their weights, evenly
+        interleaved, and those with no weight aren't picked.
+        """
+        pipe = FakePipe(['a', 'b', 'c'])
+        pipe.weights = {'a': 0.6, 'b': 0.4, 'c': 0}
+        s = WeightedRoundRobin()
+        r = [s.pick(pipe, pipe.dsts, None) for i in range(5)]
+        self.assertEqual(r, ['a', 'b', 'a', 'b', 'a'])
+
+
+
+class ConsistentHashTest(TestCase):
+
+
+    def test_sameClient(self):
+        """
+        Connections from the same host go to the same destination, whatever
+        port they come from.
+        """
+        pipe = FakePipe(['a', 'b', 'c'])
+        s = ConsistentHash()
+        first = s.pick(pipe, pipe.dsts, addr('10.0.0.1', 1000))
+        for port in range(1001, 1020):
+            client = addr('10.0.0.1', port)
+            self.assertEqual(s.pick(pipe, pipe.dsts, client), first)
+
+
+    def test_spread(self):
+        """
+        Different hosts are spread over all the destinations.
+        """
+        pipe = FakePipe(['a', 'b', 'c'])
+        s = ConsistentHash()
+        hosts = [addr('10.0.%d.%d' % (i / 256, i % 256)) for i in range(300)]
+        picked = set([s.pick(pipe, pipe.dsts, h) for h in hosts])
+        self.assertEqual(picked, set(['a', 'b', 'c']))
+
+
+    def test_remove(self):
+        """
+        Removing a destination only moves the clients that were going to it.
+        """
+        pipe = FakePipe(['a', 'b', 'c'])
+        s = ConsistentHash()
+        hosts = [addr('10.1.%d.%d' % (i / 256, i % 256)) for i in range(300)]
+        before = [s.pick(pipe, pipe.dsts, h) for h in hosts]
+        pipe.dsts = ['a', 'c']
+        after = [s.pick(pipe, pipe.dsts, h) for h in hosts]
+        for b, a in zip(before, after):
+            if b != 'b':
+                self.assertEqual(a, b)
+            else:
+                self.assertIn(a, ['a', 'c'])
+
+
+    def test_clientKey(self):
+        """
+        IP clients are keyed by host; others by their whole address.
+        """
+        self.assertEqual(clientKey(addr('1.2.3.4', 99)), '1.2.3.4')
+        self.assertEqual(clientKey(UNIXAddress('/foo')),
+                         str(UNIXAddress('/foo')))
+
+
+
+class getStrategyTest(TestCase):
+
+
+    def test_names(self):
+        """
+        Strategies are found by name.
+        """
+        self.assertTrue(isinstance(getStrategy('round-robin'), RoundRobin))
+        self.assertTrue(isinstance(getStrategy('least-conns'),
+                                   LeastConnections))
+        self.assertTrue(isinstance(getStrategy('hash'), ConsistentHash))
+        self.assertEqual(sorted(strategies),
+                         ['hash', 'least-conns', 'round-robin'])
+
+
+    def test_unknown(self):
+        """
+        Unknown strategies are an error.
+        """
+        self.assertRaises(ValueError, getStrategy, 'random')
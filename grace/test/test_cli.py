@@ -6,32 +6,21 @@ from twisted.python import log
 
 
 import tempfile
-import commands
-import sys, os
+import os
 
 
 grace_root = FilePath(__file__).parent().parent().parent()
 
 
-from grace.cli import Runner
+from grace.cli import Runner, ShiftOptions, parseDuration, formatStats
+from grace.cli import ApplyOptions, SwitchOptions, WaitOptions
+from grace.cli import formatForced, LimitOptions, parseRate
+from grace.cli import StartOptions
+from twisted.python import usage
 from grace.tac import getTac
 
 
 
-class FakeRunner(Runner):
-
-
-    def __init__(self, result=None):
-        self.called = []
-        self._result = result or ('', '', 0)
-
-
-    def twistd(self, *a, **kw):
-        self.called.append((a, kw))
-        return defer.succeed(self._result)
-
-
-
 class RunnerTest(TestCase):
 
 
@@ -60,50 +49,6 @@ class RunnerTest(TestCase):
             log.msg('%s' % e)
 
 
-    def test_twistd(self):
-        """
-        Should run twistd with the given arguments
-        """
-        runner = Runner()
-        fake_twistd = FilePath(self.mktemp())
-        fake_twistd.setContent('#!%s\n'
-                                'import sys, os\n'
-                                'print " ".join(sys.argv[1:])\n'
-                                'print os.environ["FOO"]\n'
-                                'print os.path.abspath(os.curdir)\n'
-                                'sys.stdout.flush()\n'
-                                'sys.stderr.write("error\\n")\n'
-                                'print "stdout"\n'
-                                'sys.exit(4)\n' % sys.executable)
-        fake_twistd.chmod(0777)
-        runner._twistdBin = lambda: fake_twistd.path
-        
-        path = FilePath(self.mktemp())
-        path.makedirs()
-        
-        d = runner.twistd(['foo', 'bar', 'baz'], env={'FOO': 'foo value'},
-                      path=path.path)
-        def check(result):
-            out, err, code = result
-            self.assertEqual(code, 4)
-            self.assertEqual(out, 
-                'foo bar baz\n'
-                'foo value\n'
-                '%s\n'
-                'stdout\n' % path.path)
-            self.assertEqual(err, 'error\n')
-        return d.addCallback(check)
-
-
-    def test__twistdBin(self):
-        """
-        Should know what twistd to use.
-        """
-        runner = Runner()
-        path = commands.getoutput('which twistd')
-        self.assertEqual(runner._twistdBin(), path)
-
-
     def tailUntil(self, filename, text):
         """
         Tail a file until you see text
@@ -250,6 +195,76 @@ class RunnerTest(TestCase):
         ], "Should have switched")
 
 
+    @defer.inlineCallbacks
+    def test_switch_balanced(self):
+        """
+        You can switch to several destinations at once.
+        """
+        runner = Runner()
+
+        base = FilePath(tempfile.mkdtemp())
+        root = base.child('root')
+        src = base.child('src')
+        dst = base.child('dst')
+        
+        _ = yield runner.start(root.path, 'unix:'+src.path, 'unix:'+dst.path)
+        
+        pidfile = root.child('grace.pid')
+        pid = pidfile.getContent()
+        self.addCleanup(self.kill, pid)
+        r = yield runner.switch(root.path, 'unix:'+src.path,
+                                ['unix:/foo', 'unix:/bar'])
+        r = yield runner.ls(root.path)
+        self.assertEqual(sorted(r), sorted([
+            {
+                'src': 'unix:'+src.path,
+                'dst': 'unix:/foo',
+                'conns': 0,
+                'active': True,
+            },
+            {
+                'src': 'unix:'+src.path,
+                'dst': 'unix:/bar',
+                'conns': 0,
+                'active': True,
+            },
+        ]), "Should have switched to both")
+
+
+    @defer.inlineCallbacks
+    def test_apply(self):
+        """
+        You can make the pipes match a config in one go.
+        """
+        runner = Runner()
+
+        base = FilePath(tempfile.mkdtemp())
+        root = base.child('root')
+        src = base.child('src')
+        src2 = base.child('src2')
+        dst = base.child('dst')
+        
+        _ = yield runner.start(root.path, 'unix:'+src.path, 'unix:'+dst.path)
+        
+        pidfile = root.child('grace.pid')
+        pid = pidfile.getContent()
+        self.addCleanup(self.kill, pid)
+        results = yield runner.apply(root.path, [
+            ('unix:'+src.path, 'unix:/foo'),
+            ('unix:'+src2.path, ['unix:/bar', 'unix:/baz']),
+        ], wait=True)
+        self.assertEqual(results, [
+            {'src': 'unix:'+src.path, 'action': 'switched'},
+            {'src': 'unix:'+src2.path, 'action': 'added'},
+        ])
+        r = yield runner.ls(root.path)
+        self.assertEqual(sorted((x['src'], x['dst']) for x in r), [
+            ('unix:'+src.path, 'unix:/foo'),
+            ('unix:'+src2.path, 'unix:/bar'),
+            ('unix:'+src2.path, 'unix:/baz'),
+        ])
+
+
     @defer.inlineCallbacks
     def test_wait(self):
         """
@@ -272,3 +287,249 @@ class RunnerTest(TestCase):
         
         r = yield runner.wait(root.path, 'unix:'+src.path)
 
+
+
+class parseDurationTest(TestCase):
+
+
+    def test_units(self):
+        """
+        Durations can be given in seconds, with or without units.
+        """
+        self.assertEqual(parseDuration('60'), 60)
+        self.assertEqual(parseDuration('1.5'), 1.5)
+        self.assertEqual(parseDuration('60s'), 60)
+        self.assertEqual(parseDuration('2m'), 120)
+        self.assertEqual(parseDuration('1h'), 3600)
+        self.assertEqual(parseDuration('500ms'), 0.5)
+        self.assertRaises(usage.UsageError, parseDuration, 'soon')
+
+
+
+class parseRateTest(TestCase):
+
+
+    def test_units(self):
+        """
+        Rates are bytes per second, with or without a multiplier.
+        """
+        self.assertEqual(parseRate('500'), 500)
+        self.assertEqual(parseRate('500k'), 500000)
+        self.assertEqual(parseRate('2M'), 2000000)
+        self.assertEqual(parseRate('1G'), 1000000000)
+        self.assertRaises(usage.UsageError, parseRate, 'fast')
+        self.assertRaises(usage.UsageError, parseRate, '-1M')
+
+
+
+class LimitOptionsTest(TestCase):
+
+
+    def test_limits(self):
+        """
+        Only the limits given are changed, and at least one must be.
+        """
+        o = LimitOptions()
+        o.parseOptions(['--rate-limit', '10M', '--conn-rate-limit', '0',
+                        'src'])
+        self.assertEqual(o['src'], 'src')
+        self.assertEqual(o.limits(), {'rate_limit': 10000000,
+                                      'conn_rate_limit': 0})
+        self.assertRaises(usage.UsageError, LimitOptions().parseOptions,
+                          ['src'])
+
+
+
+class StartOptionsTest(TestCase):
+
+
+    def test_engine(self):
+        """
+        The engine is a default for every pipe, rather than an option of the
+        first one, and can't be asyncio with splicing.
+        """
+        o = StartOptions()
+        o.parseOptions(['--engine', 'asyncio', 'src', 'dst'])
+        self.assertEqual(o.pipeDefaults(), {'engine': 'asyncio'})
+        self.assertEqual(o.pipeOptions(), {})
+        o = StartOptions()
+        o.parseOptions(['src', 'dst'])
+        self.assertEqual(o.pipeDefaults(), {})
+        self.assertRaises(usage.UsageError, StartOptions().parseOptions,
+                          ['--engine', 'gevent', 'src', 'dst'])
+        self.assertRaises(usage.UsageError, StartOptions().parseOptions,
+                          ['--engine', 'asyncio', '--splice', 'src', 'dst'])
+
+
+    def test_coalesce(self):
+        """
+        The coalescing delay is a duration.
+        """
+        o = StartOptions()
+        o.parseOptions(['--coalesce-delay', '2ms', '--coalesce-size', '4096',
+                        'src', 'dst'])
+        self.assertEqual(o.pipeOptions(), {'coalesce_delay': 0.002,
+                                           'coalesce_size': 4096})
+
+
+
+class ShiftOptionsTest(TestCase):
+
+
+    def test_start(self):
+        """
+        Starting a shift needs a dst and a duration.
+        """
+        o = ShiftOptions()
+        o.parseOptions(['--over', '60s', '--steps', '4', 'src', 'dst'])
+        self.assertEqual((o['src'], o['dst'], o['over'], o['steps']),
+                         ('src', 'dst', 60, 4))
+        self.assertEqual(o.action, None)
+        self.assertRaises(usage.UsageError, ShiftOptions().parseOptions,
+                          ['src', 'dst'])
+
+
+    def test_action(self):
+        """
+        A shift in progress can be paused, resumed or aborted.
+        """
+        o = ShiftOptions()
+        o.parseOptions(['--abort', 'src'])
+        self.assertEqual(o.action, 'abort')
+        self.assertRaises(usage.UsageError, ShiftOptions().parseOptions,
+                          ['--pause', '--abort', 'src'])
+
+
+
+class DrainOptionsTest(TestCase):
+
+
+    def test_switch(self):
+        """
+        A switch can be given a deadline for the old destinations to drain
+        by, and a grace period for active connections after it.
+        """
+        o = SwitchOptions()
+        o.parseOptions(['--drain-timeout', '2m', '--grace', '10s', 'src',
+                        'dst'])
+        self.assertEqual((o['drain-timeout'], o['grace']), (120, 10))
+        o = SwitchOptions()
+        o.parseOptions(['src', 'dst'])
+        self.assertEqual((o['drain-timeout'], o['grace']), (None, None))
+        self.assertRaises(usage.UsageError, SwitchOptions().parseOptions,
+                          ['--grace', '10s', 'src', 'dst'])
+
+
+    def test_wait(self):
+        """
+        A wait can be given a timeout.
+        """
+        o = WaitOptions()
+        o.parseOptions(['--timeout', '30', 'src'])
+        self.assertEqual((o['timeout'], o['grace']), (30, None))
+        self.assertRaises(usage.UsageError, WaitOptions().parseOptions,
+                          ['--grace', '10s', 'src'])
+
+
+    def test_formatForced(self):
+        """
+        The number of connections closed is reported.
+        """
+        self.assertEqual(formatForced(0),
+                         'Drained; closed 0 connections that were still open')
+        self.assertEqual(formatForced(1),
+                         'Drained; closed 1 connection that was still open')
+
+
+
+class ApplyOptionsTest(TestCase):
+
+
+    def test_file(self):
+        """
+        The config file is read and parsed.
+        """
+        fp = FilePath(self.mktemp())
+        fp.setContent('# pipes\ntcp:80 tcp:host=a:port=1 tcp:host=b:port=1\n')
+        o = ApplyOptions()
+        o.parseOptions(['--wait', fp.path])
+        self.assertEqual(o['pipes'], [
+            ('tcp:80', ['tcp:host=a:port=1', 'tcp:host=b:port=1'])])
+        self.assertTrue(o['wait'])
+
+
+    def test_bad(self):
+        """
+        A missing or bad config file is a usage error.
+        """
+        fp = FilePath(self.mktemp())
+        self.assertRaises(usage.UsageError, ApplyOptions().parseOptions,
+                          [fp.path])
+        fp.setContent('tcp:80\n')
+        self.assertRaises(usage.UsageError, ApplyOptions().parseOptions,
+                          [fp.path])
+
+
+
+class formatStatsTest(TestCase):
+
+
+    def test_table(self):
+        """
+        Each pipe's totals are followed by its destinations' counts.
+        """
+        counts = {
+            'accepted': 3,
+            'connect_failures': 1,
+            'connect_retries': 2,
+            'connect_timeouts': 1,
+            'bytes_in': 100,
+            'bytes_out': 2000,
+            'closed_by_client': 1,
+            'closed_by_upstream': 0,
+            'closed_on_error': 1,
+            'closed_forced': 2,
+            'closed_idle': 4,
+            'queued': 2,
+            'queue_wait': 3.0,
+            'rejected': 5,
+            'queue_timeouts': 0,
+            'pauses_src': 7,
+            'pauses_dst': 8,
+            'rate': 0.5,
+        }
+        lines = formatStats({
+            'pipes': [dict(counts, src='tcp:9000', waiting=6,
+                           throttled=12.5)],
+            'dsts': [dict(counts, src='tcp:9000', dst='tcp:host=a:port=1')],
+        }).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0].split()[:3], ['src/dst', 'accepted',
+                                                'conns/s'])
+        self.assertEqual(lines[1].split(), ['tcp:9000', '3', '0.50', '100',
+                                            '2000', '1', '2', '1', '1', '0',
+                                            '1', '2', '4', '2', '1.500',
+                                            '5', '0', '6', '12.5', '7',
+                                            '8'])
+        self.assertTrue(lines[2].startswith('  tcp:host=a:port=1'))
+
+
+    def test_grouped(self):
+        """
+        Destinations are listed under their own pipe, in the order given,
+        however the rows for different pipes are mixed up.
+        """
+        counts = dict.fromkeys([
+            'accepted', 'connect_failures', 'connect_retries',
+            'connect_timeouts', 'bytes_in', 'bytes_out', 'closed_by_client',
+            'closed_by_upstream', 'closed_on_error', 'closed_forced',
+            'closed_idle', 'queued', 'queue_wait', 'rejected',
+            'queue_timeouts', 'rate'], 0)
+        lines = formatStats({
+            'pipes': [dict(counts, src='a'), dict(counts, src='b')],
+            'dsts': [dict(counts, src='b', dst='b1'),
+                     dict(counts, src='a', dst='a1'),
+                     dict(counts, src='b', dst='b2')],
+        }).splitlines()
+        self.assertEqual([l.split()[0] for l in lines[1:]],
+                         ['a', 'a1', 'b', 'b1', 'b2'])
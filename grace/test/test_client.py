@@ -0,0 +1,155 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, defer, endpoints, error
+
+import tempfile
+
+from grace.client import ControlClient
+from grace.control import ServerFactory
+from grace.plumbing import Plumber
+from grace.test.util import FakeConnection
+
+
+
+class CountingServerFactory(ServerFactory):
+    """
+    I count the control connections made to me.
+    """
+
+    def __init__(self, plumber):
+        ServerFactory.__init__(self, plumber)
+        self.protocols = []
+
+
+    def buildProtocol(self, addr):
+        proto = ServerFactory.buildProtocol(self, addr)
+        self.protocols.append(proto)
+        return proto
+
+
+
+class ControlClientTest(TestCase):
+
+
+    timeout = 3
+
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp() + '/grace.socket'
+        self.plumber = Plumber()
+        self.factory = CountingServerFactory(self.plumber)
+        self.client = ControlClient(None, endpoint=endpoints.UNIXClientEndpoint(
+            reactor, self.path))
+        self.client.retryDelay = 0.01
+        self.addCleanup(self.client.close)
+
+
+    @defer.inlineCallbacks
+    def listen(self):
+        port = yield endpoints.UNIXServerEndpoint(reactor, self.path).listen(
+            self.factory)
+        self.addCleanup(port.stopListening)
+        defer.returnValue(port)
+
+
+    @defer.inlineCallbacks
+    def test_pipelined(self):
+        """
+        Many commands can be in flight at once over one connection.
+        """
+        yield self.listen()
+        self.plumber.addPipe('unix:foo', 'unix:a')
+        conn = object()
+        self.plumber.getPipe('unix:foo').addConnection('unix:a', conn)
+        yield self.client.switch('unix:foo', 'unix:b')
+        waited = []
+        waiting = self.client.wait('unix:foo').addCallback(waited.append)
+        ls = yield self.client.ls()
+        self.assertEqual(sorted((x['dst'], x['conns']) for x in ls),
+                         [('unix:a', 1), ('unix:b', 0)])
+        self.assertEqual(waited, [], "Wait shouldn't hold up ls")
+        self.plumber.getPipe('unix:foo').removeConnection('unix:a', conn)
+        yield waiting
+        yield self.client.switch('unix:foo', ['unix:c', 'unix:d'])
+        self.assertEqual(self.plumber.getDsts('unix:foo'),
+                         ['unix:c', 'unix:d'])
+        self.assertEqual(len(self.factory.protocols), 1)
+
+
+    @defer.inlineCallbacks
+    def test_apply(self):
+        """
+        Applying a config gives back what was done to each pipe, and why a
+        pipe couldn't be added.
+        """
+        yield self.listen()
+        self.plumber.pipe_services.startService()
+        self.addCleanup(self.plumber.pipe_services.stopService)
+        good = 'unix:' + self.mktemp()
+        bad = 'unix:' + self.mktemp() + '/nodir/sock'
+        results = yield self.client.apply([(good, 'unix:a'), (bad, 'unix:b')])
+        self.assertEqual(len(results), 2)
+        self.assertIn('error', results[[x['src'] for x in results].index(bad)])
+        self.assertEqual(sorted((x['src'], x['action']) for x in results),
+                         sorted([(good, 'skipped'), (bad, 'failed')]))
+        self.assertEqual(self.plumber.pipe_services.names, [])
+
+        results = yield self.client.apply([(good, 'unix:a')])
+        self.assertEqual(results, [{'src': good, 'action': 'added'}])
+
+
+    @defer.inlineCallbacks
+    def test_drain(self):
+        """
+        Switching or waiting with a drain timeout gives the number of
+        connections that had to be closed.
+        """
+        yield self.listen()
+        self.plumber.addPipe('unix:foo', 'unix:a')
+        pipe = self.plumber.getPipe('unix:foo')
+        conn = FakeConnection(pipe, 'unix:a')
+        forced = yield self.client.switch('unix:foo', 'unix:b',
+                                          drain_timeout=0)
+        self.assertEqual(forced, 1)
+        self.assertTrue(conn.forced)
+        forced = yield self.client.wait('unix:foo', timeout=0, grace=1)
+        self.assertEqual(forced, 0)
+
+
+    @defer.inlineCallbacks
+    def test_reconnect(self):
+        """
+        If the connection is lost, the next command connects again.
+        """
+        yield self.listen()
+        yield self.client.ls()
+        lost = defer.Deferred()
+        proto = self.client._proto
+        original = proto.connectionLost
+        def connectionLost(reason):
+            original(reason)
+            lost.callback(None)
+        proto.connectionLost = connectionLost
+        self.factory.protocols[0].transport.loseConnection()
+        yield lost
+        yield self.client.ls()
+        self.assertEqual(len(self.factory.protocols), 2)
+
+
+    @defer.inlineCallbacks
+    def test_retryConnect(self):
+        """
+        If the control socket isn't there yet, connecting is retried.
+        """
+        d = self.client.ls()
+        yield self.listen()
+        rows = yield d
+        self.assertEqual(rows, [])
+
+
+    def test_connectFailed(self):
+        """
+        Once the retries run out, commands fail.
+        """
+        self.client.connectRetries = 1
+        d = self.client.ls()
+        return self.assertFailure(d, error.ConnectError)
@@ -0,0 +1,69 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor
+
+
+from grace.config import parseConfig, ConfigError, dstList, checkPipe
+
+
+
+class parseConfigTest(TestCase):
+
+
+    def test_pipes(self):
+        """
+        Each line is a src followed by one or more dsts; blank lines and
+        comments are skipped.
+        """
+        pipes = parseConfig('# a comment\n'
+                            'tcp:80  tcp:host=a:port=1\n'
+                            '\n'
+                            '   \n'
+                            'tcp:81 tcp:host=a:port=2\ttcp:host=b:port=2\n')
+        self.assertEqual(pipes, [
+            ('tcp:80', 'tcp:host=a:port=1'),
+            ('tcp:81', ['tcp:host=a:port=2', 'tcp:host=b:port=2']),
+        ])
+
+
+    def test_noDst(self):
+        """
+        A line without a destination is an error.
+        """
+        e = self.assertRaises(ConfigError, parseConfig, '\ntcp:80\n')
+        self.assertIn('Line 2', str(e))
+
+
+    def test_duplicate(self):
+        """
+        A src can only be configured once.
+        """
+        self.assertRaises(ConfigError, parseConfig,
+                          'tcp:80 tcp:host=a:port=1\n'
+                          'tcp:80 tcp:host=a:port=2\n')
+
+
+
+class checkPipeTest(TestCase):
+
+
+    def test_dstList(self):
+        self.assertEqual(dstList('foo'), ['foo'])
+        self.assertEqual(dstList(('foo', 'bar')), ['foo', 'bar'])
+
+
+    def test_bad(self):
+        """
+        Endpoints that can't be parsed are errors.
+        """
+        checkPipe(reactor, 'tcp:80', ['tcp:host=a:port=1'])
+        self.assertRaises(ConfigError, checkPipe, reactor, 'bogus:80',
+                          ['tcp:host=a:port=1'])
+        self.assertRaises(ConfigError, checkPipe, reactor, 'tcp:80',
+                          ['tcp:host=a:port=1', 'tcp:nope'])
+
+
+    def test_existing(self):
+        """
+        The src of an existing pipe isn't checked.
+        """
+        checkPipe(reactor, 'bogus:80', ['tcp:host=a:port=1'], new=False)
@@ -6,6 +6,11 @@ from twisted.internet import defer
 from grace.plumbing import Plumber
 from grace.control import Server, ServerFactory
 from grace.control import AddPipe, RemovePipe, Switch, Stop, List, Wait
+from grace.control import AddBalancedPipe, SwitchBalanced
+from grace.control import Shift, PauseShift, ResumeShift, AbortShift
+from grace.control import Limit
+from grace.control import Stats, ApplyConfig
+from grace.config import ConfigError
 
 
 
@@ -18,8 +23,11 @@ class FakePlumber(Plumber):
         self._results = results or {}
 
 
-    def addPipe(self, src, dst):
-        self.called.append(('addPipe', src, dst))
+    def addPipe(self, src, dst, **options):
+        if options:
+            self.called.append(('addPipe', src, dst, options))
+        else:
+            self.called.append(('addPipe', src, dst))
         return self._results.get('addPipe', None)
 
 
@@ -33,6 +41,16 @@ class FakePlumber(Plumber):
         return self._results.get('pipeCommand', None)
 
 
+    def limit(self, src, **limits):
+        self.called.append(('limit', src, limits))
+        return self._results.get('limit', None)
+
+
+    def drain(self, src, timeout, grace=None):
+        self.called.append(('drain', src, timeout, grace))
+        return self._results.get('drain', None)
+
+
     def stop(self):
         self.called.append('stop')
         return self._results.get('stop', None)
@@ -43,6 +61,35 @@ class FakePlumber(Plumber):
         return self._results.get('ls', None)
 
 
+    def stats(self):
+        self.called.append('stats')
+        return self._results.get('stats', None)
+
+
+    def info(self, src, dst):
+        return self._results.get('info', {}).get((src, dst), {})
+
+
+    def handOff(self, proto):
+        self.called.append(('handOff', proto))
+        r = self._results.get('handOff')
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+
+    def retire(self):
+        self.called.append('retire')
+
+
+    def applyConfig(self, pipes):
+        self.called.append(('applyConfig', pipes))
+        r = self._results.get('applyConfig')
+        if isinstance(r, Exception):
+            raise r
+        return r
+
+
 
 class ServerFactoryTest(TestCase):
 
@@ -116,6 +163,24 @@ class ServerTest(TestCase):
         ])
 
 
+    def test_switch_drain_timeout(self):
+        """
+        Given a drain timeout, the switch isn't answered until the old
+        destination has drained, with the number of connections that were
+        closed by force.
+        """
+        drained = defer.Deferred()
+        c = Server(FakePlumber({'drain': drained}))
+        r = c.switch('foo', 'dst2', drain_timeout=30.0, grace=5.0)
+        self.assertEqual(c.plumber.called, [
+            ('pipeCommand', 'foo', 'switch', ('dst2',), {}),
+            ('drain', 'foo', 30.0, 5.0),
+        ])
+        self.assertNoResult(r)
+        drained.callback(2)
+        self.assertEqual(self.successResultOf(r), {'forced': 2})
+
+
     def test_stop(self):
         """
         Stop should mirror plumber.stop
@@ -160,6 +225,25 @@ class ServerTest(TestCase):
         ])
 
 
+    def test_handOff(self):
+        """
+        The pipes are handed off over the connection asking for them, and
+        then the plumber retires.
+        """
+        c = Server(FakePlumber())
+        self.assertEqual(self.successResultOf(c.handOff()), {})
+        self.assertEqual(c.plumber.called, [('handOff', c), 'retire'])
+
+
+    def test_handOff_error(self):
+        """
+        If the pipes can't be handed off, the plumber doesn't retire.
+        """
+        c = Server(FakePlumber({'handOff': ValueError('workers')}))
+        self.failureResultOf(c.handOff(), ValueError)
+        self.assertEqual(c.plumber.called, [('handOff', c)])
+
+
     def test_wait(self):
         """
         Wait should wait
@@ -179,6 +263,17 @@ class ServerTest(TestCase):
         return r.addCallback(check)
 
 
+    def test_wait_timeout(self):
+        """
+        Waiting with a timeout drains the pipe, closing what's left at the
+        deadline.
+        """
+        c = Server(FakePlumber({'drain': defer.succeed(3)}))
+        r = c.wait('foo', drain_timeout=10.0)
+        self.assertEqual(c.plumber.called, [('drain', 'foo', 10.0, None)])
+        self.assertEqual(self.successResultOf(r), {'forced': 3})
+
+
 
 class SingleCommandClient(amp.AMP):
     
@@ -225,6 +320,40 @@ class ClientTest(TestCase):
         return r.addCallback(check)
 
 
+    def test_AddPipe_options(self):
+        """
+        Pipe options are passed along when given.
+        """
+        server = Server(FakePlumber())
+        client = SingleCommandClient(AddPipe, src='foo', dst='bar',
+                                     splice=True, high_water=100)
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(server.plumber.called, [
+                ('addPipe', 'foo', 'bar', {'splice': True, 'high_water': 100}),
+            ])
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
+    def test_AddBalancedPipe(self):
+        """
+        You can add a pipe with several destinations.
+        """
+        server = Server(FakePlumber())
+        client = SingleCommandClient(AddBalancedPipe, src='foo',
+                                     dsts=['bar', 'baz'], balance='hash')
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(server.plumber.called, [
+                ('addPipe', 'foo', ['bar', 'baz'], {'balance': 'hash'}),
+            ])
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
     def test_RemovePipe(self):
         """
         You can remove a pipe.
@@ -257,6 +386,67 @@ class ClientTest(TestCase):
         return r.addCallback(check)
 
 
+    def test_SwitchBalanced(self):
+        """
+        You can switch forwarding to several destinations.
+        """
+        server = Server(FakePlumber())
+        client = SingleCommandClient(SwitchBalanced, src='foo',
+                                     dsts=['bar', 'baz'])
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(server.plumber.called, [
+                ('pipeCommand', 'foo', 'switch', (['bar', 'baz'],), {}),
+            ])
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
+    def test_Shift(self):
+        """
+        You can shift forwarding gradually, and pause, resume or abort the
+        shift.
+        """
+        plumber = FakePlumber()
+        from twisted.protocols.loopback import loopbackAsync
+        def send(result, cmd, **kwargs):
+            return loopbackAsync(Server(plumber),
+                                 SingleCommandClient(cmd, **kwargs))
+        r = send(None, Shift, src='foo', dst='bar', over=60.0)
+        r.addCallback(send, Shift, src='foo', dst='bar', over=6.0, steps=3)
+        for command in [PauseShift, ResumeShift, AbortShift]:
+            r.addCallback(send, command, src='foo')
+        def check(response):
+            self.assertEqual(plumber.called, [
+                ('pipeCommand', 'foo', 'shift', ('bar', 60.0, 0), {}),
+                ('pipeCommand', 'foo', 'shift', ('bar', 6.0, 3), {}),
+                ('pipeCommand', 'foo', 'pauseShift', (), {}),
+                ('pipeCommand', 'foo', 'resumeShift', (), {}),
+                ('pipeCommand', 'foo', 'abortShift', (), {}),
+            ])
+        return r.addCallback(check)
+
+
+    def test_Limit(self):
+        """
+        You can change a pipe's rate limits, leaving alone the ones you
+        don't send.
+        """
+        server = Server(FakePlumber())
+        client = SingleCommandClient(Limit, src='foo', rate_limit=1000.0,
+                                     conn_rate_limit=0.0)
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(server.plumber.called, [
+                ('limit', 'foo', {'rate_limit': 1000.0,
+                                  'conn_rate_limit': 0.0}),
+            ])
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
     def test_Stop(self):
         """
         You can stop the whole server.
@@ -281,24 +471,100 @@ class ClientTest(TestCase):
             ]
         }))
         client = SingleCommandClient(List)
+        # optional details that weren't sent
+        unsent = dict((name, None) for name, arg in
+                      List.response[0][1].subargs if arg.optional)
 
         from twisted.protocols.loopback import loopbackAsync
         def check(response):
             self.assertEqual(server.plumber.called, ['ls'])
             self.assertEqual(client.response, {
                 'pipes': [
-                    {
+                    dict({
                         'src': 'foo',
                         'dst': 'bar',
                         'conns': 12,
                         'active': True,
-                    },
+                    }, **unsent),
                 ]
             })
         r = loopbackAsync(server, client)
         return r.addCallback(check)
 
 
+    def test_List_info(self):
+        """
+        Extra details about a destination are included in the listing.
+        """
+        server = Server(FakePlumber({
+            'ls': [
+                ('foo', 'bar', 12, True),
+            ],
+            'info': {
+                ('foo', 'bar'): {'pool_hits': 3, 'pool_misses': 1,
+                                 'weight': 0.25},
+            },
+        }))
+        client = SingleCommandClient(List)
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            row = client.response['pipes'][0]
+            self.assertEqual(dict((k, v) for k, v in row.items()
+                                  if v is not None), {
+                'src': 'foo',
+                'dst': 'bar',
+                'conns': 12,
+                'active': True,
+                'pool_hits': 3,
+                'pool_misses': 1,
+                'weight': 0.25,
+            })
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
+    def test_Stats(self):
+        """
+        You can get traffic counts.
+        """
+        counts = {
+            'accepted': 3,
+            'connect_failures': 1,
+            'connect_retries': 2,
+            'connect_timeouts': 1,
+            'bytes_in': 100,
+            'bytes_out': 2000,
+            'closed_by_client': 1,
+            'closed_by_upstream': 0,
+            'closed_on_error': 1,
+            'closed_forced': 0,
+            'closed_idle': 0,
+            'queued': 0,
+            'queue_wait': 0.0,
+            'rejected': 0,
+            'queue_timeouts': 0,
+            'pauses_src': 4,
+            'pauses_dst': 0,
+            'rate': 0.5,
+        }
+        server = Server(FakePlumber({
+            'stats': ([dict(counts, src='foo', waiting=2, throttled=1.5)],
+                      [dict(counts, src='foo', dst='bar')]),
+        }))
+        client = SingleCommandClient(Stats)
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(client.response, {
+                'pipes': [dict(counts, src='foo', waiting=2, throttled=1.5)],
+                'dsts': [dict(counts, src='foo', dst='bar', waiting=None,
+                              throttled=None)],
+            })
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
     def test_Wait(self):
         """
         You can wait for connections to settle.
@@ -318,5 +584,118 @@ class ClientTest(TestCase):
         self.assertFalse(r.called)
         wait_ret.callback(None)
         return r.addCallback(check)
+
+
+    def test_Wait_timeout(self):
+        """
+        Waiting with a timeout says how many connections were closed.
+        """
+        server = Server(FakePlumber({'drain': defer.succeed(1)}))
+        client = SingleCommandClient(Wait, src='foo', drain_timeout=2.5,
+                                     grace=1.0)
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(server.plumber.called, [
+                ('drain', 'foo', 2.5, 1.0),
+            ])
+            self.assertEqual(client.response, {'forced': 1})
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
         
 
+
+    def test_ApplyConfig(self):
+        """
+        You can apply a whole config, and get back what was done to each
+        pipe.
+        """
+        results = [{'src': 'foo', 'action': 'switched'}]
+        server = Server(FakePlumber({
+            'applyConfig': (results, defer.Deferred()),
+        }))
+        client = SingleCommandClient(ApplyConfig, pipes=[
+            {'src': 'foo', 'dsts': ['bar']},
+            {'src': 'baz', 'dsts': ['a', 'b']},
+        ])
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(server.plumber.called, [
+                ('applyConfig', [('foo', ['bar']), ('baz', ['a', 'b'])]),
+            ])
+            self.assertEqual(client.response, {'results': [
+                {'src': 'foo', 'action': 'switched', 'error': None},
+            ]})
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
+    def test_ApplyConfig_failed(self):
+        """
+        Pipes that couldn't be added are reported with why.
+        """
+        results = [
+            {'src': 'bar', 'action': 'skipped'},
+            {'src': 'foo', 'action': 'failed', 'error': 'Address in use'},
+        ]
+        server = Server(FakePlumber({
+            'applyConfig': (results, defer.succeed(None)),
+        }))
+        client = SingleCommandClient(ApplyConfig, pipes=[
+            {'src': 'foo', 'dsts': ['a']},
+        ])
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(client.response, {'results': [
+                {'src': 'bar', 'action': 'skipped', 'error': None},
+                {'src': 'foo', 'action': 'failed', 'error': 'Address in use'},
+            ]})
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
+
+
+    def test_ApplyConfig_wait(self):
+        """
+        If asked to, applying a config waits for the switched pipes to
+        drain before responding.
+        """
+        drained = defer.Deferred()
+        server = Server(FakePlumber({
+            'applyConfig': ([], drained),
+        }))
+        client = SingleCommandClient(ApplyConfig, pipes=[], wait=True)
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(client.response, {'results': []})
+        r = loopbackAsync(server, client)
+        self.assertEqual(client.response, None)
+        drained.callback(None)
+        return r.addCallback(check)
+
+
+    def test_ApplyConfig_error(self):
+        """
+        A bad config is reported to the client.
+        """
+        server = Server(FakePlumber({
+            'applyConfig': ConfigError('no good'),
+        }))
+        client = amp.AMP()
+        errors = []
+        def connected():
+            d = client.callRemote(ApplyConfig, pipes=[])
+            d.addErrback(errors.append)
+            d.addBoth(lambda x: client.transport.loseConnection())
+        client.connectionMade = lambda: (amp.AMP.connectionMade(client),
+                                         connected())
+
+        from twisted.protocols.loopback import loopbackAsync
+        def check(response):
+            self.assertEqual(len(errors), 1)
+            errors[0].trap(ConfigError)
+            self.assertEqual(errors[0].getErrorMessage(), 'no good')
+        r = loopbackAsync(server, client)
+        return r.addCallback(check)
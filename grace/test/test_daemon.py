@@ -0,0 +1,281 @@
+from twisted.trial.unittest import TestCase
+from twisted.application import service, strports
+from twisted.internet import reactor, defer, error, protocol
+from twisted.python.filepath import FilePath
+
+import os
+import tempfile
+
+from grace.daemon import runningPid, startListening, whenListening
+from grace.daemon import spawnDaemon, _StartProtocol, Notifier
+from grace.daemon import takeOver, AppendingLogFile
+from grace.plumbing import Plumber
+from grace.control import ServerFactory
+from grace.tac import setupDir
+
+
+# Found now, before trial changes directory.
+_top = os.path.dirname(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))))
+
+
+
+class runningPidTest(TestCase):
+
+
+    def test_running(self):
+        fp = FilePath(self.mktemp())
+        self.assertEqual(runningPid(fp.path), None)
+        fp.setContent('%d\n' % (os.getpid(),))
+        self.assertEqual(runningPid(fp.path), os.getpid())
+
+
+    def test_gone(self):
+        """
+        A pid file naming a process that has exited doesn't count.
+        """
+        fp = FilePath(self.mktemp())
+        fp.setContent('999999999\n')
+        self.assertEqual(runningPid(fp.path), None)
+        fp.setContent('garbage\n')
+        self.assertEqual(runningPid(fp.path), None)
+
+
+
+class NotifierTest(TestCase):
+
+
+    def notifier(self):
+        r, w = os.pipe()
+        self.addCleanup(os.close, r)
+        return Notifier(w), r
+
+
+    def test_ready(self):
+        """
+        Ready is sent once, straight away.
+        """
+        notifier, r = self.notifier()
+        notifier.ready()
+        notifier.failed('too late')
+        notifier.close()
+        self.assertEqual(os.read(r, 100), 'ready\n')
+        self.assertEqual(os.read(r, 100), '')
+
+
+    def test_failed(self):
+        """
+        The first failure is sent when I'm closed.
+        """
+        notifier, r = self.notifier()
+        notifier.failed('first')
+        notifier.failed('second')
+        notifier.close()
+        self.assertEqual(os.read(r, 100), 'first\n')
+
+
+
+class whenListeningTest(TestCase):
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.top = service.MultiService()
+        self.addCleanup(self.stop)
+
+
+    def stop(self):
+        if self.top.running:
+            return self.top.stopService()
+
+
+    def add(self, name):
+        s = strports.service('unix:%s/%s' % (self.dir, name),
+                             protocol.Factory())
+        s.setServiceParent(self.top)
+        return s
+
+
+    def test_listening(self):
+        """
+        Fires once everything is listening.
+        """
+        self.add('a')
+        inner = service.MultiService()
+        inner.setServiceParent(self.top)
+        strports.service('unix:%s/b' % (self.dir,), protocol.Factory()
+                         ).setServiceParent(inner)
+        startListening(self.top)
+        self.successResultOf(whenListening(self.top))
+        self.assertTrue(os.path.exists(self.dir + '/b'))
+
+
+    def test_bindError(self):
+        """
+        Listening errors are raised rather than logged.
+        """
+        port = reactor.listenUNIX(self.dir + '/a', protocol.Factory(),
+                                  wantPID=False)
+        self.addCleanup(port.stopListening)
+        self.add('a')
+        self.assertRaises(error.CannotListenError, startListening, self.top)
+
+
+
+class takeOverTest(TestCase):
+
+
+    timeout = 3
+
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.old = Plumber()
+        self.stopped = []
+        self.old.stop = lambda: self.stopped.append(True)
+        self.top = service.MultiService()
+        self.old.pipe_services.setServiceParent(self.top)
+        strports.service('unix:%s/grace.socket' % (self.dir,),
+                         ServerFactory(self.old)).setServiceParent(self.top)
+        self.addCleanup(self.cleanUp)
+
+
+    def cleanUp(self):
+        draining = getattr(self.old, '_draining', None)
+        if draining is not None and draining.running:
+            draining.stop()
+        return self.top.stopService()
+
+
+    @defer.inlineCallbacks
+    def test_takeOver(self):
+        """
+        The new plumber gets the running one's pipes in place of its own,
+        still listening, and the running one stops its control socket.
+        """
+        src = 'unix:%s/s' % (self.dir,)
+        self.old.addPipe(src, 'unix:path=a', connect_retries=2)
+        startListening(self.top)
+        new = Plumber()
+        new.addPipe('unix:%s/other' % (self.dir,), 'unix:path=b')
+
+        yield takeOver(reactor, new, self.dir)
+        self.assertEqual(new.pipe_services.names, [src])
+        self.assertEqual(new.getDsts(src), ['unix:path=a'])
+        self.assertEqual(new.getPipe(src).connect_retries, 2)
+        self.assertEqual(list(self.top), [self.old.pipe_services])
+        self.assertEqual(self.stopped, [])
+
+        listener = new.getListener(src)
+        listener.startService()
+        self.addCleanup(listener.stopService)
+        self.assertEqual(listener.port.getHost().name, self.dir + '/s')
+
+
+
+class AppendingLogFileTest(TestCase):
+
+
+    def test_append(self):
+        """
+        What's already in the log is kept, and its size counted.
+        """
+        fp = FilePath(self.mktemp())
+        fp.setContent('before\n')
+        log = AppendingLogFile.fromFullPath(fp.path)
+        self.assertEqual(log.size, 7)
+        log.write('after\n')
+        log.close()
+        self.assertEqual(fp.getContent(), 'before\nafter\n')
+
+
+
+class _StartProtocolTest(TestCase):
+
+
+    def end(self, output, code):
+        proto = _StartProtocol()
+        for fd, data in output:
+            proto.childDataReceived(fd, data)
+        reason = error.ProcessDone(None) if code == 0 else \
+            error.ProcessTerminated(code)
+        proto.processEnded(FakeFailure(reason))
+        return self.successResultOf(proto.done)
+
+
+    def test_ready(self):
+        self.assertEqual(self.end([(3, 'ready\n')], 0), ('', '', 0))
+
+
+    def test_error(self):
+        """
+        An error sent on the readiness pipe is given as the error output.
+        """
+        self.assertEqual(self.end([(3, 'no way\n')], 0), ('', 'no way\n', 1))
+
+
+    def test_nothing(self):
+        """
+        If nothing is sent, it's a failure.
+        """
+        out, err, code = self.end([(2, 'Traceback\n')], 1)
+        self.assertEqual((err, code), ('Traceback\n', 1))
+        out, err, code = self.end([], 0)
+        self.assertEqual(code, 1)
+        self.assertIn('grace.log', err)
+
+
+
+class FakeFailure(object):
+
+
+    def __init__(self, value):
+        self.value = value
+
+
+
+class spawnDaemonTest(TestCase):
+
+
+    timeout = 10
+
+
+    def setUp(self):
+        self.old_env = os.environ.get('PYTHONPATH')
+        os.environ['PYTHONPATH'] = os.pathsep.join(
+            [_top] + [x for x in [self.old_env] if x])
+
+
+    def tearDown(self):
+        if self.old_env is None:
+            del os.environ['PYTHONPATH']
+        else:
+            os.environ['PYTHONPATH'] = self.old_env
+
+
+    @defer.inlineCallbacks
+    def test_bindError(self):
+        """
+        If a pipe can't listen, the error comes back and the process exits.
+        """
+        port = reactor.listenTCP(0, protocol.Factory(), interface='127.0.0.1')
+        self.addCleanup(port.stopListening)
+        root = FilePath(tempfile.mkdtemp()).child('root')
+        setupDir(root.path, ('tcp:%d:interface=127.0.0.1' % (
+                             port.getHost().port,), 'tcp:host=127.0.0.1:port=1'))
+        out, err, code = yield spawnDaemon(reactor, root.path)
+        self.assertEqual(code, 1)
+        self.assertIn('Address already in use', err)
+        self.assertFalse(root.child('grace.pid').exists())
+
+
+    @defer.inlineCallbacks
+    def test_takeoverNotRunning(self):
+        """
+        There's nothing to take over from if grace isn't running.
+        """
+        root = FilePath(tempfile.mkdtemp()).child('root')
+        setupDir(root.path, ('unix:%s/s' % (root.path,), 'unix:path=a'))
+        out, err, code = yield spawnDaemon(reactor, root.path, takeover=True)
+        self.assertEqual(code, 1)
+        self.assertIn('not running', err)
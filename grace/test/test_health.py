@@ -0,0 +1,221 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, task, defer, endpoints, protocol
+from twisted.internet import error
+from twisted.test.proto_helpers import StringTransport
+from twisted.python import failure
+
+
+from grace.health import HealthCheck, ProbeFailed, _Probe
+from grace.pipe import Pipe
+
+
+
+class ProbeTest(TestCase):
+
+
+    def connect(self, send=None, expect=None):
+        proto = _Probe(send, expect)
+        transport = StringTransport()
+        proto.makeConnection(transport)
+        return proto, transport
+
+
+    def test_connect(self):
+        """
+        Without anything to expect, connecting is enough.
+        """
+        proto, transport = self.connect()
+        self.assertEqual(self.successResultOf(proto.result), None)
+        self.assertEqual(transport.value(), '')
+
+
+    def test_expect(self):
+        """
+        The probe sends what it's told to and passes once it gets what it
+        expects.
+        """
+        proto, transport = self.connect('PING\r\n', '+PONG')
+        self.assertEqual(transport.value(), 'PING\r\n')
+        self.assertNoResult(proto.result)
+        proto.dataReceived('+PO')
+        self.assertNoResult(proto.result)
+        proto.dataReceived('NG\r\n')
+        self.assertEqual(self.successResultOf(proto.result), None)
+
+
+    def test_unexpected(self):
+        """
+        The wrong answer fails the probe.
+        """
+        proto, transport = self.connect('PING\r\n', '+PONG')
+        proto.dataReceived('-ERR no\r\n')
+        self.failureResultOf(proto.result, ProbeFailed)
+
+
+    def test_lost(self):
+        """
+        Losing the connection before the expected answer fails the probe.
+        """
+        proto, transport = self.connect('PING\r\n', '+PONG')
+        proto.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.failureResultOf(proto.result, error.ConnectionDone)
+
+
+
+class HealthCheckTest(TestCase):
+
+
+    timeout = 2
+
+
+    def test_fall_rise(self):
+        """
+        A destination is unhealthy after health_fall failures in a row, and
+        healthy again after health_rise successes in a row.
+        """
+        pipe = Pipe('foo', health_interval=1, health_fall=2, health_rise=2)
+        check = HealthCheck(pipe, 'foo')
+        check.failure(None)
+        check.success()
+        check.failure(None)
+        self.assertTrue(check.healthy)
+        check.failure(None)
+        self.assertFalse(check.healthy)
+        check.success()
+        check.failure(None)
+        check.success()
+        self.assertFalse(check.healthy)
+        check.success()
+        self.assertTrue(check.healthy)
+
+
+    def test_schedule(self):
+        """
+        Probes are sent every health_interval seconds once started.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', health_interval=5, _reactor=clock)
+        check = HealthCheck(pipe, 'foo')
+        probes = []
+        check.probe = lambda: probes.append(clock.seconds())
+        check.start()
+        clock.advance(5)
+        clock.advance(5)
+        self.assertEqual(probes, [5, 10])
+        check.stop()
+        clock.advance(5)
+        self.assertEqual(probes, [5, 10])
+
+
+    @defer.inlineCallbacks
+    def test_probe(self):
+        """
+        A probe against a listening destination succeeds and one against
+        nothing fails.
+        """
+        path = self.mktemp()
+        ep = endpoints.UNIXServerEndpoint(reactor, path)
+        port = yield ep.listen(protocol.Factory.forProtocol(protocol.Protocol))
+        self.addCleanup(port.stopListening)
+
+        pipe = Pipe('unix:path=' + path, health_interval=1, health_fall=1)
+        check = HealthCheck(pipe, 'unix:path=' + path)
+        yield check.probe()
+        self.assertEqual((check.healthy, check.successes), (True, 1))
+
+        bad = HealthCheck(pipe, 'unix:path=' + self.mktemp())
+        yield bad.probe()
+        self.assertEqual((bad.healthy, bad.failures), (False, 1))
+
+
+    @defer.inlineCallbacks
+    def test_probe_timeout(self):
+        """
+        A destination that doesn't answer in time fails the probe.
+        """
+        path = self.mktemp()
+        ep = endpoints.UNIXServerEndpoint(reactor, path)
+        port = yield ep.listen(protocol.Factory.forProtocol(protocol.Protocol))
+        self.addCleanup(port.stopListening)
+
+        pipe = Pipe('unix:path=' + path, health_interval=1, health_fall=1,
+                    health_timeout=0.1, health_send='hi', health_expect='ho')
+        check = HealthCheck(pipe, 'unix:path=' + path)
+        yield check.probe()
+        self.assertEqual(check.healthy, False)
+
+
+
+class PipeHealthTest(TestCase):
+
+
+    timeout = 2
+
+
+    def test_off(self):
+        """
+        Health isn't checked unless asked for.
+        """
+        p = Pipe(['a', 'b'])
+        self.assertEqual(p.health, {})
+        self.assertEqual(p.info('a'), {})
+        p.connectFailed('a', None)
+
+
+    def test_skip(self):
+        """
+        Unhealthy destinations get no new connections, unless none are
+        healthy.
+        """
+        p = Pipe(['a', 'b', 'c'], health_interval=1, health_fall=1)
+        self.assertEqual(sorted(p.health), ['a', 'b', 'c'])
+        p.connectFailed('b', None)
+        self.assertEqual(p.info('b'), {'healthy': False})
+        self.assertEqual(p.info('a'), {'healthy': True})
+        self.assertEqual(p.usableDsts(), ['a', 'c'])
+        self.assertEqual([p.pickDst(None) for i in range(4)],
+                         ['a', 'c', 'a', 'c'])
+        p.connectFailed('a', None)
+        self.assertEqual(p.pickDst(None), 'c')
+        p.connectFailed('c', None)
+        self.assertEqual(p.usableDsts(), ['a', 'b', 'c'])
+
+
+    def test_switch(self):
+        """
+        Destinations are only checked while they're active.
+        """
+        clock = task.Clock()
+        p = Pipe('a', health_interval=1, _reactor=clock)
+        p.startFactory()
+        self.addCleanup(p.stopFactory)
+        a = p.health['a']
+        self.assertTrue(a._call.active())
+        p.switch(['b', 'c'])
+        self.assertEqual(sorted(p.health), ['b', 'c'])
+        self.assertEqual(a._call, None)
+        self.assertTrue(p.health['b']._call.active())
+        p.stopFactory()
+        self.assertEqual(p.health['b']._call, None)
+
+
+    @defer.inlineCallbacks
+    def test_connectFailed(self):
+        """
+        When a real connection to a destination fails, the client is
+        disconnected and the failure counted.
+        """
+        pipe = Pipe('unix:path=' + self.mktemp(), health_interval=10)
+        pipe_ep = endpoints.serverFromString(reactor, 'unix:' + self.mktemp())
+        port = yield pipe_ep.listen(pipe)
+        self.addCleanup(port.stopListening)
+
+        lost = defer.Deferred()
+        class Client(protocol.Protocol):
+            def connectionLost(self, reason):
+                lost.callback(None)
+        yield endpoints.connectProtocol(
+            endpoints.UNIXClientEndpoint(reactor, port.getHost().name),
+            Client())
+        yield lost
+        self.assertEqual(pipe.health[pipe.dst].failures, 1)
@@ -0,0 +1,191 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task, defer
+from twisted.web.test.requesthelper import DummyRequest
+
+
+from grace.metrics import escape, Families, MetricsResource, processStats
+from grace.metrics import CONTENT_TYPE
+from grace.plumbing import Plumber
+
+
+
+class FamiliesTest(TestCase):
+
+
+    def test_escape(self):
+        """
+        Backslashes, double quotes and newlines in label values are escaped.
+        """
+        self.assertEqual(escape('a\\b"c\nd'), 'a\\\\b\\"c\\nd')
+
+
+    def test_lines(self):
+        """
+        Samples are written out grouped by family, with the family's
+        metadata first, in the order the families were first seen.
+        """
+        f = Families()
+        f.counter('x_bytes', 'Some bytes', [('a', '1')], 10, 'bytes')
+        f.gauge('y', 'Why', [], 0.5)
+        f.counter('x_bytes', 'Some bytes', [('a', '2')], 20, 'bytes')
+        f.gauge('z', 'Zed', [('b', 'q"')], True)
+        self.assertEqual(list(f.lines()), [
+            '# TYPE x_bytes counter\n',
+            '# UNIT x_bytes bytes\n',
+            '# HELP x_bytes Some bytes\n',
+            'x_bytes_total{a="1"} 10\n',
+            'x_bytes_total{a="2"} 20\n',
+            '# TYPE y gauge\n',
+            '# HELP y Why\n',
+            'y 0.5\n',
+            '# TYPE z gauge\n',
+            '# HELP z Zed\n',
+            'z{b="q\\""} 1\n',
+        ])
+
+
+    def test_processStats(self):
+        """
+        The process's CPU time is always known.
+        """
+        stats = processStats()
+        self.assertTrue(stats['cpu_seconds'] > 0)
+
+
+
+class MetricsResourceTest(TestCase):
+
+
+    def setUp(self):
+        self.calls = []
+        self.cooperator = task.Cooperator(scheduler=self.calls.append,
+                                          started=True)
+
+
+    def runAll(self):
+        while self.calls:
+            self.calls.pop(0)()
+
+
+    def render(self, plumber, chunkLines=None):
+        r = MetricsResource(plumber, self.cooperator)
+        if chunkLines:
+            r.chunkLines = chunkLines
+        request = DummyRequest([''])
+        d = request.notifyFinish()
+        r.render(request)
+        return request, d
+
+
+    def test_render(self):
+        """
+        Every pipe and destination has its connections and traffic counts
+        rendered, labelled with their endpoints, followed by C{# EOF}.
+        """
+        p = Plumber()
+        p.addPipe('unix:foo', 'unix:foo2')
+        p.addPipe('unix:bar', ['unix:bar2', 'unix:bar3'])
+        pipe = p.getPipe('unix:bar')
+        pipe.addConnection('unix:bar3', None)
+        pipe.accepted('unix:bar3').bytes_in += 7
+        request, d = self.render(p)
+        self.runAll()
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(request.responseHeaders.getRawHeaders('content-type'),
+                         [CONTENT_TYPE])
+        body = ''.join(request.written)
+        lines = body.splitlines()
+        self.assertEqual(lines[-1], '# EOF')
+        self.assertIn('grace_pipe_accepted_total{src="unix:bar"} 1', lines)
+        self.assertIn('grace_pipe_accepted_total{src="unix:foo"} 0', lines)
+        self.assertIn('grace_dst_accepted_total{src="unix:bar",'
+                      'dst="unix:bar3"} 1', lines)
+        self.assertIn('grace_dst_bytes_total{src="unix:bar",dst="unix:bar3",'
+                      'direction="in"} 7', lines)
+        self.assertIn('grace_dst_connections{src="unix:bar",'
+                      'dst="unix:bar3"} 1', lines)
+        self.assertIn('grace_pipe_connections{src="unix:bar"} 1', lines)
+        self.assertIn('grace_dst_active{src="unix:foo",dst="unix:foo2"} 1',
+                      lines)
+        self.assertIn('# TYPE process_cpu_seconds counter', lines)
+        self.assertEqual(len([x for x in lines
+                              if x == '# TYPE grace_dst_accepted counter']),
+                         1, "Each family should be written once")
+
+
+    def test_incremental(self):
+        """
+        The metrics are gathered a pipe at a time and written in chunks,
+        with the reactor getting a turn in between.
+        """
+        p = Plumber()
+        for i in range(3):
+            p.addPipe('unix:src%d' % (i,), 'unix:dst%d' % (i,))
+        request, d = self.render(p, chunkLines=10)
+        self.runAll()
+        self.successResultOf(d)
+        self.assertTrue(len(request.written) > 3, request.written)
+        self.assertTrue(all(len(x.splitlines()) <= 11
+                            for x in request.written))
+
+
+    def test_disconnect(self):
+        """
+        If the client goes away, rendering stops.
+        """
+        p = Plumber()
+        for i in range(3):
+            p.addPipe('unix:src%d' % (i,), 'unix:dst%d' % (i,))
+        request, d = self.render(p, chunkLines=10)
+        request.processingFailed(Exception('gone'))
+        self.failureResultOf(d)
+        written = len(request.written)
+        self.runAll()
+        self.assertEqual(len(request.written), written)
+
+
+    def test_workers(self):
+        """
+        In worker mode, the workers' combined listing and counts are
+        rendered.
+        """
+        p = Plumber()
+        p.workers = object()
+        rows = defer.Deferred()
+        stats = defer.Deferred()
+        p.listPipes = lambda: rows
+        p.stats = lambda: stats
+        request, d = self.render(p)
+        self.runAll()
+        self.assertNoResult(d)
+
+        rows.callback([{'src': 'unix:a', 'dst': 'unix:b', 'conns': 4,
+                        'active': True, 'healthy': False}])
+        self.runAll()
+        counts = {'accepted': 9, 'connect_failures': 0, 'connect_retries': 0,
+                  'connect_timeouts': 0, 'bytes_in': 1,
+                  'bytes_out': 2, 'closed_by_client': 3,
+                  'closed_by_upstream': 1, 'closed_on_error': 0,
+                  'closed_forced': 0, 'closed_idle': 0, 'queued': 2,
+                  'queue_wait': 0.5, 'rejected': 0, 'queue_timeouts': 0,
+                  'pauses_src': 5, 'pauses_dst': 1, 'rate': 0.0}
+        pipe = dict(counts, src='unix:a', waiting=3, throttled=1.5)
+        dst = dict(counts, src='unix:a', dst='unix:b')
+        stats.callback(([pipe], [dst]))
+        self.runAll()
+        self.successResultOf(d)
+        lines = ''.join(request.written).splitlines()
+        self.assertIn('grace_pipe_connections{src="unix:a"} 4', lines)
+        self.assertIn('grace_pipe_accepted_total{src="unix:a"} 9', lines)
+        self.assertIn('grace_pipe_waiting{src="unix:a"} 3', lines)
+        self.assertIn('grace_pipe_throttled_seconds_total{src="unix:a"} 1.5',
+                      lines)
+        self.assertIn('grace_dst_queue_wait_seconds_total{src="unix:a",'
+                      'dst="unix:b"} 0.5', lines)
+        self.assertIn('grace_dst_healthy{src="unix:a",dst="unix:b"} 0', lines)
+        self.assertIn('grace_dst_closed_total{src="unix:a",dst="unix:b",'
+                      'reason="client"} 3', lines)
+        self.assertIn('grace_dst_pauses_total{src="unix:a",dst="unix:b",'
+                      'side="src"} 5', lines)
+        self.assertIn('grace_pipe_pauses_total{src="unix:a",side="dst"} 1',
+                      lines)
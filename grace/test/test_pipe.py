@@ -1,17 +1,27 @@
 from twisted.trial.unittest import TestCase
-from twisted.internet import reactor, defer, task, endpoints
-from twisted.python import log
+from twisted.internet import reactor, defer, task, endpoints, protocol
+from twisted.internet import abstract, error, interfaces
+from twisted.python import log, failure
+from twisted.test import proto_helpers
+from zope.interface import implementer
 
 
-from grace.test.util import YippyYuckFactory, ClientFactory
-from grace.pipe import Pipe
-        
-
+from grace.test.util import YippyYuckFactory, ClientFactory, FakeConnection
+from grace.pipe import Pipe, ProxyServer, ProxyClient, Valve
+from grace.splice import spliceAvailable
+from grace.aio import asyncioAvailable
+from grace.stats import Counters
+from grace.sockopts import TCP_USER_TIMEOUT
 
-class PipeTest(TestCase):
+import socket
+import sys
+        
 
 
-    timeout = 1
+class RelayTestMixin:
+    """
+    Helpers for tests that relay connections through a L{Pipe}.
+    """
 
 
     @defer.inlineCallbacks
@@ -53,8 +63,16 @@ class PipeTest(TestCase):
         defer.returnValue(client)
 
 
+
+class PipeTest(TestCase, RelayTestMixin):
+
+
+    timeout = 1
+
+
+
     @defer.inlineCallbacks
-    def t_endpoints(self, client, pfserver, pfclient, server):
+    def t_endpoints(self, client, pfserver, pfclient, server, **pipe_options):
         """
         Test that forwarding works from C{client} to C{pfserver}
         using C{pfclient} to C{server}
@@ -63,7 +81,7 @@ class PipeTest(TestCase):
         server = yield self.startServer(server, ['hey'])
         
         # start Pipe
-        pipe = Pipe(pfclient)
+        pipe = Pipe(pfclient, **pipe_options)
         pipe_ep = endpoints.serverFromString(reactor, pfserver)
         pipe_port = yield pipe_ep.listen(pipe)
         self.addCleanup(pipe_port.stopListening)
@@ -120,6 +138,220 @@ class PipeTest(TestCase):
         )
 
 
+    def noPythonRelay(self):
+        """
+        Make it an error for relayed data to pass through Python.
+        """
+        def fail(proto, data):
+            self.fail('%r got %r' % (proto, data))
+        self.patch(ProxyServer, 'dataReceived', fail)
+        self.patch(ProxyClient, 'dataReceived', fail)
+
+
+    def test_TCP_to_TCP_splice(self):
+        """
+        With splice turned on, TCP data is relayed without passing through
+        the protocols.
+        """
+        self.noPythonRelay()
+        return self.t_endpoints(
+            'tcp:host=127.0.0.1:port=10333',
+            'tcp:10333',
+            'tcp:host=127.0.0.1:port=10111',
+            'tcp:10111',
+            splice=True,
+        )
+
+    if not spliceAvailable():
+        test_TCP_to_TCP_splice.skip = 'splice(2) is not available'
+
+
+    def test_UNIX_to_TCP_splice(self):
+        """
+        Splicing works between UNIX and TCP sockets, too.
+        """
+        self.noPythonRelay()
+        socket = self.mktemp()
+        return self.t_endpoints(
+            'unix:path=%s' % socket,
+            'unix:%s' % socket,
+            'tcp:host=127.0.0.1:port=10333',
+            'tcp:10333',
+            splice=True,
+        )
+
+    if not spliceAvailable():
+        test_UNIX_to_TCP_splice.skip = 'splice(2) is not available'
+
+
+    @defer.inlineCallbacks
+    def test_splice_switch(self):
+        """
+        Spliced connections are counted like any other, so switching away
+        from their destination still waits for them to finish.
+        """
+        self.noPythonRelay()
+        socket1 = self.mktemp()
+        server1 = yield self.startServer('unix:'+socket1, ['hey1'])
+        
+        pipesocket = self.mktemp()
+        pipe = Pipe('unix:path=' + socket1, splice=True)
+        pipe_ep = endpoints.serverFromString(reactor, 'unix:'+pipesocket)
+        pipe_port = yield pipe_ep.listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+        
+        client1 = yield self.connectClient('unix:path='+pipesocket, '')
+        client1.transport.write('hey1')
+        server1_proto = yield server1.connected(0)
+        yield server1_proto.satisfied
+        
+        r = pipe.switch('unix:path=' + self.mktemp())
+        self.assertFalse(r.called, "The spliced connection is still open")
+        self.assertEqual(pipe._connections['unix:path=' + socket1], 1)
+        
+        client1.transport.loseConnection()
+        dead_notice = yield r
+        self.assertEqual(dead_notice, 'unix:path=' + socket1)
+
+    if not spliceAvailable():
+        test_splice_switch.skip = 'splice(2) is not available'
+
+
+    @defer.inlineCallbacks
+    def test_asyncio(self):
+        """
+        With the asyncio engine, data is relayed without passing through the
+        protocols, and both sides are closed once one side closes.
+        """
+        self.noPythonRelay()
+        socket1 = self.mktemp()
+        server = yield self.startServer('unix:' + socket1, ['hey'])
+
+        pipesocket = self.mktemp()
+        pipe = Pipe('unix:path=' + socket1, engine='asyncio')
+        pipe_ep = endpoints.serverFromString(reactor, 'unix:' + pipesocket)
+        pipe_port = yield pipe_ep.listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+
+        client = yield self.connectClient('unix:path=' + pipesocket,
+                                          'hey back')
+        client.transport.write('hey')
+        server_proto = yield server.connected(0)
+        yield server_proto.satisfied
+        lost = defer.Deferred()
+        self.patch(server_proto, 'connectionLost',
+                   lambda reason: lost.callback(None))
+        server_proto.transport.write('hey back')
+        yield client.satisfied
+        client.transport.loseConnection()
+        yield lost
+
+    if not asyncioAvailable():
+        test_asyncio.skip = 'asyncio is not available'
+
+
+    @defer.inlineCallbacks
+    def test_coalesce(self):
+        """
+        With C{coalesce_delay}, data is relayed in both directions, and the
+        timer that flushes it lets go of its file descriptor once the last
+        connection has closed.
+        """
+        socket1 = self.mktemp()
+        server = yield self.startServer('unix:' + socket1, ['hey'])
+
+        pipesocket = self.mktemp()
+        pipe = Pipe('unix:path=' + socket1, coalesce_delay=0.001)
+        pipe_ep = endpoints.serverFromString(reactor, 'unix:' + pipesocket)
+        pipe_port = yield pipe_ep.listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+
+        client = yield self.connectClient('unix:path=' + pipesocket,
+                                          'hey back')
+        client.transport.write('hey')
+        server_proto = yield server.connected(0)
+        yield server_proto.satisfied
+        lost = defer.Deferred()
+        self.patch(server_proto, 'connectionLost',
+                   lambda reason: lost.callback(None))
+        server_proto.transport.write('hey back')
+        yield client.satisfied
+        client.transport.loseConnection()
+        yield lost
+        self.assertEqual(pipe._flushTimer.fileno(), None)
+
+
+    @defer.inlineCallbacks
+    def test_asyncio_switch(self):
+        """
+        Connections relayed by the asyncio engine are counted like any
+        other, so switching away from their destination still waits for
+        them to finish.
+        """
+        self.noPythonRelay()
+        socket1 = self.mktemp()
+        server1 = yield self.startServer('unix:'+socket1, ['hey1'])
+
+        pipesocket = self.mktemp()
+        pipe = Pipe('unix:path=' + socket1, engine='asyncio')
+        pipe_ep = endpoints.serverFromString(reactor, 'unix:'+pipesocket)
+        pipe_port = yield pipe_ep.listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+
+        client1 = yield self.connectClient('unix:path='+pipesocket, '')
+        client1.transport.write('hey1')
+        server1_proto = yield server1.connected(0)
+        yield server1_proto.satisfied
+
+        r = pipe.switch('unix:path=' + self.mktemp())
+        self.assertFalse(r.called, "The relayed connection is still open")
+        self.assertEqual(pipe._connections['unix:path=' + socket1], 1)
+
+        client1.transport.loseConnection()
+        dead_notice = yield r
+        self.assertEqual(dead_notice, 'unix:path=' + socket1)
+
+    if not asyncioAvailable():
+        test_asyncio_switch.skip = 'asyncio is not available'
+
+
+    def test_compact(self):
+        """
+        The objects kept for each connection have no instance dictionaries,
+        and all of a pipe's upstream connections share one factory.
+        """
+        pipe = Pipe('foo')
+        server = ProxyServer()
+        client = pipe.clientFactory.buildProtocol(None)
+        valve = Valve(pipe, None, None, 'src')
+        for obj in [server, client, valve]:
+            self.assertFalse(hasattr(obj, '__dict__'), obj)
+        self.assertIsInstance(client, ProxyClient)
+        self.assertIsNot(pipe.clientFactory.buildProtocol(None), client)
+
+
+    def test_splice_default(self):
+        """
+        Splicing is off unless asked for.
+        """
+        self.assertEqual(Pipe('foo').splice, False)
+        self.assertEqual(Pipe('foo', splice=True).splice, spliceAvailable())
+
+
+    def test_engine(self):
+        """
+        Bytes are relayed by Twisted unless another engine is asked for.
+        The asyncio engine falls back to Twisted if asyncio isn't available,
+        and can't be combined with splicing.
+        """
+        self.assertEqual(Pipe('foo').engine, 'twisted')
+        self.assertEqual(Pipe('foo', engine='asyncio').engine,
+                         'asyncio' if asyncioAvailable() else 'twisted')
+        self.assertRaises(ValueError, Pipe, 'foo', engine='gevent')
+        self.assertRaises(ValueError, Pipe, 'foo', engine='asyncio',
+                          splice=True)
+
+
     @defer.inlineCallbacks
     def test_switch(self):
         """
@@ -422,3 +654,1452 @@ class PipeTest(TestCase):
         
 
 
+
+
+    def test_getEndpoint_cached(self):
+        """
+        The endpoint for a destination is parsed once and reused for every
+        connection.
+        """
+        pipe = Pipe('tcp:host=127.0.0.1:port=10111')
+        ep = pipe.getEndpoint('tcp:host=127.0.0.1:port=10111')
+        self.assertTrue(ep is pipe._endpoints['tcp:host=127.0.0.1:port=10111'],
+                        "Should have parsed the endpoint at startup")
+        self.assertTrue(ep is pipe.getEndpoint('tcp:host=127.0.0.1:port=10111'))
+
+
+    def test_switch_fills_endpoint_cache(self):
+        """
+        Switching parses the new destination ahead of the first connection.
+        """
+        pipe = Pipe('tcp:host=127.0.0.1:port=10111')
+        pipe.switch('tcp:host=127.0.0.1:port=10222')
+        self.assertIn('tcp:host=127.0.0.1:port=10222', pipe._endpoints)
+
+
+    def test_expire_clears_endpoint_cache(self):
+        """
+        Once an old destination has no more connections, its endpoint is
+        forgotten.
+        """
+        pipe = Pipe('tcp:host=127.0.0.1:port=10111')
+        proto = object()
+        pipe.addConnection('tcp:host=127.0.0.1:port=10111', proto)
+        pipe.switch('tcp:host=127.0.0.1:port=10222')
+        self.assertIn('tcp:host=127.0.0.1:port=10111', pipe._endpoints,
+                      "Should keep the endpoint while connections remain")
+        pipe.removeConnection('tcp:host=127.0.0.1:port=10111', proto)
+        self.assertEqual(pipe._endpoints.keys(),
+                         ['tcp:host=127.0.0.1:port=10222'])
+
+
+    def test_switch_unparseable(self):
+        """
+        Switching to something that isn't an endpoint doesn't fail until a
+        connection tries to use it.
+        """
+        pipe = Pipe('tcp:host=127.0.0.1:port=10111')
+        pipe.switch('foo')
+        self.assertEqual(pipe.dst, 'foo')
+        self.assertNotIn('foo', pipe._endpoints)
+        self.assertRaises(ValueError, pipe.getEndpoint, 'foo')
+
+
+    def test_dsts(self):
+        """
+        A Pipe can be given a list of destinations, which are all active.
+        """
+        p = Pipe(['foo', 'bar', 'foo'])
+        self.assertEqual(p.dsts, ['foo', 'bar'])
+        self.assertEqual(p.dst, 'foo')
+        self.assertEqual(set(p.ls()), set([
+            ('foo', 0, True),
+            ('bar', 0, True),
+        ]))
+        self.assertTrue(p.wait().called)
+
+
+    def test_empty(self):
+        """
+        A Pipe needs at least one destination.
+        """
+        self.assertRaises(ValueError, Pipe, [])
+
+
+    def test_balance(self):
+        """
+        The balancing strategy picks where each connection goes.
+        """
+        self.assertRaises(ValueError, Pipe, 'foo', balance='bogus')
+        p = Pipe(['foo', 'bar'])
+        self.assertEqual([p.pickDst(None) for i in range(3)],
+                         ['foo', 'bar', 'foo'])
+        p = Pipe(['foo', 'bar'], balance='least-conns')
+        p.addConnection('foo', object())
+        self.assertEqual(p.pickDst(None), 'bar')
+
+
+    def test_switch_drains_separately(self):
+        """
+        Each destination that's switched away from drains on its own, and
+        the Deferred returned by switch fires once they all have.
+        """
+        p = Pipe(['a', 'b', 'c'])
+        conn_a, conn_b = object(), object()
+        p.addConnection('a', conn_a)
+        p.addConnection('b', conn_b)
+
+        r = p.switch(['c', 'd'])
+        self.assertEqual(p.dsts, ['c', 'd'])
+        self.assertEqual(set(p.ls()), set([
+            ('a', 1, False),
+            ('b', 1, False),
+            ('c', 0, True),
+            ('d', 0, True),
+        ]))
+        a_d = p.alive['a']
+        wait = p.wait()
+
+        p.removeConnection('a', conn_a)
+        self.assertTrue(a_d.called, "a has drained")
+        self.assertFalse(r.called, "b hasn't drained")
+        self.assertFalse(wait.called)
+
+        p.removeConnection('b', conn_b)
+        self.assertTrue(wait.called)
+        self.assertEqual(self.successResultOf(r), ['a', 'b'])
+
+
+    def test_switch_kept(self):
+        """
+        If the previous destination is still active after switching, there's
+        nothing to drain, so the Deferred returned by switch fires straight
+        away with it.
+        """
+        p = Pipe('a')
+        p.addConnection('a', object())
+        r = p.switch(['a', 'b'])
+        self.assertEqual(self.successResultOf(r), 'a')
+        self.assertFalse(p.alive['a'].called)
+
+
+    @defer.inlineCallbacks
+    def test_spread(self):
+        """
+        Connections are spread over the destinations.
+        """
+        socket1 = self.mktemp()
+        server1 = yield self.startServer('unix:'+socket1, ['hey1'])
+        socket2 = self.mktemp()
+        server2 = yield self.startServer('unix:'+socket2, ['hey2'])
+
+        pipesocket = self.mktemp()
+        pipe = Pipe(['unix:path=' + socket1, 'unix:path=' + socket2])
+        pipe_ep = endpoints.serverFromString(reactor, 'unix:'+pipesocket)
+        pipe_port = yield pipe_ep.listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+
+        client1 = yield self.connectClient('unix:path='+pipesocket, '')
+        client1.transport.write('hey1')
+        server1_proto = yield server1.connected(0)
+        yield server1_proto.satisfied
+
+        client2 = yield self.connectClient('unix:path='+pipesocket, '')
+        client2.transport.write('hey2')
+        server2_proto = yield server2.connected(0)
+        yield server2_proto.satisfied
+
+        self.assertEqual(set(pipe.ls()), set([
+            ('unix:path=' + socket1, 1, True),
+            ('unix:path=' + socket2, 1, True),
+        ]))
+
+
+
+class FakeServer(object):
+    """
+    I stand in for a L{ProxyServer} being admitted by a L{Pipe}.
+    """
+
+    dst = None
+    rejected = False
+    _waitingSince = None
+
+
+    def __init__(self, pipe):
+        self.factory = pipe
+        self.transport = proto_helpers.StringTransport()
+        pipe.admit(self)
+
+
+    def start(self, dst):
+        self.dst = dst
+        self.factory.addConnection(dst, self)
+
+
+    def reject(self):
+        self.rejected = True
+
+
+    def close(self):
+        if self.dst is not None:
+            self.factory.removeConnection(self.dst, self)
+        elif self._waitingSince is not None:
+            self.factory.unqueue(self)
+
+
+
+class AdmissionTest(TestCase):
+
+
+    def test_maxConns(self):
+        """
+        Connections beyond C{max_conns} wait until there's room, and once
+        C{queue_size} are waiting, more are turned away.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', max_conns=2, queue_size=1, _reactor=clock)
+        a, b, c, d = [FakeServer(pipe) for i in range(4)]
+        self.assertEqual([x.dst for x in (a, b, c, d)],
+                         ['foo', 'foo', None, None])
+        self.assertEqual(pipe.waiting, 1)
+        self.assertTrue(d.rejected)
+        self.assertFalse(c.rejected)
+
+        clock.advance(2)
+        a.close()
+        self.assertEqual(c.dst, 'foo')
+        self.assertEqual(pipe.waiting, 0)
+        total, dsts = pipe.stats()
+        self.assertEqual(total['rejected'], 1)
+        self.assertEqual(total['waiting'], 0)
+        self.assertEqual(dsts[0]['queued'], 1)
+        self.assertEqual(dsts[0]['queue_wait'], 2.0)
+        self.assertEqual(dsts[0]['rejected'], 0)
+
+
+    def test_maxDstConns(self):
+        """
+        Connections only go to destinations with fewer than
+        C{max_dst_conns}, and wait if there are none.
+        """
+        clock = task.Clock()
+        pipe = Pipe(['foo', 'bar'], max_dst_conns=1, _reactor=clock)
+        a, b, c = [FakeServer(pipe) for i in range(3)]
+        self.assertEqual(sorted([a.dst, b.dst]), ['bar', 'foo'])
+        self.assertEqual(c.dst, None)
+        b.close()
+        self.assertEqual(c.dst, b.dst)
+
+
+    def test_fifo(self):
+        """
+        Waiting connections are admitted in the order they arrived, and a new
+        one doesn't jump the queue.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', max_conns=1, _reactor=clock)
+        a, b, c = [FakeServer(pipe) for i in range(3)]
+        a.close()
+        self.assertEqual((b.dst, c.dst), ('foo', None))
+        b.close()
+        self.assertEqual(c.dst, 'foo')
+
+
+    def test_switch(self):
+        """
+        Switching to a destination with room admits the connections waiting
+        for a full one.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', max_dst_conns=1, _reactor=clock)
+        a, b = FakeServer(pipe), FakeServer(pipe)
+        pipe.switch('bar')
+        self.assertEqual(b.dst, 'bar')
+
+
+    def test_timeout(self):
+        """
+        Connections that wait longer than C{queue_timeout} are closed, with
+        one timed call for the whole queue.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', max_conns=1, queue_timeout=5, _reactor=clock)
+        FakeServer(pipe)
+        b = FakeServer(pipe)
+        clock.advance(2)
+        c = FakeServer(pipe)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(3)
+        self.assertEqual((b.rejected, c.rejected), (True, False))
+        self.assertEqual(pipe.waiting, 1)
+        clock.advance(2)
+        self.assertTrue(c.rejected)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        total, dsts = pipe.stats()
+        self.assertEqual(total['queue_timeouts'], 2)
+
+
+    def test_closedWhileWaiting(self):
+        """
+        A connection that closes while it waits gives up its place.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', max_conns=1, queue_size=1, _reactor=clock)
+        a, b = FakeServer(pipe), FakeServer(pipe)
+        b.close()
+        self.assertEqual(pipe.waiting, 0)
+        c = FakeServer(pipe)
+        self.assertFalse(c.rejected)
+        a.close()
+        self.assertEqual((b.dst, c.dst), (None, 'foo'))
+        clock.advance(10)
+        self.assertFalse(c.rejected)
+
+
+
+class DrainTest(TestCase):
+    """
+    L{Pipe.drain} waits for old destinations to drain, up to a point.
+    """
+
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.pipe = Pipe('foo', _reactor=self.clock)
+
+
+    def test_nothingToDrain(self):
+        """
+        With no connections to old destinations, there's nothing to wait
+        for or close.
+        """
+        conn = FakeConnection(self.pipe, 'foo')
+        self.assertEqual(self.successResultOf(self.pipe.drain(10)), 0)
+        self.assertFalse(conn.forced)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_drained(self):
+        """
+        Connections that finish by themselves before the deadline aren't
+        closed, and the deadline is forgotten.
+        """
+        conn = FakeConnection(self.pipe, 'foo')
+        self.pipe.switch('bar')
+        d = self.pipe.drain(10)
+        self.clock.advance(5)
+        self.assertNoResult(d)
+        self.pipe.removeConnection('foo', conn)
+        self.assertEqual(self.successResultOf(d), 0)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+
+    def test_timeout(self):
+        """
+        Connections to old destinations left at the deadline are closed;
+        those to current destinations aren't.
+        """
+        old = [FakeConnection(self.pipe, 'foo', idle=False)
+               for i in range(2)]
+        self.pipe.switch('bar')
+        new = FakeConnection(self.pipe, 'bar')
+        d = self.pipe.drain(10)
+        self.clock.advance(9)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertEqual(self.successResultOf(d), 2)
+        self.assertEqual([x.forced for x in old], [True, True])
+        self.assertFalse(new.forced)
+
+
+    def test_grace(self):
+        """
+        With a grace period, idle connections are closed at the deadline and
+        the rest once the grace period is up.
+        """
+        idle = FakeConnection(self.pipe, 'foo')
+        busy = FakeConnection(self.pipe, 'foo', idle=False)
+        self.pipe.switch('bar')
+        d = self.pipe.drain(10, 5)
+        self.clock.advance(10)
+        self.assertTrue(idle.forced)
+        self.assertFalse(busy.forced)
+        self.clock.advance(4)
+        self.assertNoResult(d)
+        self.clock.advance(1)
+        self.assertTrue(busy.forced)
+        self.assertEqual(self.successResultOf(d), 2)
+
+
+    def test_isIdle(self):
+        """
+        A connection is idle once it has relayed nothing for
+        L{Pipe.idleAfter} seconds.
+        """
+        proto = ProxyServer()
+        proto.factory = self.pipe
+        proto.lastActive = 100
+        self.assertFalse(proto.isIdle(100 + self.pipe.idleAfter / 2))
+        self.assertTrue(proto.isIdle(100 + self.pipe.idleAfter))
+
+
+
+class StatsTest(TestCase, RelayTestMixin):
+    """
+    Traffic through a L{Pipe} is counted.
+    """
+
+    timeout = 1
+
+
+    def relay(self, **pipe_options):
+        """
+        Start an upstream server and a pipe to it, both on UNIX sockets.
+
+        @return: A C{Deferred} firing with the server factory, the pipe and
+            the pipe's socket path.
+        """
+        socket = self.mktemp()
+        pipesocket = self.mktemp()
+        d = self.startServer('unix:' + socket, ['hello'])
+        def started(server):
+            pipe = Pipe('unix:path=' + socket, **pipe_options)
+            ep = endpoints.serverFromString(reactor, 'unix:' + pipesocket)
+            d = ep.listen(pipe)
+            def listening(port):
+                self.addCleanup(port.stopListening)
+                return server, pipe, pipesocket
+            return d.addCallback(listening)
+        return d.addCallback(started)
+
+
+    @defer.inlineCallbacks
+    def t_bytes(self, **pipe_options):
+        server, pipe, pipesocket = yield self.relay(**pipe_options)
+        client = yield self.connectClient('unix:path=' + pipesocket,
+                                          'hi there')
+        client.transport.write('hello')
+        server_proto = yield server.connected(0)
+        yield server_proto.satisfied
+        server_proto.transport.write('hi there')
+        yield client.satisfied
+
+        lost = defer.Deferred()
+        self.patch(client, 'connectionLost', lambda r: lost.callback(None))
+        server_proto.transport.loseConnection()
+        yield lost
+        # let the pipe's side of the connection finish closing
+        while not pipe.stats()[0]['closed_by_upstream']:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+        total, dsts = pipe.stats()
+        self.assertEqual(total['accepted'], 1)
+        self.assertEqual(total['bytes_in'], 5)
+        self.assertEqual(total['bytes_out'], 8)
+        self.assertEqual(total['closed_by_upstream'], 1)
+        self.assertEqual(total['closed_by_client'], 0)
+        self.assertEqual(dsts[0]['dst'], pipe.dst)
+        self.assertEqual(dsts[0]['bytes_in'], 5)
+
+
+    def test_bytes(self):
+        """
+        Connections and bytes each way are counted, as is which side closed
+        the connection.
+        """
+        return self.t_bytes()
+
+
+    def test_bytes_splice(self):
+        """
+        Spliced connections are counted too, once they're done.
+        """
+        return self.t_bytes(splice=True)
+
+    if not spliceAvailable():
+        test_bytes_splice.skip = 'splice(2) is not available'
+
+
+    def test_bytes_asyncio(self):
+        """
+        Connections relayed by the asyncio engine are counted too, once
+        they're done.
+        """
+        return self.t_bytes(engine='asyncio')
+
+    if not asyncioAvailable():
+        test_bytes_asyncio.skip = 'asyncio is not available'
+
+
+    def test_retired(self):
+        """
+        Drained destinations still count towards the totals.
+        """
+        p = Pipe('foo')
+        conn = object()
+        p.addConnection('foo', conn)
+        p.accepted('foo').bytes_in += 3
+        p.switch('bar')
+        p.accepted('bar')
+        p.removeConnection('foo', conn)
+        total, dsts = p.stats()
+        self.assertEqual(total['accepted'], 2)
+        self.assertEqual(total['bytes_in'], 3)
+        self.assertEqual([x['dst'] for x in dsts], ['bar'])
+
+
+    @defer.inlineCallbacks
+    def t_forced(self, **pipe_options):
+        server, pipe, pipesocket = yield self.relay(**pipe_options)
+        client = yield self.connectClient('unix:path=' + pipesocket, '')
+        lost = defer.Deferred()
+        self.patch(client, 'connectionLost', lambda r: lost.callback(None))
+        client.transport.write('hello')
+        server_proto = yield server.connected(0)
+        yield server_proto.satisfied
+
+        pipe.switch('unix:path=' + self.mktemp())
+        forced = yield pipe.drain(0)
+        self.assertEqual(forced, 1)
+        yield lost
+        total, dsts = pipe.stats()
+        self.assertEqual(total['closed_forced'], 1)
+        self.assertEqual(total['closed_by_client'], 0)
+        self.assertEqual(total['closed_by_upstream'], 0)
+
+
+    def test_forced(self):
+        """
+        Connections closed because they didn't drain in time are counted
+        as forced.
+        """
+        return self.t_forced()
+
+
+    def test_forced_splice(self):
+        """
+        Spliced connections can be closed by force too.
+        """
+        return self.t_forced(splice=True)
+
+    if not spliceAvailable():
+        test_forced_splice.skip = 'splice(2) is not available'
+
+
+    def test_forced_asyncio(self):
+        """
+        Connections relayed by the asyncio engine can be closed by force.
+        """
+        return self.t_forced(engine='asyncio')
+
+    if not asyncioAvailable():
+        test_forced_asyncio.skip = 'asyncio is not available'
+
+
+    @defer.inlineCallbacks
+    def test_rejected(self):
+        """
+        Connections turned away because the queue is full are closed and
+        counted.
+        """
+        server, pipe, pipesocket = yield self.relay(max_conns=0,
+                                                    queue_size=0)
+        client = yield self.connectClient('unix:path=' + pipesocket, '')
+        lost = defer.Deferred()
+        self.patch(client, 'connectionLost', lambda r: lost.callback(None))
+        yield lost
+        self.assertEqual(server.protocols, [])
+        total, dsts = pipe.stats()
+        self.assertEqual(total['rejected'], 1)
+        self.assertEqual(total['accepted'], 0)
+        self.assertEqual(pipe.ls().next()[1], 0)
+
+
+    @defer.inlineCallbacks
+    def t_idle(self, **pipe_options):
+        self.patch(Pipe, 'timerTick', 0.01)
+        server, pipe, pipesocket = yield self.relay(idle_timeout=0.05,
+                                                    **pipe_options)
+        client = yield self.connectClient('unix:path=' + pipesocket, '')
+        lost = defer.Deferred()
+        self.patch(client, 'connectionLost', lambda r: lost.callback(None))
+        client.transport.write('hello')
+        server_proto = yield server.connected(0)
+        yield server_proto.satisfied
+
+        yield lost
+        total, dsts = pipe.stats()
+        self.assertEqual(total['closed_idle'], 1)
+        self.assertEqual(total['closed_by_client'], 0)
+        self.assertEqual(total['closed_by_upstream'], 0)
+        self.assertEqual(len(pipe._timers), 0)
+
+
+    def test_idle(self):
+        """
+        Connections that relay nothing for the pipe's C{idle_timeout} are
+        closed, and counted as idle.
+        """
+        return self.t_idle()
+
+
+    def test_idle_splice(self):
+        """
+        Spliced connections time out too.
+        """
+        return self.t_idle(splice=True)
+
+    if not spliceAvailable():
+        test_idle_splice.skip = 'splice(2) is not available'
+
+
+    def test_idle_asyncio(self):
+        """
+        Connections relayed by the asyncio engine time out too.
+        """
+        return self.t_idle(engine='asyncio')
+
+    if not asyncioAvailable():
+        test_idle_asyncio.skip = 'asyncio is not available'
+
+
+    @defer.inlineCallbacks
+    def test_connectFailed(self):
+        """
+        Connections that can't be made to the destination are counted.
+        """
+        pipe = Pipe('unix:path=' + self.mktemp())
+        ep = endpoints.serverFromString(reactor, 'unix:' + self.mktemp())
+        port = yield ep.listen(pipe)
+        self.addCleanup(port.stopListening)
+
+        lost = defer.Deferred()
+        class Client(protocol.Protocol):
+            def connectionLost(self, reason):
+                lost.callback(None)
+        yield endpoints.connectProtocol(
+            endpoints.UNIXClientEndpoint(reactor, port.getHost().name),
+            Client())
+        yield lost
+        total, dsts = pipe.stats()
+        self.assertEqual(total['connect_failures'], 1)
+        self.assertEqual(total['closed_by_client'], 0)
+
+
+
+class RetryTest(TestCase, RelayTestMixin):
+
+
+    timeout = 2
+
+
+    def test_retryDelay(self):
+        """
+        The wait before each retry doubles, up to a limit, and up to half of
+        it is taken off at random.
+        """
+        pipe = Pipe('foo', retry_backoff=0.1)
+        for attempt, most in [(1, 0.1), (2, 0.2), (4, 0.8),
+                              (20, pipe.maxRetryDelay)]:
+            for i in range(20):
+                delay = pipe.retryDelay(attempt)
+                self.assertTrue(most / 2 <= delay <= most, (attempt, delay))
+
+
+    def test_retryDst(self):
+        """
+        Retries go to another usable destination if there is one.
+        """
+        self.assertEqual(Pipe(['a', 'b']).retryDst('a', None), 'b')
+        self.assertEqual(Pipe('a').retryDst('a', None), 'a')
+        pipe = Pipe('a')
+        pipe.switch('b')
+        self.assertEqual(pipe.retryDst('a', None), 'b')
+
+
+    def test_connect_timeout(self):
+        """
+        Connecting upstream gives up after C{connect_timeout} seconds, and
+        the failure counts as a timeout.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', connect_timeout=3, _reactor=clock)
+        class Endpoint:
+            def connect(self, factory):
+                return defer.Deferred()
+        pipe._endpoints['foo'] = Endpoint()
+        d = pipe.connect('foo', None)
+        clock.advance(2.9)
+        self.assertNoResult(d)
+        clock.advance(0.1)
+        f = self.failureResultOf(d, error.TimeoutError)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        pipe.connectFailed('foo', f)
+        self.assertEqual(pipe.info('foo'), {'retries': 0, 'timeouts': 1})
+
+
+    @defer.inlineCallbacks
+    def test_failover(self):
+        """
+        If the upstream connection can't be made, the client is held while
+        it's retried to another destination.
+        """
+        live = 'unix:' + self.mktemp()
+        dead = 'unix:path=' + self.mktemp()
+        live_dst = 'unix:path=' + live[5:]
+        server = yield self.startServer(live, ['hey'])
+        pipe = Pipe([dead, live_dst], connect_retries=1,
+                    retry_backoff=0.01)
+        port = yield endpoints.serverFromString(
+            reactor, 'unix:' + self.mktemp()).listen(pipe)
+        self.addCleanup(port.stopListening)
+
+        client = yield self.connectClient('unix:path=' + port.getHost().name,
+                                          'hey back')
+        client.transport.write('hey')
+        server_proto = yield server.connected(0)
+        yield server_proto.satisfied
+        server_proto.transport.write('hey back')
+        yield client.satisfied
+
+        total, dsts = pipe.stats()
+        self.assertEqual(total['accepted'], 1)
+        counts = dict((x['dst'], (x['connect_failures'], x['connect_retries']))
+                      for x in dsts)
+        self.assertEqual(counts, {dead: (1, 0), live_dst: (0, 1)})
+        self.assertEqual(pipe._connections[dead], 0)
+        self.assertEqual(pipe._connections[live_dst], 1)
+
+
+    @defer.inlineCallbacks
+    def test_retriesExhausted(self):
+        """
+        Once the retries run out, the client is disconnected.
+        """
+        pipe = Pipe('unix:path=' + self.mktemp(), connect_retries=2,
+                    retry_backoff=0.01)
+        port = yield endpoints.serverFromString(
+            reactor, 'unix:' + self.mktemp()).listen(pipe)
+        self.addCleanup(port.stopListening)
+
+        lost = defer.Deferred()
+        class Client(protocol.Protocol):
+            def connectionLost(self, reason):
+                lost.callback(None)
+        yield endpoints.connectProtocol(
+            endpoints.UNIXClientEndpoint(reactor, port.getHost().name),
+            Client())
+        yield lost
+        total, dsts = pipe.stats()
+        self.assertEqual(total['connect_failures'], 3)
+        self.assertEqual(total['connect_retries'], 2)
+        self.assertEqual(total['closed_by_client'], 0)
+        self.assertEqual(pipe.info(pipe.dst), {'retries': 2, 'timeouts': 0})
+
+
+
+class IdleTimeoutTest(TestCase):
+
+
+    def test_active(self):
+        """
+        A connection that relays something before its C{idle_timeout} is up
+        gets another C{idle_timeout} from then, without the pipe scheduling
+        another timed call.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', idle_timeout=10, _reactor=clock)
+        server = ProxyServer()
+        server.factory = pipe
+        closed = []
+        self.patch(ProxyServer, '_abort',
+                   lambda self: closed.append(clock.seconds()))
+        server._stats = pipe.counters['foo']
+        server.startIdleTimer()
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+
+        clock.advance(6)
+        server.lastActive = clock.seconds()
+        clock.advance(4)
+        self.assertEqual(closed, [])
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(6)
+        self.assertEqual(closed, [16])
+        self.assertEqual(pipe.counters['foo'].closed_idle, 1)
+
+
+    def test_off(self):
+        """
+        Without an C{idle_timeout}, no timer is started.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', _reactor=clock)
+        server = ProxyServer()
+        server.factory = pipe
+        server.startIdleTimer()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    @defer.inlineCallbacks
+    def test_keepalive(self):
+        """
+        Both sides of a relayed TCP connection get the pipe's keepalive and
+        user timeout options.
+        """
+        server = YippyYuckFactory(['hi'])
+        port = yield endpoints.serverFromString(
+            reactor, 'tcp:0:interface=127.0.0.1').listen(server)
+        self.addCleanup(port.stopListening)
+        pipe = Pipe('tcp:host=127.0.0.1:port=%d' % (port.getHost().port,),
+                    keepalive=30, user_timeout=5)
+        pipe_port = yield endpoints.serverFromString(
+            reactor, 'tcp:0:interface=127.0.0.1').listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+        clientf = ClientFactory('')
+        client = yield endpoints.clientFromString(
+            reactor, 'tcp:host=127.0.0.1:port=%d' % (
+                pipe_port.getHost().port,)).connect(clientf)
+        self.addCleanup(client.transport.loseConnection)
+        client.transport.write('hi')
+        server_proto = yield server.connected(0)
+        yield server_proto.satisfied
+
+        [proxy] = pipe._open[pipe.dst]
+        for transport in [proxy.transport, proxy.peer.transport]:
+            sock = transport.getHandle()
+            self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                            socket.SO_KEEPALIVE))
+            if sys.platform.startswith('linux'):
+                self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP,
+                                                 TCP_USER_TIMEOUT), 5000)
+
+
+
+class StringRelayMixin:
+
+
+    def relay(self, pipe, dst='foo'):
+        """
+        Make a connection relayed by C{pipe} to C{dst}, with string
+        transports.
+
+        @return: Its L{ProxyServer}.
+        """
+        server = ProxyServer()
+        server.factory = pipe
+        server.transport = proto_helpers.StringTransport()
+        server._dst = dst
+        server._stats = pipe.counters[dst]
+        server._bucket = pipe.connectionBucket()
+        pipe.addConnection(dst, server)
+        client = ProxyClient()
+        client.transport = proto_helpers.StringTransport()
+        client.attach(server)
+        return server
+
+
+
+class ShapingTest(TestCase, StringRelayMixin):
+
+    def test_connLimit(self):
+        """
+        A connection that relays more than C{conn_rate_limit} allows is
+        relayed all the same, and then not read from until the limit has
+        caught up.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', conn_rate_limit=1000, _reactor=clock)
+        server = self.relay(pipe)
+        server.dataReceived('x' * 100)
+        self.assertEqual(server.transport.producerState, 'producing')
+        server.dataReceived('x' * 100)
+        self.assertEqual(server.peer.transport.value(), 'x' * 200)
+        self.assertEqual(server.transport.producerState, 'paused')
+        self.assertEqual(pipe.throttled, 1)
+
+        clock.advance(0.1)
+        self.assertEqual(server.transport.producerState, 'producing')
+        self.assertEqual(pipe.throttled, 0)
+        self.assertAlmostEqual(pipe.stats()[0]['throttled'], 0.1)
+
+
+    def test_rateLimit(self):
+        """
+        C{rate_limit} is shared by all of a pipe's connections, in both
+        directions, and the time throttled is the time any of them was
+        held back.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', rate_limit=1000, _reactor=clock)
+        a, b = self.relay(pipe), self.relay(pipe)
+        a.dataReceived('x' * 300)
+        b.peer.dataReceived('x' * 100)
+        self.assertEqual(a.transport.producerState, 'paused')
+        self.assertEqual(b.transport.producerState, 'producing')
+        self.assertEqual(b.peer.transport.producerState, 'paused')
+        self.assertEqual(pipe.throttled, 2)
+
+        clock.advance(0.2)
+        self.assertEqual(a.transport.producerState, 'producing')
+        self.assertAlmostEqual(pipe.stats()[0]['throttled'], 0.2)
+        clock.advance(0.1)
+        self.assertEqual(b.peer.transport.producerState, 'producing')
+        self.assertAlmostEqual(pipe.stats()[0]['throttled'], 0.3)
+
+
+    def test_dstLimit(self):
+        """
+        Each destination has its own C{dst_rate_limit}.
+        """
+        clock = task.Clock()
+        pipe = Pipe(['foo', 'bar'], dst_rate_limit=1000, _reactor=clock)
+        a, b = self.relay(pipe, 'foo'), self.relay(pipe, 'bar')
+        a.dataReceived('x' * 200)
+        b.dataReceived('x' * 100)
+        self.assertEqual(a.transport.producerState, 'paused')
+        self.assertEqual(b.transport.producerState, 'producing')
+
+
+    def test_limit(self):
+        """
+        Limits changed at runtime apply to connections already being
+        relayed, and turning them off lets held connections go straight
+        away.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', _reactor=clock)
+        server = self.relay(pipe)
+        server.dataReceived('x' * 1000)
+        self.assertFalse(pipe.shaping)
+
+        pipe.limit(conn_rate_limit=1000)
+        self.assertTrue(pipe.shaping)
+        server.dataReceived('x' * 1000)
+        self.assertEqual(server.transport.producerState, 'paused')
+
+        pipe.limit(rate_limit=5000)
+        self.assertEqual(pipe.conn_rate_limit, 1000)
+        pipe.limit(rate_limit=0, conn_rate_limit=0)
+        self.assertFalse(pipe.shaping)
+        self.assertEqual(server.transport.producerState, 'producing')
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertRaises(ValueError, pipe.limit, rate_limit=-1)
+
+
+    def test_flowControl(self):
+        """
+        Flow control doesn't resume a connection side that's being held
+        back for its rate limit.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', conn_rate_limit=1000, _reactor=clock)
+        server = self.relay(pipe)
+        server.dataReceived('x' * 200)
+        server.peer.transport.producer.resumeProducing()
+        self.assertEqual(server.transport.producerState, 'paused')
+
+
+    def test_backedUp(self):
+        """
+        A connection side that flow control has paused stays paused when
+        its rate limit lets it go.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', conn_rate_limit=1000, _reactor=clock)
+        server = self.relay(pipe)
+        server.peer.transport = abstract.FileDescriptor(reactor=clock)
+        server.peer.transport.producerPaused = True
+        server.dataReceived('x' * 200)
+        clock.advance(1)
+        self.assertEqual(server.transport.producerState, 'paused')
+        self.assertEqual(pipe.throttled, 0)
+
+
+    def test_closed(self):
+        """
+        A connection that closes while it's held back is forgotten about.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', conn_rate_limit=1000, _reactor=clock)
+        server = self.relay(pipe)
+        server.peer.dataReceived('x' * 200)
+        client = server.peer
+        client.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(pipe.throttled, 0)
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(pipe.counters['foo'].closed_by_upstream, 1)
+
+
+    def test_noSplice(self):
+        """
+        Connections aren't spliced, or relayed by the asyncio engine, while
+        a pipe has rate limits, since the bytes they relay aren't seen.
+        """
+        import grace.pipe
+        self.patch(grace.pipe, 'canSplice', lambda transport: True)
+        clock = task.Clock()
+        pipe = Pipe('foo', rate_limit=1000, _reactor=clock)
+        pipe.splice = True
+        server = self.relay(pipe)
+        self.assertEqual(server.peer._spliced, None)
+        self.assertEqual(server.transport.producer.__class__, Valve)
+        pipe.splice = False
+        pipe.engine = 'asyncio'
+        server = self.relay(pipe)
+        self.assertEqual(server.peer._spliced, None)
+
+
+
+class CoalesceTest(TestCase, StringRelayMixin):
+
+
+    def writes(self, transport):
+        """
+        Log each write to C{transport}.
+        """
+        writes = []
+        self.patch(transport, 'write', writes.append)
+        self.patch(transport, 'writeSequence',
+                   lambda seq: writes.append(''.join(seq)))
+        return writes
+
+
+    def test_off(self):
+        """
+        Without C{coalesce_delay} each chunk is written as it arrives.
+        """
+        pipe = Pipe('foo', _reactor=task.Clock())
+        server = self.relay(pipe)
+        writes = self.writes(server.peer.transport)
+        server.dataReceived('a')
+        server.dataReceived('b')
+        self.assertEqual(writes, ['a', 'b'])
+
+
+    def test_delay(self):
+        """
+        Chunks are gathered and written together, in either direction, at
+        most C{coalesce_delay} after the first of them arrived.  One timed
+        call writes out everything gathered for all the pipe's
+        connections.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', coalesce_delay=0.01, _reactor=clock)
+        server = self.relay(pipe)
+        up = self.writes(server.peer.transport)
+        down = self.writes(server.transport)
+        server.dataReceived('a')
+        clock.advance(0.005)
+        server.dataReceived('b')
+        server.peer.dataReceived('c')
+        self.assertEqual(up, [])
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(0.005)
+        self.assertEqual(up, ['ab'])
+        self.assertEqual(down, ['c'])
+        self.assertEqual(clock.getDelayedCalls(), [])
+        self.assertEqual(pipe.counters['foo'].bytes_in, 2)
+        self.assertEqual(pipe.counters['foo'].bytes_out, 1)
+
+
+    def test_size(self):
+        """
+        Chunks are written as soon as there are C{coalesce_size} bytes of
+        them, and a chunk that big on its own isn't held up at all.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', coalesce_delay=0.01, coalesce_size=10,
+                    _reactor=clock)
+        server = self.relay(pipe)
+        writes = self.writes(server.peer.transport)
+        server.dataReceived('x' * 6)
+        server.dataReceived('y' * 6)
+        self.assertEqual(writes, ['x' * 6 + 'y' * 6])
+        server.dataReceived('z' * 10)
+        self.assertEqual(writes[1:], ['z' * 10])
+        clock.advance(0.01)
+        self.assertEqual(len(writes), 2)
+
+
+    def test_closed(self):
+        """
+        What's been gathered for one side is written before that side is
+        closed because the other side closed.  If the side being written to
+        closes, what's been gathered for it is dropped.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', coalesce_delay=0.01, _reactor=clock)
+        server = self.relay(pipe)
+        client = server.peer
+        server.dataReceived('a')
+        client.dataReceived('b')
+        client.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.assertEqual(server.transport.value(), 'b')
+        self.assertTrue(server.transport.disconnecting)
+        self.assertEqual(client._pending, None)
+        clock.advance(0.01)
+        self.assertEqual(client.transport.value(), '')
+
+
+
+class FakeProducer:
+
+
+    def __init__(self):
+        self.called = []
+
+
+    def pauseProducing(self):
+        self.called.append('pause')
+
+
+    def resumeProducing(self):
+        self.called.append('resume')
+
+
+    def stopProducing(self):
+        self.called.append('stop')
+
+
+
+class ValveTest(TestCase):
+
+
+    def sink(self, clock):
+        sink = abstract.FileDescriptor(reactor=clock)
+        sink.producerPaused = True
+        return sink
+
+
+    def test_highWater(self):
+        """
+        The sink's buffer size is set to the pipe's high watermark.
+        """
+        pipe = Pipe('foo', high_water=1234)
+        sink = self.sink(task.Clock())
+        Valve(pipe, FakeProducer(), sink, 'src')
+        self.assertEqual(sink.bufferSize, 1234)
+
+
+    def test_highWater_default(self):
+        """
+        Without a high watermark, the sink's buffer size is left alone.
+        """
+        pipe = Pipe('foo')
+        sink = self.sink(task.Clock())
+        Valve(pipe, FakeProducer(), sink, 'src')
+        self.assertEqual(sink.bufferSize, abstract.FileDescriptor.bufferSize)
+
+
+    def test_pause(self):
+        """
+        Pausing the valve pauses the source and is counted in the
+        destination's counters.
+        """
+        pipe = Pipe('foo')
+        source = FakeProducer()
+        stats = Counters(task.Clock())
+        valve = Valve(pipe, source, self.sink(task.Clock()), 'dst', stats)
+        valve.pauseProducing()
+        self.assertEqual(source.called, ['pause'])
+        self.assertEqual((stats.pauses_src, stats.pauses_dst), (0, 1))
+        valve.resumeProducing()
+        self.assertEqual(source.called, ['pause', 'resume'])
+        valve.stopProducing()
+        self.assertEqual(source.called, ['pause', 'resume', 'stop'])
+
+
+    def test_pause_repeated(self):
+        """
+        Transports pause their producer on every write while their buffer is
+        full.  Only the first pause after a resume pauses the source, is
+        counted, or starts checking for the low watermark.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', high_water=100, low_water=50, _reactor=clock)
+        source = FakeProducer()
+        stats = Counters(clock)
+        valve = Valve(pipe, source, self.sink(clock), 'src', stats)
+        valve.pauseProducing()
+        valve.pauseProducing()
+        valve.pauseProducing()
+        self.assertEqual(source.called, ['pause'])
+        self.assertEqual((stats.pauses_src, stats.pauses_dst), (1, 0))
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        valve.resumeProducing()
+        self.assertEqual(clock.getDelayedCalls(), [])
+        valve.pauseProducing()
+        self.assertEqual(source.called, ['pause', 'resume', 'pause'])
+        self.assertEqual((stats.pauses_src, stats.pauses_dst), (2, 0))
+
+
+    def test_lowWater(self):
+        """
+        With a low watermark, the source is resumed as soon as the sink has
+        drained to it rather than waiting for the sink to empty.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', high_water=100, low_water=50, _reactor=clock)
+        source = FakeProducer()
+        sink = self.sink(clock)
+        valve = Valve(pipe, source, sink, 'src')
+        sink._tempDataLen = 120
+        valve.pauseProducing()
+        
+        clock.advance(valve.lowWaterInterval)
+        self.assertEqual(source.called, ['pause'])
+        
+        sink._tempDataLen = 50
+        clock.advance(valve.lowWaterInterval)
+        self.assertEqual(source.called, ['pause', 'resume'])
+        self.assertEqual(sink.producerPaused, False, "The sink should pause "
+                         "the valve again when it fills up")
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_lowWater_zero(self):
+        """
+        Without a low watermark, nothing is scheduled while paused.
+        """
+        clock = task.Clock()
+        pipe = Pipe('foo', _reactor=clock)
+        valve = Valve(pipe, FakeProducer(), self.sink(clock), 'src')
+        valve.pauseProducing()
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_lowWater_above_highWater(self):
+        """
+        The low watermark can't be above the high watermark.
+        """
+        self.assertRaises(ValueError, Pipe, 'foo', high_water=10,
+                          low_water=11)
+
+
+
+class Stalled(protocol.Protocol):
+    """
+    I never read anything.
+    """
+
+
+    def connectionMade(self):
+        self.factory.stalled.append(self)
+        self.transport.pauseProducing()
+
+
+
+class BackpressureTest(TestCase):
+
+
+    timeout = 2
+
+
+    @defer.inlineCallbacks
+    def test_slowUpstream(self):
+        """
+        A client sending faster than the upstream server reads is paused.
+        """
+        upstream = protocol.Factory.forProtocol(Stalled)
+        upstream.stalled = []
+        up_port = yield endpoints.serverFromString(reactor,
+            'tcp:10111:interface=127.0.0.1').listen(upstream)
+        self.addCleanup(up_port.stopListening)
+        
+        pipe = Pipe('tcp:host=127.0.0.1:port=10111', high_water=16384)
+        pipe_port = yield endpoints.serverFromString(reactor,
+            'tcp:10333:interface=127.0.0.1').listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+        
+        client = yield endpoints.clientFromString(reactor,
+            'tcp:host=127.0.0.1:port=10333').connect(
+                protocol.Factory.forProtocol(protocol.Protocol))
+        self.addCleanup(client.transport.loseConnection)
+        while not upstream.stalled:
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        
+        chunk = 'x' * 65536
+        while not pipe.stats()[0]['pauses_src']:
+            client.transport.write(chunk)
+            yield task.deferLater(reactor, 0.01, lambda: None)
+        totals, dsts = pipe.stats()
+        self.assertEqual(totals['pauses_dst'], 0)
+        self.assertEqual(dsts[0]['pauses_src'], totals['pauses_src'])
+
+
+
+@implementer(interfaces.IHalfCloseableProtocol)
+class Flood(protocol.Protocol):
+    """
+    I send a lot as soon as I'm connected, and say goodbye once the other
+    side has finished sending.
+    """
+
+    size = 4 * 1024 * 1024
+
+
+    def connectionMade(self):
+        self.received = ''
+        self.transport.write('x' * self.size)
+
+
+    def dataReceived(self, data):
+        self.received += data
+
+
+    def readConnectionLost(self):
+        self.factory.received.append(self.received)
+        self.transport.write('bye')
+        self.transport.loseConnection()
+
+
+    def writeConnectionLost(self):
+        pass
+
+
+
+@implementer(interfaces.IHalfCloseableProtocol)
+class HalfCloser(protocol.Protocol):
+    """
+    Once I start getting data I say hello and stop sending, but keep
+    reading until the other side closes.
+    """
+
+
+    def connectionMade(self):
+        self.received = []
+        self.lost = defer.Deferred()
+
+
+    def dataReceived(self, data):
+        if not self.received:
+            self.transport.write('hello')
+            self.transport.loseWriteConnection()
+        self.received.append(data)
+
+
+    def readConnectionLost(self):
+        self.transport.loseConnection()
+
+
+    def writeConnectionLost(self):
+        pass
+
+
+    def connectionLost(self, reason):
+        self.lost.callback(''.join(self.received))
+
+
+
+class HalfCloseTest(TestCase):
+
+
+    timeout = 5
+
+
+    @defer.inlineCallbacks
+    def t_halfClose(self, **pipe_options):
+        upstream = protocol.Factory.forProtocol(Flood)
+        upstream.received = []
+        socket1 = self.mktemp()
+        up_port = yield endpoints.serverFromString(reactor,
+            'unix:' + socket1).listen(upstream)
+        self.addCleanup(up_port.stopListening)
+
+        pipe = Pipe('unix:path=' + socket1, **pipe_options)
+        pipesocket = self.mktemp()
+        pipe_port = yield endpoints.serverFromString(reactor,
+            'unix:' + pipesocket).listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+
+        client = yield endpoints.clientFromString(reactor,
+            'unix:path=' + pipesocket).connect(
+                protocol.Factory.forProtocol(HalfCloser))
+        received = yield client.lost
+        self.assertEqual(len(received), Flood.size + 3)
+        self.assertTrue(received.endswith('bye'))
+        self.assertEqual(upstream.received, ['hello'])
+        totals, dsts = pipe.stats()
+        self.assertEqual(totals['bytes_in'], 5)
+        self.assertEqual(totals['bytes_out'], Flood.size + 3)
+        self.assertEqual(totals['closed_by_client'], 1)
+
+
+    def test_splice(self):
+        """
+        When the client stops sending, a spliced connection delivers what
+        it sent and keeps relaying what's still on its way back until the
+        upstream server closes too.
+        """
+        return self.t_halfClose(splice=True)
+
+    if not spliceAvailable():
+        test_splice.skip = 'splice(2) is not available'
+
+
+
+class Banner(protocol.Protocol):
+    """
+    I speak first.
+    """
+
+
+    def connectionMade(self):
+        self.factory.count += 1
+        self.transport.write('hello')
+
+
+
+class PoolTest(TestCase):
+
+
+    timeout = 2
+
+
+    @defer.inlineCallbacks
+    def waitFor(self, predicate):
+        while not predicate():
+            yield task.deferLater(reactor, 0.01, lambda: None)
+
+
+    @defer.inlineCallbacks
+    def test_pooled(self):
+        """
+        A pipe with a pool connects upstream before any client arrives, and
+        hands the connection to the next client, including anything the
+        upstream server already sent.
+        """
+        upstream = protocol.Factory.forProtocol(Banner)
+        upstream.count = 0
+        up_port = yield endpoints.serverFromString(reactor,
+            'tcp:10111:interface=127.0.0.1').listen(upstream)
+        self.addCleanup(up_port.stopListening)
+        
+        dst = 'tcp:host=127.0.0.1:port=10111'
+        pipe = Pipe(dst, pool_size=1)
+        self.assertEqual(pipe.info(dst), {}, "Shouldn't pool until listening")
+        pipe_port = yield endpoints.serverFromString(reactor,
+            'tcp:10333:interface=127.0.0.1').listen(pipe)
+        self.addCleanup(pipe_port.stopListening)
+        
+        pool = pipe._pools[dst]
+        yield self.waitFor(lambda: pool.ready)
+        self.assertEqual(upstream.count, 1)
+        
+        clientf = ClientFactory('hello')
+        client = yield endpoints.clientFromString(reactor,
+            'tcp:host=127.0.0.1:port=10333').connect(clientf)
+        self.addCleanup(client.transport.loseConnection)
+        yield client.satisfied
+        self.assertEqual(pipe.info(dst), {'pool_hits': 1, 'pool_misses': 0})
+        self.assertEqual(pipe._connections[dst], 1)
+        
+        yield self.waitFor(lambda: pool.ready)
+        self.assertEqual(upstream.count, 2, "Should have refilled the pool")
+        
+        pipe.switch('tcp:host=127.0.0.1:port=10222')
+        self.assertTrue(pool.closed)
+        self.assertEqual(pool.ready, [])
+        self.assertEqual(pipe.info(dst), {'pool_hits': 1, 'pool_misses': 0},
+                         "Counts should stay while connections remain")
@@ -1,10 +1,45 @@
 from twisted.trial.unittest import TestCase
 from twisted.application import service
-from twisted.internet import reactor
+from twisted.internet import reactor, defer, task
 
+import os
+import socket
 
-from grace.plumbing import Plumber
+
+from grace.plumbing import Plumber, PipeServices
 from grace.pipe import Pipe
+from grace.config import ConfigError
+from grace.workers import AdoptPipe
+from grace.test.util import FakeConnection
+
+
+
+class PipeServicesTest(TestCase):
+
+
+    def test_addService_fails(self):
+        """
+        A service that fails to start isn't kept, so it can be added again.
+        """
+        class Failing(service.Service):
+            def startService(self):
+                raise ValueError('nope')
+        services = PipeServices()
+        services.startService()
+        self.addCleanup(services.stopService)
+        s = Failing()
+        s.setName('foo')
+        self.assertRaises(ValueError, s.setServiceParent, services)
+        self.assertEqual(services.names, [])
+        self.assertEqual(services.namedServices, {})
+        self.assertEqual(list(services), [])
+        self.assertEqual(s.parent, None)
+
+        s2 = service.Service()
+        s2.setName('foo')
+        s2.setServiceParent(services)
+        self.assertEqual(services.names, ['foo'])
+        self.assertIdentical(services.namedServices['foo'], s2)
 
 
 
@@ -41,6 +76,64 @@ class PlumberTest(TestCase):
                          "destination on the Pipe")
 
 
+    def test_addPipe_options(self):
+        """
+        Extra keyword arguments to addPipe are passed to the pipeFactory.
+        """
+        p = Plumber()
+        called = []
+        def factory(dst, **options):
+            called.append((dst, options))
+            return Pipe(dst, **options)
+        p.pipeFactory = factory
+        p.addPipe('unix:'+self.mktemp(), 'unix:path=foo', splice=True)
+        self.assertEqual(called, [('unix:path=foo', {'splice': True})])
+
+
+    def test_pipeDefaults(self):
+        """
+        Default pipe options apply to every pipe added, unless overridden,
+        and are kept with its options.
+        """
+        p = Plumber()
+        p.pipeDefaults['engine'] = 'asyncio'
+        called = []
+        def factory(dst, **options):
+            called.append((dst, options))
+            return Pipe(dst)
+        p.pipeFactory = factory
+        s = p.addPipe('unix:'+self.mktemp(), 'foo', splice=True)
+        p.addPipe('unix:'+self.mktemp(), 'bar', engine='twisted')
+        self.assertEqual(called, [
+            ('foo', {'engine': 'asyncio', 'splice': True}),
+            ('bar', {'engine': 'twisted'}),
+        ])
+        self.assertEqual(s.options, {'engine': 'asyncio', 'splice': True})
+        self.assertEqual(Plumber().pipeDefaults, {})
+
+
+    def test_adoptPipe(self):
+        """
+        A pipe can be started on a socket that's already listening.
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        path = self.mktemp()
+        sock.bind(path)
+        sock.listen(5)
+        self.addCleanup(sock.close)
+        
+        p = Plumber()
+        s = p.adoptPipe('unix:'+path, os.dup(sock.fileno()), socket.AF_UNIX,
+                        'unix:path=foo')
+        self.assertEqual(p.getPipe('unix:'+path).dst, 'unix:path=foo')
+        self.assertEqual(s, p.getListener('unix:'+path))
+        
+        s.startService()
+        self.addCleanup(s.stopService)
+        self.assertEqual(s.fd, None, "Should have closed the given fd")
+        self.assertEqual(s.port.getHost().name, path)
+
+
     def test_rmPipe(self):
         """
         You can remove pipes by endpoint name
@@ -73,6 +166,31 @@ class PlumberTest(TestCase):
         self.assertEqual(pipe, list(p.pipe_services)[0].factory)
 
 
+    def test_getPipe_missing(self):
+        """
+        Getting a pipe that isn't there is a KeyError.
+        """
+        p = Plumber()
+        p.addPipe('unix:foo', 'unix:foo2')
+        p.rmPipe('unix:foo')
+        self.assertRaises(KeyError, p.getPipe, 'unix:foo')
+        self.assertRaises(KeyError, p.getPipe, 'unix:bar')
+
+
+    def test_names(self):
+        """
+        The names of the pipes are kept in order as pipes are added and
+        removed.
+        """
+        p = Plumber()
+        for name in ['unix:c', 'unix:a', 'unix:d', 'unix:b']:
+            p.addPipe(name, 'unix:x')
+        p.rmPipe('unix:c')
+        self.assertEqual(p.pipe_services.names, ['unix:a', 'unix:b', 'unix:d'])
+        self.assertEqual(sorted(p.pipe_services.namedServices),
+                         p.pipe_services.names)
+
+
     def test_pipeCommand(self):
         """
         You can execute things on the Pipe with a key
@@ -98,6 +216,182 @@ class PlumberTest(TestCase):
         ], "Should have passed all the appropriate args through")
 
 
+    def test_limit(self):
+        """
+        A pipe's rate limits can be changed, and are kept with its options.
+        """
+        listen = 'unix:'+self.mktemp()
+        p = Plumber()
+        p.addPipe(listen, 'unix:path='+self.mktemp(), rate_limit=1000)
+        p.limit(listen, rate_limit=2000, conn_rate_limit=100)
+        pipe = p.getPipe(listen)
+        self.assertEqual((pipe.rate_limit, pipe.conn_rate_limit),
+                         (2000, 100))
+        self.assertEqual(p.getListener(listen).options,
+                         {'rate_limit': 2000, 'conn_rate_limit': 100})
+        self.assertRaises(ValueError, p.limit, listen, rate_limit=-1)
+        self.assertEqual(pipe.rate_limit, 2000)
+
+
+    def test_drain(self):
+        """
+        A pipe can be drained by a deadline.
+        """
+        clock = task.Clock()
+        p = Plumber()
+        p.addPipe('unix:foo', 'unix:foo2', _reactor=clock)
+        pipe = p.getPipe('unix:foo')
+        conn = FakeConnection(pipe, 'unix:foo2')
+        p.pipeCommand('unix:foo', 'switch', 'unix:foo3')
+        d = p.drain('unix:foo', 5)
+        clock.advance(5)
+        self.assertEqual(self.successResultOf(d), 1)
+        self.assertTrue(conn.forced)
+
+
+    def test_drain_workers(self):
+        """
+        With workers, they all drain the pipe, and the connections they
+        closed are added up.
+        """
+        p = Plumber()
+        called = []
+        class FakeWorkers(object):
+            def pipeCommand(self, *args):
+                called.append(args)
+                return defer.succeed([{'forced': 1}, {'forced': 2}])
+        p.workers = FakeWorkers()
+        self.assertEqual(self.successResultOf(p.drain('unix:foo', 10, 2)), 3)
+        self.assertEqual(called, [('unix:foo', 'drain', 10, 2)])
+
+
+    def test_info(self):
+        """
+        You can get the extra details of a Pipe's destination.
+        """
+        p = Plumber()
+        p.addPipe('unix:foo', 'unix:foo2')
+        pipe = p.getPipe('unix:foo')
+        pipe.info = lambda dst: {'dst': dst}
+        self.assertEqual(p.info('unix:foo', 'unix:foo2'), {'dst': 'unix:foo2'})
+
+
+    def test_stats(self):
+        """
+        You can get the traffic counts of every pipe.
+        """
+        p = Plumber()
+        p.addPipe('unix:foo', 'unix:foo2')
+        p.addPipe('unix:bar', ['unix:bar2', 'unix:bar3'])
+        p.getPipe('unix:bar').accepted('unix:bar3')
+        pipes, dsts = p.stats()
+        self.assertEqual([(x['src'], x['accepted']) for x in pipes],
+                         [('unix:bar', 1), ('unix:foo', 0)])
+        self.assertEqual([(x['src'], x['dst'], x['accepted']) for x in dsts], [
+            ('unix:bar', 'unix:bar2', 0),
+            ('unix:bar', 'unix:bar3', 1),
+            ('unix:foo', 'unix:foo2', 0),
+        ])
+
+
+    def test_applyConfig(self):
+        """
+        Applying a config adds, removes and switches pipes all at once, and
+        returns what it did to each, plus a Deferred that fires once the
+        switched pipes' old destinations have drained.
+        """
+        p = Plumber()
+        p.addPipe('unix:foo', 'unix:a')
+        p.addPipe('unix:bar', 'unix:b')
+        p.addPipe('unix:baz', 'unix:c')
+        conn = object()
+        p.getPipe('unix:baz').addConnection('unix:c', conn)
+        results, drained = p.applyConfig([
+            ('unix:bar', 'unix:b'),
+            ('unix:baz', ['unix:d', 'unix:e']),
+            ('unix:new', 'unix:f'),
+        ])
+        self.assertEqual(results, [
+            {'src': 'unix:bar', 'action': 'unchanged'},
+            {'src': 'unix:baz', 'action': 'switched'},
+            {'src': 'unix:foo', 'action': 'removed'},
+            {'src': 'unix:new', 'action': 'added'},
+        ])
+        self.assertEqual(p.pipe_services.names,
+                         ['unix:bar', 'unix:baz', 'unix:new'])
+        self.assertEqual(p.getDsts('unix:baz'), ['unix:d', 'unix:e'])
+        self.assertEqual(p.getDsts('unix:new'), ['unix:f'])
+        self.assertFalse(drained.called)
+        p.getPipe('unix:baz').removeConnection('unix:c', conn)
+        self.assertTrue(drained.called)
+
+
+    def test_applyConfig_bad(self):
+        """
+        If any of a config is bad, none of it is applied.
+        """
+        p = Plumber()
+        p.addPipe('unix:foo', 'unix:a')
+        p.addPipe('unix:bar', 'unix:b')
+        self.assertRaises(ConfigError, p.applyConfig, [
+            ('unix:foo', 'unix:c'),
+            ('unix:new', 'bogus:nope'),
+        ])
+        self.assertRaises(ConfigError, p.applyConfig, [
+            ('unix:foo', 'unix:c'),
+            ('unix:foo', 'unix:d'),
+        ])
+        self.assertEqual(p.pipe_services.names, ['unix:bar', 'unix:foo'])
+        self.assertEqual(p.getDsts('unix:foo'), ['unix:a'])
+
+
+    @defer.inlineCallbacks
+    def test_applyConfig_cannotListen(self):
+        """
+        If a new pipe can't listen, the other new pipes are removed again,
+        nothing else is changed and the failure is reported for that pipe.
+        """
+        p = Plumber()
+        p.pipe_services.startService()
+        self.addCleanup(p.pipe_services.stopService)
+        foo = 'unix:' + self.mktemp()
+        bar = 'unix:' + self.mktemp()
+        new = 'unix:' + self.mktemp()
+        bad = 'unix:' + os.path.join(self.mktemp(), 'nodir', 'sock')
+        p.addPipe(foo, 'unix:a')
+        p.addPipe(bar, 'unix:b')
+        results, drained = p.applyConfig([
+            (bar, 'unix:c'),
+            (new, 'unix:d'),
+            (bad, 'unix:e'),
+        ])
+        self.assertEqual(len(results), 4)
+        failed = results.pop(sorted([foo, bar, new, bad]).index(bad))
+        self.assertEqual(failed['action'], 'failed')
+        self.assertIn('No such file', failed['error'])
+        self.assertEqual(sorted((x['src'], x['action']) for x in results),
+                         sorted([
+            (bar, 'skipped'),
+            (foo, 'skipped'),
+            (new, 'skipped'),
+        ]))
+        self.assertEqual(p.pipe_services.names, sorted([foo, bar]))
+        self.assertEqual(p.getDsts(bar), ['unix:b'])
+        yield drained
+        
+        # The pipe can be added once whatever was in the way has gone.
+        os.makedirs(os.path.dirname(bad.split(':', 1)[1]))
+        results, drained = p.applyConfig([(bad, 'unix:e')])
+        self.assertEqual(sorted((x['src'], x['action']) for x in results),
+                         sorted([
+            (bad, 'added'),
+            (bar, 'removed'),
+            (foo, 'removed'),
+        ]))
+        self.assertEqual(p.pipe_services.names, [bad])
+        yield drained
+
+
     def test_stop(self):
         """
         You can stop the whole process.
@@ -130,3 +424,100 @@ class PlumberTest(TestCase):
         self.assertEqual(r, expected)
 
 
+
+
+    def startedPlumber(self, *pipes, **options):
+        p = Plumber()
+        for src, dst in pipes:
+            p.addPipe(src, dst, **options)
+        p.pipe_services.privilegedStartService()
+        p.pipe_services.startService()
+        self.addCleanup(p.pipe_services.stopService)
+        return p
+
+
+    def test_handOff(self):
+        """
+        Each pipe's listening socket is sent with its destinations and
+        options, and once they've all been sent I stop accepting on them.
+        The sockets go on listening, and UNIX socket files stay put.
+        """
+        path = self.mktemp()
+        p = self.startedPlumber(('unix:'+path, ['unix:path=a', 'unix:path=b']),
+                                splice=True)
+        port = p.getListener('unix:'+path).port
+        sent = []
+        class FakeProto:
+            def callRemote(self, cmd, fd, **kwargs):
+                sent.append((cmd, kwargs))
+                sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+                sent.append(sock)
+                return defer.succeed({})
+        d = p.handOff(FakeProto())
+        def check(result):
+            self.assertEqual(sent[0], (AdoptPipe, {
+                'src': 'unix:'+path,
+                'dst': 'unix:path=a',
+                'dsts': ['unix:path=a', 'unix:path=b'],
+                'splice': True,
+            }))
+            self.addCleanup(sent[1].close)
+            self.assertFalse(port.connected)
+            self.assertTrue(os.path.exists(path))
+
+            client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            self.addCleanup(client.close)
+            client.connect(path)
+            sent[1].accept()[0].close()
+        return d.addCallback(check)
+
+
+    def test_handOff_failed(self):
+        """
+        If the other process fails to adopt a pipe, I go on accepting on
+        all of them.
+        """
+        path = self.mktemp()
+        p = self.startedPlumber(('unix:'+path, 'unix:path=a'))
+        class FakeProto:
+            def callRemote(self, cmd, **kwargs):
+                return defer.fail(Exception('no'))
+        self.failureResultOf(p.handOff(FakeProto()))
+        self.assertTrue(p.getListener('unix:'+path).port.connected)
+
+
+    def test_handOff_workers(self):
+        """
+        Pipes can't be handed off by a plumber with workers.
+        """
+        p = Plumber()
+        p.workers = object()
+        self.assertRaises(ValueError, p.handOff, None)
+
+
+    def test_retire(self):
+        """
+        Retiring stops the services alongside the pipes, then stops the
+        process once the pipes have no connections, checking every
+        C{retireInterval} seconds.
+        """
+        clock = task.Clock()
+        p = Plumber(_reactor=clock)
+        p.retireInterval = 5
+        parent = service.MultiService()
+        p.pipe_services.setServiceParent(parent)
+        other = service.Service()
+        other.setServiceParent(parent)
+        conns = [1]
+        p.ls = lambda: [('unix:foo', 'unix:a', conns[0], True)]
+        stopped = []
+        p.stop = lambda: stopped.append(True)
+
+        self.successResultOf(p.retire())
+        self.assertEqual(list(parent), [p.pipe_services])
+        conns[0] = 0
+        self.assertEqual(stopped, [], "Should answer before stopping")
+        clock.advance(5)
+        self.assertEqual(stopped, [True])
+        clock.advance(5)
+        self.assertEqual(stopped, [True])
@@ -0,0 +1,214 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, task, protocol
+from twisted.test.proto_helpers import StringTransport
+
+
+from grace.pool import UpstreamPool
+
+
+
+class FakeProtocol(protocol.Protocol):
+
+    pool = None
+
+
+
+class FakeEndpoint:
+    """
+    I connect when told to.
+    """
+
+
+    def __init__(self):
+        self.pending = []
+
+
+    def connect(self, factory):
+        d = defer.Deferred()
+        self.pending.append((factory, d))
+        return d
+
+
+    def succeed(self):
+        factory, d = self.pending.pop(0)
+        proto = factory.buildProtocol(None)
+        proto.makeConnection(StringTransport())
+        d.callback(proto)
+        return proto
+
+
+    def fail(self):
+        factory, d = self.pending.pop(0)
+        d.errback(Exception('refused'))
+
+
+
+class UpstreamPoolTest(TestCase):
+
+
+    def pool(self, size=2, idle=10):
+        self.clock = task.Clock()
+        self.endpoint = FakeEndpoint()
+        return UpstreamPool(self.clock, self.endpoint, size, idle,
+                            FakeProtocol)
+
+
+    def test_start(self):
+        """
+        Starting the pool opens enough connections to fill it.
+        """
+        pool = self.pool(size=2)
+        self.assertEqual(self.endpoint.pending, [])
+        pool.start()
+        self.assertEqual(len(self.endpoint.pending), 2)
+        proto = self.endpoint.succeed()
+        self.assertEqual(pool.ready, [proto])
+        self.assertEqual(proto.pool, pool)
+
+
+    def test_take(self):
+        """
+        Taking a ready connection counts as a hit and starts a replacement.
+        """
+        pool = self.pool(size=1)
+        pool.start()
+        proto = self.endpoint.succeed()
+        
+        self.assertEqual(pool.take(), proto)
+        self.assertEqual(proto.pool, None, "Taken connections should no "
+                         "longer belong to the pool")
+        self.assertEqual((pool.hits, pool.misses), (1, 0))
+        self.assertEqual(len(self.endpoint.pending), 1, "Should refill")
+
+
+    def test_take_empty(self):
+        """
+        Taking from an empty pool counts as a miss.
+        """
+        pool = self.pool(size=1)
+        pool.start()
+        self.assertEqual(pool.take(), None)
+        self.assertEqual((pool.hits, pool.misses), (0, 1))
+        self.assertEqual(len(self.endpoint.pending), 1, "Should not start "
+                         "more connections than the pool holds")
+
+
+    def test_failed(self):
+        """
+        Failed connections aren't retried until the next take.
+        """
+        pool = self.pool(size=1)
+        pool.start()
+        self.endpoint.fail()
+        self.assertEqual(self.endpoint.pending, [])
+        self.assertEqual(pool.take(), None)
+        self.assertEqual(len(self.endpoint.pending), 1)
+
+
+    def test_lost(self):
+        """
+        A ready connection that's lost is taken out of the pool.
+        """
+        pool = self.pool(size=1)
+        pool.start()
+        proto = self.endpoint.succeed()
+        pool.lost(proto)
+        self.assertEqual(pool.ready, [])
+
+
+    def test_lost_refill(self):
+        """
+        The pool is refilled in the background after a ready connection is
+        lost.
+        """
+        pool = self.pool(size=2)
+        pool.start()
+        proto1 = self.endpoint.succeed()
+        proto2 = self.endpoint.succeed()
+        pool.lost(proto1)
+        pool.lost(proto2)
+        self.assertEqual(self.endpoint.pending, [])
+        self.clock.advance(pool.refillDelay)
+        self.assertEqual(len(self.endpoint.pending), 2)
+        self.endpoint.succeed()
+        self.endpoint.succeed()
+        self.assertEqual(len(pool.ready), 2)
+        self.assertEqual(pool.misses, 0)
+
+
+    def test_lost_backoff(self):
+        """
+        If the destination keeps closing ready connections, the pool waits
+        longer each time before refilling, up to C{maxRefillDelay} seconds.
+        Once it stops, the pool refills promptly again.
+        """
+        pool = self.pool(size=1, idle=1000)
+        pool.start()
+        delays = []
+        for i in range(12):
+            pool.lost(self.endpoint.succeed())
+            delays.append(round(pool._refillCall.getTime()
+                                - self.clock.seconds(), 6))
+            self.clock.advance(delays[-1])
+        self.assertEqual(delays[:3], [0.1, 0.2, 0.4])
+        self.assertEqual(delays[-1], pool.maxRefillDelay)
+        
+        proto = self.endpoint.succeed()
+        self.clock.advance(pool.maxRefillDelay)
+        pool.lost(proto)
+        self.clock.advance(pool.refillDelay)
+        self.assertEqual(len(self.endpoint.pending), 1)
+
+
+    def test_lost_shrunk(self):
+        """
+        Connections closed by L{UpstreamPool.shrink} aren't refilled.
+        """
+        pool = self.pool(size=1)
+        pool.start()
+        proto = self.endpoint.succeed()
+        pool.shrink()
+        pool.lost(proto)
+        self.assertEqual(self.endpoint.pending, [])
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+
+
+    def test_idle(self):
+        """
+        After being idle, the pool closes its connections and doesn't refill
+        until asked for a connection.
+        """
+        pool = self.pool(size=1, idle=10)
+        pool.start()
+        proto = self.endpoint.succeed()
+        self.clock.advance(9)
+        pool.take()
+        proto2 = self.endpoint.succeed()
+        
+        self.clock.advance(9)
+        self.assertEqual(pool.ready, [proto2], "Taking should have reset the "
+                         "idle timer")
+        self.clock.advance(1)
+        self.assertEqual(pool.ready, [])
+        self.assertTrue(proto2.transport.disconnecting)
+        self.assertEqual(self.endpoint.pending, [])
+        
+        self.assertEqual(pool.take(), None)
+        self.assertEqual(len(self.endpoint.pending), 1)
+
+
+    def test_close(self):
+        """
+        Closing the pool closes ready connections, and any that were still
+        connecting once they connect.
+        """
+        pool = self.pool(size=2)
+        pool.start()
+        proto = self.endpoint.succeed()
+        pool.close()
+        self.assertTrue(proto.transport.disconnecting)
+        proto2 = self.endpoint.succeed()
+        self.assertTrue(proto2.transport.disconnecting)
+        self.assertEqual(pool.ready, [])
+        self.assertEqual(pool.take(), None)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
@@ -0,0 +1,187 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, defer, endpoints, threads
+from twisted.protocols import amp
+
+import os
+import sys
+import subprocess
+import tempfile
+
+import grace
+
+from grace.quick import packBox, unpackBoxes, unpackList, parseArgs
+from grace.quick import listTypes, statsTypes, BlockingClient, RemoteError
+from grace.quick import runCommand
+from grace.control import ServerFactory, List, Stats, statsFields
+from grace.plumbing import Plumber
+
+
+# Found now, before trial changes directory.
+_top = os.path.dirname(os.path.dirname(os.path.abspath(grace.__file__)))
+
+
+
+class BoxTest(TestCase):
+
+
+    def test_packBox(self):
+        """
+        Boxes are serialized the way Twisted does it.
+        """
+        box = {'_command': 'Switch', 'src': 'unix:foo', 'dst': ''}
+        self.assertEqual(packBox(box), amp.AmpBox(box).serialize())
+
+
+    def test_unpackBoxes(self):
+        """
+        Complete boxes are parsed, and the rest is left over.
+        """
+        one = {'_answer': '1', 'x': ''}
+        two = {'_answer': '2', 'y': 'z' * 300}
+        data = amp.AmpBox(one).serialize() + amp.AmpBox(two).serialize()
+        self.assertEqual(unpackBoxes(data), ([one, two], ''))
+        for i in range(1, len(data)):
+            boxes, rest = unpackBoxes(data[:i])
+            self.assertEqual(boxes + unpackBoxes(rest + data[i:])[0],
+                             [one, two])
+
+
+    def test_unpackList(self):
+        """
+        The values of an AmpList are converted back into what they were.
+        """
+        rows = [
+            {'src': 'unix:foo', 'dst': 'unix:a', 'conns': 2, 'active': True,
+             'weight': 0.5, 'healthy': False},
+            {'src': 'unix:foo', 'dst': 'unix:b', 'conns': 0, 'active': False},
+        ]
+        data = List.response[0][1].toStringProto(rows, None)
+        self.assertEqual(unpackList(data, listTypes), rows)
+
+
+    def test_types(self):
+        """
+        The types to read responses with agree with the commands.
+        """
+        def types(fields):
+            return dict((name, type(argument)) for name, argument in fields
+                        if not isinstance(argument, amp.String))
+        expected = {amp.Integer: int, amp.Float: float}
+        for fields, quick in [(List.response[0][1].subargs, listTypes),
+                              (statsFields, statsTypes)]:
+            got = types(fields)
+            self.assertEqual(sorted(got), sorted(quick))
+            for name, kind in got.items():
+                if kind is amp.Boolean:
+                    self.assertEqual(quick[name]('True'), True)
+                    self.assertEqual(quick[name]('False'), False)
+                else:
+                    self.assertEqual(quick[name], expected[kind])
+        self.assertEqual(Stats.response[0][1].subargs[1:], statsFields)
+
+
+
+class ImportTest(TestCase):
+
+
+    def test_noTwisted(self):
+        """
+        Importing L{grace.quick} doesn't import Twisted.
+        """
+        output = subprocess.check_output([sys.executable, '-c',
+            'import sys, grace.quick; '
+            'print [x for x in sys.modules if x.startswith("twisted")]'],
+            env=dict(os.environ, PYTHONPATH=_top))
+        self.assertEqual(output.strip(), '[]')
+
+
+
+class parseArgsTest(TestCase):
+
+
+    def test_simple(self):
+        """
+        Commands without options are handled.
+        """
+        home = os.path.expanduser('~/.grace')
+        self.assertEqual(parseArgs(['ls']), (home, 'ls', []))
+        self.assertEqual(parseArgs(['-d', '/tmp/g', 'stats']),
+                         ('/tmp/g', 'stats', []))
+        self.assertEqual(parseArgs(['-d/tmp/g', 'w', 'tcp:80']),
+                         ('/tmp/g', 'wait', ['tcp:80']))
+        self.assertEqual(parseArgs(['--basedir=/tmp/g', 'switch', 'tcp:80',
+                                    'tcp:host=a:port=1', 'tcp:host=b:port=1']),
+                         ('/tmp/g', 'switch', ['tcp:80', 'tcp:host=a:port=1',
+                                               'tcp:host=b:port=1']))
+        self.assertEqual(parseArgs(['--basedir', '/tmp/g', 'stop']),
+                         ('/tmp/g', 'stop', []))
+
+
+    def test_other(self):
+        """
+        Everything else is left to L{grace.cli}.
+        """
+        for argv in [[], ['--help'], ['-d'], ['start', 'tcp:80', 'tcp:81'],
+                     ['ls', '--help'], ['switch', 'tcp:80'],
+                     ['wait', 'tcp:80', 'tcp:81'], ['ls', 'extra'],
+                     ['shift', '--abort', 'tcp:80'], ['--version', 'ls']]:
+            self.assertEqual(parseArgs(argv), None, argv)
+
+
+
+class BlockingClientTest(TestCase):
+
+
+    timeout = 3
+
+
+    @defer.inlineCallbacks
+    def setUp(self):
+        path = tempfile.mkdtemp() + '/grace.socket'
+        self.plumber = Plumber()
+        port = yield endpoints.UNIXServerEndpoint(reactor, path).listen(
+            ServerFactory(self.plumber))
+        self.addCleanup(port.stopListening)
+        self.client = BlockingClient(path)
+        self.addCleanup(self.client.close)
+
+
+    def call(self, f, *args):
+        # The client blocks, so it can't run in the reactor's thread.
+        return threads.deferToThread(f, *args)
+
+
+    @defer.inlineCallbacks
+    def test_commands(self):
+        """
+        Commands are sent over one connection and their answers read.
+        """
+        self.plumber.addPipe('unix:foo', 'unix:a')
+        conn = object()
+        self.plumber.getPipe('unix:foo').addConnection('unix:a', conn)
+        yield self.call(self.client.switch, 'unix:foo', 'unix:b')
+        self.assertEqual(self.plumber.getDsts('unix:foo'), ['unix:b'])
+        yield self.call(self.client.switch, 'unix:foo', ['unix:c', 'unix:d'])
+        self.assertEqual(self.plumber.getDsts('unix:foo'),
+                         ['unix:c', 'unix:d'])
+        rows = yield self.call(self.client.ls)
+        self.assertEqual(sorted((x['dst'], x['conns'], x['active'])
+                                for x in rows),
+                         [('unix:a', 1, False), ('unix:c', 0, True),
+                          ('unix:d', 0, True)])
+        self.plumber.getPipe('unix:foo').removeConnection('unix:a', conn)
+        yield self.call(self.client.wait, 'unix:foo')
+        output = yield self.call(runCommand, self.client, 'stats', [])
+        self.assertIn('unix:foo', output)
+
+
+    @defer.inlineCallbacks
+    def test_error(self):
+        """
+        An error answer is raised as L{RemoteError}.
+        """
+        e = yield self.assertFailure(
+            self.call(self.client.switch, 'unix:nothing', 'unix:b'),
+            RemoteError)
+        self.assertEqual(e.code, 'UNKNOWN')
+        self.flushLoggedErrors(KeyError)
@@ -0,0 +1,66 @@
+from twisted.trial.unittest import TestCase
+
+from grace.shaping import TokenBucket, checkRate
+
+
+
+class TokenBucketTest(TestCase):
+
+
+    def test_burst(self):
+        """
+        A full bucket lets C{burst} bytes through at once.
+        """
+        bucket = TokenBucket(1000, 100, 0)
+        self.assertEqual(bucket.take(60, 0), 0)
+        self.assertEqual(bucket.take(40, 0), 0)
+        self.assertEqual(bucket.tokens, 0)
+
+
+    def test_debt(self):
+        """
+        Taking more than the bucket holds leaves it in debt, and says how
+        long until the debt is paid off.
+        """
+        bucket = TokenBucket(1000, 100, 0)
+        self.assertEqual(bucket.take(300, 0), 0.2)
+        self.assertAlmostEqual(bucket.take(0, 0.1), 0.1)
+        self.assertEqual(bucket.take(0, 0.25), 0)
+
+
+    def test_refill(self):
+        """
+        A bucket refills at C{rate}, but never beyond C{burst}.
+        """
+        bucket = TokenBucket(1000, 100, 0)
+        bucket.take(100, 0)
+        bucket.take(0, 0.05)
+        self.assertEqual(bucket.tokens, 50)
+        bucket.take(0, 10)
+        self.assertEqual(bucket.tokens, 100)
+
+
+    def test_setRate(self):
+        """
+        A new rate applies from when it's set; the debt built up is kept.
+        """
+        bucket = TokenBucket(1000, 100, 0)
+        bucket.take(300, 0)
+        bucket.setRate(100, 10, 0.1)
+        self.assertEqual(bucket.tokens, -100)
+        self.assertEqual(bucket.take(0, 0.1), 1.0)
+
+
+
+class checkRateTest(TestCase):
+
+
+    def test_negative(self):
+        """
+        A rate limit may be C{0} or C{None}, meaning no limit, but not
+        negative.
+        """
+        checkRate(None)
+        checkRate(0)
+        checkRate(1.5)
+        self.assertRaises(ValueError, checkRate, -1)
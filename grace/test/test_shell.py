@@ -0,0 +1,138 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer
+from twisted.python import usage
+from twisted.test.proto_helpers import StringTransport
+
+
+from grace.shell import parseCommand, CommandShell
+
+
+
+class parseCommandTest(TestCase):
+
+
+    def test_parse(self):
+        """
+        A line is a grace command and its arguments, quoted like a shell's.
+        """
+        name, options = parseCommand("switch tcp:9000 'tcp:host=a:port=1' b")
+        self.assertEqual(name, 'switch')
+        self.assertEqual(options['src'], 'tcp:9000')
+        self.assertEqual(options['dst'], ['tcp:host=a:port=1', 'b'])
+
+
+    def test_empty(self):
+        """
+        Blank lines and comments aren't commands.
+        """
+        self.assertEqual(parseCommand('   '), None)
+        self.assertEqual(parseCommand('# ls'), None)
+
+
+    def test_bad(self):
+        self.assertRaises(usage.UsageError, parseCommand, 'start tcp:1 tcp:2')
+        self.assertRaises(usage.UsageError, parseCommand, 'switch')
+        self.assertRaises(usage.UsageError, parseCommand, 'apply -')
+
+
+
+class FakeClient:
+
+
+    def __init__(self):
+        self.calls = []
+
+
+    def _call(self, *args):
+        d = defer.Deferred()
+        self.calls.append(args + (d,))
+        return d
+
+
+    def switch(self, src, dst, drain_timeout=None, grace=None):
+        return self._call('switch', src, dst, drain_timeout, grace)
+
+
+    def wait(self, src, timeout=None, grace=None):
+        return self._call('wait', src, timeout, grace)
+
+
+    def ls(self):
+        return self._call('ls')
+
+
+
+class CommandShellTest(TestCase):
+
+
+    def shell(self, interactive=False):
+        client = FakeClient()
+        shell = CommandShell(client, interactive)
+        transport = StringTransport()
+        shell.makeConnection(transport)
+        return client, shell, transport
+
+
+    def test_batch(self):
+        """
+        In batch mode commands are all sent straight away, and their output
+        is written in order.
+        """
+        client, shell, transport = self.shell()
+        shell.dataReceived('wait tcp:9000\nswitch tcp:9000 b\nls\n')
+        self.assertEqual([x[:-1] for x in client.calls], [
+            ('wait', 'tcp:9000', None, None),
+            ('switch', 'tcp:9000', 'b', None, None),
+            ('ls',),
+        ])
+        client.calls[2][-1].callback([])
+        client.calls[1][-1].callback(None)
+        self.assertEqual(transport.value(), '')
+        client.calls[0][-1].callback(None)
+        self.assertEqual(transport.value(),
+                         'ok\nok\nsrc dst connections status\n')
+
+
+    def test_drain(self):
+        """
+        A switch with a drain timeout says how many connections it closed.
+        """
+        client, shell, transport = self.shell()
+        shell.dataReceived('switch --drain-timeout=1m --grace=5 tcp:9000 b\n')
+        self.assertEqual(client.calls[0][:-1],
+                         ('switch', 'tcp:9000', 'b', 60.0, 5.0))
+        client.calls[0][-1].callback(2)
+        self.assertEqual(transport.value(), 'Drained; closed 2 connections '
+                         'that were still open\n')
+
+
+    def test_errors(self):
+        """
+        Failed commands are reported and counted, and the count is given
+        once the input ends and the output has been written.
+        """
+        client, shell, transport = self.shell()
+        shell.dataReceived('bogus\nwait tcp:9000\n')
+        shell.readConnectionLost()
+        self.assertFalse(transport.disconnecting,
+                         "Should wait for the output first")
+        client.calls[0][-1].errback(Exception('no such pipe'))
+        self.assertTrue(transport.disconnecting)
+        shell.connectionLost(None)
+        self.assertEqual(self.successResultOf(shell.done), 2)
+        self.assertEqual(transport.value().splitlines()[1],
+                         'Error: no such pipe')
+
+
+    def test_interactive(self):
+        """
+        Interactively, each command is prompted for and finishes before the
+        next is read.
+        """
+        client, shell, transport = self.shell(interactive=True)
+        self.assertEqual(transport.value(), 'grace> ')
+        shell.dataReceived('wait tcp:9000\n')
+        self.assertEqual(transport.producerState, 'paused')
+        client.calls[0][-1].callback(None)
+        self.assertEqual(transport.producerState, 'producing')
+        self.assertEqual(transport.value(), 'grace> ok\ngrace> ')
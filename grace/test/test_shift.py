@@ -0,0 +1,201 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task
+
+
+from grace.pipe import Pipe
+from grace.shift import Shift
+
+
+
+class ShiftTest(TestCase):
+
+
+    def pipe(self, dst='old'):
+        self.clock = task.Clock()
+        return Pipe(dst, _reactor=self.clock)
+
+
+    def test_linear(self):
+        """
+        The share of new connections going to the new destination goes up
+        steadily.  Both destinations are active until the shift is done.
+        """
+        p = self.pipe()
+        p.shift('new', 10)
+        self.assertEqual(p.dsts, ['old', 'new'])
+        self.assertEqual(p.weights, {'old': 1.0, 'new': 0.0})
+        self.clock.advance(1)
+        self.assertEqual(p.weights, {'old': 0.9, 'new': 0.1})
+        self.clock.advance(4)
+        self.assertEqual(p.weights, {'old': 0.5, 'new': 0.5})
+        self.assertEqual(p.info('new'), {'weight': 0.5})
+        self.assertEqual(set(p.ls()), set([
+            ('old', 0, True),
+            ('new', 0, True),
+        ]))
+
+
+    def test_steps(self):
+        """
+        A shift can go in steps.
+        """
+        p = self.pipe()
+        p.shift('new', 10, steps=4)
+        self.assertEqual(p.weights['new'], 0)
+        self.clock.advance(2)
+        self.assertEqual(p.weights['new'], 0)
+        self.clock.advance(0.5)
+        self.assertEqual(p.weights['new'], 0.25)
+        self.clock.advance(5)
+        self.assertEqual(p.weights['new'], 0.75)
+
+
+    def test_done(self):
+        """
+        Once the shift is done, the pipe forwards only to the new
+        destination and the old one drains.
+        """
+        p = self.pipe()
+        conn = object()
+        p.addConnection('old', conn)
+        d = p.shift('new', 10)
+        wait = p.wait()
+        self.clock.advance(10)
+        self.assertEqual(p.dsts, ['new'])
+        self.assertEqual(p.weights, None)
+        self.assertEqual(p.shifting, None)
+        self.assertEqual(p.info('new'), {})
+        self.assertFalse(d.called)
+        self.assertFalse(wait.called)
+        p.removeConnection('old', conn)
+        self.assertEqual(self.successResultOf(d), ['old'])
+        self.assertTrue(wait.called)
+
+
+    def test_done_result(self):
+        """
+        The Deferred from the final switch keeps its result after firing the
+        shift's, and every callback on the shift's gets the old
+        destinations.
+        """
+        p = self.pipe()
+        switched = []
+        switch = p.switch
+        def recordSwitch(dst):
+            d = switch(dst)
+            switched.append(d)
+            return d
+        p.switch = recordSwitch
+        d = p.shift('new', 10)
+        results = []
+        def record(result):
+            results.append(result)
+            return result
+        d.addCallback(record)
+        d.addCallback(record)
+        self.clock.advance(10)
+        self.assertEqual(results, [['old'], ['old']])
+        self.assertEqual(self.successResultOf(switched[-1]), ['old'])
+
+
+    def test_wait(self):
+        """
+        Waiting on a pipe waits for a shift in progress to finish.
+        """
+        p = self.pipe()
+        p.shift('new', 10)
+        wait = p.wait()
+        self.clock.advance(5)
+        self.assertFalse(wait.called)
+        self.clock.advance(5)
+        self.assertTrue(wait.called)
+
+
+    def test_pick(self):
+        """
+        New connections are spread according to the weights.
+        """
+        p = self.pipe()
+        p.shift('new', 10)
+        self.clock.advance(3)
+        picked = [p.pickDst(None) for i in range(10)]
+        self.assertEqual(picked.count('new'), 3)
+        self.assertEqual(picked.count('old'), 7)
+
+
+    def test_pause(self):
+        """
+        A paused shift holds the weights where they are.
+        """
+        p = self.pipe()
+        p.shift('new', 10)
+        self.clock.advance(2)
+        p.pauseShift()
+        self.assertEqual(p.shifting.state, 'paused')
+        self.clock.advance(100)
+        self.assertEqual(p.weights, {'old': 0.8, 'new': 0.2})
+        p.resumeShift()
+        self.clock.advance(3)
+        self.assertEqual(p.weights, {'old': 0.5, 'new': 0.5})
+        self.assertRaises(ValueError, p.resumeShift)
+
+
+    def test_abort(self):
+        """
+        Aborting a shift sends everything back to the old destination and the
+        new one drains.
+        """
+        p = self.pipe()
+        d = p.shift('new', 10)
+        self.clock.advance(2)
+        conn = object()
+        p.addConnection('new', conn)
+        p.abortShift()
+        self.assertEqual(p.dsts, ['old'])
+        self.assertEqual(p.weights, None)
+        self.assertEqual(self.successResultOf(d), None)
+        self.assertEqual(set(p.ls()), set([
+            ('old', 0, True),
+            ('new', 1, False),
+        ]))
+        self.clock.advance(100)
+        self.assertEqual(p.dsts, ['old'])
+        self.assertRaises(ValueError, p.abortShift)
+
+
+    def test_switch(self):
+        """
+        Switching during a shift cancels the shift.
+        """
+        p = self.pipe()
+        d = p.shift('new', 10)
+        p.switch('other')
+        self.assertEqual(p.dsts, ['other'])
+        self.assertEqual(p.shifting, None)
+        self.assertEqual(self.successResultOf(d), None)
+        self.clock.advance(100)
+        self.assertEqual(p.dsts, ['other'])
+
+
+    def test_once(self):
+        """
+        Only one shift can happen at a time, and it must take some time.
+        """
+        p = self.pipe()
+        self.assertRaises(ValueError, p.shift, 'new', 0)
+        self.assertEqual(p.shifting, None)
+        p.shift('new', 10)
+        self.assertRaises(ValueError, p.shift, 'other', 10)
+
+
+    def test_several(self):
+        """
+        Shifting from several destinations to several splits the weights
+        evenly within each group.
+        """
+        p = self.pipe(['a', 'b'])
+        s = Shift(p, ['c', 'd'], 10)
+        s.start()
+        s.setFraction(0.5)
+        self.assertEqual(p.weights, {'a': 0.25, 'b': 0.25,
+                                     'c': 0.25, 'd': 0.25})
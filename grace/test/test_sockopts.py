@@ -0,0 +1,81 @@
+from twisted.trial.unittest import TestCase
+
+import socket
+import sys
+
+from grace.sockopts import tcpSocket, tuneConnection, TCP_USER_TIMEOUT
+
+
+
+class FakeTransport:
+
+
+    def __init__(self, sock):
+        self.sock = sock
+
+
+    def getHandle(self):
+        return self.sock
+
+
+
+class tuneConnectionTest(TestCase):
+
+
+    def tcp(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.addCleanup(sock.close)
+        return sock
+
+
+    def test_tcpSocket(self):
+        """
+        Only TCP sockets are tuned.
+        """
+        sock = self.tcp()
+        self.assertIdentical(tcpSocket(FakeTransport(sock)), sock)
+        unix = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(unix.close)
+        self.assertEqual(tcpSocket(FakeTransport(unix)), None)
+        self.assertEqual(tcpSocket(object()), None)
+
+
+    def test_keepalive(self):
+        """
+        Keepalives are turned on, with the given timings where the platform
+        has them.
+        """
+        sock = self.tcp()
+        tuneConnection(FakeTransport(sock), keepalive=30,
+                       keepalive_interval=5, keepalive_probes=4)
+        self.assertTrue(sock.getsockopt(socket.SOL_SOCKET,
+                                        socket.SO_KEEPALIVE))
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP,
+                                             socket.TCP_KEEPIDLE), 30)
+            self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP,
+                                             socket.TCP_KEEPINTVL), 5)
+            self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP,
+                                             socket.TCP_KEEPCNT), 4)
+
+
+    def test_userTimeout(self):
+        """
+        The user timeout is given to the kernel in milliseconds.
+        """
+        sock = self.tcp()
+        tuneConnection(FakeTransport(sock), user_timeout=2.5)
+        self.assertEqual(sock.getsockopt(socket.IPPROTO_TCP,
+                                         TCP_USER_TIMEOUT), 2500)
+        self.assertFalse(sock.getsockopt(socket.SOL_SOCKET,
+                                         socket.SO_KEEPALIVE))
+
+    if not sys.platform.startswith('linux'):
+        test_userTimeout.skip = 'TCP_USER_TIMEOUT is Linux only'
+
+
+    def test_nothing(self):
+        """
+        Without options the socket isn't even looked at.
+        """
+        tuneConnection(object())
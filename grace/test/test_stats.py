@@ -0,0 +1,111 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import task
+
+
+from grace.stats import Rate, Counters, mergeStats
+
+
+
+class RateTest(TestCase):
+
+
+    def test_steady(self):
+        """
+        A steady rate of events converges on that rate.
+        """
+        clock = task.Clock()
+        rate = Rate(clock, window=10, interval=1)
+        for i in range(100):
+            rate.mark(5)
+            clock.advance(1)
+        self.assertAlmostEqual(rate.value(), 5, places=2)
+
+
+    def test_lazy(self):
+        """
+        Nothing is counted until an interval has passed, and the rate decays
+        while nothing happens even if nobody is looking.
+        """
+        clock = task.Clock()
+        rate = Rate(clock, window=10, interval=1)
+        rate.mark(10)
+        self.assertEqual(rate.value(), 0)
+        clock.advance(1)
+        first = rate.value()
+        self.assertTrue(first > 0)
+        clock.advance(50)
+        self.assertTrue(rate.value() < first / 100)
+
+
+
+class CountersTest(TestCase):
+
+
+    def test_add(self):
+        """
+        Counters can be added together and turned into a dictionary.
+        """
+        clock = task.Clock()
+        a = Counters(clock)
+        a.accepted = 2
+        a.bytes_in = 10
+        b = Counters(clock)
+        b.accepted = 1
+        b.closed_on_error = 1
+        a.add(b)
+        self.assertEqual(a.asDict(), {
+            'accepted': 3,
+            'connect_failures': 0,
+            'connect_retries': 0,
+            'connect_timeouts': 0,
+            'bytes_in': 10,
+            'bytes_out': 0,
+            'closed_by_client': 0,
+            'closed_by_upstream': 0,
+            'closed_on_error': 1,
+            'closed_forced': 0,
+            'closed_idle': 0,
+            'queued': 0,
+            'queue_wait': 0.0,
+            'rejected': 0,
+            'queue_timeouts': 0,
+            'pauses_src': 0,
+            'pauses_dst': 0,
+            'rate': 0.0,
+        })
+
+
+
+class mergeStatsTest(TestCase):
+
+
+    def test_merge(self):
+        """
+        Rows with the same keys are added up.
+        """
+        r = mergeStats([
+            {'src': 'b', 'accepted': 1, 'rate': 0.5},
+            {'src': 'a', 'accepted': 2, 'rate': 1.0},
+            {'src': 'b', 'accepted': 3, 'rate': 0.25},
+        ], ('src',))
+        self.assertEqual(r, [
+            {'src': 'a', 'accepted': 2, 'rate': 1.0},
+            {'src': 'b', 'accepted': 4, 'rate': 0.75},
+        ])
+
+
+    def test_missing(self):
+        """
+        Counts some rows don't have (such as C{'waiting'}, which only pipes
+        have) are left out of the sum.
+        """
+        r = mergeStats([
+            {'src': 'a', 'waiting': None},
+            {'src': 'a', 'waiting': None},
+            {'src': 'b', 'waiting': None},
+            {'src': 'b', 'waiting': 2},
+        ], ('src',))
+        self.assertEqual(r, [
+            {'src': 'a', 'waiting': None},
+            {'src': 'b', 'waiting': 2},
+        ])
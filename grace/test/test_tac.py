@@ -28,6 +28,54 @@ class getTacTest(TestCase):
         self.assertEqual(s, expected)
 
 
+    def test_pipeOptions(self):
+        """
+        Options for the pipe are passed as keyword arguments.
+        """
+        s = getTac(('src', 'dst', {'splice': True}))
+        expected = tac_template.getContent()
+        expected += "\nplumber.addPipe('src', 'dst', splice=True)\n"
+        self.assertEqual(s, expected)
+
+
+    def test_workers(self):
+        """
+        If workers are asked for, the tac file sets them up before adding
+        any pipes.
+        """
+        s = getTac(('src', 'dst'), workers=3)
+        expected = tac_template.getContent()
+        expected += ("\nplumber.useWorkers(3, d.path).setServiceParent("
+                     "application)\n")
+        expected += "\nplumber.addPipe('src', 'dst')\n"
+        self.assertEqual(s, expected)
+
+
+    def test_defaults(self):
+        """
+        Default options for every pipe are set before adding any pipes.
+        """
+        s = getTac(('src', 'dst'), defaults={'engine': 'asyncio'})
+        expected = tac_template.getContent()
+        expected += "\nplumber.pipeDefaults.update({'engine': 'asyncio'})\n"
+        expected += "\nplumber.addPipe('src', 'dst')\n"
+        self.assertEqual(s, expected)
+
+
+    def test_metrics(self):
+        """
+        If a metrics endpoint is given, the tac file serves metrics on it.
+        """
+        s = getTac(('src', 'dst'), metrics='tcp:9100')
+        expected = tac_template.getContent()
+        expected += ("\nfrom grace.metrics import metricsSite\n"
+                     "metrics_service = strports.service('tcp:9100', "
+                     "metricsSite(plumber))\n"
+                     "metrics_service.setServiceParent(application)\n")
+        expected += "\nplumber.addPipe('src', 'dst')\n"
+        self.assertEqual(s, expected)
+
+
 
 class setupDirTest(TestCase):
 
@@ -0,0 +1,171 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import defer, reactor, task
+
+import os
+import time
+
+from grace import timers
+from grace.timers import TimerWheel, ShortTimer
+
+
+
+class TimerWheelTest(TestCase):
+
+
+    def test_late(self):
+        """
+        A timer is called at the end of the tick its deadline falls in,
+        never before its deadline.
+        """
+        clock = task.Clock()
+        wheel = TimerWheel(clock, 1.0)
+        called = []
+        wheel.add(2.5, lambda: called.append(clock.seconds()))
+        clock.advance(2.5)
+        self.assertEqual(called, [])
+        clock.advance(0.5)
+        self.assertEqual(called, [3.0])
+
+
+    def test_oneCall(self):
+        """
+        However many timers are waiting, there's only one timed call with
+        the reactor, for the earliest of them.
+        """
+        clock = task.Clock()
+        wheel = TimerWheel(clock, 1.0)
+        called = []
+        for i in range(1000):
+            wheel.add(5 + i % 10, lambda i=i: called.append(i))
+        self.assertEqual(len(wheel), 1000)
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        self.assertEqual(clock.getDelayedCalls()[0].getTime(), 5)
+
+        clock.advance(5)
+        self.assertEqual(len(called), 100)
+        self.assertEqual(clock.getDelayedCalls()[0].getTime(), 6)
+        clock.advance(10)
+        self.assertEqual(len(called), 1000)
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    def test_earlier(self):
+        """
+        A timer due before any of the others is still called on time.
+        """
+        clock = task.Clock()
+        wheel = TimerWheel(clock, 1.0)
+        called = []
+        wheel.add(10, lambda: called.append(10))
+        wheel.add(2, lambda: called.append(2))
+        self.assertEqual(len(clock.getDelayedCalls()), 1)
+        clock.advance(2)
+        self.assertEqual(called, [2])
+
+
+    def test_remove(self):
+        """
+        A removed timer isn't called.
+        """
+        clock = task.Clock()
+        wheel = TimerWheel(clock, 1.0)
+        called = []
+        f = lambda: called.append(True)
+        key = wheel.add(3, f)
+        wheel.remove(key, f)
+        self.assertEqual(len(wheel), 0)
+        wheel.remove(key, f)
+        clock.advance(3)
+        self.assertEqual(called, [])
+
+        wheel.add(4, f)
+        clock.advance(1)
+        self.assertEqual(called, [True])
+
+
+    def test_error(self):
+        """
+        A timer that raises an exception has it logged, and the others due
+        at the same time are still called.
+        """
+        clock = task.Clock()
+        wheel = TimerWheel(clock, 1.0)
+        called = []
+        wheel.add(1, lambda: 1 / 0)
+        wheel.add(1, lambda: called.append(True))
+        clock.advance(1)
+        self.assertEqual(called, [True])
+        self.assertEqual(len(self.flushLoggedErrors(ZeroDivisionError)), 1)
+
+
+
+class ShortTimerTest(TestCase):
+
+
+    def test_callLater(self):
+        """
+        With a reactor that doesn't watch file descriptors, a timed call is
+        used.
+        """
+        clock = task.Clock()
+        called = []
+        timer = ShortTimer(clock, lambda: called.append(clock.seconds()))
+        timer.start(0.002)
+        self.assertTrue(timer.pending)
+        clock.advance(0.002)
+        self.assertEqual(called, [0.002])
+        self.assertFalse(timer.pending)
+        timer.start(0.001)
+        timer.stop()
+        clock.advance(1)
+        self.assertEqual(called, [0.002])
+        self.assertEqual(clock.getDelayedCalls(), [])
+
+
+    @defer.inlineCallbacks
+    def test_timerfd(self):
+        """
+        With a real reactor on Linux, a timerfd is watched, and kept to be
+        set again each time the timer is started until it's closed.
+        """
+        called = []
+        timer = ShortTimer(reactor, lambda: called[-1].callback(time.time()))
+        self.addCleanup(timer.close)
+        for i in range(2):
+            called.append(defer.Deferred())
+            start = time.time()
+            timer.start(0.002)
+            if i == 0:
+                fd = timer.fileno()
+                self.assertEqual(reactor.getDelayedCalls(), [])
+            self.assertEqual(timer.fileno(), fd)
+            self.assertIn(timer, reactor.getReaders())
+            when = yield called[-1]
+            self.assertTrue(when - start >= 0.002)
+            self.assertFalse(timer.pending)
+            self.assertIn(timer, reactor.getReaders())
+
+        timer.close()
+        self.assertNotIn(timer, reactor.getReaders())
+        self.assertRaises(OSError, os.fstat, fd)
+
+    if timers._timerfd is None:
+        test_timerfd.skip = 'timerfd is Linux only'
+
+
+    def test_timerfdStop(self):
+        """
+        A stopped timer doesn't go off, even if its timerfd had already
+        expired.
+        """
+        timer = ShortTimer(reactor, lambda: self.fail('went off'))
+        self.addCleanup(timer.close)
+        timer.start(0.001)
+        time.sleep(0.002)
+        timer.stop()
+        self.assertFalse(timer.pending)
+        timer.doRead()
+        return task.deferLater(reactor, 0.005, lambda: None)
+
+    if timers._timerfd is None:
+        test_timerfdStop.skip = 'timerfd is Linux only'
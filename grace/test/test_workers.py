@@ -0,0 +1,111 @@
+from twisted.trial.unittest import TestCase
+from twisted.internet import reactor, endpoints
+from twisted.python.filepath import FilePath
+
+import shutil
+import tempfile
+
+
+from grace.workers import mergeListings
+from grace.plumbing import Plumber
+from grace.test.util import YippyYuckFactory, ClientFactory
+
+
+
+class mergeListingsTest(TestCase):
+
+
+    def test_empty(self):
+        """
+        No workers, no pipes.
+        """
+        self.assertEqual(mergeListings([]), [])
+        self.assertEqual(mergeListings([[], []]), [])
+
+
+    def test_sum(self):
+        """
+        Connection counts and other numbers for the same pipe and destination
+        are summed, and the rows come out sorted.
+        """
+        r = mergeListings([
+            [
+                {'src': 'b', 'dst': 'x', 'conns': 1, 'active': True,
+                 'pool_hits': 2, 'pool_misses': None},
+                {'src': 'a', 'dst': 'y', 'conns': 0, 'active': False},
+            ],
+            [
+                {'src': 'b', 'dst': 'x', 'conns': 3, 'active': True,
+                 'pool_hits': 1, 'pool_misses': 4},
+            ],
+        ])
+        self.assertEqual(r, [
+            {'src': 'a', 'dst': 'y', 'conns': 0, 'active': False},
+            {'src': 'b', 'dst': 'x', 'conns': 4, 'active': True,
+             'pool_hits': 3, 'pool_misses': 4},
+        ])
+
+
+    def test_active(self):
+        """
+        A destination is active if it's active in any worker.
+        """
+        r = mergeListings([
+            [{'src': 'a', 'dst': 'x', 'conns': 0, 'active': False}],
+            [{'src': 'a', 'dst': 'x', 'conns': 0, 'active': True}],
+        ])
+        self.assertEqual(r[0]['active'], True)
+
+
+
+class WorkerPoolTest(TestCase):
+
+    timeout = 10
+
+
+    def test_relay(self):
+        """
+        Pipes added to a plumber using workers are listened on by every
+        worker, and connections through them are relayed.
+        """
+        # Somewhere short enough for UNIX socket paths.
+        basedir = FilePath(tempfile.mkdtemp())
+        self.addCleanup(shutil.rmtree, basedir.path)
+        listen = 'unix:' + basedir.child('src').path
+        dst_path = basedir.child('dst').path
+
+        server = YippyYuckFactory(['hello'])
+        sep = endpoints.UNIXServerEndpoint(reactor, dst_path)
+        d = sep.listen(server)
+        d.addCallback(lambda p: self.addCleanup(p.stopListening))
+
+        plumber = Plumber()
+        pool = plumber.useWorkers(2, basedir.path)
+        pool.startService()
+        self.addCleanup(pool.stopService)
+        plumber.pipe_services.startService()
+        self.addCleanup(plumber.pipe_services.stopService)
+        plumber.addPipe(listen, 'unix:' + dst_path)
+
+        d.addCallback(lambda x: pool.ready)
+
+        def ready(pool):
+            self.assertEqual(sorted(pool.workers), [0, 1])
+            client = ClientFactory('')
+            reactor.connectUNIX(basedir.child('src').path, client)
+            return client.connected
+        d.addCallback(ready)
+
+        def connected(proto):
+            self.addCleanup(proto.transport.loseConnection)
+            proto.transport.write('hello')
+            return server.connected(0).addCallback(lambda p: p.satisfied)
+        d.addCallback(connected)
+
+        d.addCallback(lambda x: plumber.listPipes())
+        def listed(rows):
+            self.assertEqual(len(rows), 1)
+            self.assertEqual(rows[0]['src'], listen)
+            self.assertEqual(rows[0]['dst'], 'unix:' + dst_path)
+            self.assertEqual(rows[0]['conns'], 1)
+        return d.addCallback(listed)
@@ -95,3 +95,26 @@ class ClientFactory(protocol.ClientFactory):
         proto.expected_data = self.expected_data
         self.connected.callback(proto)
 
+
+
+class FakeConnection(object):
+    """
+    I stand in for a L{grace.pipe.ProxyServer} being drained.
+    """
+
+
+    def __init__(self, pipe, dst, idle=True):
+        self.pipe = pipe
+        self.dst = dst
+        self.idle = idle
+        self.forced = False
+        pipe.addConnection(dst, self)
+
+
+    def isIdle(self, now):
+        return self.idle
+
+
+    def forceClose(self):
+        self.forced = True
+        self.pipe.removeConnection(self.dst, self)
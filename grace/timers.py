@@ -0,0 +1,254 @@
+"""
+Timeouts for very many connections at once, and short ones on time.
+
+A C{callLater} for each of hundreds of thousands of connections would make
+the reactor's heap of timed calls that big, and every timed call anything
+schedules would pay for it.  A L{TimerWheel} keeps its timers in buckets a
+tick apart instead, and has one timed call with the reactor for all of
+them.
+
+A reactor's timed calls are only as precise as its poll timeout, which
+Python 2's C{epoll} rounds down to a whole millisecond: in the last
+millisecond before one the reactor polls over and over without sleeping.
+That doesn't matter for a timeout of seconds, but does for one of a
+millisecond or two that's set again and again; a L{ShortTimer} is for
+those.
+"""
+
+from twisted.internet import interfaces
+from twisted.python import log
+from zope.interface import implementer
+
+import ctypes
+import ctypes.util
+import errno
+import heapq
+import math
+import os
+import sys
+
+
+CLOCK_MONOTONIC = 1
+TFD_CLOEXEC = 0o2000000
+TFD_NONBLOCK = 0o4000
+
+
+
+class _timespec(ctypes.Structure):
+    _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+
+
+class _itimerspec(ctypes.Structure):
+    _fields_ = [('it_interval', _timespec), ('it_value', _timespec)]
+
+
+
+def _loadTimerfd():
+    """
+    Get libc's C{timerfd_create} and C{timerfd_settime} functions, or
+    C{None} if they aren't available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        create = libc.timerfd_create
+        settime = libc.timerfd_settime
+    except (OSError, AttributeError):
+        return None
+    create.argtypes = [ctypes.c_int, ctypes.c_int]
+    create.restype = ctypes.c_int
+    settime.argtypes = [ctypes.c_int, ctypes.c_int,
+                        ctypes.POINTER(_itimerspec), ctypes.c_void_p]
+    settime.restype = ctypes.c_int
+    return create, settime
+
+_timerfd = _loadTimerfd()
+
+
+
+class TimerWheel(object):
+    """
+    I call things at the time they ask for, or up to C{tick} seconds after
+    it (never before), using one reactor timed call however many are
+    waiting.
+
+    Each deadline is rounded up to a whole number of ticks, and everything
+    due in the same tick is kept in one bucket.  Adding and removing a timer
+    is adding to and removing from a set; only a new bucket, of which there
+    are at most as many as there are ticks in the longest timeout, costs
+    more.
+
+    @ivar tick: Seconds between buckets.
+    """
+
+    def __init__(self, reactor, tick=1.0):
+        self.reactor = reactor
+        self.tick = tick
+        self._buckets = {}
+        self._due = []
+        self._call = None
+
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self._buckets.values())
+
+
+    def add(self, when, f):
+        """
+        Call C{f} with no arguments at C{when} (by the reactor's clock) or
+        soon after.
+
+        @return: A key to pass to L{remove} with C{f} to cancel the call.
+        """
+        key = int(math.ceil(when / self.tick))
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = set()
+            heapq.heappush(self._due, key)
+            if self._due[0] == key:
+                self._schedule()
+        bucket.add(f)
+        return key
+
+
+    def remove(self, key, f):
+        """
+        Cancel a call set up with L{add}, if it hasn't happened yet.
+        """
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            # An emptied bucket stays until it's due, so that a timer added
+            # to it again doesn't need another entry in the heap.
+            bucket.discard(f)
+
+
+    def _schedule(self):
+        if not self._due:
+            return
+        delay = max(0, self._due[0] * self.tick - self.reactor.seconds())
+        if self._call is None:
+            self._call = self.reactor.callLater(delay, self._fire)
+        else:
+            self._call.reset(delay)
+
+
+    def _fire(self):
+        self._call = None
+        now = self.reactor.seconds()
+        while self._due and self._due[0] * self.tick <= now:
+            for f in self._buckets.pop(heapq.heappop(self._due)):
+                try:
+                    f()
+                except Exception:
+                    log.err(None, 'Error in timer %r' % (f,))
+        self._schedule()
+
+
+
+@implementer(interfaces.IReadDescriptor)
+class ShortTimer(object):
+    """
+    I call C{f} with no arguments C{delay} seconds after each L{start}, to
+    within a few microseconds rather than a millisecond.
+
+    With a reactor that watches file descriptors, on Linux, I use a
+    C{timerfd} that it watches along with its sockets.  It's made the first
+    time I'm started and kept until L{close}, so that starting me again is
+    one C{timerfd_settime} and going off is one C{read}.  Otherwise I use a
+    C{callLater}.
+
+    @ivar pending: C{True} from L{start} until I go off or am stopped.
+    """
+
+    def __init__(self, reactor, f):
+        self.reactor = reactor
+        self.f = f
+        self.pending = False
+        self._fd = None
+        self._call = None
+
+
+    def start(self, delay):
+        """
+        Go off in C{delay} seconds.  I mustn't already be pending.
+        """
+        if (_timerfd is None
+                or not interfaces.IReactorFDSet.providedBy(self.reactor)):
+            self.pending = True
+            self._call = self.reactor.callLater(delay, self._fire)
+            return
+        if self._fd is None:
+            fd = _timerfd[0](CLOCK_MONOTONIC, TFD_CLOEXEC | TFD_NONBLOCK)
+            if fd < 0:
+                err = ctypes.get_errno()
+                raise OSError(err, os.strerror(err))
+            self._fd = fd
+            self.reactor.addReader(self)
+        # A zero it_value would disarm the timer rather than set it off.
+        self._settime(max(1, int(delay * 1e9)))
+        self.pending = True
+
+
+    def _settime(self, nsec):
+        spec = _itimerspec()
+        spec.it_value.tv_sec, spec.it_value.tv_nsec = divmod(nsec, 10 ** 9)
+        if _timerfd[1](self._fd, 0, ctypes.byref(spec), None) < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+
+
+    def stop(self):
+        """
+        Don't go off after all.
+        """
+        if self._call is not None:
+            self._call.cancel()
+            self._call = None
+        if self.pending and self._fd is not None:
+            self._settime(0)
+        self.pending = False
+
+
+    def close(self):
+        """
+        Stop, and close my C{timerfd} if I have one.  I can still be started
+        again afterwards.
+        """
+        self.stop()
+        if self._fd is not None:
+            self.reactor.removeReader(self)
+            os.close(self._fd)
+            self._fd = None
+
+
+    def _fire(self):
+        self._call = None
+        self.pending = False
+        self.f()
+
+
+    def fileno(self):
+        return self._fd
+
+
+    def doRead(self):
+        try:
+            os.read(self._fd, 8)
+        except OSError as e:
+            if e.errno == errno.EAGAIN:
+                # Stopped or started again since it went off.
+                return
+            raise
+        if self.pending:
+            self._fire()
+
+
+    def connectionLost(self, reason):
+        pass
+
+
+    def logPrefix(self):
+        return 'ShortTimer'
@@ -0,0 +1,440 @@
+"""
+Spreading one grace daemon's pipes over several worker processes.
+
+In worker mode the main process binds each pipe's listening socket but never
+accepts on it.  Instead it passes the socket to every worker process over a
+private UNIX socket, and each worker accepts and relays connections on its
+own reactor.  Control commands sent to the main process are fanned out to
+all the workers and their answers merged.
+"""
+
+from twisted.application import service
+from twisted.internet import defer, endpoints, protocol, error
+from twisted.protocols import amp
+from twisted.python import log
+from twisted.python.filepath import FilePath
+
+import sys, os
+
+from grace.control import Server, RemovePipe, Switch, SwitchBalanced
+from grace.control import Stop, Wait, List
+from grace.control import Shift, PauseShift, ResumeShift, AbortShift
+from grace.control import Stats, Limit
+from grace.control import pipeOptions, _given
+from grace.listeners import socketFamily
+from grace.stats import mergeStats
+
+
+# The directory grace is imported from, so workers import the same one.
+_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Register(amp.Command):
+    """
+    Sent by a worker to the main process once it's ready for pipes.
+    """
+
+    arguments = [
+        ('index', amp.Integer()),
+    ]
+    response = []
+
+
+class AdoptPipe(amp.Command):
+    """
+    Sent by the main process to a worker to have it start a L{Pipe} on an
+    already-listening socket.
+    """
+
+    arguments = [
+        ('src', amp.String()),
+        ('dst', amp.String()),
+        ('fd', amp.Descriptor()),
+        ('dsts', amp.ListOf(amp.String(), optional=True)),
+    ] + pipeOptions
+    response = []
+
+
+
+def mergeListings(listings):
+    """
+    Merge the C{List} responses of several workers.
+
+    @param listings: A list of lists of C{List} rows.
+
+    @return: One list of rows, with a row for each (src, dst) pair.
+        Connection counts and other numbers are summed, and a destination is
+        active if it's active in any worker.  Weights are the same in every
+        worker (give or take timing) so the largest is kept.  A destination
+        is healthy if it's healthy in every worker.
+    """
+    merged = {}
+    for rows in listings:
+        for row in rows:
+            key = (row['src'], row['dst'])
+            if key not in merged:
+                merged[key] = dict(row)
+                continue
+            m = merged[key]
+            m['active'] = m['active'] or row['active']
+            for k, v in row.items():
+                if k in ('src', 'dst', 'active') or v is None:
+                    continue
+                if k == 'weight':
+                    m[k] = max(m.get(k), v)
+                elif k == 'healthy':
+                    m[k] = v and m.get(k) is not False
+                else:
+                    m[k] = (m.get(k) or 0) + v
+    return [merged[k] for k in sorted(merged)]
+
+
+
+class SharedListener(service.Service):
+    """
+    I bind a pipe's listening socket in the main process and share it with
+    the workers, without accepting any connections on it myself.
+
+    @ivar listening: Once I've started, a C{Deferred} that fires when my
+        socket is bound, or fails if it can't be.
+
+    @ivar dst: The pipe's current destination, kept up to date so that
+        restarted workers forward to the right place.
+    """
+
+    port = None
+    listening = None
+
+
+    def __init__(self, pool, src, dst, options):
+        self.pool = pool
+        self.src = src
+        self.dst = dst
+        self.options = options
+        self.setName(src)
+
+
+    def startService(self):
+        service.Service.startService(self)
+        ep = endpoints.serverFromString(self.pool.reactor, self.src)
+        if not isinstance(ep, (endpoints.TCP4ServerEndpoint,
+                               endpoints.TCP6ServerEndpoint,
+                               endpoints.UNIXServerEndpoint)):
+            raise ValueError("Only tcp and unix pipes can be shared with "
+                             "workers: %r" % (self.src,))
+        d = ep.listen(protocol.Factory())
+        self.listening = d.addCallback(self._listening)
+        return self.listening
+
+
+    def _listening(self, port):
+        # The workers do the accepting.
+        port.stopReading()
+        self.port = port
+        self.pool.share(self)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        if self.port is not None:
+            port, self.port = self.port, None
+            return port.stopListening()
+
+
+    def adopt(self, worker):
+        """
+        Have a worker start accepting on my socket.
+
+        @return: A C{Deferred} that fires once it has.
+        """
+        fd = self.port.fileno()
+        if isinstance(self.dst, basestring):
+            dst, dsts = self.dst, None
+        else:
+            dst, dsts = self.dst[0], self.dst
+        return worker.callRemote(AdoptPipe, src=self.src, dst=dst, fd=fd,
+                                 dsts=dsts, **self.options)
+
+
+
+class _MainProtocol(amp.AMP):
+    """
+    The main process's end of its connection to a worker.
+    """
+
+    index = None
+
+
+    @Register.responder
+    def register(self, index):
+        self.index = index
+        self.factory.pool.registered(self)
+        return {}
+
+
+    def connectionLost(self, reason):
+        amp.AMP.connectionLost(self, reason)
+        self.factory.pool.lost(self)
+
+
+
+class _WorkerProcess(protocol.ProcessProtocol):
+    """
+    I pass a worker process's output on to the log and tell the pool when it
+    exits.
+    """
+
+    def __init__(self, pool, index):
+        self.pool = pool
+        self.index = index
+
+
+    def outReceived(self, data):
+        for line in data.splitlines():
+            log.msg('[worker %d] %s' % (self.index, line))
+
+    errReceived = outReceived
+
+
+    def processEnded(self, reason):
+        self.pool.processEnded(self.index, reason)
+
+
+
+class WorkerPool(service.Service):
+    """
+    I run C{count} worker processes and talk to them.
+
+    @ivar workers: Dictionary of worker index to the connected protocol of
+        every worker that has registered.
+    @ivar ready: A C{Deferred} that fires once every worker has registered
+        for the first time.
+    """
+
+    respawnDelay = 1
+
+    pipeCommands = {
+        'switch': (Switch, ('dst',)),
+        'wait': (Wait, ()),
+        'drain': (Wait, ('drain_timeout', 'grace')),
+        'shift': (Shift, ('dst', 'over', 'steps')),
+        'pauseShift': (PauseShift, ()),
+        'resumeShift': (ResumeShift, ()),
+        'abortShift': (AbortShift, ()),
+        'limit': (Limit, ()),
+    }
+
+
+    def __init__(self, plumber, count, basedir, reactor):
+        self.plumber = plumber
+        self.count = count
+        self.reactor = reactor
+        self.socket = FilePath(basedir).child('grace.workers.socket')
+        self.workers = {}
+        self.processes = {}
+        self._respawns = {}
+        self._exits = {}
+        self.ready = defer.Deferred()
+        self._port = None
+
+
+    def startService(self):
+        service.Service.startService(self)
+        if self.socket.exists():
+            self.socket.remove()
+        factory = protocol.Factory.forProtocol(_MainProtocol)
+        factory.pool = self
+        ep = endpoints.UNIXServerEndpoint(self.reactor, self.socket.path)
+        d = ep.listen(factory)
+        def listening(port):
+            self._port = port
+            for i in range(self.count):
+                self.spawn(i)
+        return d.addCallback(listening)
+
+
+    def stopService(self):
+        service.Service.stopService(self)
+        for call in self._respawns.values():
+            call.cancel()
+        self._respawns.clear()
+        dl = []
+        for worker in self.workers.values():
+            worker.callRemote(Stop).addErrback(lambda x: None)
+        for index in self.processes:
+            d = self._exits[index] = defer.Deferred()
+            dl.append(d)
+        if self._port is not None:
+            dl.append(defer.maybeDeferred(self._port.stopListening))
+        return defer.DeferredList(dl)
+
+
+    def spawn(self, index):
+        """
+        Start worker number C{index}.
+        """
+        self._respawns.pop(index, None)
+        args = [sys.executable, '-c',
+                'from grace.workers import workerMain; workerMain()',
+                self.socket.path, str(index)]
+        # Make sure the worker imports the same grace we're running.
+        env = dict(os.environ)
+        env['PYTHONPATH'] = os.pathsep.join(
+            [_root] + [x for x in [env.get('PYTHONPATH')] if x])
+        self.processes[index] = self.reactor.spawnProcess(
+            _WorkerProcess(self, index), sys.executable, args, env=env)
+
+
+    def processEnded(self, index, reason):
+        del self.processes[index]
+        if index in self._exits:
+            self._exits.pop(index).callback(None)
+        if self.running:
+            log.msg('worker %d exited (%s); restarting in %ss' % (
+                    index, reason.getErrorMessage(), self.respawnDelay))
+            self._respawns[index] = self.reactor.callLater(
+                self.respawnDelay, self.spawn, index)
+
+
+    def registered(self, worker):
+        """
+        A worker has connected and is ready for pipes.  Give it all the pipes
+        that are already listening.
+        """
+        self.workers[worker.index] = worker
+        dl = []
+        for listener in self.plumber.pipe_services:
+            if isinstance(listener, SharedListener) and listener.port:
+                dl.append(listener.adopt(worker))
+        d = defer.gatherResults(dl)
+        if len(self.workers) == self.count and not self.ready.called:
+            d.addCallback(lambda x: self.ready.callback(self))
+        d.addErrback(log.err)
+
+
+    def lost(self, worker):
+        if self.workers.get(worker.index) is worker:
+            del self.workers[worker.index]
+
+
+    def share(self, listener):
+        """
+        Have every worker start accepting on a newly bound listener.
+        """
+        return self._each(listener.adopt)
+
+
+    def _each(self, f):
+        return defer.gatherResults([f(w) for w in self.workers.values()],
+                                   consumeErrors=True)
+
+
+    def callAll(self, command, **kwargs):
+        """
+        Send a command to every worker.
+
+        @return: A C{Deferred} that fires with a list of their responses.
+        """
+        return self._each(lambda w: w.callRemote(command, **kwargs))
+
+
+    def pipeCommand(self, src, command, *args, **kwargs):
+        """
+        Call a L{Pipe} method in every worker, for the commands that can be
+        sent over AMP.
+
+        @return: A C{Deferred} that fires once every worker has answered.
+        """
+        if command not in self.pipeCommands:
+            raise ValueError("Can't send %r to workers" % (command,))
+        amp_command, names = self.pipeCommands[command]
+        if command == 'switch' and not isinstance(args[0], basestring):
+            amp_command, names = SwitchBalanced, ('dsts',)
+        kwargs.update(zip(names, args))
+        return self.callAll(amp_command, src=src, **kwargs)
+
+
+    def rmPipe(self, src):
+        return self.callAll(RemovePipe, src=src)
+
+
+    def stats(self):
+        """
+        @return: A C{Deferred} firing with the traffic counts of every
+            worker added together, like L{grace.plumbing.Plumber.stats}.
+        """
+        d = self.callAll(Stats)
+        def merge(responses):
+            pipes = sum([r['pipes'] for r in responses], [])
+            dsts = sum([r['dsts'] for r in responses], [])
+            return (mergeStats(pipes, ('src',)),
+                    mergeStats(dsts, ('src', 'dst')))
+        return d.addCallback(merge)
+
+
+    def listPipes(self):
+        """
+        @return: A C{Deferred} firing with the merged C{List} rows of every
+            worker.
+        """
+        d = self.callAll(List)
+        return d.addCallback(lambda r: mergeListings([x['pipes'] for x in r]))
+
+
+
+class WorkerServer(Server):
+    """
+    A worker's end of its connection to the main process: the usual control
+    commands plus L{AdoptPipe}.
+    """
+
+    index = None
+
+
+    @AdoptPipe.responder
+    def adoptPipe(self, src, dst, fd, dsts=None, **options):
+        family = socketFamily(fd, src)
+        self.plumber.adoptPipe(src, fd, family, dsts or dst,
+                               **_given(options))
+        return {}
+
+
+    def connectionMade(self):
+        Server.connectionMade(self)
+        self.callRemote(Register, index=self.index)
+
+
+    def connectionLost(self, reason):
+        Server.connectionLost(self, reason)
+        # Without the main process, nobody can control us.
+        try:
+            self.plumber.stop()
+        except error.ReactorNotRunning:
+            pass
+
+
+
+def workerMain(argv=None):
+    """
+    Run a worker process.  Arguments are the main process's worker socket
+    and this worker's index.
+    """
+    from twisted.internet import reactor
+    from grace.plumbing import Plumber
+
+    argv = argv or sys.argv[1:]
+    path, index = argv[0], int(argv[1])
+    log.startLogging(sys.stdout, setStdout=False)
+
+    plumber = Plumber()
+    plumber.pipe_services.startService()
+
+    proto = WorkerServer(plumber)
+    proto.index = index
+    ep = endpoints.UNIXClientEndpoint(reactor, path)
+    d = endpoints.connectProtocol(ep, proto)
+    def failed(reason):
+        log.err(reason, 'Could not connect to the main process')
+        reactor.stop()
+    d.addErrback(failed)
+    reactor.run()
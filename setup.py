@@ -7,7 +7,7 @@ setup(
     name='grace',
     version='0.1',
     packages=[
-        'grace', 'grace.test',
+        'grace', 'grace.test', 'grace.bench',
     ],
     package_data={
         'grace': ['grace.tac'],